@@ -10,8 +10,9 @@ results -- newest first -- as an HTML table (with a full-frame preview and a
 zoom-in cutout marked with a red circle of the photometric aperture, plus a
 link to the FITS file) and as a copy-paste plain-text photometry table.
 
-Which fields cover the position is determined exactly like coord_search.py: by
-running lib/bin/sky2xy over $REFERENCE_IMAGES. The reference set contains every
+Which fields cover the position is determined exactly like coord_search.py:
+through the reference index of $REFERENCE_IMAGES (nmw_ref_index.py), falling
+back to lib/bin/sky2xy. The reference set contains every
 camera's (co-pointed) references, so multi-camera setups are handled without
 special-casing. The calibration band is derived per camera by parsing
 util/transients/transient_factory_test31.sh, and can be overridden on the form.
@@ -25,11 +26,47 @@ Configuration (read from local_config.sh next to this script):
   URL_OF_DATA_PROCESSING_ROOT     URL prefix for the served uploads/ directory
   COORD_SEARCH_THUMBNAIL_PIXELS   in-page thumbnail size (optional)
   COORD_FORCED_PHOT_ZOOMIN_PIXELS zoom-in half-width in source pixels (optional)
+  COORD_THUMBNAIL_CACHE_MB        thumbnail cache budget, see coord_search.py
+  COORD_THUMBNAIL_RENDERER        thumbnail renderer, see coord_search.py
+  COORD_RENDER_BUDGET             server-wide renderer limit, see coord_search.py
+  COORD_PHASE1_CACHE_MB           disk budget of the shared cache of plate-solve
+                                  and catalogue products (nmw_phase1_cache.py);
+                                  0 disables it (optional, default 4096)
+  VAST_WORKING_COPY_POOL_SIZE     VaST working copies kept ready for reuse
+                                  (nmw_vast_pool.py); 0 rsyncs a fresh copy
+                                  per request (optional, default 4)
+  COORD_QUEUE_MAX_DEPTH           admission queue limits, see coord_search.py
+  COORD_QUEUE_MAX_WAIT_SECONDS
+
+With mode=job the request runs as a background job (nmw_jobs.py): the
+CGI only stores the form in a new output directory, starts
+'coord_forced_photometry.py --job <id>' detached from the request and
+redirects to the status endpoint ?job=<id> (add format=json for the raw
+status), which reloads itself until the job is finished and then redirects
+to the results page written into the job directory.
+
+With action=multi the targets are the lines of the 'positions' textarea
+(one position per line, up to nmw_coord_lib.MAX_BATCH_POSITIONS): each
+image covering any of them is plate-solved once and all of its targets are
+measured in the same scratch directory (forced_photometry.sh still runs
+once per target); the page shows one table and lightcurve per target. The
+same from the command line (run as the web server user, from any
+directory), printing one plain-text photometry table per target and, with
+--lightcurves DIR, writing each target's lightcurve files to DIR:
+  python3 coord_forced_photometry.py --targets FILE|- [--days N]
+                                     [--max-images N] [--band BAND]
+                                     [--lightcurves DIR]
 
 Per-request output directory uploads/forced_phot_<pid><rand>/ is left in place;
 external housekeeping prunes uploads/forced_phot_* (this CGI prunes nothing).
 """
 
+# Hand the request to a running nmw_worker.py server, if any, before the
+# imports below (see nmw_worker.py).
+if __name__ == "__main__":
+    import nmw_worker
+    nmw_worker.forward_request("coord_forced_photometry")
+
 # Handle cgi module removal in Python 3.13+
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -44,22 +81,33 @@ except ImportError:
 import concurrent.futures
 import datetime
 import glob
+import json
 import os
+import queue
 import random
 import re
 import shutil
 import signal
+import sqlite3
 import string
 import subprocess
 import sys
 import time
+import traceback
 import urllib.parse
 
 import nmw_coord_lib as ncl
+import nmw_date
+import nmw_jobs
+import nmw_phase1_cache
+import nmw_phot_store
+import nmw_vast_pool
+import nmw_timing
 from nmw_coord_lib import (
-    html_escape, _PAGE_CSS, form_page_url, emit_redirect,
-    emit_message_page, parse_coordinates, read_config_vars,
-    acquire_concurrency_slot, run_sky2xy_scan, get_image_metadata,
+    html_escape, _PAGE_CSS, form_page_url, site_url, emit_redirect,
+    emit_headers, emit_message_page, parse_coordinates, read_config_vars,
+    wait_for_concurrency_slot, run_sky2xy_scan, run_sky2xy_batch_scan,
+    parse_position_list, get_image_size, target_off_frame, radec_to_degrees,
     make_zoomout_thumbnail, make_zoomin_thumbnail, render_thumbnail_link,
     field_name_from_fits, HIRES_THUMBNAIL_MULTIPLIER,
 )
@@ -79,13 +127,38 @@ DEFAULT_WINDOW_DAYS = 7
 MAX_WINDOW_DAYS = 30
 DEFAULT_MAX_IMAGES = 8
 MAX_MAX_IMAGES = 50
+# Cap on the 'positions' textarea of a multi-target request; the number of
+# targets is capped at nmw_coord_lib.MAX_BATCH_POSITIONS.
+MAX_POSITIONS_INPUT_BYTES = 65536
 FORCED_PHOT_MAX_CONCURRENT = 3          # each request uses its own VaST working copy, so this only caps server load
 # Phase 1 (parallel UCAC5+APASS plate-solve) worker cap. The effective number
 # of workers per request is min(len(images), os.cpu_count() or 4, this).
 # Server-wide peak parallel solve_plate processes = this * FORCED_PHOT_MAX_CONCURRENT.
 FORCED_PHOT_PARALLEL_SOLVE_WORKERS = 8
+# Phase 2 (forced_photometry.sh per image) worker cap; each worker measures in
+# its own scratch directory inside the working copy (_make_phase2_scratch).
+# The effective number per request is min(len(images), os.cpu_count() or 4,
+# this).
+FORCED_PHOT_PARALLEL_MEASURE_WORKERS = 4
+PHASE2_SCRATCH_PREFIX = 'phase2_scratch_'
+# Threads building the table rows of measured images (image date lookup,
+# image size, four thumbnails) while Phase 2 goes on; thumbnail renderers
+# are further capped server-wide by COORD_RENDER_BUDGET.
+FORCED_PHOT_ROW_WORKERS = 4
+# Phase 1 products of which every Phase 2 scratch directory gets its own
+# copy (besides the files of the VaST tree, see nmw_vast_pool.make_scratch):
+# forced_photometry.sh may append to the catalog log.
+PHASE2_PRIVATE_FILES = ('vast_images_catalogs.log',)
 FORCED_PHOT_TIMEOUT_SECONDS = 900       # per-image safety cap on forced_photometry.sh
 VAST_COPY_TIMEOUT_SECONDS = 300         # cap on the per-request rsync of the VaST tree
+# Job mode (mode=job on the form, see nmw_jobs.py): a background worker
+# waits up to JOB_SLOT_WAIT_SECONDS in the admission queue for a free
+# concurrency slot (streamed requests wait COORD_QUEUE_MAX_WAIT_SECONDS);
+# the status page reloads itself every JOB_STATUS_REFRESH_SECONDS while
+# the job is queued or running.
+JOB_SLOT_WAIT_SECONDS = 1800
+JOB_STATUS_REFRESH_SECONDS = 5
+DEFAULT_SCRIPT_PATH = '/cgi-bin/unmw/coord_forced_photometry.py'
 # Floor for the magnitude error written to lightcurve.dat. The forced-photometry tools report the
 # true formal error, which is ~0 for a bright high-SNR star; lib/lightcurve_png silently drops
 # points whose error is 0.0 (its raw reader's isnormal() check rejects 0.0), so such points vanish
@@ -111,6 +184,10 @@ VALID_BANDS = ('B', 'V', 'R', 'Rc', 'I', 'Ic', 'r', 'i', 'g')
 # is the primary validator.
 _SAFE_COORD_RE = re.compile(r'^[0-9:+\-.]{1,32}$')
 
+# nmw_jobs.Job of the request when running as a background worker
+# ('--job <id>', see run_job); None for an ordinary streamed request.
+JOB = None
+
 
 def _canonicalize_coord(token):
     """Re-parse a single ra-or-dec token through int()/float() and return
@@ -170,11 +247,31 @@ def _looks_like_fits(name):
 # sorting on this alone reproduces JD order closely enough for streamed output.
 _IMG_TS_RE = re.compile(r'(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})')
 
+
+def _image_timestamp(path):
+    """Sort key of an image: the timestamp embedded in its wcs_fd_ file
+    name, which closely tracks JD and is known without opening the file."""
+    m = _IMG_TS_RE.search(os.path.basename(path))
+    return m.group(1) if m else ''
+
+
 # Apache's CGI buffer is ~4 KB. Each streamed table row is appended with this
 # whitespace comment so the buffer crosses the flush threshold within a couple
 # of rows instead of stalling until many rows have accumulated.
 _ROW_FLUSH_PAD = "<!-- " + (" " * 1500) + " -->\n"
 
+# Page-local CSS of the results pages (skipped rows, muted status lines)
+# and the header row of their results tables.
+_RESULTS_STYLE = ("<style type='text/css'>"
+                  "tr.skipped td { color: #888; font-size: 90%; "
+                  "background: #f8f8f8; }"
+                  " p.secondary { color: #666; font-style: italic; }"
+                  "</style>")
+_RESULTS_TABLE_HEADER = (
+    "<tr><th>Date (UTC)</th><th>JD (UTC)</th><th>mag</th><th>err</th>"
+    "<th>Status</th><th>Band</th><th>Field</th>"
+    "<th>Cutout</th><th>Image</th></tr>")
+
 FACTORY_REL_PATH = os.path.join('util', 'transients', 'transient_factory_test31.sh')
 
 
@@ -338,36 +435,22 @@ def derive_sextractor_config(factory_text, path):
 
 # ---------- forced photometry + date helpers ----------
 
-def get_jd_and_atel_date(vast_dir, fits_path):
-    """Return (jd_str, atel_date_str) from util/get_image_date, or (None, None).
+def get_jd_and_atel_date(fits_path, fallback_jd=None):
+    """Return (jd_str, atel_date_str) of the middle of the exposure, or
+    (None, None).
 
-    Uses get_image_date for consistency with the rest of the codebase. Both
-    values are trimmed to 4 decimal places (e.g. '2461181.2822', '2026-05-20.7822').
+    Computed from the header by nmw_date with get_image_date's conventions;
+    if the header has no usable date, from fallback_jd (the C engine's JD)
+    when given. Both values are trimmed to 4 decimal places (e.g.
+    '2461181.2822', '2026-05-20.7822'), the date truncated, never carried.
     """
-    tool = os.path.join(vast_dir, 'util', 'get_image_date')
     try:
-        result = subprocess.run([tool, fits_path], capture_output=True,
-                                text=True, timeout=60)
-    except (subprocess.TimeoutExpired, OSError):
-        return None, None
-    jd = None
-    atel = None
-    for line in result.stdout.splitlines():
-        s = line.strip()
-        if jd is None and s.startswith('JD '):
-            try:
-                jd = '{:.4f}'.format(float(s.split()[1]))
-            except (IndexError, ValueError):
-                pass
-        elif atel is None and s.startswith('ATel style '):
-            tok = s.split()[-1]
-            # Trim the day fraction to 4 digits (truncate, never carry).
-            m = re.match(r'(\d{4}-\d{2}-\d{2})\.(\d+)', tok)
-            if m:
-                atel = '{}.{}'.format(m.group(1), m.group(2)[:4])
-            else:
-                atel = tok
-    return jd, atel
+        jd = nmw_date.image_jd(fits_path)
+    except (OSError, ValueError):
+        if not _is_float(fallback_jd):
+            return None, None
+        jd = float(fallback_jd)
+    return '{:.4f}'.format(jd), nmw_date.atel_date(jd, digits=4)
 
 
 def _funpack_to_workdir(work_dir, fits_path):
@@ -378,7 +461,7 @@ def _funpack_to_workdir(work_dir, fits_path):
     binary (Unknown TFORM), and sky2xy (in some builds correct pixel
     coords but misreads dimensions so on-image targets get tagged as off
     image) -- consume the funpacked sibling instead. VaST tools that DO
-    handle .fz natively (get_image_date, fov_of_wcs_calibrated_image.sh,
+    handle .fz natively (fov_of_wcs_calibrated_image.sh,
     fits2png, make_finding_chart, forced_photometry C engine) keep using
     the original path, so the served FITS link still points at the
     upload as the user submitted it.
@@ -545,6 +628,11 @@ def _phase1_solve_one(work_dir, local_config_path, fits_path):
     compute_path is None when funpack failed; the parent then logs a
     skip and Phase 2 won't try to measure the image.
 
+    If an earlier request already solved this image, its products are
+    copied in from the shared Phase 1 cache (nmw_phase1_cache) right after
+    the funpack, both binaries below are skipped and cache_status is
+    'phase1_hit'. A successful solve adds its products to that cache.
+
     Two binaries run sequentially per image, both inside the same
     Phase-1 worker task. Across images, tasks run in parallel.
 
@@ -577,6 +665,12 @@ def _phase1_solve_one(work_dir, local_config_path, fits_path):
     if compute_path is None:
         return (fits_path, None, None,
                 'funpack failed for {}'.format(fits_path), None)
+    # Keyed before the solve, so an image replaced meanwhile is not cached
+    # under its new identity.
+    phase1_key = nmw_phase1_cache.entry_key(fits_path, work_dir)
+    if phase1_key is not None and nmw_phase1_cache.restore(
+            phase1_key, work_dir, compute_path):
+        return (fits_path, compute_path, 0, '', 'phase1_hit')
     cache_status = _seed_sextractor_catalog(work_dir, fits_path, compute_path)
     env = os.environ.copy()
     def _bash_wrap(script_path):
@@ -615,6 +709,8 @@ def _phase1_solve_one(work_dir, local_config_path, fits_path):
     except OSError as exc:
         return (fits_path, compute_path, None,
                 'solve_plate OSError: {}'.format(exc), cache_status)
+    if result.returncode == 0 and phase1_key is not None:
+        nmw_phase1_cache.store(phase1_key, work_dir, compute_path)
     return (fits_path, compute_path, result.returncode,
             result.stderr or '', cache_status)
 
@@ -626,8 +722,8 @@ def _phase1_parallel_solve_plate(work_dir, local_config_path, images,
     seeding, lib/sextract_single_image_noninteractive, and
     util/solve_plate_with_UCAC5, all in parallel across images, so that
     each per-image wcs_<basename>.cat.ucac5 (photometric, APASS columns
-    populated) is on disk in work_dir before the serial
-    forced_photometry.sh loop starts. Phase 2's internal solve_plate call
+    populated) is on disk in work_dir before the Phase 2
+    forced_photometry.sh runs start. Phase 2's internal solve_plate call
     then short-circuits.
 
     All four steps run inside _phase1_solve_one (one task per image),
@@ -638,11 +734,13 @@ def _phase1_parallel_solve_plate(work_dir, local_config_path, images,
     Phase 2 (compute_path_map.get(img) is None).
 
     Returns
-        (n_solved, n_cache_hits, n_funpacked, compute_path_map, elapsed)
-    where compute_path_map[fits_path] is the path Phase 2 must hand to
-    forced_photometry.sh -- the funpacked sibling for `.fz` uploads, or
-    fits_path itself for plain FITS. Images missing from the map are
-    those whose funpack failed.
+        (n_solved, n_cache_hits, n_phase1_hits, n_funpacked,
+         compute_path_map, elapsed)
+    where n_phase1_hits counts the images served from the shared Phase 1
+    cache (also counted as solved), and compute_path_map[fits_path] is
+    the path Phase 2 must hand to forced_photometry.sh -- the funpacked
+    sibling for `.fz` uploads, or fits_path itself for plain FITS. Images
+    missing from the map are those whose funpack failed.
 
     If progress_callback is provided, it is invoked once per completed
     future as (n_done, n_total, fits_path, rc). The caller uses this to
@@ -652,10 +750,11 @@ def _phase1_parallel_solve_plate(work_dir, local_config_path, images,
     progress UI glitch cannot fail the request.
     """
     if not images:
-        return (0, 0, 0, {}, 0.0)
+        return (0, 0, 0, 0, {}, 0.0)
     start = time.time()
     n_solved = 0
     n_cache_hits = 0
+    n_phase1_hits = 0
     n_funpacked = 0
     compute_path_map = {}
     n_done = 0
@@ -673,6 +772,8 @@ def _phase1_parallel_solve_plate(work_dir, local_config_path, images,
                     n_funpacked += 1
             if cache_status == 'cache_hit':
                 n_cache_hits += 1
+            elif cache_status == 'phase1_hit':
+                n_phase1_hits += 1
             if rc == 0:
                 n_solved += 1
             else:
@@ -691,8 +792,8 @@ def _phase1_parallel_solve_plate(work_dir, local_config_path, images,
                     progress_callback(n_done, n_total, fits_path, rc)
                 except Exception:
                     pass
-    return (n_solved, n_cache_hits, n_funpacked, compute_path_map,
-            time.time() - start)
+    return (n_solved, n_cache_hits, n_phase1_hits, n_funpacked,
+            compute_path_map, time.time() - start)
 
 
 def _exc_stderr_text(exc):
@@ -733,6 +834,102 @@ def _log_skip(debug_log, fits_path, reason, returncode, stderr):
         pass
 
 
+def _phase2_product_names(work_dir, compute_paths):
+    """Name prefixes of the per-image Phase 1 products in work_dir: the
+    funpacked images, their wcs_ catalogs and the SExtractor catalogs
+    registered in vast_images_catalogs.log."""
+    names = set()
+    for compute_path in compute_paths:
+        base = os.path.basename(compute_path)
+        names.add(base)
+        names.add(nmw_phase1_cache.wcs_name(compute_path))
+    try:
+        with open(os.path.join(work_dir, 'vast_images_catalogs.log')) as fh:
+            for line in fh:
+                toks = line.split()
+                if toks:
+                    names.add(os.path.basename(toks[0]))
+    except OSError:
+        pass
+    return tuple(sorted(names))
+
+
+def _make_phase2_scratch(work_dir, vast_dir, index, product_names):
+    """Create the scratch directory of Phase 2 worker index in work_dir and
+    return its path. Raises OSError.
+
+    forced_photometry.sh writes its scratch (calib.txt, catalogs, logs) into
+    the current directory and reads the SExtractor config from default.sex
+    there, so workers measuring at the same time need separate directories.
+    nmw_vast_pool.make_scratch gives each its own copy of every file of the
+    VaST tree that is not an executable (default.sex included) and of
+    PHASE2_PRIVATE_FILES; directories, executables and the per-image
+    Phase 1 products (names starting with product_names: each image is
+    measured by one worker) are symlinks into work_dir. Anything else
+    Phase 1 left in work_dir (its calib.txt and logs) is not carried over.
+    The directory is removed together with work_dir.
+    """
+    scratch = os.path.join(work_dir, '{}{}'.format(PHASE2_SCRATCH_PREFIX,
+                                                  index))
+    return nmw_vast_pool.make_scratch(
+        work_dir, vast_dir, scratch, shared_prefixes=product_names,
+        private_names=PHASE2_PRIVATE_FILES)
+
+
+def _select_sextractor_config(work_dir, factory_text, img):
+    """Put the SExtractor config of img's camera (see
+    sextractor_config_for_camera) in place as work_dir/default.sex.
+
+    Falls through silently if the chosen file is missing, so we never fail
+    the measurement on this account -- the generic default.sex remains in
+    place.
+    """
+    sex_config_name = derive_sextractor_config(factory_text, img)
+    if not sex_config_name:
+        return
+    src_sex = os.path.join(work_dir, sex_config_name)
+    if os.path.isfile(src_sex):
+        try:
+            # copy2, not copy: we need the destination default.sex
+            # to inherit the source's older mtime (set by the
+            # request-start rsync) rather than getting bumped to
+            # "now". Otherwise sextract_single_image_noninteractive
+            # sees default.sex newer than the cached
+            # wcs_<basename>.fits.cat (whether produced by Phase 1
+            # or seeded from the autoprocess artifacts) and the
+            # mtime check in autodetect_aperture.c forces a full
+            # SExtractor recompute -- defeating the whole point of
+            # Phase 1 and the catalog cache.
+            shutil.copy2(src_sex, os.path.join(work_dir, 'default.sex'))
+        except OSError:
+            pass  # keep whatever default.sex was already there
+
+
+def _phot_store_keys(vast_dir, factory_text, images, bands, ra_deg, dec_deg):
+    """{img: nmw_phot_store.measurement_key()} of the images at the
+    position. The SExtractor configuration is the one
+    _select_sextractor_config would put in place. Images whose key cannot
+    be made (unreadable file or tool) are left out: they are measured and
+    not stored."""
+    cells = nmw_phot_store.position_cells(ra_deg, dec_deg)
+    configs = {}
+    keys = {}
+    for img in images:
+        sex_config_name = derive_sextractor_config(factory_text, img)
+        if not (sex_config_name and
+                os.path.isfile(os.path.join(vast_dir, sex_config_name))):
+            sex_config_name = None
+        try:
+            if sex_config_name not in configs:
+                configs[sex_config_name] = nmw_phot_store.config_key(
+                    vast_dir, sex_config_name)
+            keys[img] = nmw_phot_store.measurement_key(
+                img, cells, bands[img], configs[sex_config_name])
+        except OSError:
+            continue
+    return keys
+
+
 def run_forced_photometry_c(work_dir, local_config_path, fits_path, compute_path,
                             ra, dec, band, debug_log=None):
     """Run the C-only forced photometry on one image inside the working copy.
@@ -804,6 +1001,11 @@ def run_forced_photometry_c(work_dir, local_config_path, fits_path, compute_path
     # original (possibly .fz) upload path retained for diagnostic
     # messages (debug_log, skip rows).
     env['FORCED_PHOT_FITS'] = compute_path
+    # The VaST scripts derive VAST_PATH from their own resolved location,
+    # which for a Phase 2 scratch directory (symlinked util/) would be the
+    # shared working copy rather than the directory holding this worker's
+    # default.sex.
+    env['VAST_PATH'] = os.path.join(work_dir, '')
     env['FORCED_PHOT_RA'] = ra_safe
     env['FORCED_PHOT_DEC'] = dec_safe
     env['FORCED_PHOT_BAND'] = band
@@ -902,6 +1104,103 @@ def run_forced_photometry_c(work_dir, local_config_path, fits_path, compute_path
     }
 
 
+class ImagePipeline:
+    """Calibrate-then-measure of the images of one request in the VaST
+    working copy work_dir, shared by main() and measure_targets().
+
+    solve() runs Phase 1 (_phase1_parallel_solve_plate) on all images and
+    then sets up the Phase 2 scratch directories (_make_phase2_scratch),
+    falling back to measuring in work_dir when they cannot be made.
+    measure() then runs forced_photometry.sh on one calibrated image, at
+    each of its positions in turn in one scratch directory, and may be
+    called from up to measure_workers threads at once. Phase 1 is done
+    once per image however many positions are measured on it;
+    forced_photometry.sh runs once per position.
+    """
+
+    def __init__(self, work_dir, vast_dir, local_config_path, factory_text,
+                 images, debug_log=None):
+        self.work_dir = work_dir
+        self.vast_dir = vast_dir
+        self.local_config_path = local_config_path
+        self.factory_text = factory_text
+        self.images = list(images)
+        self.debug_log = debug_log
+        self.solve_workers = max(1, min(len(self.images),
+                                        os.cpu_count() or 4,
+                                        FORCED_PHOT_PARALLEL_SOLVE_WORKERS))
+        self.measure_workers = 0
+        self.n_solved = 0
+        self.sextractor_cache_hits = 0
+        self.phase1_cache_hits = 0
+        self.n_funpacked = 0
+        self.solve_elapsed = 0.0
+        self.compute_path_map = {}
+        self._scratch_dirs = queue.Queue()
+
+    def solve(self, progress_callback=None):
+        """Phase 1 on all images, then the Phase 2 scratch directories.
+        progress_callback is passed to _phase1_parallel_solve_plate."""
+        self.n_solved, self.sextractor_cache_hits, self.phase1_cache_hits, \
+            self.n_funpacked, self.compute_path_map, self.solve_elapsed = \
+            _phase1_parallel_solve_plate(
+                self.work_dir, self.local_config_path, self.images,
+                self.solve_workers, self.debug_log,
+                progress_callback=progress_callback)
+        nmw_timing.record('phase1', self.solve_elapsed,
+                          images=len(self.images), solved=self.n_solved,
+                          sextractor_cache_hits=self.sextractor_cache_hits,
+                          phase1_cache_hits=self.phase1_cache_hits,
+                          workers=self.solve_workers)
+        workers = max(1, min(len(self.images), os.cpu_count() or 4,
+                             FORCED_PHOT_PARALLEL_MEASURE_WORKERS))
+        try:
+            if self.images:
+                product_names = _phase2_product_names(
+                    self.work_dir, self.compute_path_map.values())
+                for index in range(workers):
+                    self._scratch_dirs.put(_make_phase2_scratch(
+                        self.work_dir, self.vast_dir, index, product_names))
+        except OSError:
+            pass
+        if self._scratch_dirs.empty():
+            self._scratch_dirs.put(self.work_dir)
+        self.measure_workers = self._scratch_dirs.qsize()
+
+    def measure(self, img, band, positions):
+        """Forced photometry of img at positions, a list of (ra, dec,
+        store_key): the run_forced_photometry_c() dicts in the same order,
+        None where the measurement failed (all None when Phase 1 could not
+        funpack img). Measurements with a store_key go to nmw_phot_store.
+        """
+        # compute_path is the funpacked sibling for `.fz` uploads, or img
+        # itself for plain FITS.
+        compute_path = self.compute_path_map.get(img)
+        if compute_path is None:
+            return [None] * len(positions)
+        results = []
+        scratch = self._scratch_dirs.get()
+        try:
+            # SExtractor config selected per image, mirroring how
+            # transient_factory_test31.sh picks per-camera.
+            _select_sextractor_config(scratch, self.factory_text, img)
+            for ra, dec, store_key in positions:
+                with nmw_timing.phase('measure') as counts:
+                    fp = run_forced_photometry_c(
+                        scratch, self.local_config_path, img, compute_path,
+                        ra, dec, band, debug_log=self.debug_log)
+                    counts['failed'] = int(fp is None)
+                if fp is not None and store_key is not None:
+                    try:
+                        nmw_phot_store.store(store_key, fp)
+                    except (OSError, sqlite3.Error):
+                        pass
+                results.append(fp)
+        finally:
+            self._scratch_dirs.put(scratch)
+        return results
+
+
 # ---------- per-request VaST working copy ----------
 
 def setup_vast_working_copy(vast_ref, parent_dir):
@@ -949,6 +1248,33 @@ def setup_vast_working_copy(vast_ref, parent_dir):
 
 # ---------- image discovery ----------
 
+def checkout_working_copy(vast_dir):
+    """(work_dir, pooled): a ready VaST working copy from nmw_vast_pool when
+    one is free, otherwise (and when the copy is to be kept for debugging)
+    a fresh setup_vast_working_copy(). work_dir is None on failure."""
+    work_dir = None
+    pooled = False
+    with nmw_timing.phase('working_copy') as counts:
+        if not os.environ.get('DEBUG_KEEP_WORK_DIR'):
+            work_dir = nmw_vast_pool.checkout(vast_dir, TEMP_PARENT)
+            pooled = work_dir is not None
+        if work_dir is None:
+            work_dir = setup_vast_working_copy(vast_dir, TEMP_PARENT)
+        counts['pooled'] = pooled
+    return work_dir, pooled
+
+
+def release_working_copy(work_dir, pooled):
+    """Return a checkout_working_copy() copy to the pool or delete it
+    (DEBUG_KEEP_WORK_DIR keeps it)."""
+    if os.environ.get('DEBUG_KEEP_WORK_DIR'):
+        sys.stderr.write('DEBUG: keeping work_dir {}\n'.format(work_dir))
+    elif pooled:
+        nmw_vast_pool.checkin(work_dir)
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
 def list_recent_field_images(uploads_dir, covering_fields, window_days):
     """Return absolute paths of wcs_fd_ images in the last window_days whose
     field is in covering_fields. Newest directory date first.
@@ -1002,7 +1328,7 @@ def fits_url(url_prefix, fits_abs_path, uploads_abs):
     return '{}/{}'.format(url_prefix, rel)
 
 
-def _write_lightcurve_data_files(out_dir, results):
+def _write_lightcurve_data_files(out_dir, results, tag=''):
     """Write the two ASCII files lib/lightcurve_png reads.
 
     Splits the in-memory `results` rows by status:
@@ -1019,7 +1345,9 @@ def _write_lightcurve_data_files(out_dir, results):
               a positional input).
       ul_path is the path to upperlimits.dat, or None if there were no
               upper-limit rows.
-    Returns (None, None) if no row had a parseable JD.
+    Returns (None, None) if no row had a parseable JD. tag is inserted
+    before the file extensions (lightcurve<tag>.dat), so the lightcurves
+    of several targets can share out_dir.
     """
     lc_lines = []
     ul_lines = []
@@ -1052,7 +1380,7 @@ def _write_lightcurve_data_files(out_dir, results):
                 jd_val, mag_val, err_val))
     if not lc_lines and not ul_lines:
         return None, None
-    lc_path = os.path.join(out_dir, 'lightcurve.dat')
+    lc_path = os.path.join(out_dir, 'lightcurve{}.dat'.format(tag))
     try:
         with open(lc_path, 'w') as fh:
             fh.write('# JD mag err\n')
@@ -1061,7 +1389,7 @@ def _write_lightcurve_data_files(out_dir, results):
         return None, None
     ul_path = None
     if ul_lines:
-        ul_path = os.path.join(out_dir, 'upperlimits.dat')
+        ul_path = os.path.join(out_dir, 'upperlimits{}.dat'.format(tag))
         try:
             with open(ul_path, 'w') as fh:
                 fh.write('# JD limit_mag\n')
@@ -1071,8 +1399,9 @@ def _write_lightcurve_data_files(out_dir, results):
     return lc_path, ul_path
 
 
-def _render_lightcurve_png(work_dir, out_dir, ra, dec, lc_path, ul_path):
-    """Invoke lib/lightcurve_png to render lightcurve.png in out_dir.
+def _render_lightcurve_png(work_dir, out_dir, ra, dec, lc_path, ul_path,
+                           tag=''):
+    """Invoke lib/lightcurve_png to render lightcurve<tag>.png in out_dir.
 
     Returns the PNG basename ('lightcurve.png') on success, None on any
     failure (binary missing, exit non-zero, timeout, OSError, no output).
@@ -1096,7 +1425,8 @@ def _render_lightcurve_png(work_dir, out_dir, ra, dec, lc_path, ul_path):
     # whose cwd it is interpreted against.
     lc_abs = os.path.abspath(lc_path)
     ul_abs = os.path.abspath(ul_path) if ul_path is not None else None
-    out_png = os.path.abspath(os.path.join(out_dir, 'lightcurve.png'))
+    out_png = os.path.abspath(os.path.join(
+        out_dir, 'lightcurve{}.png'.format(tag)))
     # Numeric round-trip on ra/dec right before they go into argv. The
     # title is a single argv element (no shell), so injection is already
     # impossible, but CodeQL's taint analysis does not see that and
@@ -1135,6 +1465,102 @@ def _render_lightcurve_png(work_dir, out_dir, ra, dec, lc_path, ul_path):
     return os.path.basename(out_png)
 
 
+def emit_lightcurve(vast_dir, out_dir, url_prefix, ra, dec, results,
+                    tag=''):
+    """Print the lightcurve plot of the results rows and links to its
+    data files (see _write_lightcurve_data_files; vast_dir holds
+    lib/lightcurve_png). Prints only the links when the plot cannot be
+    rendered, and nothing when no row has a usable JD."""
+    lc_path, ul_path = _write_lightcurve_data_files(out_dir, results, tag)
+    if lc_path is None:
+        return
+    sub_name = os.path.basename(out_dir)
+    with nmw_timing.phase('lightcurve', points=len(results)):
+        png_basename = _render_lightcurve_png(vast_dir, out_dir, ra, dec,
+                                              lc_path, ul_path, tag)
+    if png_basename is not None:
+        png_url = '{}/{}/{}'.format(url_prefix, sub_name, png_basename)
+        print("<p style='text-align: center;'>"
+              "<img src='{}' alt='Lightcurve plot' "
+              "style='max-width: 100%;'></p>".format(html_escape(png_url)),
+              flush=True)
+    # Link the ASCII data files immediately under the plot, so the
+    # underlying numbers stay one click away. Emitted even when the PNG
+    # render failed (binary missing, etc.) -- the data files are still
+    # useful on their own.
+    links = []
+    for path, what in ((lc_path, 'detections'), (ul_path, 'upper limits')):
+        if path is not None:
+            base = os.path.basename(path)
+            links.append("<a href='{}'>{}</a> ({})".format(
+                html_escape('{}/{}/{}'.format(url_prefix, sub_name, base)),
+                html_escape(base), what))
+    print("<p class='secondary' style='text-align: center;'>"
+          "Data files: {}</p>".format(', '.join(links)), flush=True)
+
+
+def result_row(img, band, fp, url_prefix, uploads_abs):
+    """Results-table row dict of the measurement fp of img (a
+    run_forced_photometry_c() dict), without thumbnails (see
+    add_row_thumbnails): the date from the image header, the formatted
+    magnitude and error, the field and the FITS link."""
+    jd, atel = get_jd_and_atel_date(img, fallback_jd=fp['jd'])
+    if jd is None:
+        jd = fp['jd']
+    if atel is None:
+        atel = '-'
+    # Pre-format mag/err once so HTML and ASCII renderers use the
+    # same string (rounded to 2 d.p.; '>' prefix on upper limits).
+    return {
+        'jd': jd, 'atel': atel,
+        'mag': _fmt_mag(fp['mag'], fp['status']),
+        'err': _fmt_err(fp['err']),
+        'status': fp['status'], 'band': band,
+        'field': field_name_from_fits(img),
+        # The C engine prints the basename of whatever path it was
+        # handed, which for `.fz` uploads is the funpacked sibling. Use
+        # the original upload basename so the row labels match the FITS
+        # link the user clicks through to.
+        'basename': os.path.basename(img),
+        'fits_url': fits_url(url_prefix, img, uploads_abs),
+        'png_preview': None,
+        'png_preview_hires': None,
+        'png_cutout': None,
+        'png_cutout_hires': None,
+    }
+
+
+def add_row_thumbnails(r, img, fp, out_dir, vast_dir, thumb_pixels,
+                       hires_pixels, zoomin_pixels, tag='', image=None):
+    """Render the zoom-out and zoom-in thumbnails (each with its hi-res
+    click-through version) of the result_row() r of img into out_dir.
+
+    tag is appended to the PNG suffixes, so the rows of several targets on
+    one image get PNGs of their own; image (ncl.open_thumbnail_image) lets
+    them share one decode.
+    """
+    if image is None:
+        image = ncl.open_thumbnail_image(img)
+    nx, ny = get_image_size(img, vast_dir) or (None, None)
+    if nx and ny:
+        # Two PNGs per image: the small in-page thumbnail and a
+        # higher-resolution version reached by clicking the thumbnail.
+        r['png_preview'] = make_zoomout_thumbnail(
+            img, fp['x'], fp['y'], nx, ny, out_dir, vast_dir, thumb_pixels,
+            suffix='zoomout' + tag, image=image)
+        r['png_preview_hires'] = make_zoomout_thumbnail(
+            img, fp['x'], fp['y'], nx, ny, out_dir, vast_dir, hires_pixels,
+            suffix='zoomout_hires' + tag, image=image)
+    r['png_cutout'] = make_zoomin_thumbnail(
+        img, fp['x'], fp['y'], out_dir, vast_dir, thumb_pixels,
+        zoomin_pixels, suffix='zoomin' + tag,
+        aperture_circle_diameter=fp['aperture'], image=image)
+    r['png_cutout_hires'] = make_zoomin_thumbnail(
+        img, fp['x'], fp['y'], out_dir, vast_dir, hires_pixels,
+        zoomin_pixels, suffix='zoomin_hires' + tag,
+        aperture_circle_diameter=fp['aperture'], image=image)
+
+
 def ascii_table(rows):
     """Build the fixed-width, space-padded plain-text photometry table."""
     header = ['date', 'JD', 'mag/limit', 'err', 'status', 'field', 'image']
@@ -1156,6 +1582,581 @@ def ascii_table(rows):
     return '\n'.join([fmt(header)] + [fmt(line) for line in body])
 
 
+def make_output_dir():
+    """Create a fresh uploads/forced_phot_<pid><rand>/ directory and return
+    its path, or emit an error page and return None."""
+    rand = ''.join(random.choice(string.ascii_letters) for _ in range(8))
+    sub = '{}{}{}'.format(TEMP_DIR_PREFIX, os.getpid(), rand)
+    out_dir = os.path.join(TEMP_PARENT, sub)
+    try:
+        os.makedirs(out_dir, mode=0o755)
+    except OSError as err:
+        emit_message_page(
+            "Internal error",
+            "<p>Cannot create output directory '{}': {}</p>".format(
+                html_escape(out_dir), html_escape(err)),
+            status_line="Status: 500 Internal Server Error")
+        return None
+    return out_dir
+
+
+# ---------- multi-target forced photometry ----------
+
+def target_images_for(ref_dir, vast_dir, targets, window_days, max_images):
+    """The images to measure each target of targets (a list of (line, ra,
+    dec)) on: the recent images of the reference fields covering it,
+    newest first, at most max_images of them.
+
+    All targets are resolved in one pass (run_sky2xy_batch_scan). Returns
+    (target_images, target_fields, truncated) with one list per target.
+    """
+    matches, truncated = run_sky2xy_batch_scan(
+        ref_dir, [(ra, dec) for _line, ra, dec in targets], vast_dir)
+    target_fields = [sorted(set(field_name_from_fits(path)
+                                for path, _x, _y in target_matches))
+                     for target_matches in matches]
+    all_fields = set(f for fields in target_fields for f in fields)
+    images = []
+    if all_fields:
+        images = list_recent_field_images(TEMP_PARENT, all_fields,
+                                          window_days)
+        images.sort(key=_image_timestamp, reverse=True)
+    target_images = [[img for img in images
+                      if field_name_from_fits(img) in fields][:max_images]
+                     for fields in target_fields]
+    return target_images, target_fields, truncated
+
+
+def measure_targets(vast_dir, local_config_path, targets, target_images,
+                    factory_text, band_override, skip_log, progress=None):
+    """Forced photometry of several targets in one pass.
+
+    targets is a list of (line, ra, dec) and target_images[k] the images
+    to measure target k on (see target_images_for). Every image is
+    calibrated by Phase 1 once, however many targets it holds, and one
+    Phase 2 worker then runs forced_photometry.sh for each of its targets
+    in turn in the same scratch directory, where it finds the image's
+    catalogues and plate solution ready (see ImagePipeline); only Phase 1
+    is shared between the targets. Targets already measured on an
+    image come from nmw_phot_store; a target that the header WCS of an
+    image puts off the frame is not measured on it.
+
+    progress(message), if given, is called with a line of plain text as
+    the work goes on. Returns (results, stats): results[k] lists
+    (img, band, fp) for target k in the order of target_images[k], fp being
+    the run_forced_photometry_c() dict, or None if the measurement failed;
+    stats counts the images, the stored and the new measurements and the
+    Phase 2 workers. Raises OSError if no VaST working copy can be set up.
+    """
+    note = progress or (lambda message: None)
+    images = []
+    seen = set()
+    for img in (img for imgs in target_images for img in imgs):
+        if img not in seen:
+            seen.add(img)
+            images.append(img)
+    bands = dict((img, derive_band(factory_text, img, band_override))
+                 for img in images)
+    wanted = {}                      # img -> [k, ...] of targets on its frame
+    keys = {}                        # (img, k) -> nmw_phot_store key
+    with nmw_timing.phase('phot_store') as counts:
+        for k, (_line, ra, dec) in enumerate(targets):
+            ra_deg, dec_deg = radec_to_degrees(ra, dec)
+            on_frame = []
+            for img in target_images[k]:
+                if target_off_frame(img, ra_deg, dec_deg):
+                    _log_skip(skip_log, img, 'target {} off frame (header '
+                              'WCS)'.format(k + 1), None, None)
+                    continue
+                on_frame.append(img)
+                wanted.setdefault(img, []).append(k)
+            for img, key in _phot_store_keys(vast_dir, factory_text, on_frame,
+                                             bands, ra_deg, dec_deg).items():
+                keys[(img, k)] = key
+        try:
+            found = nmw_phot_store.lookup(keys.values())
+        except (OSError, sqlite3.Error):
+            found = {}
+        stored = dict((pair, found[key]) for pair, key in keys.items()
+                      if key in found)
+        counts['hits'] = len(stored)
+    pending = {}                     # img -> [k, ...] still to measure
+    for img in images:
+        ks = [k for k in wanted.get(img, ()) if (img, k) not in stored]
+        if ks:
+            pending[img] = ks
+    pending_images = [img for img in images if img in pending]
+    stats = {'images': len(images), 'stored': len(stored), 'measured': 0,
+             'workers': 0}
+    if stored:
+        note('{} measurement(s) come from the photometry store.'.format(
+            len(stored)))
+    measured = {}
+    if pending_images:
+        note('Preparing working copy of VaST...')
+        work_dir, pooled = checkout_working_copy(vast_dir)
+        if work_dir is None:
+            raise OSError('could not set up the calibration working copy '
+                          'of VaST')
+        try:
+            pipeline = ImagePipeline(work_dir, vast_dir, local_config_path,
+                                     factory_text, pending_images, skip_log)
+            note('Plate-solving and photometric catalog-matching {} '
+                 'image(s) using {} parallel workers...'.format(
+                     len(pending_images), pipeline.solve_workers))
+            pipeline.solve()
+            stats['workers'] = pipeline.measure_workers
+
+            def _measure_image(img):
+                """{k: fp} of the pending targets of img."""
+                ks = pending[img]
+                positions = [targets[k][1:] + (keys.get((img, k)),)
+                             for k in ks]
+                return dict(zip(ks, pipeline.measure(img, bands[img],
+                                                     positions)))
+
+            n_pairs = sum(len(ks) for ks in pending.values())
+            note('Measuring {} target position(s) on {} image(s) using {} '
+                 'parallel workers...'.format(n_pairs, len(pending_images),
+                                              stats['workers']))
+            phase2_start = time.time()
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=stats['workers']) as pool:
+                for img, out in zip(pending_images,
+                                    pool.map(_measure_image, pending_images)):
+                    for k, fp in out.items():
+                        measured[(img, k)] = fp
+            nmw_timing.record('phase2', time.time() - phase2_start,
+                              images=len(pending_images), targets=n_pairs,
+                              workers=stats['workers'])
+        finally:
+            release_working_copy(work_dir, pooled)
+    stats['measured'] = sum(1 for fp in measured.values() if fp is not None)
+
+    results = []
+    for k in range(len(targets)):
+        rows = []
+        for img in target_images[k]:
+            if (img, k) in stored:
+                rows.append((img, bands[img], dict(stored[(img, k)])))
+            elif k in wanted.get(img, ()):
+                rows.append((img, bands[img], measured.get((img, k))))
+        results.append(rows)
+    return results, stats
+
+
+def emit_multi_target_page(targets, bad_lines, ref_dir, vast_dir,
+                           local_config_path, url_prefix, uploads_abs,
+                           out_dir, window_days, max_images, band_override,
+                           thumb_pixels, hires_pixels, zoomin_pixels,
+                           request_start):
+    """Results page of a multi-target request (action=multi): one table
+    and lightcurve per target, built by measure_targets.
+
+    The thumbnails of all targets on one image are rendered by one worker,
+    so the in-process renderer decodes the image once.
+    """
+    page_title = "Multi-target forced photometry"
+    sub_name = os.path.basename(out_dir)
+    emit_headers()
+    print("<html><head><title>{}</title>".format(html_escape(page_title)))
+    print(_PAGE_CSS)
+    print(_RESULTS_STYLE)
+    print("</head><body>")
+    if JOB is None:
+        print("<!-- {} -->".format(' ' * 4000))  # past Apache's CGI buffer
+    print("<h2>{}</h2>".format(html_escape(page_title)))
+    print("<p>{} target position(s); last {} days, at most {} images per "
+          "target.</p>".format(len(targets), window_days, max_images),
+          flush=True)
+    if bad_lines:
+        print("<div class='notice'>Skipped {} line(s) that could not be "
+              "parsed:<br>{}</div>".format(len(bad_lines), '<br>'.join(
+                  "line {}: <span class='code'>{}</span> ({})".format(
+                      number, html_escape(line), html_escape(err))
+                  for number, line, err in bad_lines)), flush=True)
+
+    def _progress(message):
+        _job_update(phase=message.rstrip('.'))
+        print("<p class='secondary'>{}</p>".format(html_escape(message)),
+              flush=True)
+
+    _progress('Looking up which reference fields cover the targets...')
+    target_images, target_fields, truncated = target_images_for(
+        ref_dir, vast_dir, targets, window_days, max_images)
+    if truncated:
+        print("<div class='notice'>WARNING: reference-field scan timed out "
+              "after {} s; some targets may be missing fields.</div>".format(
+                  ncl.SCAN_TIMEOUT_SECONDS), flush=True)
+    n_images = len(set(img for imgs in target_images for img in imgs))
+    nmw_timing.count(mode='multi', targets=len(targets), images=n_images,
+                     job=JOB is not None)
+    _job_update(state='running', images=n_images)
+    skip_log = os.path.join(out_dir, 'forced_phot_skipped.log')
+    factory_text = _read_factory_text(vast_dir)
+    try:
+        results, stats = measure_targets(
+            vast_dir, local_config_path, targets, target_images,
+            factory_text, band_override, skip_log, progress=_progress)
+    except OSError as err:
+        print("<div class='notice'>Cannot measure: {}.</div>".format(
+            html_escape(err)))
+        print("<br><a href='{}'>Search again</a>".format(
+            html_escape(DEFAULT_FORM_PATH)))
+        print("</body></html>")
+        return
+
+    _progress('Preparing the result tables...')
+    by_image = {}
+    for k, rows in enumerate(results):
+        for img, band, fp in rows:
+            if fp is not None:
+                by_image.setdefault(img, []).append((k, band, fp))
+
+    def _rows_of_image(img):
+        """{k: row} of every target measured on img."""
+        image = ncl.open_thumbnail_image(img)
+        out = {}
+        for k, band, fp in by_image[img]:
+            r = result_row(img, band, fp, url_prefix, uploads_abs)
+            add_row_thumbnails(r, img, fp, out_dir, vast_dir, thumb_pixels,
+                               hires_pixels, zoomin_pixels,
+                               tag='_t{}'.format(k + 1), image=image)
+            out[k] = r
+        return out
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=FORCED_PHOT_ROW_WORKERS) as pool:
+        image_rows = dict(zip(by_image, pool.map(_rows_of_image, by_image)))
+
+    for k, ((line, ra, dec), rows) in enumerate(zip(targets, results)):
+        print("<h3>Target {}: <span class='code'>{}</span></h3>".format(
+            k + 1, html_escape(line)))
+        if not target_fields[k]:
+            print("<p>No reference field covers this position.</p>")
+            continue
+        print("<p>Covering field(s): <b>{}</b>; {} image(s).</p>".format(
+            html_escape(', '.join(target_fields[k])), len(rows)))
+        if not rows:
+            continue
+        table_rows = []
+        print("<table class='main'>")
+        print(_RESULTS_TABLE_HEADER)
+        for img, _band, fp in rows:
+            if fp is None:
+                print(_html_skipped_row(
+                    img, field_name_from_fits(img),
+                    fits_url(url_prefix, img, uploads_abs)))
+                continue
+            r = image_rows[img][k]
+            table_rows.append(r)
+            if JOB is not None:
+                JOB.add_row(dict(r, target=k + 1, position=line))
+            print(_html_row(r, url_prefix, sub_name))
+        print("</table>")
+        if table_rows:
+            print("<pre>{}</pre>".format(html_escape(ascii_table(table_rows))))
+            emit_lightcurve(vast_dir, out_dir, url_prefix, ra, dec,
+                            table_rows, tag='_t{}'.format(k + 1))
+        print('', flush=True)
+
+    elapsed = time.time() - request_start
+    print("<p class='secondary'>Total computation time: {}; {} image(s), "
+          "{} new measurement(s), {} from the photometry store (parallel "
+          "workers: {}).</p>".format(
+              _fmt_duration(elapsed), stats['images'], stats['measured'],
+              stats['stored'], stats['workers']))
+    _job_update(measured=stats['images'],
+                rows=stats['measured'] + stats['stored'])
+    print("<br><br><a href='{}'>Search again</a>".format(
+        html_escape(DEFAULT_FORM_PATH)))
+    print("</body></html>", flush=True)
+
+
+@nmw_timing.timed_request('coord_forced_photometry')
+def run_targets_cli(argv):
+    """Command line: measure a list of targets and print one plain-text
+    photometry table per target (see the module docstring). With
+    --lightcurves DIR the lightcurve data files and plot of target N are
+    written to DIR as lightcurve_tN.dat, upperlimits_tN.dat and
+    lightcurve_tN.png."""
+    usage = ('usage: {} --targets FILE [--days N] [--max-images N] '
+             '[--band BAND] [--lightcurves DIR]'.format(
+                 os.path.basename(sys.argv[0])))
+    opts = {'--targets': None, '--days': str(DEFAULT_WINDOW_DAYS),
+            '--max-images': str(DEFAULT_MAX_IMAGES), '--band': '',
+            '--lightcurves': ''}
+    args = list(argv)
+    while args:
+        name = args.pop(0)
+        if name not in opts or not args:
+            print(usage, file=sys.stderr)
+            return 2
+        opts[name] = args.pop(0)
+    try:
+        window_days = max(1, min(int(opts['--days']), MAX_WINDOW_DAYS))
+        max_images = max(1, min(int(opts['--max-images']), MAX_MAX_IMAGES))
+    except ValueError:
+        print(usage, file=sys.stderr)
+        return 2
+    band_override = opts['--band']
+    if opts['--targets'] is None or (band_override and
+                                     band_override not in VALID_BANDS):
+        print(usage, file=sys.stderr)
+        return 2
+    try:
+        if opts['--targets'] == '-':
+            text = sys.stdin.read()
+        else:
+            with open(opts['--targets']) as fh:
+                text = fh.read()
+        targets, bad_lines = parse_position_list(text)
+    except (OSError, ValueError) as err:
+        print('ERROR: {}'.format(err), file=sys.stderr)
+        return 1
+    for number, line, err in bad_lines:
+        print('WARNING: line {} skipped: {} ({})'.format(number, line, err),
+              file=sys.stderr)
+    if not targets:
+        print('ERROR: no valid position in the list', file=sys.stderr)
+        return 1
+    lc_dir = opts['--lightcurves']
+    if lc_dir:
+        if not os.path.isdir(lc_dir):
+            print('ERROR: {} is not a directory'.format(lc_dir),
+                  file=sys.stderr)
+            return 1
+        lc_dir = os.path.abspath(lc_dir)
+
+    # Same cwd convention as the CGI: local_config.sh and uploads/ live
+    # next to this script.
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    os.chdir(script_dir)
+    cfg = read_config_vars(
+        'REFERENCE_IMAGES', 'VAST_REFERENCE_COPY',
+        'URL_OF_DATA_PROCESSING_ROOT', 'COORD_PHASE1_CACHE_MB',
+        'VAST_WORKING_COPY_POOL_SIZE')
+    ref_dir = cfg['REFERENCE_IMAGES'].strip()
+    vast_dir = cfg['VAST_REFERENCE_COPY'].strip()
+    url_prefix = cfg['URL_OF_DATA_PROCESSING_ROOT'].strip().rstrip('/')
+    if not os.path.isdir(ref_dir) or not os.path.isdir(vast_dir):
+        print('ERROR: REFERENCE_IMAGES or VAST_REFERENCE_COPY is not a '
+              'directory (check local_config.sh)', file=sys.stderr)
+        return 1
+    nmw_phase1_cache.CACHE_MAX_MB = nmw_phase1_cache.cache_budget_mb(
+        cfg['COORD_PHASE1_CACHE_MB'])
+    nmw_vast_pool.POOL_SIZE = nmw_vast_pool.pool_size(
+        cfg['VAST_WORKING_COPY_POOL_SIZE'])
+
+    def _progress(message):
+        print(message, file=sys.stderr, flush=True)
+
+    # Shares the CGI's concurrency slots, so it cannot overload the server.
+    slot, _reason = wait_for_concurrency_slot(
+        prefix='forced_phot', max_concurrent=FORCED_PHOT_MAX_CONCURRENT,
+        max_wait=JOB_SLOT_WAIT_SECONDS,
+        progress=lambda position, wait: _progress(
+            'Waiting in the queue: number {}'.format(position)))
+    if slot is None:
+        print('ERROR: server busy, no forced-photometry slot became free',
+              file=sys.stderr)
+        return 1
+    try:
+        target_images, target_fields, _truncated = target_images_for(
+            ref_dir, vast_dir, targets, window_days, max_images)
+        nmw_timing.count(mode='cli', targets=len(targets))
+        results, stats = measure_targets(
+            vast_dir, os.path.join(script_dir, 'local_config.sh'), targets,
+            target_images, _read_factory_text(vast_dir), band_override,
+            None, progress=_progress)
+    except OSError as err:
+        print('ERROR: {}'.format(err), file=sys.stderr)
+        return 1
+    finally:
+        slot.close()
+    uploads_abs = os.path.abspath(TEMP_PARENT)
+    for k, ((line, ra, dec), rows) in enumerate(zip(targets, results)):
+        table_rows = [result_row(img, band, fp, url_prefix, uploads_abs)
+                      for img, band, fp in rows if fp is not None]
+        print('# Target {}: {} -- field(s) {}; {} image(s), {} '
+              'measurement(s)'.format(
+                  k + 1, line, ', '.join(target_fields[k]) or 'none',
+                  len(rows), len(table_rows)))
+        if table_rows:
+            print(ascii_table(table_rows))
+            if lc_dir:
+                tag = '_t{}'.format(k + 1)
+                lc_path, ul_path = _write_lightcurve_data_files(
+                    lc_dir, table_rows, tag)
+                png = _render_lightcurve_png(vast_dir, lc_dir, ra, dec,
+                                             lc_path, ul_path, tag)
+                written = [path for path in (lc_path, ul_path, png) if path]
+                if written:
+                    print('# Lightcurve: {}'.format(', '.join(
+                        os.path.join(lc_dir, os.path.basename(path))
+                        for path in written)))
+        print('')
+    _progress('{} image(s): {} new measurement(s), {} from the photometry '
+              'store'.format(stats['images'], stats['measured'],
+                             stats['stored']))
+    return 0
+
+
+# ---------- job mode ----------
+
+def _job_update(**fields):
+    """Record progress in status.json when running as a background job."""
+    if JOB is not None:
+        JOB.update(**fields)
+
+
+def job_status_url(job_id):
+    """Absolute URL of the status page of job_id (this CGI with ?job=)."""
+    script = os.environ.get('SCRIPT_NAME', '').strip() or DEFAULT_SCRIPT_PATH
+    return site_url('{}?{}'.format(
+        script, urllib.parse.urlencode({'job': job_id})))
+
+
+def submit_job(raw_coords, window_days, max_images, band_override,
+               positions=None):
+    """mode=job: store the validated request in a new job directory, start
+    the background worker and redirect the browser to the status page.
+    positions is the target list of a multi-target request.
+
+    Nothing is measured here and no concurrency slot is taken; the worker
+    (run_job) waits for one.
+    """
+    out_dir = make_output_dir()
+    if out_dir is None:
+        return
+    params = {
+        'coords': raw_coords,
+        'window_days': str(window_days),
+        'max_images': str(max_images),
+    }
+    if band_override:
+        params['band'] = band_override
+    if positions is not None:
+        params['action'] = 'multi'
+        params['positions'] = positions
+    try:
+        job = nmw_jobs.Job.create(out_dir, params)
+        nmw_jobs.start_worker(os.path.realpath(__file__), out_dir)
+    except OSError as err:
+        emit_message_page(
+            "Internal error",
+            "<p>Cannot start the background job: {}</p>".format(
+                html_escape(err)),
+            status_line="Status: 500 Internal Server Error")
+        return
+    emit_redirect(job_status_url(job.id))
+
+
+def _worker_alive(status):
+    """False if the worker recorded in status has exited without finishing."""
+    pid = status.get('pid')
+    if not pid:
+        return True          # not started yet
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, ValueError):
+        pass
+    return True
+
+
+def serve_job_status(job_id, fmt):
+    """Status endpoint (?job=<id>): a self-reloading progress page while
+    the job is queued or running, then a redirect to its results page.
+    format=json returns status.json plus the result URLs instead."""
+    job_dir = os.path.join(TEMP_PARENT, job_id)
+    status = None
+    if nmw_jobs.valid_job_id(job_id, TEMP_DIR_PREFIX):
+        status = nmw_jobs.read_status(job_dir)
+    if status is None:
+        emit_message_page(
+            "Unknown job",
+            "<p>There is no job <span class='code'>{}</span>; it may have "
+            "been removed by housekeeping.</p>".format(html_escape(job_id)),
+            status_line="Status: 404 Not Found")
+        return
+    if status.get('state') in nmw_jobs.ACTIVE_STATES and \
+            not _worker_alive(status):
+        status['state'] = 'failed'
+        status['phase'] = 'The background worker exited unexpectedly'
+    url_prefix = read_config_vars(
+        'URL_OF_DATA_PROCESSING_ROOT')['URL_OF_DATA_PROCESSING_ROOT']
+    url_prefix = url_prefix.strip().rstrip('/')
+    page_url = '{}/{}/{}'.format(url_prefix, job_id, nmw_jobs.PAGE_FILE)
+
+    if fmt == 'json':
+        status.update(job=job_id, page_url=page_url,
+                      rows_url='{}/{}/{}'.format(url_prefix, job_id,
+                                                 nmw_jobs.ROWS_FILE))
+        print("Content-Type: application/json\n")
+        print(json.dumps(status, sort_keys=True))
+        return
+    if status.get('state') not in nmw_jobs.ACTIVE_STATES:
+        emit_redirect(page_url)
+        return
+
+    page_title = "Forced-photometry job"
+    print("Content-Type: text/html\n")
+    print("<html><head><title>{}</title>".format(html_escape(page_title)))
+    print("<meta http-equiv='refresh' content='{}'>".format(
+        JOB_STATUS_REFRESH_SECONDS))
+    print(_PAGE_CSS)
+    print("</head><body>")
+    print("<h2>{}</h2>".format(html_escape(page_title)))
+    print("<p>Job <span class='code'>{}</span>: {} &mdash; {}.</p>".format(
+        html_escape(job_id), html_escape(status.get('state')),
+        html_escape(status.get('phase', ''))))
+    if status.get('images'):
+        print("<p>Plate-solved {s} of {n} image(s); measured {m} of {n} "
+              "({r} measurement(s) so far).</p>".format(
+                  s=status.get('solved', 0), m=status.get('measured', 0),
+                  r=status.get('rows', 0), n=status['images']))
+    if status.get('state') == 'running':
+        print("<p><a href='{}'>Results so far</a></p>".format(
+            html_escape(page_url)))
+    print("<p class='secondary'>This page reloads every {} s and shows the "
+          "results when the job is finished. You can close it and come back "
+          "later, or share it: <a href='{u}'>{u}</a></p>".format(
+              JOB_STATUS_REFRESH_SECONDS,
+              u=html_escape(job_status_url(job_id))))
+    print("</body></html>")
+
+
+def run_job(job_id):
+    """Background worker ('--job <id>'): run the stored request through
+    main() with the page written to the job's index.html."""
+    global JOB
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    if not nmw_jobs.valid_job_id(job_id, TEMP_DIR_PREFIX):
+        sys.exit('invalid job id: {}'.format(job_id))
+    JOB = nmw_jobs.Job(os.path.join(TEMP_PARENT, job_id))
+    JOB.update(pid=os.getpid())
+    # main() reads the form through cgi.FieldStorage.
+    os.environ['REQUEST_METHOD'] = 'GET'
+    os.environ['QUERY_STRING'] = urllib.parse.urlencode(JOB.params)
+    page = nmw_jobs.JobPage(JOB.dir)
+    real_stdout = sys.stdout
+    sys.stdout = page
+    try:
+        main()
+    except Exception as err:
+        traceback.print_exc()
+        JOB.update(state='failed', phase='Internal error: {}'.format(err))
+    else:
+        if JOB.status.get('state') != 'failed':
+            JOB.update(state='done', phase='Finished')
+    finally:
+        sys.stdout = real_stdout
+        page.close()
+
+
+@nmw_timing.timed_request('coord_forced_photometry')
 def main():
     cgitb.enable()
     # Wall-clock start so the bottom of the page can report total and
@@ -1179,24 +2180,51 @@ def main():
         return
 
     form = cgi.FieldStorage()
+    job_id = (form.getfirst('job', '') or '').strip()
+    if job_id and JOB is None:
+        serve_job_status(job_id, form.getfirst('format'))
+        return
     raw_coords = (form.getfirst('coords', '') or '').strip()
     band_override = (form.getfirst('band', '') or '').strip()
     raw_window_days = (form.getfirst('window_days', '') or '').strip()
     raw_max_images = (form.getfirst('max_images', '') or '').strip()
+    # action=multi: the targets are the lines of the 'positions' textarea
+    # (see emit_multi_target_page); otherwise the single 'coords' position.
+    multi_mode = form.getfirst('action') == 'multi'
+    raw_positions = (form.getfirst('positions', '') or '')[
+        :MAX_POSITIONS_INPUT_BYTES]
 
-    if not raw_coords:
+    if multi_mode:
+        try:
+            targets, bad_lines = parse_position_list(raw_positions)
+        except ValueError as err:
+            emit_message_page(
+                "Too many positions",
+                "<p>{}. Please split the list into several requests.</p>"
+                .format(html_escape(err)))
+            return
+        if not targets:
+            emit_message_page(
+                "No valid positions",
+                "<p>No line of the list could be parsed as coordinates.</p>"
+                "<p>{}</p>".format('<br>'.join(
+                    "line {}: <span class='code'>{}</span> ({})".format(
+                        number, html_escape(line), html_escape(err))
+                    for number, line, err in bad_lines)))
+            return
+    elif not raw_coords:
         emit_redirect(form_page_url())
         return
-
-    try:
-        ra, dec = parse_coordinates(raw_coords)
-    except ValueError as err:
-        emit_message_page(
-            "Invalid coordinates",
-            "<p>Could not parse coordinates: <b>{}</b></p>"
-            "<p>You typed: <span class='code'>{}</span></p>".format(
-                html_escape(err), html_escape(raw_coords)))
-        return
+    else:
+        try:
+            ra, dec = parse_coordinates(raw_coords)
+        except ValueError as err:
+            emit_message_page(
+                "Invalid coordinates",
+                "<p>Could not parse coordinates: <b>{}</b></p>"
+                "<p>You typed: <span class='code'>{}</span></p>".format(
+                    html_escape(err), html_escape(raw_coords)))
+            return
 
     # Per-request "look back days" and "max images" values from the form.
     # Empty -> default; non-integer -> error page; out-of-range -> silent clamp.
@@ -1237,14 +2265,48 @@ def main():
                 ' '.join(VALID_BANDS)))
         return
 
-    slot = acquire_concurrency_slot(prefix='forced_phot',
-                                    max_concurrent=FORCED_PHOT_MAX_CONCURRENT)
+    if form.getfirst('mode') == 'job' and JOB is None:
+        submit_job(raw_coords, window_days, max_images, band_override,
+                   positions=raw_positions if multi_mode else None)
+        return
+
+    cfg = read_config_vars(
+        'REFERENCE_IMAGES', 'VAST_REFERENCE_COPY',
+        'URL_OF_DATA_PROCESSING_ROOT', 'COORD_SEARCH_THUMBNAIL_PIXELS',
+        'COORD_FORCED_PHOT_ZOOMIN_PIXELS', 'COORD_THUMBNAIL_CACHE_MB',
+        'COORD_THUMBNAIL_RENDERER', 'COORD_RENDER_BUDGET',
+        'COORD_PHASE1_CACHE_MB', 'VAST_WORKING_COPY_POOL_SIZE',
+        'COORD_QUEUE_MAX_DEPTH', 'COORD_QUEUE_MAX_WAIT_SECONDS')
+    ncl.QUEUE_MAX_DEPTH, ncl.QUEUE_MAX_WAIT_SECONDS = ncl.queue_limits(
+        cfg['COORD_QUEUE_MAX_DEPTH'], cfg['COORD_QUEUE_MAX_WAIT_SECONDS'])
+
+    # All slots busy: wait in the admission queue. The streamed page shows
+    # the position; a background job, with nobody waiting on the
+    # connection, reports it in its status and waits longer.
+    if JOB is not None:
+        def queue_progress(position, wait_seconds):
+            _job_update(phase='Waiting in the queue: number {}, about '
+                        '{:.0f} s'.format(position, max(1.0, wait_seconds)))
+        max_wait = JOB_SLOT_WAIT_SECONDS
+    else:
+        queue_progress = ncl.emit_queue_notice
+        max_wait = None
+    slot, busy_reason = wait_for_concurrency_slot(
+        prefix='forced_phot', max_concurrent=FORCED_PHOT_MAX_CONCURRENT,
+        max_wait=max_wait, progress=queue_progress)
     if slot is None:
+        if busy_reason == 'full':
+            detail = ("{} requests are already waiting for one of the {} "
+                      "slots".format(ncl.QUEUE_MAX_DEPTH,
+                                     FORCED_PHOT_MAX_CONCURRENT))
+        else:
+            detail = "no slot became free within {} s".format(
+                max_wait or ncl.QUEUE_MAX_WAIT_SECONDS)
+        _job_update(state='failed', phase='Server busy')
         emit_message_page(
             "Server busy",
-            "<p>The maximum number of concurrent forced-photometry requests "
-            "({0} of {0}) is currently running. Please try again in a "
-            "minute.</p>".format(FORCED_PHOT_MAX_CONCURRENT),
+            "<p>The server is busy with other forced-photometry requests: "
+            "{}. Please try again in a few minutes.</p>".format(detail),
             status_line="Status: 503 Service Unavailable")
         return
 
@@ -1265,15 +2327,24 @@ def main():
 
     try:
         work_dir = None  # per-request VaST working copy; cleaned up in finally
-        cfg = read_config_vars(
-            'REFERENCE_IMAGES', 'VAST_REFERENCE_COPY',
-            'URL_OF_DATA_PROCESSING_ROOT', 'COORD_SEARCH_THUMBNAIL_PIXELS',
-            'COORD_FORCED_PHOT_ZOOMIN_PIXELS')
+        work_dir_pooled = False  # checked out of nmw_vast_pool
+        phase2_pool = None  # Phase 2 measurements; stopped before cleanup
+        row_pool = None  # dates and thumbnails of the measured images
+        phase2_futures = []
         ref_dir = cfg['REFERENCE_IMAGES'].strip()
         vast_dir = cfg['VAST_REFERENCE_COPY'].strip()
         url_prefix = cfg['URL_OF_DATA_PROCESSING_ROOT'].strip().rstrip('/')
         thumb_raw = cfg['COORD_SEARCH_THUMBNAIL_PIXELS'].strip()
         zoomin_raw = cfg['COORD_FORCED_PHOT_ZOOMIN_PIXELS'].strip()
+        ncl.THUMB_CACHE_MAX_MB = ncl.thumb_cache_budget_mb(
+            cfg['COORD_THUMBNAIL_CACHE_MB'])
+        ncl.THUMBNAIL_RENDERER = ncl.thumbnail_renderer(
+            cfg['COORD_THUMBNAIL_RENDERER'])
+        ncl.RENDER_BUDGET = ncl.render_budget(cfg['COORD_RENDER_BUDGET'])
+        nmw_phase1_cache.CACHE_MAX_MB = nmw_phase1_cache.cache_budget_mb(
+            cfg['COORD_PHASE1_CACHE_MB'])
+        nmw_vast_pool.POOL_SIZE = nmw_vast_pool.pool_size(
+            cfg['VAST_WORKING_COPY_POOL_SIZE'])
 
         try:
             thumb_pixels = int(thumb_raw) if thumb_raw else DEFAULT_THUMBNAIL_PIXELS
@@ -1323,17 +2394,22 @@ def main():
         uploads_abs = os.path.abspath(TEMP_PARENT)
 
         # Per-request output directory; left in place for external housekeeping.
-        rand = ''.join(random.choice(string.ascii_letters) for _ in range(8))
-        sub = '{}{}{}'.format(TEMP_DIR_PREFIX, os.getpid(), rand)
-        out_dir = os.path.join(TEMP_PARENT, sub)
-        try:
-            os.makedirs(out_dir, mode=0o755)
-        except OSError as err:
-            emit_message_page(
-                "Internal error",
-                "<p>Cannot create output directory '{}': {}</p>".format(
-                    html_escape(out_dir), html_escape(err)),
-                status_line="Status: 500 Internal Server Error")
+        # A background job writes into its job directory.
+        if JOB is not None:
+            out_dir = JOB.dir
+        else:
+            out_dir = make_output_dir()
+        if out_dir is None:
+            return
+
+        if multi_mode:
+            emit_multi_target_page(
+                targets, bad_lines, ref_dir, vast_dir, local_config_path,
+                url_prefix, uploads_abs, out_dir, window_days, max_images,
+                band_override, thumb_pixels,
+                min(MAX_THUMBNAIL_PIXELS,
+                    thumb_pixels * HIRES_THUMBNAIL_MULTIPLIER),
+                zoomin_pixels, start_time)
             return
 
         # ---- Stream the page header EARLY, before the slow reference-field
@@ -1346,19 +2422,16 @@ def main():
         # already-open page (with no HTTP status), because we have already
         # committed to a 200 OK response.
         page_title = "Forced-photometry lightcurve"
-        print("Content-Type: text/html\n", flush=True)
+        emit_headers()
         print("<html><head><title>{}</title>".format(html_escape(page_title)))
         print(_PAGE_CSS)
         # Page-local CSS in <head> so muted status lines streamed before the
         # table (e.g. "Preparing working copy of VaST...") are styled from
         # the moment they hit the browser, with no later restyle flash.
-        print("<style type='text/css'>"
-              "tr.skipped td { color: #888; font-size: 90%; "
-              "background: #f8f8f8; }"
-              " p.secondary { color: #666; font-style: italic; }"
-              "</style>")
+        print(_RESULTS_STYLE)
         print("</head><body>")
-        print("<!-- {} -->".format(' ' * 4000))  # past Apache's CGI buffer
+        if JOB is None:
+            print("<!-- {} -->".format(' ' * 4000))  # past Apache's CGI buffer
         print("<h2>{}</h2>".format(html_escape(page_title)))
         print("<p>Position: <span class='code'>{} {}</span>; "
               "last {} days.</p>".format(html_escape(ra), html_escape(dec),
@@ -1367,6 +2440,7 @@ def main():
         # ---- Find which fields cover the position (both/all cameras). ----
         print("<p class='secondary'>Looking up which reference fields cover "
               "this position...</p>", flush=True)
+        _job_update(state='running', phase='Looking up covering fields')
         try:
             matches, sky2xy_truncated = run_sky2xy_scan(
                 ref_dir, ra, dec, vast_dir)
@@ -1415,19 +2489,16 @@ def main():
             print("</body></html>")
             return
         # Stream rows in (approximate) newest-first order without waiting
-        # for all images to be measured. The timestamp embedded in the
-        # wcs_fd_ filename closely tracks JD and is known without opening
-        # the file, so it makes a cheap proxy sort key.
-        def _img_ts(p):
-            m = _IMG_TS_RE.search(os.path.basename(p))
-            return m.group(1) if m else ''
-        images.sort(key=_img_ts, reverse=True)
+        # for all images to be measured.
+        images.sort(key=_image_timestamp, reverse=True)
         # Honor the user-selected "Max images" cap from the form.
         # Remembered so we can tell the user when the cap actually clipped
         # the result set.
         total_matching = len(images)
         images = images[:max_images]
         capped_by_user = (len(images) < total_matching)
+        nmw_timing.count(fields=len(covering_fields), images=len(images),
+                         job=JOB is not None)
 
         if not images:
             print("<div class='notice'>ERROR: no images of these fields "
@@ -1438,54 +2509,114 @@ def main():
             return
         print("<p>Performing forced photometry on {} images; this will "
               "take a while...</p>".format(len(images)), flush=True)
+        _job_update(phase='Preparing working copy of VaST',
+                    images=len(images), solved=0, measured=0, rows=0)
         if capped_by_user:
             # Tell the user when the "Max images" cap clipped the result set,
             # so nobody mistakes a 6-of-50 lightcurve for the full result.
             print("<p class='secondary'><i>Limited to the first {} of {} "
                   "matching images by the Max images setting.</i></p>".format(
                       len(images), total_matching), flush=True)
-        # Give the user something to watch during the ~30 s rsync that builds
-        # the per-request working copy of VaST; without this line the page
-        # sits silent until the first measurement row arrives.
-        print("<p class='secondary'>Preparing working copy of VaST...</p>",
-              flush=True)
+        # Why-skipped diagnostics for any image that produced no measurement
+        # are appended here (kept with the request output for inspection).
+        skip_log = os.path.join(out_dir, 'forced_phot_skipped.log')
+        # Images whose header WCS already puts the target well off the
+        # frame would only fail in forced_photometry.sh after a funpack, a
+        # SExtractor run and a plate solve; leave them out of both phases.
+        # (Read from the header in-process, no VaST tool is started.)
+        try:
+            ra_deg, dec_deg = radec_to_degrees(ra, dec)
+            off_frame = set(img for img in images
+                            if target_off_frame(img, ra_deg, dec_deg))
+        except ValueError:
+            ra_deg = dec_deg = None
+            off_frame = set()
+        for img in sorted(off_frame):
+            _log_skip(skip_log, img, 'target off frame (header WCS)',
+                      None, None)
+        if off_frame:
+            print("<p class='secondary'>{} of {} image(s) do not contain the "
+                  "position according to their header WCS and are "
+                  "skipped.</p>".format(len(off_frame), len(images)),
+                  flush=True)
 
-        # ---- Disposable VaST working copy (autoprocess.sh style) so forced
-        # photometry's scratch stays isolated from $VAST_REFERENCE_COPY. ----
-        work_dir = setup_vast_working_copy(vast_dir, TEMP_PARENT)
-        if work_dir is None:
-            print("<div class='notice'>Could not set up the calibration "
-                  "working copy of VaST; cannot measure.</div>")
-            print("<br><a href='{}'>Search again</a>".format(
-                html_escape(search_again_url)))
-            print("</body></html>")
-            return
+        # ---- Images measured at this position by an earlier request (see
+        # nmw_phot_store) get their rows from the store; only the others go
+        # through the working copy and the two phases below.
+        factory_text = _read_factory_text(vast_dir)
+        bands = dict((img, derive_band(factory_text, img, band_override))
+                     for img in images)
+        phot_keys = {}
+        stored = {}
+        if ra_deg is not None:
+            with nmw_timing.phase('phot_store') as counts:
+                phot_keys = _phot_store_keys(
+                    vast_dir, factory_text,
+                    [img for img in images if img not in off_frame],
+                    bands, ra_deg, dec_deg)
+                try:
+                    found = nmw_phot_store.lookup(phot_keys.values())
+                except (OSError, sqlite3.Error):
+                    found = {}
+                stored = dict((img, found[key])
+                              for img, key in phot_keys.items()
+                              if key in found)
+                counts['hits'] = len(stored)
+        if stored:
+            print("<p class='secondary'>{} of {} image(s) were already "
+                  "measured at this position; their rows come from the "
+                  "photometry store.</p>".format(len(stored), len(images)),
+                  flush=True)
+        pending = [img for img in images
+                   if img not in off_frame and img not in stored]
+
+        if pending:
+            # Give the user something to watch during the ~30 s rsync that
+            # builds the per-request working copy of VaST when no pooled
+            # copy is free; without this line the page sits silent until
+            # the first measurement row arrives.
+            print("<p class='secondary'>Preparing working copy of "
+                  "VaST...</p>", flush=True)
+
+            # ---- Disposable VaST working copy (autoprocess.sh style) so
+            # forced photometry's scratch stays isolated from
+            # $VAST_REFERENCE_COPY.
+            work_dir, work_dir_pooled = checkout_working_copy(vast_dir)
+            if work_dir is None:
+                print("<div class='notice'>Could not set up the calibration "
+                      "working copy of VaST; cannot measure.</div>")
+                print("<br><a href='{}'>Search again</a>".format(
+                    html_escape(search_again_url)))
+                print("</body></html>")
+                return
 
         # ---- Phase 1: run util/solve_plate_with_UCAC5 in parallel across
         # all images so each wcs_<basename>.cat.ucac5 (photometric) is on
-        # disk before the serial Phase 2 starts. This is the network-bound
-        # step (UCAC5 + APASS queries) and the only one that benefits much
-        # from in-request parallelism. Phase 2's internal solve_plate call
+        # disk before Phase 2 starts. This is the network-bound step
+        # (UCAC5 + APASS queries). Phase 2's internal solve_plate call
         # then short-circuits via check_if_the_output_catalog_already_exist.
         # (Failures here just mean Phase 2 falls through to the normal
         # recompute path for that image.)
-        skip_log = os.path.join(out_dir, 'forced_phot_skipped.log')
-        phase1_workers = min(len(images), os.cpu_count() or 4,
-                             FORCED_PHOT_PARALLEL_SOLVE_WORKERS)
+        pipeline = ImagePipeline(work_dir, vast_dir, local_config_path,
+                                 factory_text, pending, skip_log)
         # Stream a flushed line per finished plate-solve so the browser
         # sees regular bytes during Phase 1 (~30-60 s per image on
         # UCAC5+APASS). Without this the page sits silent from the
         # "Preparing working copy" line above until the table header
         # below, which on larger image sets risks browser/proxy timeouts.
-        print("<p class='secondary'>Plate-solving and photometric "
-              "catalog-matching {n} images using {w} parallel workers; "
-              "each line below appears as one image finishes...</p>".format(
-                  n=len(images), w=phase1_workers),
-              flush=True)
+        if pending:
+            print("<p class='secondary'>Plate-solving and photometric "
+                  "catalog-matching {n} images using {w} parallel workers; "
+                  "each line below appears as one image finishes...</p>"
+                  .format(n=len(pending), w=pipeline.solve_workers),
+                  flush=True)
         _phase1_progress_start = time.time()
 
+        _job_update(phase='Plate-solving')
+
         def _phase1_progress(done, total, fits_path, rc):
             elapsed_so_far = time.time() - _phase1_progress_start
+            _job_update(solved=done)
             status = 'solved' if rc == 0 else 'failed (rc={})'.format(rc)
             print("<p class='secondary'>&nbsp;&nbsp;{d}/{t} {st}: {b} "
                   "(at {e:.1f} s)</p>".format(
@@ -1494,20 +2625,13 @@ def main():
                       e=elapsed_so_far),
                   flush=True)
 
-        n_phase1_solved, sextractor_cache_hits, n_funpacked, \
-            compute_path_map, phase1_elapsed = \
-            _phase1_parallel_solve_plate(
-                work_dir, local_config_path, images, phase1_workers,
-                skip_log, progress_callback=_phase1_progress)
+        pipeline.solve(progress_callback=_phase1_progress)
 
         # ---- Streamed results table. We open the table immediately and emit
         # one <tr> per image as it finishes (success or skip) so the page
         # fills in instead of waiting for all measurements before any output
         # appears. The plain-text photometry table is rendered once at the end, because its
         # column widths depend on the full result set.
-        # Why-skipped diagnostics for any image that produced no measurement
-        # are appended here (kept with the request output for inspection).
-        factory_text = _read_factory_text(vast_dir)
         sub_name = os.path.basename(out_dir)
         # Hi-res click-through PNGs are HIRES_THUMBNAIL_MULTIPLIER times larger
         # than the in-page thumbnails (capped at MAX_THUMBNAIL_PIXELS).
@@ -1518,115 +2642,72 @@ def main():
         print("<p class='secondary'>Each finished measurement appears as a "
               "row in the table below; the page keeps filling in until all "
               "images are processed.</p>", flush=True)
+        _job_update(phase='Measuring')
+        # The padding only pushes streamed rows through Apache's buffer.
+        row_pad = _ROW_FLUSH_PAD if JOB is None else '\n'
         print("<table class='main'>")
-        print("<tr><th>Date (UTC)</th><th>JD (UTC)</th><th>mag</th><th>err</th>"
-              "<th>Status</th><th>Band</th><th>Field</th>"
-              "<th>Cutout</th><th>Image</th></tr>", flush=True)
-        # SExtractor config selected per image, mirroring how
-        # transient_factory_test31.sh picks per-camera (see
-        # sextractor_config_for_camera). Copied over the working copy's
-        # default.sex right before each measurement; falls through silently
-        # if the chosen file is missing so we never fail the measurement on
-        # this account -- the generic default.sex remains in place.
-        work_dir_default_sex = os.path.join(work_dir, 'default.sex')
+        print(_RESULTS_TABLE_HEADER, flush=True)
+        # Phase 2 runs forced_photometry.sh for several images at once, each
+        # worker in its own scratch directory with its own default.sex (see
+        # ImagePipeline); the rows are still emitted in image order,
+        # each as soon as it and all rows above it are done. If the scratch
+        # directories cannot be made, one worker measures in work_dir.
+        # Rows from the photometry store need no working copy at all.
+        def _measure(img):
+            band = bands[img]
+            if img in stored:
+                fp = dict(stored[img])
+                return band, fp, row_pool.submit(_row_for, img, band, fp)
+            # Images left out as off-frame were not calibrated and give
+            # None, like those whose funpack failed.
+            fp, = pipeline.measure(img, band, [(ra, dec, phot_keys.get(img))])
+            if fp is None:
+                return band, None, None
+            # Hand the dates and thumbnails to row_pool right away, so they
+            # overlap with the measurements that follow.
+            return band, fp, row_pool.submit(_row_for, img, band, fp)
+
+        def _row_for(img, band, fp):
+            """Table row of a measured image: the date lookup, the image
+            size and the four thumbnails. Runs on row_pool, overlapping
+            with the measurements that follow."""
+            r = result_row(img, band, fp, url_prefix, uploads_abs)
+            add_row_thumbnails(r, img, fp, out_dir, vast_dir, thumb_pixels,
+                               hires_pixels, zoomin_pixels)
+            return r
+
         results = []
-        # SExtractor catalogs were already seeded by Phase 1 above (which
-        # also counted cache hits into sextractor_cache_hits). Per-image
-        # default.sex is still picked per camera here just before the
-        # measurement runs.
-        for img in images:
-            band = derive_band(factory_text, img, band_override)
-            sex_config_name = derive_sextractor_config(factory_text, img)
-            if sex_config_name:
-                src_sex = os.path.join(work_dir, sex_config_name)
-                if os.path.isfile(src_sex):
-                    try:
-                        # copy2, not copy: we need the destination default.sex
-                        # to inherit the source's older mtime (set by the
-                        # request-start rsync) rather than getting bumped to
-                        # "now". Otherwise sextract_single_image_noninteractive
-                        # sees default.sex newer than the cached
-                        # wcs_<basename>.fits.cat (whether produced by Phase 1
-                        # or seeded from the autoprocess artifacts) and the
-                        # mtime check in autodetect_aperture.c forces a full
-                        # SExtractor recompute -- defeating the whole point of
-                        # Phase 1 and the catalog cache.
-                        shutil.copy2(src_sex, work_dir_default_sex)
-                    except OSError:
-                        pass  # keep whatever default.sex was already there
-            # compute_path is the funpacked sibling for `.fz` uploads, or
-            # img itself for plain FITS. If the image is missing from the
-            # map, Phase 1's funpack failed for it and there is nothing to
-            # measure -- emit a skip row and move on.
-            compute_path = compute_path_map.get(img)
-            if compute_path is None:
-                print(_html_skipped_row(
-                    img, field_name_from_fits(img),
-                    fits_url(url_prefix, img, uploads_abs)) + _ROW_FLUSH_PAD,
-                    flush=True)
-                continue
-            fp = run_forced_photometry_c(work_dir, local_config_path, img,
-                                         compute_path, ra, dec, band,
-                                         debug_log=skip_log)
+        phase2_start = time.time()
+        row_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=FORCED_PHOT_ROW_WORKERS)
+        phase2_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=pipeline.measure_workers)
+        phase2_futures = [phase2_pool.submit(_measure, img) for img in images]
+        for n_done, (img, future) in enumerate(zip(images, phase2_futures)):
+            _job_update(measured=n_done, rows=len(results))
+            band, fp, row_future = future.result()
             if fp is None:
                 # Faint placeholder so processing progress stays visible even
                 # when several images in a row produce no measurement.
                 print(_html_skipped_row(
                     img, field_name_from_fits(img),
-                    fits_url(url_prefix, img, uploads_abs)) + _ROW_FLUSH_PAD,
+                    fits_url(url_prefix, img, uploads_abs)) + row_pad,
                     flush=True)
                 continue
-            # The C engine prints the basename of whatever path it was
-            # handed, which for `.fz` uploads is the funpacked sibling.
-            # Override with the original upload basename so the row labels
-            # match the FITS link the user clicks through to.
-            fp['basename'] = os.path.basename(img)
-            jd, atel = get_jd_and_atel_date(vast_dir, img)
-            if jd is None:
-                jd = '{:.4f}'.format(float(fp['jd'])) if _is_float(fp['jd']) else fp['jd']
-            if atel is None:
-                atel = '-'
-            meta = get_image_metadata(img, vast_dir)
-            nx = meta.get('nx') if meta else None
-            ny = meta.get('ny') if meta else None
-            png_preview = None
-            png_preview_hires = None
-            png_cutout = None
-            png_cutout_hires = None
-            if nx and ny:
-                # Two PNGs per image: the small in-page thumbnail and a
-                # higher-resolution version reached by clicking the thumbnail.
-                png_preview = make_zoomout_thumbnail(
-                    img, fp['x'], fp['y'], nx, ny, out_dir, vast_dir, thumb_pixels)
-                png_preview_hires = make_zoomout_thumbnail(
-                    img, fp['x'], fp['y'], nx, ny, out_dir, vast_dir, hires_pixels,
-                    suffix='zoomout_hires')
-            png_cutout = make_zoomin_thumbnail(
-                img, fp['x'], fp['y'], out_dir, vast_dir, thumb_pixels,
-                zoomin_pixels, aperture_circle_diameter=fp['aperture'])
-            png_cutout_hires = make_zoomin_thumbnail(
-                img, fp['x'], fp['y'], out_dir, vast_dir, hires_pixels,
-                zoomin_pixels, suffix='zoomin_hires',
-                aperture_circle_diameter=fp['aperture'])
-            # Pre-format mag/err once so HTML and ASCII renderers use the
-            # same string (rounded to 2 d.p.; '>' prefix on upper limits).
-            r = {
-                'jd': jd, 'atel': atel,
-                'mag': _fmt_mag(fp['mag'], fp['status']),
-                'err': _fmt_err(fp['err']),
-                'status': fp['status'], 'band': band,
-                'field': field_name_from_fits(img),
-                'basename': fp['basename'],
-                'fits_url': fits_url(url_prefix, img, uploads_abs),
-                'png_preview': png_preview,
-                'png_preview_hires': png_preview_hires,
-                'png_cutout': png_cutout,
-                'png_cutout_hires': png_cutout_hires,
-            }
+            r = row_future.result()
             results.append(r)
-            print(_html_row(r, url_prefix, sub_name) + _ROW_FLUSH_PAD,
-                  flush=True)
+            if JOB is not None:
+                JOB.add_row(r)
+            print(_html_row(r, url_prefix, sub_name) + row_pad, flush=True)
         print("</table>", flush=True)
+        phase2_pool.shutdown()
+        row_pool.shutdown()
+        phase2_elapsed = time.time() - phase2_start
+        nmw_timing.record('phase2', phase2_elapsed,
+                          images=len(images), rows=len(results),
+                          stored=len(stored), workers=pipeline.measure_workers)
+        _job_update(measured=len(images), rows=len(results),
+                    phase='Plotting the lightcurve')
 
         # ---- Lightcurve PNG plot.
         # Write the two data files into the per-request output directory so
@@ -1635,36 +2716,10 @@ def main():
         # missing, PGPLOT without libpng, etc.) is silent -- the rest of the
         # page renders normally without the plot.
         if results:
-            _lc_path, _ul_path = _write_lightcurve_data_files(out_dir, results)
-            if _lc_path is not None:
-                _png_basename = _render_lightcurve_png(
-                    work_dir, out_dir, ra, dec, _lc_path, _ul_path)
-                if _png_basename is not None:
-                    _png_url = '{}/{}/{}'.format(
-                        url_prefix, sub_name, _png_basename)
-                    print("<p style='text-align: center;'>"
-                          "<img src='{}' alt='Lightcurve plot' "
-                          "style='max-width: 100%;'></p>".format(
-                              html_escape(_png_url)),
-                          flush=True)
-                # Link the ASCII data files immediately under the plot, so
-                # the underlying numbers stay one click away. Emitted even
-                # when the PNG render failed (binary missing, etc.) -- the
-                # data files are still useful on their own.
-                _lc_base = os.path.basename(_lc_path)
-                _lc_url = '{}/{}/{}'.format(url_prefix, sub_name, _lc_base)
-                _links = ["<a href='{}'>{}</a> (detections)".format(
-                              html_escape(_lc_url), html_escape(_lc_base))]
-                if _ul_path is not None:
-                    _ul_base = os.path.basename(_ul_path)
-                    _ul_url = '{}/{}/{}'.format(
-                        url_prefix, sub_name, _ul_base)
-                    _links.append(
-                        "<a href='{}'>{}</a> (upper limits)".format(
-                            html_escape(_ul_url), html_escape(_ul_base)))
-                print("<p class='secondary' style='text-align: center;'>"
-                      "Data files: {}</p>".format(', '.join(_links)),
-                      flush=True)
+            # The reference copy has the same binary when every row came
+            # from the photometry store.
+            emit_lightcurve(work_dir or vast_dir, out_dir, url_prefix, ra, dec,
+                            results)
 
         # ---- Photometry table for copy/paste -- rendered only after the
         # loop so column widths reflect the full result set. A simple <pre>
@@ -1692,25 +2747,43 @@ def main():
             # the image and used in place of running SExtractor again.
             print("<p class='secondary'>SExtractor catalog: {hit} reused "
                   "from autoprocess artifacts, {miss} computed fresh.</p>".format(
-                      hit=sextractor_cache_hits,
-                      miss=n_processed - sextractor_cache_hits))
+                      hit=pipeline.sextractor_cache_hits,
+                      miss=len(pending) - pipeline.sextractor_cache_hits
+                      - pipeline.phase1_cache_hits))
+            # Images whose catalogues and plate solution came from the
+            # shared Phase 1 cache (solved by an earlier request).
+            if pipeline.phase1_cache_hits > 0:
+                print("<p class='secondary'>Phase 1 cache: {n} of {tot} "
+                      "image(s) calibrated by an earlier request; SExtractor "
+                      "and the plate solve were skipped for them.</p>".format(
+                          n=pipeline.phase1_cache_hits, tot=len(pending)))
             # Funpack diagnostic -- only shown when at least one `.fz`
             # upload was processed. The funpacked siblings live inside
             # the per-request VaST working copy and are cleaned up with
             # it; sextract / sky2xy / forced_photometry.sh consume the
             # uncompressed file while thumbnails / metadata / the served
             # FITS link still reference the original .fz.
-            if n_funpacked > 0:
+            if pipeline.n_funpacked > 0:
                 print("<p class='secondary'>Funpack: {n} .fz upload(s) "
                       "decompressed for SExtractor / sky2xy compatibility."
-                      "</p>".format(n=n_funpacked))
+                      "</p>".format(n=pipeline.n_funpacked))
             # Parallel UCAC5 + APASS plate-solve timing.
             print("<p class='secondary'>UCAC5 plate-solve: "
                   "{n} of {tot} image(s) solved in parallel in {t} "
                   "(workers: {w}).</p>".format(
-                      n=n_phase1_solved, tot=n_processed,
-                      t=_fmt_duration(phase1_elapsed),
-                      w=phase1_workers))
+                      n=pipeline.n_solved, tot=len(pending),
+                      t=_fmt_duration(pipeline.solve_elapsed),
+                      w=pipeline.solve_workers))
+            print("<p class='secondary'>Forced photometry: {n} image(s) "
+                  "measured in {t} (parallel workers: {w}).</p>".format(
+                      n=len(pending), t=_fmt_duration(phase2_elapsed),
+                      w=pipeline.measure_workers))
+            # Rows served from nmw_phot_store (measured by an earlier
+            # request at this position).
+            if stored:
+                print("<p class='secondary'>Photometry store: {n} of {tot} "
+                      "image(s) measured by an earlier request.</p>".format(
+                          n=len(stored), tot=len(images)))
         else:
             print("<p class='secondary'>Total computation time: "
                   "{}.</p>".format(_fmt_duration(elapsed)))
@@ -1719,12 +2792,17 @@ def main():
             html_escape(search_again_url)))
         print("</body></html>")
     finally:
+        if phase2_pool is not None:
+            # Do not pull the working copy from under running measurements.
+            for future in phase2_futures:
+                future.cancel()
+            phase2_pool.shutdown()
+        if row_pool is not None:
+            row_pool.shutdown()
         if work_dir is not None:
             if os.environ.get('DEBUG_KEEP_WORK_DIR'):
                 print('<!-- DEBUG: keeping work_dir {} -->'.format(work_dir))
-                sys.stderr.write('DEBUG: keeping work_dir {}\n'.format(work_dir))
-            else:
-                shutil.rmtree(work_dir, ignore_errors=True)
+            release_working_copy(work_dir, work_dir_pooled)
         slot.close()
 
 
@@ -1818,4 +2896,13 @@ def _html_skipped_row(img_path, field_name, fits_link_url):
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) == 3 and sys.argv[1] == '--job':
+        run_job(sys.argv[2])
+    elif len(sys.argv) > 1 and sys.argv[1] == '--targets':
+        if 'REQUEST_METHOD' in os.environ:
+            print("This option cannot be used via a web request.",
+                  file=sys.stderr)
+            sys.exit(1)
+        sys.exit(run_targets_cli(sys.argv[1:]))
+    else:
+        main()
@@ -3,10 +3,13 @@
 CGI for finding which reference fields cover a given sky position.
 
 Reads the user's coordinate string from a POST form, parses one of three
-formats (colon-sexagesimal, space-sexagesimal, decimal degrees), iterates
-the FITS files in $REFERENCE_IMAGES, calls lib/bin/sky2xy on each one,
-and produces an HTML table of matching fields with pixel coordinates,
-distance to the nearest image edge, and a small thumbnail.
+formats (colon-sexagesimal, space-sexagesimal, decimal degrees), looks up
+the FITS files in $REFERENCE_IMAGES whose footprint contains the position
+(persistent footprint index and HEALPix cell table, see nmw_ref_index.py),
+computes the pixel position on each (nmw_wcs.py, or lib/bin/sky2xy for
+headers it does not support), and produces an HTML table of matching
+fields with pixel coordinates, distance to the nearest image edge, and a
+small thumbnail.
 
 Configuration (read from local_config.sh next to this script):
   REFERENCE_IMAGES                directory containing reference FITS images
@@ -15,12 +18,58 @@ Configuration (read from local_config.sh next to this script):
   COORD_SEARCH_THUMBNAIL_PIXELS   thumbnail width/height in pixels
                                   (default 128, matching the smallest preview
                                   in util/transients/transient_factory_test31.sh)
+  COORD_THUMBNAIL_CACHE_MB        disk budget of the shared thumbnail cache in
+                                  uploads/coord_cache/thumbs (default 2048,
+                                  0 disables it; see nmw_thumb_cache.py)
+  COORD_THUMBNAIL_RENDERER        'pgfv' (default: util/fits2png and
+                                  util/make_finding_chart) or 'numpy' (the
+                                  in-process nmw_render.py)
+  COORD_SEARCH_PARALLEL_WORKERS   most worker threads per request (default
+                                  two per CPU, 16 to 32); fewer are used
+                                  when the load average is high
+  COORD_RENDER_BUDGET             thumbnail renderers running at once on the
+                                  server, over all requests (default one per
+                                  CPU, 0 = no limit)
+  COORD_QUEUE_MAX_DEPTH           requests allowed to wait for a busy
+                                  concurrency slot (default 20)
+  COORD_QUEUE_MAX_WAIT_SECONDS    longest wait in that queue (default 120)
+
+When all concurrency slots are taken, a request waits in a first-come,
+first-served queue (nmw_coord_lib.wait_for_concurrency_slot) and the page
+shows its position and an estimated wait; it gets 503 "Server busy" only
+when the queue is full or the wait times out.
+
+The "show all reference images" action (action=list_all) redirects to the
+static page uploads/reference_catalogue/index.html maintained by
+nmw_catalogue.py, starting a background rebuild when $REFERENCE_IMAGES has
+changed since the last build; it does not take a concurrency slot.
+
+The batch action (action=batch) searches for every position listed in
+the 'positions' textarea and/or the uploaded 'positions_file' (one per
+line, up to nmw_coord_lib.MAX_BATCH_POSITIONS) in one pass over the
+references and shows one table grouped by target.
+
+format=ndjson (with action=search or action=batch) answers for scripts
+instead: application/x-ndjson, one JSON object per line, a 'match' object
+(path, x, y, edge, from_center, scale, ...) per reference image covering
+a target, written as soon as it is resolved, then a final 'done' object.
+Thumbnails are not rendered unless thumbnails=1 is also given; errors come
+back as a single 'error' object. Example:
+  curl -d action=search -d format=ndjson \
+       --data-urlencode 'coords=17:45:37.199 -28:56:10.22' \
+       https://<server>/cgi-bin/unmw/coord_search.py
 
 Per-request output directory uploads/coord_search_<pid><rand>/ is left in
 place; existing housekeeping that prunes uploads/web_upload_* should also
 prune uploads/coord_search_*.
 """
 
+# Hand the request to a running nmw_worker.py server, if any, before the
+# imports below (see nmw_worker.py).
+if __name__ == "__main__":
+    import nmw_worker
+    nmw_worker.forward_request("coord_search")
+
 # Handle cgi module removal in Python 3.13+
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -34,12 +83,14 @@ except ImportError:
 
 import fcntl
 import html
+import json
 import os
 import random
 import re
 import string
 import subprocess
 import sys
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 
@@ -56,12 +107,10 @@ TEMP_DIR_PREFIX = 'coord_search_'
 # nmw_coord_lib import below (DEFAULT_THUMBNAIL_PIXELS, HIRES_THUMBNAIL_MULTIPLIER,
 # MIN/MAX_THUMBNAIL_PIXELS).
 MAX_RESULTS_TO_PROCESS = 200         # safety cap on coord-search matches
-LIST_ALL_MAX_FILES = 2000            # safety cap on the "show all" listing
-LIST_ALL_TIMEOUT_SECONDS = 900       # wall-clock cap for the "show all" flow (15 min)
+MAX_BATCH_INPUT_BYTES = 65536        # cap on each of the batch textarea and file
 DEFAULT_FORM_PATH = '/unmw/coord_search.html'
 DEFAULT_ZOOMIN_PIXELS = 200          # half-width of zoom-in thumbnail in source pix
 ZOOMIN_MARKER_APERTURE_DIAMETER_PIX = 10.0  # fixed red circle (pix) marking the target on the zoom-in cutout
-DEFAULT_PARALLEL_WORKERS = 16        # threads rendering PNGs concurrently
 MIN_PARALLEL_WORKERS = 1
 MAX_PARALLEL_WORKERS = 32
 
@@ -73,13 +122,17 @@ COORDS_REGEX = re.compile(r'^[0-9 :+\-.\t]{3,80}$')
 # ---------- shared helpers (single source of truth: nmw_coord_lib.py) ----------
 # Shared with coord_forced_photometry.py so a fix to any of these updates
 # both pages at once.
+import nmw_catalogue
 import nmw_coord_lib as ncl
+import nmw_timing
 from nmw_coord_lib import (
     html_escape, _PAGE_CSS, back_link_url, form_page_url, emit_redirect,
-    emit_message_page, parse_coordinates, read_config_vars,
-    acquire_concurrency_slot, run_sky2xy_scan, get_image_metadata,
+    emit_headers, emit_message_page, parse_coordinates, read_config_vars,
+    wait_for_concurrency_slot, run_sky2xy_batch_scan, Sky2xyScan,
+    get_image_metadata, parse_position_list,
     zoomout_png_dims, make_zoomout_thumbnail, make_zoomin_thumbnail,
-    render_thumbnail_link, field_name_from_fits, list_fits_files,
+    render_thumbnail_link, render_image_size, render_mean_scale,
+    field_name_from_fits,
     DEFAULT_THUMBNAIL_PIXELS, HIRES_THUMBNAIL_MULTIPLIER,
     MIN_THUMBNAIL_PIXELS, MAX_THUMBNAIL_PIXELS,
 )
@@ -89,31 +142,6 @@ from nmw_coord_lib import (
 ncl.DEFAULT_FORM_PATH = DEFAULT_FORM_PATH
 
 
-def render_image_size(arcmin_str, deg_str, nx, ny):
-    """Three-line HTML for the Image size cell."""
-    lines = []
-    if arcmin_str:
-        lines.append(html_escape(arcmin_str))
-    if deg_str:
-        # Already pre-rendered HTML with the &deg; entity.
-        lines.append(deg_str)
-    lines.append('{}x{} pix'.format(nx, ny))
-    return '<br>'.join(lines)
-
-
-def render_mean_scale(scale_x, scale_y):
-    """Returns (formatted_html, mean_scale_value_or_None)."""
-    if scale_x is None and scale_y is None:
-        return '-', None
-    if scale_y is None:
-        m = scale_x
-    elif scale_x is None:
-        m = scale_y
-    else:
-        m = (scale_x + scale_y) / 2.0
-    return '{:.2f}'.format(m), m
-
-
 def render_distance_cell(pix, mean_scale):
     """Three-line cell: arcmin, deg, pix. Pix-only when scale unknown."""
     if mean_scale is None:
@@ -158,39 +186,322 @@ def emit_match_row(r, url_prefix, sub):
               zi=zi_cell, zo=zo_cell), flush=True)
 
 
-def emit_listall_row(r, url_prefix, sub):
-    """Emit one <tr> for the show-all table and flush stdout."""
-    base = os.path.basename(r['path'])
-    field = field_name_from_fits(r['path'])
-    size_html = render_image_size(
-        r['arcmin_str'], r['deg_str'], r['nx'], r['ny'])
-    scale_html, _ = render_mean_scale(r['scale_x'], r['scale_y'])
-    center_radec = r.get('center_radec') or '-'
-    zo_cell = render_thumbnail_link(
-        r.get('png_zoomout'), r.get('png_zoomout_hires'),
-        'zoom-out', base, url_prefix, sub)
-    print("<tr>"
-          "<td><b>{f}</b></td>"
-          "<td title='{full}'>{base}</td>"
-          "<td>{cr}</td>"
-          "<td>{s}</td>"
-          "<td>{sc}</td>"
-          "<td>{zo}</td>"
-          "</tr>".format(
-              f=html_escape(field),
-              full=html_escape(r['path']),
-              base=html_escape(base),
-              cr=html_escape(center_radec),
-              s=size_html, sc=scale_html, zo=zo_cell), flush=True)
+def build_match_row(path, x, y, meta):
+    """Result-table row dict for the target at pixel (x, y) of path."""
+    nx, ny = meta['nx'], meta['ny']
+    edge = int(round(min(x, y, nx - x, ny - y)))
+    cx, cy = nx / 2.0, ny / 2.0
+    from_center = int(round(((x - cx) ** 2 + (y - cy) ** 2) ** 0.5))
+    return {
+        'path': path,
+        'x': x, 'y': y,
+        'nx': nx, 'ny': ny,
+        'edge': edge,
+        'from_center': from_center,
+        'arcmin_str': meta['arcmin_str'],
+        'deg_str': meta['deg_str'],
+        'scale_x': meta['scale_x'],
+        'scale_y': meta['scale_y'],
+    }
+
+
+def render_match_thumbnails(r, image, out_dir_abs, vast_dir, thumb_pixels,
+                            hires_pixels, zoomin_pixels, tag=''):
+    """All four PNGs for one match, rendered sequentially into r.
+
+    tag is appended to the PNG suffixes ('<base>_zoomin<tag>.png', ...) so
+    that several targets on one image get their own files. image is the
+    shared decode from ncl.open_thumbnail_image (or None).
+    """
+    r['png_zoomin'] = make_zoomin_thumbnail(
+        r['path'], r['x'], r['y'], out_dir_abs, vast_dir,
+        thumb_pixels, zoomin_pixels, suffix='zoomin' + tag,
+        aperture_circle_diameter=ZOOMIN_MARKER_APERTURE_DIAMETER_PIX,
+        image=image)
+    r['png_zoomin_hires'] = make_zoomin_thumbnail(
+        r['path'], r['x'], r['y'], out_dir_abs, vast_dir,
+        hires_pixels, zoomin_pixels, suffix='zoomin_hires' + tag,
+        aperture_circle_diameter=ZOOMIN_MARKER_APERTURE_DIAMETER_PIX,
+        image=image)
+    r['png_zoomout'] = make_zoomout_thumbnail(
+        r['path'], r['x'], r['y'], r['nx'], r['ny'],
+        out_dir_abs, vast_dir, thumb_pixels, suffix='zoomout' + tag,
+        image=image)
+    r['png_zoomout_hires'] = make_zoomout_thumbnail(
+        r['path'], r['x'], r['y'], r['nx'], r['ny'],
+        out_dir_abs, vast_dir, hires_pixels,
+        suffix='zoomout_hires' + tag, image=image)
+    return r
+
+
+def emit_results_table_header():
+    print("<table class='main'>", flush=True)
+    print("<tr><th>Field</th><th>Reference image</th>"
+          "<th>X, Y (pix)</th>"
+          "<th>From center</th>"
+          "<th>Nearest edge</th>"
+          "<th>Image size</th>"
+          "<th>Scale (&quot;/pix)</th>"
+          "<th>Zoom-out</th><th>Zoom-in</th></tr>", flush=True)
 
 
 # Number of columns in each table — used for inline error rows.
 COORD_SEARCH_TABLE_COLS = 9
-LIST_ALL_TABLE_COLS = 6
+
+
+# ---------- list-all view ----------
+
+def serve_reference_catalogue():
+    """Redirect to the static page written by nmw_catalogue.py.
+
+    If the page is out of date with $REFERENCE_IMAGES a background rebuild
+    is started and the current page is still served; if there is no page
+    yet the user is asked to come back once the first build is done.
+    """
+    cfg = read_config_vars(
+        'REFERENCE_IMAGES',
+        'URL_OF_DATA_PROCESSING_ROOT',
+        'COORD_SEARCH_THUMBNAIL_PIXELS',
+    )
+    ref_dir = cfg['REFERENCE_IMAGES'].strip()
+    url_prefix = cfg['URL_OF_DATA_PROCESSING_ROOT'].strip().rstrip('/')
+    if not ref_dir or not os.path.isdir(ref_dir) or not url_prefix:
+        emit_message_page(
+            "Configuration error",
+            "<p>Set <span class='code'>REFERENCE_IMAGES</span> and "
+            "<span class='code'>URL_OF_DATA_PROCESSING_ROOT</span> in "
+            "<span class='code'>local_config.sh</span>.</p>",
+            status_line="Status: 500 Internal Server Error",
+        )
+        return
+    state = nmw_catalogue.load_state()
+    if nmw_catalogue.is_stale(
+            state, ref_dir, nmw_catalogue.thumbnail_pixels_from_config(cfg)):
+        nmw_catalogue.start_background_build()
+    if state is not None and os.path.isfile(os.path.join(
+            nmw_catalogue.catalogue_dir(), nmw_catalogue.PAGE_NAME)):
+        emit_redirect(nmw_catalogue.page_url(url_prefix))
+        return
+    emit_message_page(
+        "Catalogue is being built",
+        "<p>The list of all reference images is being generated for the "
+        "first time. This takes a few minutes; please reload this page "
+        "later.</p>",
+    )
+
+
+# ---------- batch search ----------
+
+def read_position_list(form):
+    """Text of a batch search: the 'positions' textarea followed by the
+    uploaded 'positions_file', at most MAX_BATCH_INPUT_BYTES of each."""
+    parts = [(form.getfirst('positions', '') or '')[:MAX_BATCH_INPUT_BYTES]]
+    item = form['positions_file'] if 'positions_file' in form else None
+    if item is not None and not isinstance(item, list) and item.filename:
+        data = item.file.read(MAX_BATCH_INPUT_BYTES)
+        if isinstance(data, bytes):
+            data = data.decode('ascii', errors='replace')
+        parts.append(data)
+    return '\n'.join(parts)
+
+
+def emit_batch_page(positions, bad_lines, ref_dir, vast_dir, url_prefix, sub,
+                    out_dir_abs, thumb_pixels, hires_pixels, zoomin_pixels,
+                    parallel_workers, request_start):
+    """Streaming results page of a batch search, one table grouped by target.
+
+    All positions are resolved in one pass (run_sky2xy_batch_scan). Each
+    reference image covering any target has its metadata fetched once, and
+    the thumbnails of all of its targets are rendered by one worker, so the
+    in-process renderer decodes it once.
+    """
+    page_title = "Batch coordinate search results"
+    emit_headers()
+    print("<html><head><title>{}</title>".format(html_escape(page_title)))
+    print(_PAGE_CSS)
+    print("</head><body>")
+    print("<!-- {} -->".format(' ' * 4000))
+    print("<h2>{}</h2>".format(html_escape(page_title)))
+    print("<p>Searched for {} position(s) in <span class='code'>{}</span></p>"
+          .format(len(positions), html_escape(ref_dir)), flush=True)
+    if bad_lines:
+        print("<div class='notice'>Skipped {} line(s) that could not be "
+              "parsed:<br>{}</div>".format(len(bad_lines), '<br>'.join(
+                  "line {}: <span class='code'>{}</span> ({})".format(
+                      number, html_escape(line), html_escape(err))
+                  for number, line, err in bad_lines)), flush=True)
+
+    print("<p>Scanning reference images for matches ...</p>", flush=True)
+    matches, truncated = run_sky2xy_batch_scan(
+        ref_dir, [(ra, dec) for _line, ra, dec in positions], vast_dir)
+    if truncated:
+        print("<div class='notice'>Scan stopped after {} s; "
+              "results may be incomplete.</div>".format(
+                  SCAN_TIMEOUT_SECONDS), flush=True)
+
+    paths = sorted(set(path for m in matches for path, _x, _y in m))
+    print("<p>{} reference image(s) cover at least one position; fetching "
+          "image metadata ...</p>".format(len(paths)), flush=True)
+    metas = {}
+    if paths:
+        with ThreadPoolExecutor(max_workers=parallel_workers) as ex:
+            metas = dict(zip(paths, ex.map(
+                lambda path: get_image_metadata(path, vast_dir), paths)))
+
+    groups = []
+    by_path = {}
+    for k, target_matches in enumerate(matches):
+        rows = [build_match_row(path, x, y, metas[path])
+                for path, x, y in target_matches if metas.get(path)]
+        rows.sort(key=lambda r: r['from_center'])
+        for r in rows:
+            r['tag'] = '_t{}'.format(k + 1)
+            by_path.setdefault(r['path'], []).append(r)
+        groups.append(rows)
+
+    def _render_reference(rows):
+        """Thumbnails of every target on one reference image."""
+        image = ncl.open_thumbnail_image(rows[0]['path'])
+        for r in rows:
+            render_match_thumbnails(r, image, out_dir_abs, vast_dir,
+                                    thumb_pixels, hires_pixels, zoomin_pixels,
+                                    tag=r['tag'])
+
+    emit_results_table_header()
+    with ThreadPoolExecutor(max_workers=parallel_workers) as ex:
+        # Submitted in order of first appearance, so the rows of the first
+        # targets are ready first.
+        futures = {path: ex.submit(_render_reference, rows)
+                   for path, rows in by_path.items()}
+        for k, ((line, _ra, _dec), rows) in enumerate(zip(positions, groups)):
+            print("<tr><th colspan='{}' style='text-align: left;'>"
+                  "Target {}: <span class='code'>{}</span> &mdash; {} "
+                  "reference image(s)</th></tr>".format(
+                      COORD_SEARCH_TABLE_COLS, k + 1, html_escape(line),
+                      len(rows)), flush=True)
+            if not rows:
+                print("<tr><td colspan='{}'>No reference images cover this "
+                      "position.</td></tr>".format(COORD_SEARCH_TABLE_COLS),
+                      flush=True)
+            for r in rows:
+                try:
+                    futures[r['path']].result()
+                except Exception as err:
+                    print("<tr><td colspan='{}'><b>render failed for "
+                          "{}:</b> {}</td></tr>".format(
+                              COORD_SEARCH_TABLE_COLS,
+                              html_escape(os.path.basename(r['path'])),
+                              html_escape(err)), flush=True)
+                    continue
+                emit_match_row(r, url_prefix, sub)
+    print("</table>", flush=True)
+
+    print("<br><br><a href='{}'>Search again</a>".format(
+        html_escape(back_link_url())), flush=True)
+    print("<p style='color: #888; font-size: 90%;'>"
+          "Page generated in {:.1f} s.</p>".format(
+              time.time() - request_start), flush=True)
+    print("</body></html>", flush=True)
+
+
+# ---------- NDJSON output ----------
+
+def emit_ndjson(obj):
+    """Write one JSON object as a line and flush stdout."""
+    print(json.dumps(obj, sort_keys=True), flush=True)
+
+
+def emit_ndjson_error(title, body_html, status_line=None):
+    """format=ndjson counterpart of emit_message_page: one error object."""
+    emit_headers('application/x-ndjson', status_line)
+    text = html.unescape(re.sub(r'<[^>]*>', ' ', body_html))
+    emit_ndjson({'type': 'error', 'error': title,
+                 'message': ' '.join(text.split())})
+
+
+def match_json(k, line, r, url_prefix, sub):
+    """The NDJSON object of one match (target k, 0-based) of row dict r."""
+    _scale_html, mean_scale = render_mean_scale(r['scale_x'], r['scale_y'])
+    obj = {
+        'type': 'match',
+        'target': k + 1,
+        'position': line,
+        'path': r['path'],
+        'field': field_name_from_fits(r['path']),
+        'x': round(r['x'], 3), 'y': round(r['y'], 3),
+        'nx': r['nx'], 'ny': r['ny'],
+        'edge': r['edge'],
+        'from_center': r['from_center'],
+        'scale': mean_scale,
+    }
+    for key in ('png_zoomout', 'png_zoomout_hires',
+                'png_zoomin', 'png_zoomin_hires'):
+        if key in r:
+            obj[key[4:] + '_url'] = ('{}/{}/{}'.format(url_prefix, sub, r[key])
+                                     if r[key] else None)
+    return obj
+
+
+def emit_ndjson_results(targets, bad_lines, ref_dir, vast_dir, url_prefix,
+                        sub, out_dir_abs, thumb_pixels, hires_pixels,
+                        zoomin_pixels, parallel_workers, request_start):
+    """format=ndjson response: one JSON object per line for scripts.
+
+    targets is a list of (line, ra, dec). Lines have a 'type': 'skipped'
+    for unparsable batch lines, 'match' for each reference image covering
+    a target, emitted as soon as its metadata is known, while the scan
+    is still running (completion order, not sorted), 'error' for a
+    reference that failed, and a final 'done' with the totals.
+    Thumbnails are only rendered when sub is not None (thumbnails=1),
+    adding their URLs to the match objects.
+    """
+    emit_headers('application/x-ndjson')
+    for number, line, err in bad_lines:
+        emit_ndjson({'type': 'skipped', 'line': number, 'text': line,
+                     'message': err})
+    scan = Sky2xyScan(ref_dir, [(ra, dec) for _line, ra, dec in targets],
+                      vast_dir)
+    # Workers write their own lines; the lock keeps lines whole. The
+    # per-reference locks keep two targets on one image from rendering
+    # into the same '<basename>.png' at once.
+    emit_lock = threading.Lock()
+    path_locks = {}
+    n_matches = [0]
+
+    def _resolve_match(k, path, x, y):
+        """Metadata (and thumbnails) of one match, emitted when ready."""
+        try:
+            meta = get_image_metadata(path, vast_dir)
+            if meta is None:
+                return
+            r = build_match_row(path, x, y, meta)
+            if sub is not None:
+                with path_locks[path]:
+                    render_match_thumbnails(
+                        r, ncl.open_thumbnail_image(path), out_dir_abs,
+                        vast_dir, thumb_pixels, hires_pixels, zoomin_pixels,
+                        tag='_t{}'.format(k + 1))
+            obj = match_json(k, targets[k][0], r, url_prefix, sub)
+        except Exception as err:
+            obj = {'type': 'error', 'path': path, 'message': str(err)}
+        with emit_lock:
+            emit_ndjson(obj)
+            if obj['type'] == 'match':
+                n_matches[0] += 1
+
+    # Matches go to the pool as the scan finds them.
+    with ThreadPoolExecutor(max_workers=parallel_workers) as ex:
+        for k, path, x, y in scan:
+            path_locks.setdefault(path, threading.Lock())
+            ex.submit(_resolve_match, k, path, x, y)
+    emit_ndjson({'type': 'done', 'targets': len(targets),
+                 'matches': n_matches[0], 'truncated': scan.truncated,
+                 'elapsed_s': round(time.time() - request_start, 2)})
 
 
 # ---------- main ----------
 
+@nmw_timing.timed_request('coord_search')
 def main():
     cgitb.enable()
     request_start = time.time()
@@ -212,27 +523,69 @@ def main():
 
     form = cgi.FieldStorage()
 
+    # format=ndjson: machine-readable output for scripts (see
+    # emit_ndjson_results); thumbnails=1 also renders the PNGs. Errors are
+    # then reported as a single JSON object.
+    ndjson = form.getfirst('format') == 'ndjson'
+    with_thumbnails = (form.getfirst('thumbnails', '') or '').lower() in (
+        '1', 'yes', 'true')
+
+    def emit_error(title, body_html, status_line=None):
+        if ndjson:
+            emit_ndjson_error(title, body_html, status_line)
+        else:
+            emit_message_page(title, body_html, status_line=status_line)
+
     # The landing page sets a hidden 'action' field via JS click handlers
-    # on each submit button: 'search' for coord-search, 'list_all' for
-    # the show-all-reference-images view. The default value is 'search'
+    # on each submit button: 'search' for coord-search, 'batch' for the
+    # list-of-positions search, 'list_all' for the
+    # show-all-reference-images view. The default value is 'search'
     # (used when JS is disabled or when the user submits via Enter in
     # the coords input).
-    list_all_mode = form.getfirst('action') == 'list_all'
+    if form.getfirst('action') == 'list_all':
+        # Served from the pre-built catalogue; needs no concurrency slot.
+        serve_reference_catalogue()
+        return
 
-    if list_all_mode:
-        ra = dec = None
-        raw_coords = ''
+    batch_mode = form.getfirst('action') == 'batch'
+    if batch_mode:
+        try:
+            positions, bad_lines = parse_position_list(read_position_list(form))
+        except ValueError as err:
+            emit_error(
+                "Too many positions",
+                "<p>{}. Please split the list into several searches.</p>".format(
+                    html_escape(err)),
+            )
+            return
+        if not positions:
+            emit_error(
+                "No valid positions",
+                "<p>No line of the list could be parsed as coordinates.</p>"
+                "<p>{}</p>"
+                "<p>Please use one of the accepted formats, one position per "
+                "line.</p>".format('<br>'.join(
+                    "line {}: <span class='code'>{}</span> ({})".format(
+                        number, html_escape(line), html_escape(err))
+                    for number, line, err in bad_lines)),
+            )
+            return
     else:
         raw_coords = (form.getfirst('coords', '') or '').strip()
         # No search parameters supplied (e.g. the .py was opened directly):
         # send the user to the input form rather than showing an error.
         if not raw_coords:
-            emit_redirect(form_page_url())
+            if ndjson:
+                emit_error("No coordinates",
+                           "<p>Pass the position as coords=RA+DEC.</p>",
+                           status_line="Status: 400 Bad Request")
+            else:
+                emit_redirect(form_page_url())
             return
         try:
             ra, dec = parse_coordinates(raw_coords)
         except ValueError as err:
-            emit_message_page(
+            emit_error(
                 "Invalid coordinates",
                 "<p>Could not parse coordinates: <b>{}</b></p>"
                 "<p>You typed: <span class='code'>{}</span></p>"
@@ -241,32 +594,58 @@ def main():
             )
             return
 
-    slot = acquire_concurrency_slot()
+    cfg = read_config_vars(
+        'REFERENCE_IMAGES',
+        'VAST_REFERENCE_COPY',
+        'URL_OF_DATA_PROCESSING_ROOT',
+        'COORD_SEARCH_THUMBNAIL_PIXELS',
+        'COORD_SEARCH_ZOOMIN_PIXELS',
+        'COORD_SEARCH_PARALLEL_WORKERS',
+        'COORD_RENDER_BUDGET',
+        'COORD_THUMBNAIL_CACHE_MB',
+        'COORD_THUMBNAIL_RENDERER',
+        'COORD_QUEUE_MAX_DEPTH',
+        'COORD_QUEUE_MAX_WAIT_SECONDS',
+    )
+    ncl.QUEUE_MAX_DEPTH, ncl.QUEUE_MAX_WAIT_SECONDS = ncl.queue_limits(
+        cfg['COORD_QUEUE_MAX_DEPTH'], cfg['COORD_QUEUE_MAX_WAIT_SECONDS'])
+
+    # All slots busy: wait in the admission queue, showing the position.
+    if ndjson:
+        def queue_progress(position, wait_seconds):
+            emit_headers('application/x-ndjson')
+            emit_ndjson({'type': 'queued', 'position': position,
+                         'estimated_wait_s': round(wait_seconds)})
+    else:
+        queue_progress = ncl.emit_queue_notice
+    slot, busy_reason = wait_for_concurrency_slot(progress=queue_progress)
     if slot is None:
-        emit_message_page(
+        if busy_reason == 'full':
+            detail = ("{} requests are already waiting for one of the {} "
+                      "search slots".format(ncl.QUEUE_MAX_DEPTH, MAX_CONCURRENT))
+        else:
+            detail = ("no search slot became free within {} s".format(
+                ncl.QUEUE_MAX_WAIT_SECONDS))
+        emit_error(
             "Server busy",
-            "<p>The maximum number of concurrent coordinate searches "
-            "({} of {}) is currently running. Please try again in a few "
-            "seconds.</p>".format(MAX_CONCURRENT, MAX_CONCURRENT),
+            "<p>The server is busy: {}. Please try again in a minute.</p>"
+            .format(detail),
             status_line="Status: 503 Service Unavailable",
         )
         return
 
     try:
-        cfg = read_config_vars(
-            'REFERENCE_IMAGES',
-            'VAST_REFERENCE_COPY',
-            'URL_OF_DATA_PROCESSING_ROOT',
-            'COORD_SEARCH_THUMBNAIL_PIXELS',
-            'COORD_SEARCH_ZOOMIN_PIXELS',
-            'COORD_SEARCH_PARALLEL_WORKERS',
-        )
         ref_dir = cfg['REFERENCE_IMAGES'].strip()
         vast_dir = cfg['VAST_REFERENCE_COPY'].strip()
         url_prefix = cfg['URL_OF_DATA_PROCESSING_ROOT'].strip().rstrip('/')
         thumb_raw = cfg['COORD_SEARCH_THUMBNAIL_PIXELS'].strip()
         zoomin_raw = cfg['COORD_SEARCH_ZOOMIN_PIXELS'].strip()
         workers_raw = cfg['COORD_SEARCH_PARALLEL_WORKERS'].strip()
+        ncl.THUMB_CACHE_MAX_MB = ncl.thumb_cache_budget_mb(
+            cfg['COORD_THUMBNAIL_CACHE_MB'])
+        ncl.THUMBNAIL_RENDERER = ncl.thumbnail_renderer(
+            cfg['COORD_THUMBNAIL_RENDERER'])
+        ncl.RENDER_BUDGET = ncl.render_budget(cfg['COORD_RENDER_BUDGET'])
 
         try:
             thumb_pixels = int(thumb_raw) if thumb_raw else DEFAULT_THUMBNAIL_PIXELS
@@ -287,17 +666,20 @@ def main():
         if zoomin_pixels < 5:
             zoomin_pixels = DEFAULT_ZOOMIN_PIXELS
 
+        # The configured value is a ceiling; the pool shrinks with the load
+        # average, and ncl.render_token caps the renderers server-wide.
         try:
-            parallel_workers = (int(workers_raw) if workers_raw
-                                else DEFAULT_PARALLEL_WORKERS)
+            configured_workers = int(workers_raw) if workers_raw else None
         except ValueError:
-            parallel_workers = DEFAULT_PARALLEL_WORKERS
-        if (parallel_workers < MIN_PARALLEL_WORKERS
-                or parallel_workers > MAX_PARALLEL_WORKERS):
-            parallel_workers = DEFAULT_PARALLEL_WORKERS
+            configured_workers = None
+        if configured_workers is not None and (
+                configured_workers < MIN_PARALLEL_WORKERS
+                or configured_workers > MAX_PARALLEL_WORKERS):
+            configured_workers = None
+        parallel_workers = ncl.adaptive_workers(configured_workers)
 
         if not ref_dir or not os.path.isdir(ref_dir):
-            emit_message_page(
+            emit_error(
                 "Configuration error",
                 "<p>Reference image directory not found: "
                 "<span class='code'>{}</span></p>"
@@ -308,7 +690,7 @@ def main():
             )
             return
         if not vast_dir or not os.path.isdir(vast_dir):
-            emit_message_page(
+            emit_error(
                 "Configuration error",
                 "<p>VaST install directory not found: "
                 "<span class='code'>{}</span></p>"
@@ -319,7 +701,7 @@ def main():
             )
             return
         if not url_prefix:
-            emit_message_page(
+            emit_error(
                 "Configuration error",
                 "<p><span class='code'>URL_OF_DATA_PROCESSING_ROOT</span> "
                 "is not set in <span class='code'>local_config.sh</span>.</p>",
@@ -327,11 +709,27 @@ def main():
             )
             return
 
+        if batch_mode:
+            targets = positions
+        else:
+            targets = [(raw_coords, ra, dec)]
+            bad_lines = []
+        nmw_timing.count(mode='batch' if batch_mode else 'search',
+                         format='ndjson' if ndjson else 'html',
+                         targets=len(targets), workers=parallel_workers)
+        if ndjson and not with_thumbnails:
+            # Nothing is written to disk: no output directory needed.
+            emit_ndjson_results(targets, bad_lines, ref_dir, vast_dir,
+                                url_prefix, None, None, thumb_pixels,
+                                hires_pixels, zoomin_pixels, parallel_workers,
+                                request_start)
+            return
+
         if not os.path.isdir(TEMP_PARENT):
             try:
                 os.makedirs(TEMP_PARENT, mode=0o755)
             except OSError as err:
-                emit_message_page(
+                emit_error(
                     "Configuration error",
                     "<p>Cannot create '{}': {}</p>".format(
                         html_escape(TEMP_PARENT), html_escape(err)),
@@ -346,7 +744,7 @@ def main():
         try:
             os.makedirs(out_dir, mode=0o755)
         except OSError as err:
-            emit_message_page(
+            emit_error(
                 "Internal error",
                 "<p>Cannot create output directory '{}': {}</p>".format(
                     html_escape(out_dir), html_escape(err)),
@@ -355,130 +753,21 @@ def main():
             return
         out_dir_abs = os.path.abspath(out_dir)
 
-        if list_all_mode:
-            # ---- Catalogue mode: list every WCS-calibrated reference image.
-            # Streaming response: header + table opener flushed up front so
-            # the user sees progress, rows emitted as their futures finish.
-            page_title = "All reference images"
-            print("Content-Type: text/html\n", flush=True)
-            print("<html><head><title>{}</title>".format(
-                html_escape(page_title)))
-            print(_PAGE_CSS)
-            print("</head><body>")
-            # Push past Apache's CGI output buffer so the heading shows up
-            # immediately rather than waiting for more data.
-            print("<!-- {} -->".format(' ' * 4000))
-            print("<h2>{}</h2>".format(html_escape(page_title)))
-            print("<p>Listing reference images from "
-                  "<span class='code'>{}</span> ...</p>".format(
-                      html_escape(ref_dir)), flush=True)
-            fits_paths = list_fits_files(ref_dir)
-            if len(fits_paths) > LIST_ALL_MAX_FILES:
-                fits_paths = fits_paths[:LIST_ALL_MAX_FILES]
-                paths_truncated = True
-            else:
-                paths_truncated = False
-            # Sort upfront by field name so streaming output order matches
-            # the sorted view.
-            fits_paths.sort(key=lambda p: (field_name_from_fits(p), p))
-
-            print("<p>Found {} FITS file(s); generating thumbnails as they "
-                  "complete ...</p>".format(len(fits_paths)), flush=True)
-            if paths_truncated:
-                print("<div class='notice'>Reference image directory contains "
-                      "more than {} files; only the first {} (alphabetical) "
-                      "are listed.</div>".format(
-                          LIST_ALL_MAX_FILES, LIST_ALL_MAX_FILES), flush=True)
-
-            print("<table class='main'>", flush=True)
-            print("<tr><th>Field</th><th>Reference image</th>"
-                  "<th>Image center (J2000)</th>"
-                  "<th>Image size</th>"
-                  "<th>Scale (&quot;/pix)</th>"
-                  "<th>Zoom-out</th></tr>", flush=True)
-
-            deadline = time.time() + LIST_ALL_TIMEOUT_SECONDS
-
-            def _process_listall_entry(path):
-                """Per-FITS: get metadata, render preview + hi-res zoom-out.
-
-                Each thread owns one FITS file, so the two pgfv calls (which
-                both write '<basename>.png' to cwd before being renamed) do
-                not collide with other threads working on different files.
-                Sequential within the thread guarantees that 'preview' is
-                renamed before 'hires' overwrites it.
-                """
-                if time.time() > deadline:
-                    return ('timeout', None)
-                meta = get_image_metadata(path, vast_dir)
-                if meta is None:
-                    return ('no_meta', None)
-                nx, ny = meta['nx'], meta['ny']
-                png_preview = make_zoomout_thumbnail(
-                    path, None, None, nx, ny,
-                    out_dir_abs, vast_dir, thumb_pixels, suffix='zoomout')
-                png_hires = make_zoomout_thumbnail(
-                    path, None, None, nx, ny,
-                    out_dir_abs, vast_dir, hires_pixels, suffix='zoomout_hires')
-                return ('ok', {
-                    'path': path,
-                    'nx': nx, 'ny': ny,
-                    'arcmin_str': meta['arcmin_str'],
-                    'deg_str': meta['deg_str'],
-                    'scale_x': meta['scale_x'],
-                    'scale_y': meta['scale_y'],
-                    'center_radec': meta['center_radec'],
-                    'png_zoomout': png_preview,
-                    'png_zoomout_hires': png_hires,
-                })
-
-            timed_out = False
-            n_emitted = 0
-            with ThreadPoolExecutor(max_workers=parallel_workers) as ex:
-                # Submit all tasks; iterate futures in submission order so
-                # rows appear in the user-expected (alphabetical) order even
-                # though completion order may differ. The bottleneck is the
-                # current-position task; subsequent already-finished ones
-                # appear in quick succession after each blocking wait.
-                futures = [ex.submit(_process_listall_entry, p)
-                           for p in fits_paths]
-                for fut, path in zip(futures, fits_paths):
-                    try:
-                        status, row = fut.result()
-                    except Exception as err:
-                        print("<tr><td colspan='{}'><b>render failed for "
-                              "{}:</b> {}</td></tr>".format(
-                                  LIST_ALL_TABLE_COLS,
-                                  html_escape(os.path.basename(path)),
-                                  html_escape(err)), flush=True)
-                        continue
-                    if status == 'timeout':
-                        timed_out = True
-                    elif status == 'ok':
-                        emit_listall_row(row, url_prefix, sub)
-                        n_emitted += 1
-
-            print("</table>", flush=True)
-
-            if timed_out:
-                print("<div class='notice'>Listing stopped after {} s; "
-                      "results may be incomplete.</div>".format(
-                          LIST_ALL_TIMEOUT_SECONDS), flush=True)
-            if n_emitted == 0:
-                print("<p>No WCS-calibrated reference images found.</p>",
-                      flush=True)
-
-            print("<br><br><a href='{}'>Search again</a>".format(
-                html_escape(back_link_url())), flush=True)
-            print("<p style='color: #888; font-size: 90%;'>"
-                  "Page generated in {:.1f} s.</p>".format(
-                      time.time() - request_start), flush=True)
-            print("</body></html>", flush=True)
-            return  # done with list-all flow
+        if ndjson:
+            emit_ndjson_results(targets, bad_lines, ref_dir, vast_dir,
+                                url_prefix, sub, out_dir_abs, thumb_pixels,
+                                hires_pixels, zoomin_pixels, parallel_workers,
+                                request_start)
+            return
+        if batch_mode:
+            emit_batch_page(positions, bad_lines, ref_dir, vast_dir, url_prefix,
+                            sub, out_dir_abs, thumb_pixels, hires_pixels,
+                            zoomin_pixels, parallel_workers, request_start)
+            return  # done with the batch flow
 
         # ---- Coord-search mode (streaming).
         page_title = "Coordinate search results"
-        print("Content-Type: text/html\n", flush=True)
+        emit_headers()
         print("<html><head><title>{}</title>".format(html_escape(page_title)))
         print(_PAGE_CSS)
         print("</head><body>")
@@ -489,98 +778,59 @@ def main():
                   html_escape(ra), html_escape(dec), html_escape(ref_dir)),
               flush=True)
 
+        def _render_match(r):
+            """All four PNGs for one matched FITS, rendered sequentially.
+
+            Each thread owns one FITS file, so the four pgfv calls (each
+            of which writes '<basename>.png' to cwd before being renamed)
+            cannot collide with threads on other files. Sequential within
+            the thread guarantees each rename completes before the next
+            call writes a new '<basename>.png'. With the in-process
+            renderer the four PNGs share one decode of the image.
+            """
+            return render_match_thumbnails(
+                r, ncl.open_thumbnail_image(r['path']), out_dir_abs,
+                vast_dir, thumb_pixels, hires_pixels, zoomin_pixels)
+
         print("<p>Scanning reference images for matches ...</p>", flush=True)
-        matches, truncated = run_sky2xy_scan(ref_dir, ra, dec, vast_dir)
-        if truncated:
-            print("<div class='notice'>Scan stopped after {} s; "
-                  "results may be incomplete.</div>".format(
-                      SCAN_TIMEOUT_SECONDS), flush=True)
-
-        # Parallel metadata fetch (fast: ~1 s per image, no PNG yet) so we
-        # can compute from-center and sort before opening the table.
-        def _fetch_match_meta(item):
-            path, x, y = item
-            meta = get_image_metadata(path, vast_dir)
-            if meta is None:
-                return None
-            nx, ny = meta['nx'], meta['ny']
-            edge = int(round(min(x, y, nx - x, ny - y)))
-            cx, cy = nx / 2.0, ny / 2.0
-            from_center = int(round(((x - cx) ** 2 + (y - cy) ** 2) ** 0.5))
-            return {
-                'path': path,
-                'x': x, 'y': y,
-                'nx': nx, 'ny': ny,
-                'edge': edge,
-                'from_center': from_center,
-                'arcmin_str': meta['arcmin_str'],
-                'deg_str': meta['deg_str'],
-                'scale_x': meta['scale_x'],
-                'scale_y': meta['scale_y'],
-            }
-
-        print("<p>Found {} candidate match(es); fetching image metadata "
-              "...</p>".format(len(matches)), flush=True)
-        results = []
-        if matches:
-            with ThreadPoolExecutor(max_workers=parallel_workers) as ex:
-                for row in ex.map(_fetch_match_meta, matches):
-                    if row is not None:
-                        results.append(row)
-
-        # Best-centred first: smallest distance to image centre. Sort BEFORE
-        # submitting render tasks so the streaming order matches the sort.
-        results.sort(key=lambda r: r['from_center'])
-
-        if not results:
-            print("<p>No reference images cover this sky position.</p>",
-                  flush=True)
-        else:
-            print("<p>{} reference image(s) cover this position, sorted by "
-                  "distance from image centre (best-centred first); rows "
-                  "appear as thumbnails finish:</p>".format(len(results)),
-                  flush=True)
-            print("<table class='main'>", flush=True)
-            print("<tr><th>Field</th><th>Reference image</th>"
-                  "<th>X, Y (pix)</th>"
-                  "<th>From center</th>"
-                  "<th>Nearest edge</th>"
-                  "<th>Image size</th>"
-                  "<th>Scale (&quot;/pix)</th>"
-                  "<th>Zoom-out</th><th>Zoom-in</th></tr>", flush=True)
-
-            def _render_match(r):
-                """All four PNGs for one matched FITS, rendered sequentially.
-
-                Each thread owns one FITS file, so the four pgfv calls (each
-                of which writes '<basename>.png' to cwd before being renamed)
-                cannot collide with threads on other files. Sequential within
-                the thread guarantees each rename completes before the next
-                call writes a new '<basename>.png'.
-                """
-                r['png_zoomin'] = make_zoomin_thumbnail(
-                    r['path'], r['x'], r['y'], out_dir_abs, vast_dir,
-                    thumb_pixels, zoomin_pixels, suffix='zoomin',
-                    aperture_circle_diameter=ZOOMIN_MARKER_APERTURE_DIAMETER_PIX)
-                r['png_zoomin_hires'] = make_zoomin_thumbnail(
-                    r['path'], r['x'], r['y'], out_dir_abs, vast_dir,
-                    hires_pixels, zoomin_pixels, suffix='zoomin_hires',
-                    aperture_circle_diameter=ZOOMIN_MARKER_APERTURE_DIAMETER_PIX)
-                r['png_zoomout'] = make_zoomout_thumbnail(
-                    r['path'], r['x'], r['y'], r['nx'], r['ny'],
-                    out_dir_abs, vast_dir, thumb_pixels, suffix='zoomout')
-                r['png_zoomout_hires'] = make_zoomout_thumbnail(
-                    r['path'], r['x'], r['y'], r['nx'], r['ny'],
-                    out_dir_abs, vast_dir, hires_pixels,
-                    suffix='zoomout_hires')
-                return r
-
-            with ThreadPoolExecutor(max_workers=parallel_workers) as ex:
-                # Submit in sort order; iterate futures in submission order
-                # so rows appear sorted by from_center even though the
-                # workers may finish out of submission order.
-                futures = [ex.submit(_render_match, r) for r in results]
-                for fut, r in zip(futures, results):
+        scan = Sky2xyScan(ref_dir, [(ra, dec)], vast_dir)
+        with ThreadPoolExecutor(max_workers=parallel_workers) as ex:
+            # Each match is handed to the pool the moment the scan finds
+            # it: its metadata is fetched (fast: ~1 s per image, no PNG
+            # yet) and its thumbnails are queued right after, so by the
+            # time the scan ends most rows are rendered already.
+            def _resolve_match(path, x, y):
+                meta = get_image_metadata(path, vast_dir)
+                if meta is None:
+                    return None
+                r = build_match_row(path, x, y, meta)
+                return r, ex.submit(_render_match, r)
+
+            pending = [ex.submit(_resolve_match, path, x, y)
+                       for _k, path, x, y in scan]
+            if scan.truncated:
+                print("<div class='notice'>Scan stopped after {} s; "
+                      "results may be incomplete.</div>".format(
+                          SCAN_TIMEOUT_SECONDS), flush=True)
+            print("<p>Found {} candidate match(es); waiting for image "
+                  "metadata ...</p>".format(len(pending)), flush=True)
+            results = [item for item in (fut.result() for fut in pending)
+                       if item is not None]
+
+            # Best-centred first: smallest distance to image centre. The
+            # rows are written in this order, each once its PNGs are done.
+            results.sort(key=lambda item: item[0]['from_center'])
+
+            if not results:
+                print("<p>No reference images cover this sky position.</p>",
+                      flush=True)
+            else:
+                print("<p>{} reference image(s) cover this position, sorted "
+                      "by distance from image centre (best-centred first); "
+                      "rows appear as thumbnails finish:</p>".format(
+                          len(results)), flush=True)
+                emit_results_table_header()
+                for r, fut in results:
                     try:
                         fut.result()
                     except Exception as err:
@@ -591,8 +841,7 @@ def main():
                                   html_escape(err)), flush=True)
                         continue
                     emit_match_row(r, url_prefix, sub)
-
-            print("</table>", flush=True)
+                print("</table>", flush=True)
 
         print("<br><br><a href='{}'>Search again</a>".format(
             html_escape(back_link_url())), flush=True)
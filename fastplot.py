@@ -7,6 +7,12 @@ validates input, checks for cached results, enforces rate limits
 and concurrency, and launches fastplot_wrapper.sh for new jobs.
 """
 
+# Hand the request to a running nmw_worker.py server, if any, before the
+# imports below (see nmw_worker.py).
+if __name__ == "__main__":
+    import nmw_worker
+    nmw_worker.forward_request("fastplot")
+
 # Handle cgi module removal in Python 3.13+
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -25,6 +31,9 @@ import glob
 import fcntl
 import subprocess
 
+import nmw_config
+import nmw_timing
+
 
 # --- Configuration ---
 
@@ -42,115 +51,26 @@ MIN_FREE_DISK_SPACE_KB = 5 * 1024 * 1024
 SHOW_LOG_ON_ERROR = True
 
 
-def _parse_config_value(config_path, var_name):
-    """Read a variable value from a bash-style config file."""
-    try:
-        with open(config_path) as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('#') or '=' not in line:
-                    continue
-                if line.startswith('export '):
-                    line = line[7:]
-                key, _, value = line.partition('=')
-                key = key.strip()
-                value = value.strip().strip('"').strip("'")
-                # Strip inline comments
-                comment_pos = value.find(' #')
-                if comment_pos >= 0:
-                    value = value[:comment_pos].strip()
-                if key == var_name:
-                    return value
-    except (FileNotFoundError, PermissionError):
-        pass
-    return None
-
-
-def _expand_shell_vars(value, script_dir):
-    """Expand shell variables in config values.
-
-    Python reads config files as text without shell expansion,
-    so variables need manual expansion.
-    """
-    if not value:
-        return value
-    # In CGI context, $PWD is the script directory
-    value = value.replace('$PWD', script_dir)
-    value = value.replace('${PWD}', script_dir)
-    # Expand $HOME
-    home = os.path.expanduser('~')
-    value = value.replace('$HOME', home)
-    value = value.replace('${HOME}', home)
-    # Expand any remaining $VAR or ${VAR} from environment
-    # Handle ${VAR} form first, then $VAR
-    import re as _re
-    def _env_replace(m):
-        var = m.group(1) or m.group(2)
-        return os.environ.get(var, m.group(0))
-    value = _re.sub(r'\$\{(\w+)\}|\$(\w+)', _env_replace, value)
-    return value
-
-
-def _parse_all_config_values(config_path):
-    """Read all variable assignments from a bash-style config file."""
-    all_vars = {}
-    try:
-        with open(config_path) as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('#') or '=' not in line:
-                    continue
-                if line.startswith('export '):
-                    line = line[7:]
-                key, _, value = line.partition('=')
-                key = key.strip()
-                value = value.strip().strip('"').strip("'")
-                comment_pos = value.find(' #')
-                if comment_pos >= 0:
-                    value = value[:comment_pos].strip()
-                if key:
-                    all_vars[key] = value
-    except (FileNotFoundError, PermissionError):
-        pass
-    return all_vars
-
-
 def get_config():
     """Load configuration from environment or local_config.sh.
 
-    Handles cross-references between config variables, e.g.
-    DATA_PROCESSING_ROOT="$IMAGE_DATA_ROOT" where IMAGE_DATA_ROOT
-    is defined in the same file.
+    local_config.sh is evaluated by bash (nmw_config), so cross-references
+    between config variables, e.g. DATA_PROCESSING_ROOT="$IMAGE_DATA_ROOT"
+    where IMAGE_DATA_ROOT is defined in the same file, and $PWD (the script
+    directory) expand exactly as in the shell scripts.
     """
     script_dir = os.path.dirname(os.path.abspath(__file__))
     config_path = os.path.join(script_dir, 'local_config.sh')
-
-    # Read all variables from config to resolve cross-references
-    all_config_vars = _parse_all_config_values(config_path)
-
-    # Build a lookup that checks env first, then config file
-    def expand_var(m):
-        var = m.group(1) or m.group(2)
-        # Environment takes precedence over config file
-        val = os.environ.get(var)
-        if val:
-            return val
-        return all_config_vars.get(var, m.group(0))
+    with nmw_timing.phase('config'):
+        config_vars = nmw_config.load(config_path)
 
     needed = ('DATA_PROCESSING_ROOT', 'VAST_REFERENCE_COPY',
               'URL_OF_DATA_PROCESSING_ROOT')
     config = {}
     for var_name in needed:
-        val = os.environ.get(var_name)
-        if not val:
-            val = all_config_vars.get(var_name)
-        if val:
-            val = _expand_shell_vars(val, script_dir)
-            # Resolve cross-references to other config variables
-            # (e.g. $IMAGE_DATA_ROOT defined in the same file)
-            val = re.sub(r'\$\{(\w+)\}|\$(\w+)', expand_var, val)
-        config[var_name] = val
-
+        # Environment takes precedence over config file
+        config[var_name] = (os.environ.get(var_name)
+                            or config_vars.get(var_name) or None)
     return config
 
 
@@ -501,6 +421,7 @@ def send_error_with_log(candidate_id, fastplot_dir, config):
 
 # --- Main CGI Handler ---
 
+@nmw_timing.timed_request('fastplot')
 def main():
     """Main CGI entry point."""
     # Load configuration
@@ -533,7 +454,9 @@ def main():
         return
 
     # Step 2: Check cache
-    cached = check_cache(fastplot_dir, candidate_id)
+    with nmw_timing.phase('cache_check') as counts:
+        cached = check_cache(fastplot_dir, candidate_id)
+        counts['hit'] = int(bool(cached))
     if cached:
         url_base = config.get('URL_OF_DATA_PROCESSING_ROOT', '').rstrip('/')
         # fastplot dir is under DATA_PROCESSING_ROOT, which maps to URL_OF_DATA_PROCESSING_ROOT
@@ -629,7 +552,8 @@ def main():
         # interpolation is safe here.
         cmd = ('nohup "%s" "%s" "%s" > "%s" 2>&1 &'
                % (wrapper_path, safe_url, candidate_id, log_path))
-        os.system(cmd)
+        with nmw_timing.phase('launch'):
+            os.system(cmd)
     except Exception as e:
         send_html(500, "Server Error",
                   "<h2>Server Error</h2>"
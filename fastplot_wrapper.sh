@@ -1,7 +1,8 @@
 #!/usr/bin/env bash
 
 # Fastplot wrapper script
-# Creates a disposable VaST copy, runs fastplot.sh, moves output to serving directory.
+# Checks out a VaST working copy (pooled, see nmw_vast_pool.py, or a disposable
+# rsync copy), runs fastplot.sh, moves output to serving directory.
 # Uses flock for concurrency control (compatible with the CGI's fcntl.flock).
 #
 # Arguments: $1 = candidate URL, $2 = candidate ID
@@ -149,31 +150,50 @@ fi
 
 # --- Create Disposable VaST Copy ---
 
-FASTPLOT_VAST_WORKDIR="$DATA_PROCESSING_ROOT/vast_fastplot_${CANDIDATE_ID}_$$"
-
-echo "Creating disposable VaST copy at $FASTPLOT_VAST_WORKDIR"
-echo "Source: $RESOLVED_VAST_REFERENCE_COPY"
+# A ready copy from the pool of VaST working copies (nmw_vast_pool.py), or,
+# if the pool is off or busy, a fresh rsync copy as autoprocess.sh makes.
+FASTPLOT_VAST_POOLED=0
+FASTPLOT_VAST_WORKDIR=$(python3 "$SCRIPTDIR/nmw_vast_pool.py" checkout "$RESOLVED_VAST_REFERENCE_COPY" "$DATA_PROCESSING_ROOT" $$ 2>/dev/null)
+if [ -n "$FASTPLOT_VAST_WORKDIR" ] && [ -d "$FASTPLOT_VAST_WORKDIR" ]; then
+ FASTPLOT_VAST_POOLED=1
+ echo "Using pooled VaST copy at $FASTPLOT_VAST_WORKDIR"
+else
+ FASTPLOT_VAST_WORKDIR="$DATA_PROCESSING_ROOT/vast_fastplot_${CANDIDATE_ID}_$$"
+
+ echo "Creating disposable VaST copy at $FASTPLOT_VAST_WORKDIR"
+ echo "Source: $RESOLVED_VAST_REFERENCE_COPY"
+
+ # rsync excluding large/unnecessary items (mirroring autoprocess.sh)
+ rsync -a --whole-file --no-times --omit-dir-times \
+  --exclude 'astorb.dat' --exclude 'lib/catalogs' \
+  --exclude 'src' --exclude '.git' --exclude '.github' \
+  "$RESOLVED_VAST_REFERENCE_COPY/" "$FASTPLOT_VAST_WORKDIR"
+ if [ $? -ne 0 ]; then
+  echo "ERROR: rsync failed"
+  rm -rf "$FASTPLOT_VAST_WORKDIR"
+  exit 1
+ fi
 
-# rsync excluding large/unnecessary items (mirroring autoprocess.sh)
-rsync -a --whole-file --no-times --omit-dir-times \
- --exclude 'astorb.dat' --exclude 'lib/catalogs' \
- --exclude 'src' --exclude '.git' --exclude '.github' \
- "$RESOLVED_VAST_REFERENCE_COPY/" "$FASTPLOT_VAST_WORKDIR"
-if [ $? -ne 0 ]; then
- echo "ERROR: rsync failed"
- rm -rf "$FASTPLOT_VAST_WORKDIR"
- exit 1
+ # Create symlinks for large excluded items
+ if [ -f "$RESOLVED_VAST_REFERENCE_COPY/astorb.dat" ]; then
+  ln -s "$RESOLVED_VAST_REFERENCE_COPY/astorb.dat" "$FASTPLOT_VAST_WORKDIR/astorb.dat"
+ fi
+ if [ -d "$RESOLVED_VAST_REFERENCE_COPY/lib/catalogs" ]; then
+  cd "$FASTPLOT_VAST_WORKDIR/lib/" || exit 1
+  ln -s "$RESOLVED_VAST_REFERENCE_COPY/lib/catalogs" .
+  cd "$DATA_PROCESSING_ROOT" || exit 1
+ fi
 fi
 
-# Create symlinks for large excluded items
-if [ -f "$RESOLVED_VAST_REFERENCE_COPY/astorb.dat" ]; then
- ln -s "$RESOLVED_VAST_REFERENCE_COPY/astorb.dat" "$FASTPLOT_VAST_WORKDIR/astorb.dat"
-fi
-if [ -d "$RESOLVED_VAST_REFERENCE_COPY/lib/catalogs" ]; then
- cd "$FASTPLOT_VAST_WORKDIR/lib/" || exit 1
- ln -s "$RESOLVED_VAST_REFERENCE_COPY/lib/catalogs" .
- cd "$DATA_PROCESSING_ROOT" || exit 1
-fi
+# Give the working copy back: a pooled copy is reset and returned to the
+# pool, a disposable one is deleted.
+release_vast_workdir() {
+ if [ "$FASTPLOT_VAST_POOLED" -eq 1 ]; then
+  python3 "$SCRIPTDIR/nmw_vast_pool.py" checkin "$FASTPLOT_VAST_WORKDIR"
+ else
+  rm -rf "$FASTPLOT_VAST_WORKDIR"
+ fi
+}
 
 # --- Run Fastplot ---
 
@@ -187,7 +207,7 @@ echo "fastplot.sh exit code: $FASTPLOT_EXIT_CODE"
 
 if [ $FASTPLOT_EXIT_CODE -ne 0 ]; then
  echo "ERROR: fastplot.sh failed with exit code $FASTPLOT_EXIT_CODE"
- rm -rf "$FASTPLOT_VAST_WORKDIR"
+ release_vast_workdir
  exit 1
 fi
 
@@ -211,7 +231,7 @@ if [ -z "$OUTPUT_ARCHIVE" ] || [ ! -f "$OUTPUT_ARCHIVE" ]; then
  echo "ERROR: Cannot find output archive for candidate $CANDIDATE_ID"
  echo "Expected pattern: $FASTPLOT_VAST_WORKDIR/fastplot__*__${CANDIDATE_ID}.tar.gz (or .tar.bz2)"
  ls -la "$FASTPLOT_VAST_WORKDIR"/fastplot__* 2>/dev/null
- rm -rf "$FASTPLOT_VAST_WORKDIR"
+ release_vast_workdir
  exit 1
 fi
 
@@ -221,14 +241,14 @@ echo "Moving $ARCHIVE_BASENAME to $FASTPLOT_OUTPUT_DIR/"
 mv "$OUTPUT_ARCHIVE" "$FASTPLOT_OUTPUT_DIR/$ARCHIVE_BASENAME"
 if [ $? -ne 0 ]; then
  echo "ERROR: Failed to move archive to output directory"
- rm -rf "$FASTPLOT_VAST_WORKDIR"
+ release_vast_workdir
  exit 1
 fi
 
 # --- Cleanup ---
 
-echo "Removing disposable VaST directory: $FASTPLOT_VAST_WORKDIR"
-rm -rf "$FASTPLOT_VAST_WORKDIR"
+echo "Releasing VaST working copy: $FASTPLOT_VAST_WORKDIR"
+release_vast_workdir
 
 echo "=== Fastplot completed successfully ==="
 echo "Output: $FASTPLOT_OUTPUT_DIR/$ARCHIVE_BASENAME"
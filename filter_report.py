@@ -6,13 +6,14 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 import json
 import os
 import re
-import subprocess
 import sys
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from os.path import splitext
 
 from bs4 import BeautifulSoup
 
+import nmw_date
+
 # CONSTANTS
 # MAX_MAG = 40
 # AST_MAG_DIF_PREDICTED_OBSERVED = 2
@@ -186,71 +187,15 @@ def _url_of_data_processing_root():
     return os.environ.get('URL_OF_DATA_PROCESSING_ROOT') or DEFAULT_URL_OF_DATA_PROCESSING_ROOT
 
 
-def _resolve_get_image_date_binary():
-    # Match the precedence autoprocess.sh uses for VAST_REFERENCE_COPY.
-    candidates = []
-    vrc = os.environ.get('VAST_REFERENCE_COPY')
-    if vrc:
-        candidates.append(os.path.join(vrc, 'util', 'get_image_date'))
-    dpr = os.environ.get('DATA_PROCESSING_ROOT')
-    if dpr:
-        candidates.append(os.path.join(dpr, 'vast', 'util', 'get_image_date'))
-    for path in candidates:
-        if os.path.isfile(path) and os.access(path, os.X_OK):
-            return path
-    # Last resort: PATH lookup.
-    for path_dir in os.environ.get('PATH', '').split(os.pathsep):
-        path = os.path.join(path_dir, 'get_image_date')
-        if os.path.isfile(path) and os.access(path, os.X_OK):
-            return path
-    return None
-
-
-_GET_IMAGE_DATE_BIN = None
-_GET_IMAGE_DATE_BIN_RESOLVED = False
-_GET_IMAGE_DATE_FALLBACK_USED = False
-_JD_TO_ISO_CACHE = {}
-
-
 def _jd_to_iso_utc(jd):
-    """Convert a JD (UTC) to an ISO 8601 string. Uses get_image_date when
-    available, falls back to Python datetime arithmetic. Memoized.
-    Sets a module-level flag the caller can read to emit a single top-level
-    warning rather than spamming per-candidate lists."""
-    global _GET_IMAGE_DATE_BIN, _GET_IMAGE_DATE_BIN_RESOLVED
-    global _GET_IMAGE_DATE_FALLBACK_USED
+    """Convert a JD (UTC) to an ISO 8601 string the way get_image_date's
+    '(mid. exp)' line prints it, or None."""
     if jd is None:
         return None
-    if jd in _JD_TO_ISO_CACHE:
-        return _JD_TO_ISO_CACHE[jd]
-    iso = None
-    if not _GET_IMAGE_DATE_BIN_RESOLVED:
-        _GET_IMAGE_DATE_BIN = _resolve_get_image_date_binary()
-        _GET_IMAGE_DATE_BIN_RESOLVED = True
-    if _GET_IMAGE_DATE_BIN is not None:
-        try:
-            result = subprocess.run(
-                [_GET_IMAGE_DATE_BIN, '{:.8f}'.format(jd)],
-                capture_output=True, text=True, timeout=10, check=False)
-            for line in result.stdout.splitlines():
-                # Looking for: " (mid. exp) 2026-05-09T23:04:14.000"
-                m = re.search(r'\(mid\. exp\)\s+(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})', line)
-                if m:
-                    iso = m.group(1) + 'Z'
-                    break
-        except (OSError, subprocess.SubprocessError):
-            pass
-    if iso is None:
-        # Python fallback. JD 2440587.5 == 1970-01-01 00:00 UTC.
-        _GET_IMAGE_DATE_FALLBACK_USED = True
-        try:
-            unix_seconds = (jd - 2440587.5) * 86400.0
-            dt = datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=unix_seconds)
-            iso = dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-        except (TypeError, ValueError):
-            iso = None
-    _JD_TO_ISO_CACHE[jd] = iso
-    return iso
+    try:
+        return nmw_date.iso_utc(jd) + 'Z'
+    except (TypeError, ValueError, OverflowError):
+        return None
 
 
 def _absolutize_url(rel_or_abs, base_url):
@@ -770,7 +715,6 @@ def filter_report(path_to_report):
                 "session": session_meta,
                 "totals": {"total": 0, "new": 0, "known_asteroid": 0, "known_variable": 0, "known_transient": 0},
                 "candidates": [],
-                "parse_warnings": [],
             })
             return
 
@@ -851,11 +795,6 @@ def filter_report(path_to_report):
         with open(output_html_path, 'w') as f:
             f.write(output)
 
-        top_warnings = []
-        if _GET_IMAGE_DATE_FALLBACK_USED:
-            top_warnings.append(
-                'date: VAST get_image_date binary not found or unusable, '
-                'used Python datetime fallback for ISO 8601 conversion')
         _write_json(output_json_path, {
             "schema_version": JSON_SCHEMA_VERSION,
             "generated_at_utc": _now_utc_iso(),
@@ -870,7 +809,6 @@ def filter_report(path_to_report):
                 "known_transient": known_transient_count,
             },
             "candidates": candidates_json,
-            "parse_warnings": top_warnings,
         })
     except Exception as e:
         print("Error in filter_report: {}".format(e))
@@ -894,7 +832,6 @@ def filter_report(path_to_report):
                 "session": session_meta,
                 "error": str(e),
                 "candidates": [],
-                "parse_warnings": [],
             })
         except Exception as e2:
             print('An error occurred while writing the error JSON: {}'.format(e2))
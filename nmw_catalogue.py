@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Pre-built "All reference images" catalogue page for coord_search.py.
+
+The list_all view used to be generated live by the CGI: up to
+LIST_ALL_MAX_FILES metadata lookups and two fits2png renders per reference
+image, for up to 15 minutes, holding one of the two coord_search
+concurrency slots. This builder writes the same table once, as a static
+page with its previews, into uploads/reference_catalogue/, and on later
+runs only re-renders the rows whose reference FITS file changed (size or
+mtime), dropping rows and PNGs of references that disappeared.
+
+The CGI's list_all action redirects to the static page without taking a
+concurrency slot. When the page is missing or out of date with
+$REFERENCE_IMAGES it starts this builder in the background
+(start_background_build); a lock file keeps builds from overlapping.
+
+Command-line use (run from the directory holding local_config.sh, e.g. from
+cron after new reference images are added):
+  python3 nmw_catalogue.py            (re)build uploads/reference_catalogue/
+"""
+
+import warnings
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import nmw_coord_lib as ncl
+from nmw_coord_lib import (
+    html_escape, _PAGE_CSS, field_name_from_fits, render_thumbnail_link,
+    render_image_size, render_mean_scale,
+)
+
+
+CATALOGUE_SUBDIR = 'reference_catalogue'
+PAGE_NAME = 'index.html'
+STATE_NAME = 'catalogue.json'
+BUILD_LOCK_NAME = 'catalogue.lock'
+STATE_VERSION = 1
+PAGE_TITLE = 'All reference images'
+
+
+def catalogue_dir():
+    """Directory of the static page, relative to the script directory."""
+    return os.path.join(ncl.TEMP_PARENT, CATALOGUE_SUBDIR)
+
+
+def page_url(url_prefix):
+    """URL of the static catalogue page under URL_OF_DATA_PROCESSING_ROOT."""
+    return '{}/{}/{}'.format(url_prefix, CATALOGUE_SUBDIR, PAGE_NAME)
+
+
+def load_state():
+    """The builder's record of the last build, or None if there is none."""
+    try:
+        with open(os.path.join(catalogue_dir(), STATE_NAME)) as fh:
+            state = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+        return None
+    return state
+
+
+def _ref_stats(ref_dir):
+    stats = {}
+    for path in ncl.list_fits_files(ref_dir):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats[path] = [st.st_size, st.st_mtime]
+    return stats
+
+
+def is_stale(state, ref_dir, thumb_pixels):
+    """True if the catalogue described by state does not match the files
+    in ref_dir (added, removed or changed references) or thumb_pixels."""
+    if state is None or state.get('thumb_pixels') != thumb_pixels:
+        return True
+    if state.get('ref_dir') != os.path.abspath(ref_dir):
+        return True
+    recorded = {p: e['stat'] for p, e in state.get('rows', {}).items()}
+    return recorded != _ref_stats(ref_dir)
+
+
+def listall_row_html(r, url_prefix, sub):
+    """One <tr> of the catalogue table."""
+    base = os.path.basename(r['path'])
+    field = field_name_from_fits(r['path'])
+    size_html = render_image_size(
+        r['arcmin_str'], r['deg_str'], r['nx'], r['ny'])
+    scale_html, _ = render_mean_scale(r['scale_x'], r['scale_y'])
+    center_radec = r.get('center_radec') or '-'
+    zo_cell = render_thumbnail_link(
+        r.get('png_zoomout'), r.get('png_zoomout_hires'),
+        'zoom-out', base, url_prefix, sub)
+    return ("<tr>"
+            "<td><b>{f}</b></td>"
+            "<td title='{full}'>{base}</td>"
+            "<td>{cr}</td>"
+            "<td>{s}</td>"
+            "<td>{sc}</td>"
+            "<td>{zo}</td>"
+            "</tr>".format(
+                f=html_escape(field),
+                full=html_escape(r['path']),
+                base=html_escape(base),
+                cr=html_escape(center_radec),
+                s=size_html, sc=scale_html, zo=zo_cell))
+
+
+def _render_entry(path, vast_dir, out_dir, thumb_pixels, hires_pixels):
+    """Metadata plus preview and hi-res zoom-out PNGs for one reference, or
+    None if it has no usable metadata. Each call owns one FITS file, so the
+    two renders (both writing '<basename>.png' before the rename) cannot
+    collide with other threads."""
+    meta = ncl.get_image_metadata(path, vast_dir)
+    if meta is None:
+        return None
+    nx, ny = meta['nx'], meta['ny']
+    image = ncl.open_thumbnail_image(path)
+    return {
+        'path': path,
+        'nx': nx, 'ny': ny,
+        'arcmin_str': meta['arcmin_str'],
+        'deg_str': meta['deg_str'],
+        'scale_x': meta['scale_x'],
+        'scale_y': meta['scale_y'],
+        'center_radec': meta['center_radec'],
+        'png_zoomout': ncl.make_zoomout_thumbnail(
+            path, None, None, nx, ny, out_dir, vast_dir, thumb_pixels,
+            suffix='zoomout', image=image),
+        'png_zoomout_hires': ncl.make_zoomout_thumbnail(
+            path, None, None, nx, ny, out_dir, vast_dir, hires_pixels,
+            suffix='zoomout_hires', image=image),
+    }
+
+
+def _write_atomic(path, text):
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'w') as fh:
+        fh.write(text)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def write_page(out_dir, rows, ref_dir):
+    """Write the static catalogue page for the given row dicts."""
+    rows = sorted(rows, key=lambda r: (field_name_from_fits(r['path']),
+                                       r['path']))
+    parts = [
+        "<html><head><title>{}</title>".format(html_escape(PAGE_TITLE)),
+        _PAGE_CSS,
+        "</head><body>",
+        "<h2>{}</h2>".format(html_escape(PAGE_TITLE)),
+        "<p>{} reference image(s) from <span class='code'>{}</span>; "
+        "catalogue updated {} UTC.</p>".format(
+            len(rows), html_escape(ref_dir),
+            time.strftime('%Y-%m-%d %H:%M', time.gmtime())),
+    ]
+    if rows:
+        parts.append("<table class='main'>")
+        parts.append("<tr><th>Field</th><th>Reference image</th>"
+                     "<th>Image center (J2000)</th>"
+                     "<th>Image size</th>"
+                     "<th>Scale (&quot;/pix)</th>"
+                     "<th>Zoom-out</th></tr>")
+        # PNGs sit next to the page: '../<subdir>/<png>' works whatever
+        # URL the uploads/ directory is served under.
+        parts.extend(listall_row_html(r, '..', CATALOGUE_SUBDIR)
+                     for r in rows)
+        parts.append("</table>")
+    else:
+        parts.append("<p>No WCS-calibrated reference images found.</p>")
+    parts.append("<br><br><a href='{}'>Search again</a>".format(
+        html_escape(ncl.DEFAULT_FORM_PATH)))
+    parts.append("</body></html>")
+    _write_atomic(os.path.join(out_dir, PAGE_NAME), '\n'.join(parts) + '\n')
+
+
+def build(ref_dir, vast_dir, thumb_pixels, workers=ncl.DEFAULT_PARALLEL_WORKERS):
+    """(Re)build the catalogue incrementally.
+
+    Returns (n_rows, n_rendered, n_removed), or None if another build holds
+    the lock. Raises OSError if the output directory cannot be written.
+    """
+    out_dir = catalogue_dir()
+    os.makedirs(out_dir, mode=0o755, exist_ok=True)
+    lock = open(ncl.cache_path(BUILD_LOCK_NAME), 'w')
+    try:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return None
+        hires_pixels = min(ncl.MAX_THUMBNAIL_PIXELS,
+                           thumb_pixels * ncl.HIRES_THUMBNAIL_MULTIPLIER)
+        state = load_state() or {}
+        old_rows = state.get('rows', {})
+        if state.get('thumb_pixels') != thumb_pixels:
+            old_rows = {}
+        stats = _ref_stats(ref_dir)
+        keep = {}
+        todo = []
+        for path, stat in stats.items():
+            entry = old_rows.get(path)
+            if entry is not None and entry['stat'] == stat and all(
+                    os.path.isfile(os.path.join(out_dir, png))
+                    for png in (entry['row'].get('png_zoomout'),
+                                entry['row'].get('png_zoomout_hires'))
+                    if png):
+                keep[path] = entry
+            else:
+                todo.append(path)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            rendered = list(ex.map(
+                lambda p: _render_entry(p, vast_dir, os.path.abspath(out_dir),
+                                        thumb_pixels, hires_pixels), todo))
+        for path, row in zip(todo, rendered):
+            # References without metadata are recorded too (row None), so
+            # they are not retried until the file changes.
+            keep[path] = {'stat': stats[path], 'row': row}
+        # Delete the PNGs no row refers to any more.
+        wanted = set(png for e in keep.values() if e['row']
+                     for png in (e['row'].get('png_zoomout'),
+                                 e['row'].get('png_zoomout_hires')) if png)
+        removed = 0
+        for name in os.listdir(out_dir):
+            if name.endswith('.png') and name not in wanted:
+                try:
+                    os.unlink(os.path.join(out_dir, name))
+                    removed += 1
+                except OSError:
+                    pass
+        rows = [e['row'] for e in keep.values() if e['row']]
+        write_page(out_dir, rows, ref_dir)
+        _write_atomic(os.path.join(out_dir, STATE_NAME), json.dumps({
+            'version': STATE_VERSION,
+            'ref_dir': os.path.abspath(ref_dir),
+            'thumb_pixels': thumb_pixels,
+            'rows': keep,
+        }))
+        return len(rows), len(todo), removed
+    finally:
+        lock.close()
+
+
+def start_background_build():
+    """Start `python3 nmw_catalogue.py` detached from the calling CGI.
+
+    Its output goes to uploads/coord_cache/catalogue_build.log. Returns
+    False if it could not be started.
+    """
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          'nmw_catalogue.py')
+    env = {k: v for k, v in os.environ.items()
+           if k not in ('REQUEST_METHOD', 'GATEWAY_INTERFACE')}
+    try:
+        with open(ncl.cache_path('catalogue_build.log'), 'a') as log:
+            subprocess.Popen([sys.executable, script], stdin=subprocess.DEVNULL,
+                             stdout=log, stderr=log, env=env,
+                             start_new_session=True, close_fds=True)
+    except OSError:
+        return False
+    return True
+
+
+def _config_int(raw, default, lo, hi):
+    try:
+        value = int(raw.strip()) if raw.strip() else default
+    except ValueError:
+        return default
+    return value if lo <= value <= hi else default
+
+
+def thumbnail_pixels_from_config(cfg):
+    """In-page thumbnail size from COORD_SEARCH_THUMBNAIL_PIXELS, validated
+    the same way coord_search.py does."""
+    return _config_int(cfg.get('COORD_SEARCH_THUMBNAIL_PIXELS', ''),
+                       ncl.DEFAULT_THUMBNAIL_PIXELS,
+                       ncl.MIN_THUMBNAIL_PIXELS, ncl.MAX_THUMBNAIL_PIXELS)
+
+
+# ---------- command line ----------
+
+def main(argv):
+    if len(argv) != 1:
+        print('Usage: `python3 nmw_catalogue.py` to (re)build the reference '
+              'image catalogue page in {}'.format(catalogue_dir()))
+        return 1
+    # Same cwd convention as the CGIs: local_config.sh and uploads/ live
+    # next to this script.
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    cfg = ncl.read_config_vars(
+        'REFERENCE_IMAGES', 'VAST_REFERENCE_COPY',
+        'COORD_SEARCH_THUMBNAIL_PIXELS', 'COORD_SEARCH_PARALLEL_WORKERS',
+        'COORD_THUMBNAIL_CACHE_MB', 'COORD_THUMBNAIL_RENDERER',
+        'COORD_RENDER_BUDGET')
+    ref_dir = cfg['REFERENCE_IMAGES'].strip()
+    vast_dir = cfg['VAST_REFERENCE_COPY'].strip()
+    if not os.path.isdir(ref_dir) or not os.path.isdir(vast_dir):
+        print('ERROR: REFERENCE_IMAGES or VAST_REFERENCE_COPY is not a '
+              'directory (check local_config.sh)', file=sys.stderr)
+        return 1
+    ncl.THUMB_CACHE_MAX_MB = ncl.thumb_cache_budget_mb(
+        cfg['COORD_THUMBNAIL_CACHE_MB'])
+    ncl.THUMBNAIL_RENDERER = ncl.thumbnail_renderer(
+        cfg['COORD_THUMBNAIL_RENDERER'])
+    ncl.RENDER_BUDGET = ncl.render_budget(cfg['COORD_RENDER_BUDGET'])
+    workers = _config_int(cfg['COORD_SEARCH_PARALLEL_WORKERS'],
+                          ncl.DEFAULT_PARALLEL_WORKERS,
+                          ncl.MIN_PARALLEL_WORKERS, ncl.MAX_PARALLEL_WORKERS)
+    start = time.time()
+    result = build(ref_dir, vast_dir, thumbnail_pixels_from_config(cfg),
+                   workers)
+    if result is None:
+        print('Catalogue build already running, nothing to do.')
+        return 0
+    print('Reference catalogue: {} rows, {} references (re)rendered, {} '
+          'stale PNGs removed; {:.1f} s'.format(
+              result[0], result[1], result[2], time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    if 'REQUEST_METHOD' in os.environ:
+        print("This script cannot be run via a web request.", file=sys.stderr)
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Cached snapshot of the variables set by local_config.sh.
+
+local_config.sh is a bash script (values refer to each other and to the
+environment, e.g. URL_OF_DATA_PROCESSING_ROOT uses $UNMW_FREE_PORT), so
+only bash can evaluate it. Instead of sourcing it on every request, load()
+sources it once with 'set -a' and keeps every resulting variable in a
+JSON snapshot, keyed by the inode, size and mtime of the file and by the
+environment it was sourced in. Later calls in any process only stat the
+file and read the snapshot; a changed file is re-sourced and the snapshot
+replaced atomically.
+
+Request-specific CGI variables (QUERY_STRING, HTTP_*, ...) are removed
+from the environment bash sees, so every request of a server shares one
+snapshot. The snapshot lives in SNAPSHOT_DIR, outside the web-served
+uploads/ tree, readable only by its owner; one that is a symlink, owned by
+someone else or readable by others is ignored and never written through.
+
+Command-line use:
+  python3 nmw_config.py [NAME ...]    print the variables (all, or NAME ...)
+"""
+
+import hashlib
+import json
+import os
+import stat
+import subprocess
+import sys
+
+
+CONFIG_PATH = 'local_config.sh'      # relative to the caller's cwd
+SNAPSHOT_DIR = '/tmp'                # same place as the concurrency locks
+SOURCE_TIMEOUT_SECONDS = 10
+
+# Environment variables set per request by the web server (RFC 3875 and
+# common extensions); they must not leak into, or split, the snapshot.
+_CGI_VARS = ('AUTH_TYPE', 'CONTENT_LENGTH', 'CONTENT_TYPE', 'DOCUMENT_ROOT',
+             'GATEWAY_INTERFACE', 'PATH_INFO', 'PATH_TRANSLATED',
+             'QUERY_STRING', 'UNIQUE_ID')
+_CGI_PREFIXES = ('HTTP_', 'REMOTE_', 'REQUEST_', 'SERVER_', 'SCRIPT_',
+                 'CONTEXT_', 'SSL_', 'REDIRECT_')
+# Set by bash itself, different on every run.
+_BASH_VARS = ('_', 'SHLVL', 'OLDPWD')
+
+_memo = {}                           # abs config path -> (key, values)
+
+
+def _source_environment():
+    return {k: v for k, v in os.environ.items()
+            if k not in _CGI_VARS and not k.startswith(_CGI_PREFIXES)}
+
+
+def _snapshot_key(config_path, env):
+    """Identity of the file version and environment, or None if the file
+    cannot be stat'ed."""
+    try:
+        st = os.stat(config_path)
+    except OSError:
+        return None
+    env_hash = hashlib.sha256(
+        json.dumps(sorted(env.items())).encode('utf-8')).hexdigest()
+    return [st.st_ino, st.st_size, st.st_mtime_ns, env_hash]
+
+
+def _snapshot_path(config_path):
+    ident = hashlib.sha256(config_path.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(SNAPSHOT_DIR, 'unmw_config_{}_{}.json'.format(
+        os.getuid(), ident))
+
+
+def source_config(config_path, env):
+    """Source config_path in bash (cwd = its directory) and return all
+    variables set afterwards, or None if sourcing fails."""
+    try:
+        result = subprocess.run(
+            ['bash', '-c', 'set -a; source "$0" >/dev/null || exit 1; env -0',
+             config_path],
+            cwd=os.path.dirname(config_path), env=env, capture_output=True,
+            timeout=SOURCE_TIMEOUT_SECONDS)
+    except (subprocess.TimeoutExpired, OSError):
+        return None
+    if result.returncode != 0:
+        return None
+    values = {}
+    for item in result.stdout.decode('utf-8', 'replace').split('\0'):
+        name, sep, value = item.partition('=')
+        if sep and name not in _BASH_VARS:
+            values[name] = value
+    return values
+
+
+def _write_snapshot(path, key, values):
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    try:
+        os.unlink(tmp)               # left over by a killed process
+    except OSError:
+        pass
+    # O_EXCL | O_NOFOLLOW: SNAPSHOT_DIR is shared with other local users,
+    # who must not be able to plant the file or a symlink in its place.
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+                 0o600)
+    with os.fdopen(fd, 'w') as fh:
+        json.dump({'key': key, 'values': values}, fh)
+    os.replace(tmp, path)
+
+
+def _read_snapshot(path):
+    """The snapshot dict in path, or None unless it is a regular file owned
+    by this user and not accessible to anyone else."""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    with os.fdopen(fd) as fh:
+        st = os.fstat(fh.fileno())
+        if (not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid()
+                or st.st_mode & 0o077):
+            return None
+        try:
+            return json.load(fh)
+        except ValueError:
+            return None
+
+
+def load(config_path=None):
+    """All variables local_config.sh sets (plus the inherited environment),
+    as a dict of strings; {} if the file is missing or fails to source."""
+    config_path = os.path.abspath(config_path or CONFIG_PATH)
+    env = _source_environment()
+    key = _snapshot_key(config_path, env)
+    if key is None:
+        return {}
+    memo = _memo.get(config_path)
+    if memo is not None and memo[0] == key:
+        return memo[1]
+    snapshot_path = _snapshot_path(config_path)
+    snapshot = _read_snapshot(snapshot_path)
+    try:
+        if snapshot.get('key') == key:
+            _memo[config_path] = (key, snapshot['values'])
+            return snapshot['values']
+    except (AttributeError, KeyError):
+        pass
+    values = source_config(config_path, env)
+    if values is None:
+        return {}
+    try:
+        _write_snapshot(snapshot_path, key, values)
+    except OSError:
+        pass                         # still correct, just not cached
+    _memo[config_path] = (key, values)
+    return values
+
+
+def read_vars(*var_names, config_path=None):
+    """Dict of the named variables; missing ones come back as ''."""
+    values = load(config_path)
+    return {name: values.get(name, '') for name in var_names}
+
+
+if __name__ == '__main__':
+    all_values = load()
+    for name in sys.argv[1:] or sorted(all_values):
+        print('{}={}'.format(name, all_values.get(name, '')))
@@ -16,11 +16,19 @@ import html
 import os
 import random
 import re
+import signal
+import sqlite3
 import string
 import subprocess
 import sys
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import nmw_config
+import nmw_fits
+import nmw_timing
 
 
 # Code-level operational constants (not deployment-specific).
@@ -28,22 +36,43 @@ MAX_CONCURRENT = 2
 SCAN_TIMEOUT_SECONDS = 90
 FITS2PNG_TIMEOUT_SECONDS = 30
 FOV_TIMEOUT_SECONDS = 30
+OFF_FRAME_MARGIN_PIX = 32.0          # header-WCS precheck tolerance before an
+                                     # image is declared not to contain a target
 LOCK_DIR = '/tmp'
 TEMP_PARENT = 'uploads'              # mirrors upload.py's upload_dir
 TEMP_DIR_PREFIX = 'coord_search_'
+CACHE_DIR = os.path.join(TEMP_PARENT, 'coord_cache')  # persistent, shared by all requests
 DEFAULT_THUMBNAIL_PIXELS = 256       # fallback for in-page thumbnail size
 HIRES_THUMBNAIL_MULTIPLIER = 4       # click-through PNG is this many times
                                      # bigger than the in-page thumbnail
 MIN_THUMBNAIL_PIXELS = 32
 MAX_THUMBNAIL_PIXELS = 4096
 MAX_RESULTS_TO_PROCESS = 200         # safety cap on coord-search matches
-LIST_ALL_MAX_FILES = 2000            # safety cap on the "show all" listing
-LIST_ALL_TIMEOUT_SECONDS = 900       # wall-clock cap for the "show all" flow (15 min)
+MAX_BATCH_POSITIONS = 50             # safety cap on positions per batch search
 DEFAULT_FORM_PATH = '/unmw/coord_search.html'
 DEFAULT_ZOOMIN_PIXELS = 200          # half-width of zoom-in thumbnail in source pix
 DEFAULT_PARALLEL_WORKERS = 16        # threads rendering PNGs concurrently
+THUMB_CACHE_MAX_MB = 2048            # thumbnail cache budget; the CGIs set it
+                                     # from COORD_THUMBNAIL_CACHE_MB (0 = off)
+THUMBNAIL_RENDERER = 'pgfv'          # 'pgfv' tools or in-process 'numpy'; the
+                                     # CGIs set it from COORD_THUMBNAIL_RENDERER
 MIN_PARALLEL_WORKERS = 1
 MAX_PARALLEL_WORKERS = 32
+ADAPTIVE_MIN_WORKERS = 2             # pool size floor on a fully loaded server
+RENDER_BUDGET = None                 # thumbnail renderers running at once on
+                                     # the whole server; the CGIs set it from
+                                     # COORD_RENDER_BUDGET (None = one per CPU,
+                                     # 0 = no limit)
+RENDER_TOKEN_POLL_SECONDS = 0.05
+RENDER_TOKEN_WAIT_SECONDS = 60       # then render without a token
+QUEUE_MAX_DEPTH = 20                 # requests allowed to wait for a slot; the
+                                     # CGIs set it from COORD_QUEUE_MAX_DEPTH
+QUEUE_MAX_WAIT_SECONDS = 120         # longest wait for a slot; the CGIs set it
+                                     # from COORD_QUEUE_MAX_WAIT_SECONDS
+QUEUE_POLL_SECONDS = 0.25
+QUEUE_NOTICE_SECONDS = 10            # repeat the queue position this often
+QUEUE_DEFAULT_SERVICE_SECONDS = 20   # assumed slot hold time before any is timed
+QUEUE_SERVICE_EMA_WEIGHT = 0.2       # weight of the newest hold time
 
 # Whitelist of characters allowed in the raw coordinate string.
 # Defends every later subprocess that takes the parsed values.
@@ -97,13 +126,19 @@ def back_link_url():
 def form_page_url():
     """Absolute URL of the input form page, derived from the current request.
 
-    Mirrors the request's scheme and host:port so the redirect lands on the
-    same deployment, e.g. a request to
+    Mirrors the request's scheme and host:port (site_url) so the redirect
+    lands on the same deployment, e.g. a request to
       http://scan.sai.msu.ru:8889/cgi-bin/unmw/coord_search.py
     redirects to
       http://scan.sai.msu.ru:8889/unmw/coord_search.html
     and likewise for the :8888 and the https://tau.kirx.net deployments.
-    Falls back to the bare path (DEFAULT_FORM_PATH) when the request
+    """
+    return site_url(DEFAULT_FORM_PATH)
+
+
+def site_url(path):
+    """Absolute URL of path (starting with '/') on the scheme and host:port
+    of the current request. Falls back to the bare path when the request
     environment does not identify the host.
     """
     # Scheme: HTTPS is "on"/"1" behind TLS; some servers set REQUEST_SCHEME.
@@ -124,8 +159,27 @@ def form_page_url():
             else:
                 host = name
     if not host:
-        return DEFAULT_FORM_PATH
-    return '{}://{}{}'.format(scheme, host, DEFAULT_FORM_PATH)
+        return path
+    return '{}://{}{}'.format(scheme, host, path)
+
+
+_headers_sent = False
+
+
+def emit_headers(content_type='text/html', status_line=None):
+    """Print the CGI header block, once per request.
+
+    Later calls print nothing, so a page can follow the admission-queue
+    notices (emit_queue_notice) that were streamed while the request
+    waited for a slot; the status line is lost in that case.
+    """
+    global _headers_sent
+    if _headers_sent:
+        return
+    _headers_sent = True
+    if status_line:
+        print(status_line)
+    print("Content-Type: {}\n".format(content_type), flush=True)
 
 
 def emit_redirect(url):
@@ -141,9 +195,7 @@ def emit_redirect(url):
 
 
 def emit_message_page(title, body_html, status_line=None):
-    if status_line:
-        print(status_line)
-    print("Content-Type: text/html\n")
+    emit_headers(status_line=status_line)
     print("<html><head><title>{}</title>".format(html_escape(title)))
     print(_PAGE_CSS)
     print("</head><body>")
@@ -205,48 +257,124 @@ def parse_coordinates(raw):
         "6 space-tokens, or 2 decimal-degree tokens)")
 
 
+def parse_position_list(text, max_positions=MAX_BATCH_POSITIONS):
+    """Parse a list of positions for a batch search, one per line.
+
+    Each line takes any format accepted by parse_coordinates(); blank lines
+    and lines starting with '#' are skipped. Returns (positions, errors):
+    positions is a list of (line, ra, dec) for the valid lines, errors a
+    list of (line_number, line, message) for the others. Raises ValueError
+    if more than max_positions lines hold a position.
+    """
+    positions = []
+    errors = []
+    for number, line in enumerate((text or '').splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if len(positions) + len(errors) >= max_positions:
+            raise ValueError(
+                "more than {} positions in the list".format(max_positions))
+        try:
+            ra, dec = parse_coordinates(line)
+            radec_to_degrees(ra, dec)
+        except ValueError as err:
+            errors.append((number, line, str(err)))
+            continue
+        positions.append((line, ra, dec))
+    return positions, errors
+
+
+def radec_to_degrees(ra, dec):
+    """Convert the (ra, dec) strings from parse_coordinates() to degrees.
+
+    Sexagesimal R.A. is in hours ('HH:MM:SS.ss'), decimal R.A. is in degrees,
+    matching what sky2xy accepts. Returns (ra_deg, dec_deg) as floats.
+    Raises ValueError on any problem.
+    """
+    def _sexagesimal(token):
+        sign = -1.0 if token.startswith('-') else 1.0
+        parts = token.lstrip('+-').split(':')
+        if len(parts) != 3:
+            raise ValueError("invalid sexagesimal token: {!r}".format(token))
+        a, m, s = (float(p) for p in parts)
+        return sign * (a + m / 60.0 + s / 3600.0)
+
+    if ':' in ra:
+        ra_deg = _sexagesimal(ra) * 15.0
+    else:
+        ra_deg = float(ra)
+    if ':' in dec:
+        dec_deg = _sexagesimal(dec)
+    else:
+        dec_deg = float(dec)
+    if not (0.0 <= ra_deg < 360.0) or not (-90.0 <= dec_deg <= 90.0):
+        raise ValueError("coordinates out of range")
+    return ra_deg, dec_deg
+
+
 # ---------- config loading ----------
 
 def read_config_vars(*var_names):
-    """Source local_config.sh in bash and return a dict of variable values.
+    """Return a dict of local_config.sh variable values.
 
     Values that contain shell expansion (e.g. URL_OF_DATA_PROCESSING_ROOT
     referencing $UNMW_FREE_PORT) require real bash sourcing rather than
-    a Python-side parser.
+    a Python-side parser; nmw_config sources the file once per version
+    and serves later requests from its snapshot.
 
     Missing variables come back as empty strings.
     """
-    sep = '\x1f'  # ASCII Unit Separator: cannot legitimately appear in values
-    parts = ['source ./local_config.sh']
-    for name in var_names:
-        # ${name-} expands to "" when name is unset, with no warning.
-        parts.append('printf "%s{sep}" "${{{name}-}}"'.format(name=name, sep=sep))
-    cmd = ' && '.join(parts)
-    try:
-        result = subprocess.run(
-            ['bash', '-c', cmd],
-            capture_output=True, text=True, timeout=10
-        )
-    except (subprocess.TimeoutExpired, OSError):
-        return {n: '' for n in var_names}
-    if result.returncode != 0:
-        return {n: '' for n in var_names}
-    chunks = result.stdout.split(sep)
-    chunks = chunks[:len(var_names)]
-    while len(chunks) < len(var_names):
-        chunks.append('')
-    return dict(zip(var_names, chunks))
+    with nmw_timing.phase('config'):
+        return nmw_config.read_vars(*var_names)
+
+
+# ---------- persistent caches ----------
+
+def cache_path(name):
+    """Return the path of a file inside CACHE_DIR, creating the directory.
+
+    CACHE_DIR is relative to the CGI's cwd (the script directory), like
+    TEMP_PARENT. Raises OSError if the directory cannot be created.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR, mode=0o755, exist_ok=True)
+    return os.path.join(CACHE_DIR, name)
 
 
 # ---------- concurrency limit ----------
 
+class ConcurrencySlot:
+    """A held slot lock. close() releases it and records how long it was
+    held, the service time behind the admission queue's wait estimate."""
+
+    def __init__(self, fd, prefix):
+        self._fd = fd
+        self._prefix = prefix
+        self._start = time.time()
+
+    def fileno(self):
+        return self._fd.fileno()
+
+    def close(self):
+        if self._fd is None:
+            return
+        self._fd.close()
+        self._fd = None
+        try:
+            _record_service_time(self._prefix, time.time() - self._start)
+        except OSError:
+            pass
+
+
 def acquire_concurrency_slot(prefix='coord_search', max_concurrent=MAX_CONCURRENT):
     """Try to acquire one of max_concurrent exclusive flock slots.
 
     Lock files are named '<prefix>_slot_<i>.lock' so different pages can use
-    independent slot pools. Returns the open file object on success (caller
-    must keep it alive until the end of the request), or None when no slot
-    is free.
+    independent slot pools. Returns a ConcurrencySlot on success (caller
+    must keep it alive until the end of the request, then close it), or
+    None when no slot is free. Requests that should wait for a slot go
+    through wait_for_concurrency_slot instead.
     """
     for i in range(1, max_concurrent + 1):
         path = os.path.join(LOCK_DIR, '{}_slot_{}.lock'.format(prefix, i))
@@ -256,77 +384,478 @@ def acquire_concurrency_slot(prefix='coord_search', max_concurrent=MAX_CONCURREN
             continue
         try:
             fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            return fd
+            return ConcurrencySlot(fd, prefix)
         except OSError:
             fd.close()
             continue
     return None
 
 
+# ---------- admission queue ----------
+#
+# Requests that find every slot busy wait in a first-come, first-served
+# queue kept next to the slot locks in LOCK_DIR:
+#   <prefix>_queue.lock            serialises the queue; holds the last
+#                                  ticket number handed out
+#   <prefix>_ticket_<n>.lock       one per waiting request, flock'ed by it
+#                                  for as long as it waits
+#   <prefix>_queue.stats           moving average of the slot hold time
+# Only the oldest live ticket may take a free slot. A ticket file that can
+# be flock'ed belongs to a request that died while waiting and is removed.
+
+def _queue_file(prefix, suffix):
+    return os.path.join(LOCK_DIR, '{}_{}'.format(prefix, suffix))
+
+
+def _locked_queue(prefix):
+    """Open and flock the queue lock file of prefix. Raises OSError."""
+    fh = open(_queue_file(prefix, 'queue.lock'), 'a+')
+    fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+    return fh
+
+
+def _take_ticket(prefix):
+    """Next ticket number and its held ticket file. Raises OSError."""
+    with _locked_queue(prefix) as queue:
+        queue.seek(0)
+        try:
+            ticket = int(queue.read().strip() or 0) + 1
+        except ValueError:
+            ticket = 1
+        queue.seek(0)
+        queue.truncate()
+        queue.write(str(ticket))
+        queue.flush()
+        fh = open(_queue_file(prefix, 'ticket_{:012d}.lock'.format(ticket)), 'w')
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return ticket, fh
+
+
+def _drop_ticket(prefix, ticket, fh):
+    with _locked_queue(prefix):
+        try:
+            os.unlink(_queue_file(prefix, 'ticket_{:012d}.lock'.format(ticket)))
+        except OSError:
+            pass
+        fh.close()
+
+
+def queue_position(prefix, ticket):
+    """Number of live tickets of prefix older than ticket (0 = first in
+    line); tickets of dead waiters are removed. Raises OSError."""
+    ticket_re = re.compile(r'^{}_ticket_(\d+)\.lock$'.format(re.escape(prefix)))
+    ahead = 0
+    with _locked_queue(prefix):
+        for name in os.listdir(LOCK_DIR):
+            m = ticket_re.match(name)
+            if not m or int(m.group(1)) >= ticket:
+                continue
+            path = os.path.join(LOCK_DIR, name)
+            try:
+                fh = open(path, 'r')
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                ahead += 1               # its request is still waiting
+            else:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            finally:
+                fh.close()
+    return ahead
+
+
+def _record_service_time(prefix, seconds):
+    """Fold one slot hold time into <prefix>_queue.stats. Raises OSError."""
+    with _locked_queue(prefix):
+        average = service_time(prefix)
+        average += QUEUE_SERVICE_EMA_WEIGHT * (seconds - average)
+        with open(_queue_file(prefix, 'queue.stats'), 'w') as fh:
+            fh.write('{:.3f}\n'.format(average))
+
+
+def service_time(prefix):
+    """Moving average of how long a request holds a slot of prefix."""
+    try:
+        with open(_queue_file(prefix, 'queue.stats')) as fh:
+            return max(0.0, float(fh.read().strip()))
+    except (OSError, ValueError):
+        return float(QUEUE_DEFAULT_SERVICE_SECONDS)
+
+
+def estimated_wait(prefix, position, max_concurrent):
+    """Rough wait in seconds of the request at queue position (1 = next):
+    position slot releases, one every service_time / max_concurrent."""
+    return position * service_time(prefix) / max(1, max_concurrent)
+
+
+def wait_for_concurrency_slot(prefix='coord_search', max_concurrent=MAX_CONCURRENT,
+                              max_depth=None, max_wait=None, progress=None):
+    """acquire_concurrency_slot() behind the first-come, first-served queue.
+
+    max_depth and max_wait default to QUEUE_MAX_DEPTH and
+    QUEUE_MAX_WAIT_SECONDS. progress(position, estimated_wait_seconds),
+    if given, is called whenever the request has to wait: when its
+    position changes and every QUEUE_NOTICE_SECONDS (position 1 = next in
+    line). Returns (slot, None), or (None, reason) with reason 'full' if
+    max_depth requests were already waiting and 'timeout' after max_wait
+    seconds.
+    """
+    with nmw_timing.phase('slot_wait') as counts:
+        slot, reason = _wait_for_slot(prefix, max_concurrent, max_depth,
+                                      max_wait, progress, counts)
+        counts['outcome'] = reason or 'ok'
+    return slot, reason
+
+
+def _wait_for_slot(prefix, max_concurrent, max_depth, max_wait, progress,
+                   counts):
+    if max_depth is None:
+        max_depth = QUEUE_MAX_DEPTH
+    if max_wait is None:
+        max_wait = QUEUE_MAX_WAIT_SECONDS
+    try:
+        ticket, ticket_fh = _take_ticket(prefix)
+    except OSError:
+        # No queue without LOCK_DIR; fall back to a plain attempt.
+        slot = acquire_concurrency_slot(prefix, max_concurrent)
+        return (slot, None) if slot is not None else (None, 'full')
+    try:
+        deadline = time.time() + max_wait
+        last_position, last_notice = None, 0.0
+        while True:
+            ahead = queue_position(prefix, ticket)
+            if ahead == 0:
+                slot = acquire_concurrency_slot(prefix, max_concurrent)
+                if slot is not None:
+                    return slot, None
+            elif last_position is None and ahead >= max_depth:
+                return None, 'full'
+            now = time.time()
+            if now >= deadline:
+                return None, 'timeout'
+            counts['queue_position'] = max(counts.get('queue_position', 0),
+                                           ahead + 1)
+            if progress is not None and (ahead + 1 != last_position or
+                                         now - last_notice >= QUEUE_NOTICE_SECONDS):
+                progress(ahead + 1,
+                         estimated_wait(prefix, ahead + 1, max_concurrent))
+                last_notice = now
+            last_position = ahead + 1
+            time.sleep(QUEUE_POLL_SECONDS)
+    finally:
+        _drop_ticket(prefix, ticket, ticket_fh)
+
+
+def queue_limits(raw_depth, raw_wait):
+    """Parse COORD_QUEUE_MAX_DEPTH and COORD_QUEUE_MAX_WAIT_SECONDS; empty
+    or invalid values give the defaults. Returns (depth, wait_seconds)."""
+    def _parse(raw, default):
+        try:
+            return max(0, int(raw.strip())) if raw.strip() else default
+        except ValueError:
+            return default
+    return (_parse(raw_depth, QUEUE_MAX_DEPTH),
+            _parse(raw_wait, QUEUE_MAX_WAIT_SECONDS))
+
+
+_queue_notice_shown = False
+
+
+def emit_queue_notice(position, wait_seconds):
+    """progress callback of wait_for_concurrency_slot for HTML pages: one
+    line with the queue position, streamed before the page itself."""
+    global _queue_notice_shown
+    emit_headers()
+    if not _queue_notice_shown:
+        _queue_notice_shown = True
+        print("<!-- {} -->".format(' ' * 4000))  # past Apache's CGI buffer
+    print("<p style='color: #888;'>Server busy: your request is number {} "
+          "in the queue (estimated wait about {:.0f} s). It starts "
+          "automatically; please keep this page open.</p>".format(
+              position, max(1.0, wait_seconds)), flush=True)
+
+
+# ---------- load-aware sizing ----------
+#
+# Thread pools are sized per request from the load average, and the
+# processes they start are capped server-wide by a counting semaphore:
+# RENDER_BUDGET token files '<LOCK_DIR>/coord_render_token_<i>.lock', each
+# flock'ed by one running renderer. Tokens of a crashed request are freed
+# with its file descriptors.
+
+def system_load():
+    """1-minute load average (/proc/loadavg), or None if unavailable."""
+    try:
+        return os.getloadavg()[0]
+    except OSError:
+        return None
+
+
+def adaptive_workers(configured=None, cpus=None, load=None):
+    """Thread-pool size for one request.
+
+    configured (COORD_SEARCH_PARALLEL_WORKERS) is the ceiling; without it
+    an idle server may use two threads per CPU (at least
+    DEFAULT_PARALLEL_WORKERS, at most MAX_PARALLEL_WORKERS). The ceiling is
+    scaled down by the fraction of the CPUs the load average leaves idle,
+    to no less than ADAPTIVE_MIN_WORKERS.
+    """
+    cpus = cpus or os.cpu_count() or 1
+    if load is None:
+        load = system_load()
+    if configured:
+        ceiling = configured
+    else:
+        ceiling = min(MAX_PARALLEL_WORKERS,
+                      max(DEFAULT_PARALLEL_WORKERS, 2 * cpus))
+    if load is None:
+        return ceiling
+    idle = max(0.0, 1.0 - load / float(cpus))
+    return max(min(ceiling, ADAPTIVE_MIN_WORKERS),
+               min(ceiling, int(round(ceiling * idle))))
+
+
+def render_budget(raw):
+    """Parse COORD_RENDER_BUDGET; empty or invalid gives None (one per
+    CPU), 0 or less disables the limit."""
+    try:
+        return max(0, int(raw.strip())) if raw.strip() else None
+    except ValueError:
+        return None
+
+
+@contextmanager
+def render_token():
+    """Hold one of the RENDER_BUDGET server-wide renderer tokens.
+
+    Waits until a token is free, or RENDER_TOKEN_WAIT_SECONDS at most
+    (then the render runs anyway: a slow thumbnail beats a missing one).
+    """
+    budget = RENDER_BUDGET
+    if budget is None:
+        budget = os.cpu_count() or 1
+    if budget <= 0:
+        yield
+        return
+    fd = None
+    deadline = time.time() + RENDER_TOKEN_WAIT_SECONDS
+    first = random.randrange(budget)
+    while fd is None and time.time() < deadline:
+        for i in range(budget):
+            path = os.path.join(LOCK_DIR, 'coord_render_token_{}.lock'.format(
+                (first + i) % budget + 1))
+            try:
+                candidate = open(path, 'w')
+            except OSError:
+                continue
+            try:
+                fcntl.flock(candidate.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                candidate.close()
+                continue
+            fd = candidate
+            break
+        else:
+            time.sleep(RENDER_TOKEN_POLL_SECONDS)
+    try:
+        yield
+    finally:
+        if fd is not None:
+            fd.close()
+
+
 # ---------- sky2xy scan ----------
 
-# Single bash subprocess does the whole scan. ref_dir / ra / dec come in
-# via the environment so they cannot be reinterpreted as shell tokens.
-_BASH_SCAN_LOOP = r'''
-for i in "$REF_DIR"/*; do
+# Single bash subprocess does the whole scan. Each stdin line holds a
+# position number, a FITS path, R.A. and Dec. separated by tabs, so none of
+# them can be reinterpreted as shell tokens. The greps are line-buffered so
+# every match reaches Sky2xyScan as soon as sky2xy prints it.
+_BASH_SCAN_LOOP = r"""
+while IFS=$'\t' read -r k i ra dec; do
   [ -f "$i" ] || continue
-  case "$i" in
-    *.fits|*.fit|*.fts|*.FITS|*.FIT|*.FTS) ;;
-    *) continue ;;
-  esac
-  printf '%s\t' "$i"
-  lib/bin/sky2xy "$i" "$RA" "$DEC" 2>/dev/null
-done | grep -v -e 'offscale' -e 'off image' | grep ' -> '
-'''
+  printf '%s\t%s\t' "$k" "$i"
+  lib/bin/sky2xy "$i" "$ra" "$dec" 2>/dev/null
+done | grep --line-buffered -v -e 'offscale' -e 'off image' \
+     | grep --line-buffered ' -> '
+"""
+
+
+def _parse_scan_line(line, n_positions):
+    """(k, path, x, y) from one line of _BASH_SCAN_LOOP, or None."""
+    fields = line.rstrip('\n').split('\t', 2)
+    if len(fields) != 3:
+        return None
+    k, path, sky2xy_part = fields
+    tokens = sky2xy_part.split()
+    if len(tokens) < 2:
+        return None
+    try:
+        k = int(k)
+        x = float(tokens[-2])
+        y = float(tokens[-1])
+    except ValueError:
+        return None
+    if not 0 <= k < n_positions:
+        return None
+    return k, path, x, y
+
+
+class Sky2xyScan:
+    """The matches of a list of (ra, dec) positions, as they are found.
+
+    Iterating yields (k, path, x, y) tuples, k being the index of the
+    position: first the matches nmw_wcs computed from the footprint index,
+    then each sky2xy match the moment the bash pipeline prints it, so
+    metadata fetching and rendering can start long before the scan ends.
+    At most max_results matches per position are yielded (None: no cap),
+    in the order they are found. After the iteration, truncated tells
+    whether the scan was stopped by SCAN_TIMEOUT_SECONDS; stopping the
+    iteration early stops the pipeline.
+    """
+
+    def __init__(self, ref_dir, positions, vast_dir,
+                 max_results=MAX_RESULTS_TO_PROCESS):
+        self.ref_dir = ref_dir
+        self.positions = list(positions)
+        self.vast_dir = vast_dir
+        self.max_results = max_results
+        self.truncated = False
+
+    def __iter__(self):
+        with nmw_timing.phase('scan', positions=len(self.positions)) as counts:
+            for match in self._scan():
+                counts['matches'] = counts.get('matches', 0) + 1
+                yield match
+            counts['truncated'] = self.truncated
+
+    def _scan(self):
+        # Imported here: nmw_ref_index itself imports this module.
+        import nmw_ref_index
+
+        deadline = time.time() + SCAN_TIMEOUT_SECONDS
+        positions = self.positions
+        located = [[] for _ in positions]
+        candidates = None
+        try:
+            points = [radec_to_degrees(ra, dec) for ra, dec in positions]
+            located, candidates = nmw_ref_index.locate_many_in_references(
+                self.ref_dir, self.vast_dir, points,
+                deadline=time.time() + nmw_ref_index.REFRESH_BUDGET_SECONDS)
+        except (ValueError, OSError, sqlite3.Error) as err:
+            sys.stderr.write('footprint index unavailable, scanning all '
+                             'references: {}\n'.format(err))
+
+        counts = [0] * len(positions)
+
+        def _take(k):
+            if self.max_results is not None and counts[k] >= self.max_results:
+                return False
+            counts[k] += 1
+            return True
+
+        for k, target_matches in enumerate(located):
+            for path, x, y in target_matches:
+                if _take(k):
+                    yield k, path, x, y
+
+        if candidates is None:
+            all_files = list_fits_files(self.ref_dir)
+            candidates = [all_files] * len(positions)
+        pairs = []
+        for k, ((ra, dec), paths) in enumerate(zip(positions, candidates)):
+            for path in paths:
+                if '\t' not in path and '\n' not in path:
+                    pairs.append('{}\t{}\t{}\t{}\n'.format(k, path, ra, dec))
+        if not pairs:
+            return
+        try:
+            # Own session, so a timeout can stop sky2xy and the greps too.
+            proc = subprocess.Popen(
+                ['bash', '-c', _BASH_SCAN_LOOP], cwd=self.vast_dir,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL, text=True, start_new_session=True)
+        except OSError as err:
+            sys.stderr.write('sky2xy scan failed: {}\n'.format(err))
+            return
+        # The input is fed from a thread: written up front it could fill
+        # the pipe while bash waits for its output to be read.
+        feeder = threading.Thread(target=self._feed,
+                                  args=(proc, ''.join(pairs)), daemon=True)
+        timer = threading.Timer(max(1.0, deadline - time.time()),
+                                self._expire, (proc,))
+        feeder.start()
+        timer.start()
+        try:
+            for line in proc.stdout:
+                match = _parse_scan_line(line, len(positions))
+                if match is not None and _take(match[0]):
+                    yield match
+        finally:
+            timer.cancel()
+            if proc.poll() is None:
+                self._stop(proc)
+            proc.stdout.close()
+            proc.wait()
+
+    @staticmethod
+    def _feed(proc, text):
+        try:
+            proc.stdin.write(text)
+            proc.stdin.close()
+        except (OSError, ValueError):
+            pass                     # the scan was stopped
+
+    def _expire(self, proc):
+        self.truncated = True
+        self._stop(proc)
+
+    @staticmethod
+    def _stop(proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
 
 
 def run_sky2xy_scan(ref_dir, ra, dec, vast_dir, max_results=MAX_RESULTS_TO_PROCESS):
-    """Iterate FITS files in ref_dir, call sky2xy from vast_dir.
+    """Find the FITS files in ref_dir covering (ra, dec).
+
+    The persistent footprint index (nmw_ref_index) narrows the reference
+    set down to the few images whose footprint contains the position, and
+    nmw_wcs computes the pixel position on all of them in-process. sky2xy
+    is run only on the candidates nmw_wcs cannot handle; if the index
+    cannot be used at all (e.g. the cache directory is not writable) every
+    file in ref_dir is scanned with sky2xy.
 
     Returns (matches, truncated_by_timeout) where matches is a list of
-    (path, x, y) tuples.
+    (path, x, y) tuples. Sky2xyScan yields the same matches as they are
+    found.
     """
-    env = os.environ.copy()
-    env['REF_DIR'] = ref_dir
-    env['RA'] = ra
-    env['DEC'] = dec
-    truncated = False
-    stdout = ''
-    try:
-        result = subprocess.run(
-            ['bash', '-c', _BASH_SCAN_LOOP],
-            cwd=vast_dir,
-            env=env,
-            capture_output=True,
-            text=True,
-            timeout=SCAN_TIMEOUT_SECONDS,
-        )
-        stdout = result.stdout or ''
-    except subprocess.TimeoutExpired as exc:
-        truncated = True
-        partial = exc.stdout or ''
-        if isinstance(partial, (bytes, bytearray)):
-            stdout = partial.decode('utf-8', errors='replace')
-        else:
-            stdout = partial
+    matches, truncated = run_sky2xy_batch_scan(
+        ref_dir, [(ra, dec)], vast_dir, max_results)
+    return matches[0], truncated
 
-    matches = []
-    for line in stdout.splitlines():
-        if '\t' not in line:
-            continue
-        path, sky2xy_part = line.split('\t', 1)
-        tokens = sky2xy_part.split()
-        if len(tokens) < 2:
-            continue
-        try:
-            x = float(tokens[-2])
-            y = float(tokens[-1])
-        except ValueError:
-            continue
-        matches.append((path, x, y))
-        if len(matches) >= max_results:
-            break
-    return matches, truncated
+
+def run_sky2xy_batch_scan(ref_dir, positions, vast_dir,
+                          max_results=MAX_RESULTS_TO_PROCESS):
+    """run_sky2xy_scan() for a list of (ra, dec) positions in one pass.
+
+    The footprint index is queried once for all positions, and every
+    (reference, position) pair left to sky2xy goes through one bash
+    subprocess. Returns (matches, truncated_by_timeout) where matches has
+    one sorted list of (path, x, y) per position, each capped at
+    max_results.
+    """
+    scan = Sky2xyScan(ref_dir, positions, vast_dir, max_results=None)
+    matches = [[] for _ in positions]
+    for k, path, x, y in scan:
+        matches[k].append((path, x, y))
+    return [sorted(m)[:max_results] for m in matches], scan.truncated
 
 
 # ---------- per-image helpers ----------
@@ -334,6 +863,8 @@ def run_sky2xy_scan(ref_dir, ra, dec, vast_dir, max_results=MAX_RESULTS_TO_PROCE
 def get_image_metadata(fits_path, vast_dir):
     """Return image metadata dict from util/fov_of_wcs_calibrated_image.sh.
 
+    Results are kept in the persistent metadata cache (nmw_meta_cache),
+    so the script only runs once per image version (realpath, size, mtime).
     Going through the script (rather than reading NAXIS directly) makes
     this work for compressed FITS files as well.
 
@@ -342,6 +873,59 @@ def get_image_metadata(fits_path, vast_dir):
     center_radec (e.g. "21:00:00.47 +30:00:01.6", or None).
     Returns None on failure.
     """
+    # Imported here: nmw_meta_cache itself imports this module.
+    import nmw_meta_cache
+    with nmw_timing.phase('metadata'):
+        return nmw_meta_cache.cached_image_metadata(
+            fits_path, vast_dir, _run_fov_script)
+
+
+def get_image_size(fits_path, vast_dir):
+    """Return (nx, ny) of fits_path, or None on failure.
+
+    Read straight from the FITS header (plain or .fz) by nmw_fits; falls
+    back to get_image_metadata() for files nmw_fits cannot parse.
+    """
+    try:
+        return nmw_fits.image_size(fits_path)
+    except (OSError, ValueError):
+        pass
+    meta = get_image_metadata(fits_path, vast_dir)
+    if meta is None:
+        return None
+    return meta['nx'], meta['ny']
+
+
+def target_off_frame(fits_path, ra_deg, dec_deg, margin=OFF_FRAME_MARGIN_PIX):
+    """True if the header WCS of fits_path puts (ra_deg, dec_deg) more than
+    margin pixels outside the frame.
+
+    Answers False whenever it cannot tell (no NumPy, unreadable header, a
+    projection nmw_wcs does not handle), so callers only use it to skip
+    work that would certainly find the target off the image.
+    """
+    # Imported here: NumPy is only loaded by the pages that need it.
+    import nmw_wcs
+    if not nmw_wcs.HAVE_NUMPY:
+        return False
+    try:
+        wcs = nmw_wcs.parse_wcs(nmw_fits.read_header(fits_path))
+    except (OSError, ValueError):
+        return False
+    if wcs is None:
+        return False
+    x, y, status = nmw_wcs.sky_to_pixel(
+        nmw_wcs.stack_wcs([wcs]), ra_deg, dec_deg)
+    if status[0, 0] == 'offscale':
+        return True
+    x = float(x[0, 0])
+    y = float(y[0, 0])
+    return not (0.5 - margin <= x <= wcs['nx'] + 0.5 + margin and
+                0.5 - margin <= y <= wcs['ny'] + 0.5 + margin)
+
+
+def _run_fov_script(fits_path, vast_dir):
+    """Uncached get_image_metadata(): run and parse the fov script."""
     try:
         result = subprocess.run(
             ['util/fov_of_wcs_calibrated_image.sh', fits_path],
@@ -437,6 +1021,25 @@ def _reformat_sexagesimal(token, sec_decimals):
 
 
 def _run_pgfv_tool(argv, out_dir, png_w, png_h, fits_path, suffix):
+    """Produce <basename>_<suffix>.png in out_dir with a pgfv-family tool.
+
+    Goes through the shared thumbnail cache (nmw_thumb_cache): a PNG
+    rendered before from the same file with the same arguments is hard
+    linked instead of rendered again.
+    Returns the suffixed PNG name (relative to out_dir) on success, else None.
+    """
+    # Imported here: nmw_thumb_cache itself imports this module.
+    import nmw_thumb_cache
+    base = os.path.splitext(os.path.basename(fits_path))[0]
+    with nmw_timing.phase('thumbnail', renderer='pgfv'):
+        return nmw_thumb_cache.cached_render(
+            argv, out_dir, png_w, png_h, fits_path,
+            '{}_{}.png'.format(base, suffix),
+            lambda: _render_pgfv_tool(argv, out_dir, png_w, png_h, fits_path,
+                                      suffix))
+
+
+def _render_pgfv_tool(argv, out_dir, png_w, png_h, fits_path, suffix):
     """Run a pgfv-family tool that writes <basename>.png to cwd, then rename.
 
     Returns the suffixed PNG name (relative to out_dir) on success, else None.
@@ -448,13 +1051,14 @@ def _run_pgfv_tool(argv, out_dir, png_w, png_h, fits_path, suffix):
     env['PGPLOT_PNG_WIDTH'] = str(png_w)
     env['PGPLOT_PNG_HEIGHT'] = str(png_h)
     try:
-        subprocess.run(
-            argv,
-            cwd=out_dir,
-            env=env,
-            capture_output=True,
-            timeout=FITS2PNG_TIMEOUT_SECONDS,
-        )
+        with render_token(), nmw_timing.phase('render', renderer='pgfv'):
+            subprocess.run(
+                argv,
+                cwd=out_dir,
+                env=env,
+                capture_output=True,
+                timeout=FITS2PNG_TIMEOUT_SECONDS,
+            )
     except (subprocess.TimeoutExpired, OSError):
         return None
     base = os.path.splitext(os.path.basename(fits_path))[0]
@@ -470,6 +1074,69 @@ def _run_pgfv_tool(argv, out_dir, png_w, png_h, fits_path, suffix):
     return dst_name
 
 
+def _run_numpy_render(mode_args, out_dir, png_w, png_h, fits_path, suffix,
+                      draw):
+    """Produce <basename>_<suffix>.png in out_dir with nmw_render.
+
+    draw() returns the PNG bytes. Goes through the shared thumbnail cache
+    like _run_pgfv_tool, with the renderer module standing in for the tool.
+    Returns the suffixed PNG name on success, else None.
+    """
+    # Imported here: nmw_thumb_cache itself imports this module.
+    import nmw_render
+    import nmw_thumb_cache
+    base = os.path.splitext(os.path.basename(fits_path))[0]
+    dst_name = '{}_{}.png'.format(base, suffix)
+
+    def _render():
+        try:
+            with render_token(), nmw_timing.phase('render', renderer='numpy'):
+                png = draw()
+            nmw_render.write_png(os.path.join(out_dir, dst_name), png)
+        except (OSError, ValueError, MemoryError):
+            return None
+        return dst_name
+
+    argv = [os.path.abspath(nmw_render.__file__)] + mode_args + [fits_path]
+    with nmw_timing.phase('thumbnail', renderer='numpy'):
+        return nmw_thumb_cache.cached_render(
+            argv, out_dir, png_w, png_h, fits_path, dst_name, _render)
+
+
+def thumbnail_renderer(raw):
+    """Parse COORD_THUMBNAIL_RENDERER: 'numpy', else the default 'pgfv'."""
+    return 'numpy' if raw.strip().lower() == 'numpy' else 'pgfv'
+
+
+def open_thumbnail_image(fits_path):
+    """nmw_render.FitsImage of fits_path, to be passed as image= to the
+    make_*_thumbnail calls of one file so they share a single decode.
+
+    None when the pgfv tools are to be used: THUMBNAIL_RENDERER is 'pgfv',
+    NumPy is missing, or the file is one nmw_render cannot read (such as a
+    floating-point .fz). Zoom-outs of .fz images always use the pgfv tools.
+    """
+    if THUMBNAIL_RENDERER != 'numpy':
+        return None
+    # Imported here: NumPy is only loaded by the pages that need it.
+    import nmw_render
+    if not nmw_render.HAVE_NUMPY:
+        return None
+    try:
+        return nmw_render.FitsImage(fits_path)
+    except (OSError, ValueError):
+        return None
+
+
+def thumb_cache_budget_mb(raw):
+    """Parse COORD_THUMBNAIL_CACHE_MB; empty or invalid gives the default."""
+    try:
+        value = int(raw.strip()) if raw.strip() else THUMB_CACHE_MAX_MB
+    except ValueError:
+        return THUMB_CACHE_MAX_MB
+    return max(0, value)
+
+
 def zoomout_png_dims(nx, ny, thumb_pixels):
     """PNG dimensions for the zoom-out thumbnail.
 
@@ -483,16 +1150,30 @@ def zoomout_png_dims(nx, ny, thumb_pixels):
 
 
 def make_zoomout_thumbnail(fits_path, x, y, nx, ny, out_dir, vast_dir,
-                           thumb_pixels, suffix='zoomout'):
+                           thumb_pixels, suffix='zoomout', image=None):
     """Full-frame view of the FITS image. If x and y are not None, draws a
     marker at pixel (x, y) (requires the pgfv.c edits). Pass x=y=None to
     render a plain full-frame preview with no marker.
 
     PNG dimensions follow source aspect ratio so the longer axis is
     thumb_pixels, matching the zoom-in's axes.
+    Rendered in-process when image (see open_thumbnail_image) is given or
+    THUMBNAIL_RENDERER is 'numpy', falling back to util/fits2png.
     """
-    fits2png = os.path.join(vast_dir, 'util', 'fits2png')
     png_w, png_h = zoomout_png_dims(nx, ny, thumb_pixels)
+    if image is None:
+        image = open_thumbnail_image(fits_path)
+    if image is not None:
+        import nmw_render
+        mode_args = ['zoomout']
+        if x is not None and y is not None:
+            mode_args.extend(['{:.3f}'.format(x), '{:.3f}'.format(y)])
+        name = _run_numpy_render(
+            mode_args, out_dir, png_w, png_h, fits_path, suffix,
+            lambda: nmw_render.zoomout_png(image, x, y, png_w, png_h))
+        if name is not None:
+            return name
+    fits2png = os.path.join(vast_dir, 'util', 'fits2png')
     args = [fits2png, fits_path]
     if x is not None and y is not None:
         args.extend(['{:.3f}'.format(x), '{:.3f}'.format(y)])
@@ -501,13 +1182,29 @@ def make_zoomout_thumbnail(fits_path, x, y, nx, ny, out_dir, vast_dir,
 
 def make_zoomin_thumbnail(fits_path, x, y, out_dir, vast_dir, thumb_pixels,
                           zoomin_pixels, suffix='zoomin',
-                          aperture_circle_diameter=None):
+                          aperture_circle_diameter=None, image=None):
     """Square zoom-in centred on (x, y), 2N x 2N source pixels.
 
     If aperture_circle_diameter (pixels) is given, draw a red circle of that
     diameter at the target -- requires the pgfv.c --targetaperturecircle option.
     Left as None (the default) the chart is drawn exactly as before.
+    image selects the in-process renderer as in make_zoomout_thumbnail.
     """
+    if image is None:
+        image = open_thumbnail_image(fits_path)
+    if image is not None:
+        import nmw_render
+        mode_args = ['zoomin', str(zoomin_pixels)]
+        if aperture_circle_diameter is not None and aperture_circle_diameter > 0:
+            mode_args.append('{:.3f}'.format(aperture_circle_diameter))
+        mode_args.extend(['{:.3f}'.format(x), '{:.3f}'.format(y)])
+        name = _run_numpy_render(
+            mode_args, out_dir, thumb_pixels, thumb_pixels, fits_path, suffix,
+            lambda: nmw_render.zoomin_png(
+                image, x, y, zoomin_pixels, thumb_pixels,
+                aperture_circle_diameter))
+        if name is not None:
+            return name
     tool = os.path.join(vast_dir, 'util', 'make_finding_chart')
     args = [tool, '--width', str(zoomin_pixels), '--nolabels']
     if aperture_circle_diameter is not None and aperture_circle_diameter > 0:
@@ -536,6 +1233,31 @@ def render_thumbnail_link(thumb_name, hires_name, label, base, url_prefix, sub):
                           b=html_escape(base)))
 
 
+def render_image_size(arcmin_str, deg_str, nx, ny):
+    """Three-line HTML for the Image size cell."""
+    lines = []
+    if arcmin_str:
+        lines.append(html_escape(arcmin_str))
+    if deg_str:
+        # Already pre-rendered HTML with the &deg; entity.
+        lines.append(deg_str)
+    lines.append('{}x{} pix'.format(nx, ny))
+    return '<br>'.join(lines)
+
+
+def render_mean_scale(scale_x, scale_y):
+    """Returns (formatted_html, mean_scale_value_or_None)."""
+    if scale_x is None and scale_y is None:
+        return '-', None
+    if scale_y is None:
+        m = scale_x
+    elif scale_x is None:
+        m = scale_y
+    else:
+        m = (scale_x + scale_y) / 2.0
+    return '{:.2f}'.format(m), m
+
+
 def list_fits_files(ref_dir):
     """Return a sorted list of absolute paths to FITS files in ref_dir.
 
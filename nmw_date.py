@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Image timestamps without forking VaST's util/get_image_date.
+
+The coordinate pages ran get_image_date once per result row to learn an
+image's mid-exposure JD and ATel-style date, and filter_report.py ran it
+once per candidate JD for an ISO 8601 date. image_jd() reads the header
+with nmw_fits and applies the conventions get_image_date uses for the
+headers the NMW cameras (and the older archives) write:
+
+  DATE-OBS 'YYYY-MM-DDThh:mm:ss[.sss]'   start of the exposure
+  DATE-OBS 'YYYY-MM-DD' or 'DD/MM/YY'    with the time in TIME-OBS,
+                                         UT-START, UT or TIME-BEG
+  MJD-OBS, JD                            start of the exposure, used when
+                                         there is no DATE-OBS
+  EXPTIME, EXPOSURE                      exposure in seconds; half of it is
+                                         added for the middle of the
+                                         exposure (0 if neither is present)
+
+All times are UTC; JDs are UTC JDs as get_image_date prints them on its
+'JD' line (leap seconds are not counted, as with Unix time). atel_date()
+and iso_utc() format a JD the way the 'ATel style' and '(mid. exp)'
+lines do. test_python.py checks all three against the binary where VaST
+is installed, as in CI after unmw_selftest.sh, on the real headers of the
+self-test images.
+
+Command-line use:
+  python3 nmw_date.py image.fits|JD   print the JD, ATel-style and ISO 8601
+                                      dates like get_image_date
+"""
+
+import warnings
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+import re
+import sys
+from datetime import datetime, timedelta
+
+import nmw_fits
+
+
+JD_UNIX_EPOCH = 2440587.5             # 1970-01-01T00:00:00 UTC
+MJD_OFFSET = 2400000.5
+TIME_KEYWORDS = ('TIME-OBS', 'UT-START', 'UT', 'TIME-BEG')
+EXPOSURE_KEYWORDS = ('EXPTIME', 'EXPOSURE')
+
+_UNIX_EPOCH = datetime(1970, 1, 1)
+_ISO_DATE_RE = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$')
+_OLD_DATE_RE = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{2})$')
+_TIME_RE = re.compile(r'^(\d{1,2}):(\d{1,2}):(\d{1,2}(?:\.\d*)?)$')
+
+
+def _parse_date(text):
+    """(year, month, day) of a DATE-OBS date; 'DD/MM/YY' is 19YY."""
+    m = _ISO_DATE_RE.match(text)
+    if m:
+        return int(m.group(1)), int(m.group(2)), int(m.group(3))
+    m = _OLD_DATE_RE.match(text)
+    if m:
+        return 1900 + int(m.group(3)), int(m.group(2)), int(m.group(1))
+    raise ValueError('unrecognised date {!r}'.format(text))
+
+
+def _parse_time(text):
+    """Seconds since midnight of an 'hh:mm:ss[.sss]' time."""
+    m = _TIME_RE.match(text)
+    if not m:
+        raise ValueError('unrecognised time {!r}'.format(text))
+    return int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+
+
+def _datetime_jd(dt):
+    delta = dt - _UNIX_EPOCH
+    return JD_UNIX_EPOCH + (delta.days + (delta.seconds
+                            + delta.microseconds / 1e6) / 86400.0)
+
+
+def _exposure(keywords):
+    for key in EXPOSURE_KEYWORDS:
+        value = keywords.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+    return 0.0
+
+
+def start_jd(keywords):
+    """UTC JD of the start of the exposure described by a header keyword
+    dict. Raises ValueError if the header carries no usable date."""
+    date_obs = keywords.get('DATE-OBS')
+    if isinstance(date_obs, str) and date_obs.strip():
+        date_obs = date_obs.strip()
+        if 'T' in date_obs:
+            date_text, time_text = date_obs.split('T', 1)
+        else:
+            date_text, time_text = date_obs, None
+            for key in TIME_KEYWORDS:
+                value = keywords.get(key)
+                if isinstance(value, str) and value.strip():
+                    time_text = value.strip()
+                    break
+            if time_text is None:
+                raise ValueError('DATE-OBS without a time of day')
+        year, month, day = _parse_date(date_text)
+        return _datetime_jd(datetime(year, month, day)
+                            + timedelta(seconds=_parse_time(time_text)))
+    for key, offset in (('MJD-OBS', MJD_OFFSET), ('JD', 0.0)):
+        value = keywords.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value) + offset
+    raise ValueError('no DATE-OBS, MJD-OBS or JD keyword')
+
+
+def mid_exposure_jd(keywords):
+    """UTC JD of the middle of the exposure; raises like start_jd."""
+    return start_jd(keywords) + _exposure(keywords) / 2.0 / 86400.0
+
+
+def image_jd(fits_path):
+    """Mid-exposure UTC JD of the image in fits_path (plain or .fz).
+
+    Raises OSError if the file cannot be read and ValueError if it is not
+    a FITS image or its header has no usable date.
+    """
+    return mid_exposure_jd(nmw_fits.read_header(fits_path))
+
+
+def _jd_datetime(jd):
+    """UTC datetime of a JD, rounded to the millisecond so a time that is
+    whole seconds in the header prints as such."""
+    ms = int(round((jd - JD_UNIX_EPOCH) * 86400000.0))
+    return _UNIX_EPOCH + timedelta(milliseconds=ms)
+
+
+def atel_date(jd, digits=5):
+    """'YYYY-MM-DD.fffff' date of a JD. The day fraction is truncated to
+    digits, never carried into the next day."""
+    dt = _jd_datetime(jd)
+    ms = ((dt.hour * 60 + dt.minute) * 60 + dt.second) * 1000 \
+        + dt.microsecond // 1000
+    fraction = ms * 10 ** digits // 86400000
+    return '{}.{:0{}d}'.format(dt.strftime('%Y-%m-%d'), fraction, digits)
+
+
+def iso_utc(jd):
+    """'YYYY-MM-DDThh:mm:ss' of a JD (UTC), rounded to the nearest second
+    like get_image_date's '(mid. exp)' line."""
+    dt = _jd_datetime(jd)
+    if dt.microsecond >= 500000:
+        dt += timedelta(seconds=1)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+# ---------- command line ----------
+
+def main(argv):
+    if len(argv) != 2:
+        print('Usage: `python3 nmw_date.py image.fits` or '
+              '`python3 nmw_date.py JD`')
+        return 1
+    try:
+        jd = float(argv[1])
+    except ValueError:
+        try:
+            jd = image_jd(argv[1])
+        except (OSError, ValueError) as e:
+            print('ERROR: {}'.format(e), file=sys.stderr)
+            return 1
+    print('         JD {:.8f}'.format(jd))
+    print(' ATel style {}'.format(atel_date(jd)))
+    print(' (mid. exp) {}'.format(iso_utc(jd)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Minimal FITS header reader for plain and tile-compressed (.fz) images.
+
+The coordinate pages used to fork VaST tools (util/listhead, the fov
+script) only to learn an image's size, WCS or date. read_header() maps the
+file and parses just the 2880-byte header blocks, skipping over data units
+by their declared size, so pixel data is never read. For fpack-compressed
+files the header of the compressed-image extension is returned as the
+header of the uncompressed image: ZBITPIX / ZNAXIS / ZNAXISn replace the
+binary-table structure keywords and the remaining compression bookkeeping
+(ZCMPTYPE, ZTILEn, TFORMn, ...) is dropped.
+"""
+
+import mmap
+import os
+import re
+
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+MAX_HDUS = 16                         # give up looking for an image past this
+
+# Binary-table and tile-compression keywords that describe the storage of a
+# compressed image, not the image itself.
+_COMPRESSION_KEY_RE = re.compile(
+    r'^(?:XTENSION|PCOUNT|GCOUNT|TFIELDS|THEAP|EXTNAME'
+    r'|T(?:TYPE|FORM|UNIT|DIM|NULL|SCAL|ZERO)\d+'
+    r'|Z(?:IMAGE|CMPTYPE|TILE\d+|NAME\d+|VAL\d+|MASKCMP|QUANTIZ|DITHER0'
+    r'|SIMPLE|TENSION|EXTEND|BLOCKED|PCOUNT|GCOUNT|HECKSUM|DATASUM))$')
+
+
+def parse_card(card):
+    """Return (keyword, value) for one 80-column FITS header card, or None
+    for cards without a value (COMMENT, HISTORY, END, blank lines).
+
+    Values come back as str (quoted strings, trailing blanks removed),
+    bool (T/F), int or float.
+    """
+    if len(card) < 10 or card[8:10] != '= ':
+        return None
+    key = card[:8].strip()
+    rest = card[10:].strip()
+    if rest.startswith("'"):
+        # Quoted string: '' inside the quotes is an escaped single quote.
+        chars = []
+        i = 1
+        while i < len(rest):
+            if rest[i] == "'":
+                if i + 1 < len(rest) and rest[i + 1] == "'":
+                    chars.append("'")
+                    i += 2
+                    continue
+                break
+            chars.append(rest[i])
+            i += 1
+        return key, ''.join(chars).rstrip()
+    value = rest.split('/', 1)[0].strip()
+    if value == 'T':
+        return key, True
+    if value == 'F':
+        return key, False
+    try:
+        return key, int(value)
+    except ValueError:
+        pass
+    try:
+        return key, float(value.replace('D', 'E'))
+    except ValueError:
+        return key, value
+
+
+def _read_hdu_header(buf, offset):
+    """Parse the header starting at offset; return (keywords, data_offset).
+
+    When a keyword repeats, the first value is kept.
+    """
+    keywords = {}
+    size = len(buf)
+    while True:
+        if offset + BLOCK_SIZE > size:
+            raise ValueError('truncated FITS header')
+        block = buf[offset:offset + BLOCK_SIZE].decode('ascii', 'replace')
+        offset += BLOCK_SIZE
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[i:i + CARD_SIZE]
+            if card.startswith('END') and not card[3:].strip():
+                return keywords, offset
+            parsed = parse_card(card)
+            if parsed is not None:
+                keywords.setdefault(parsed[0], parsed[1])
+
+
+def _data_size(keywords):
+    """Size in bytes of the data unit described by a header, padded to
+    whole FITS blocks."""
+    naxis = int(keywords.get('NAXIS', 0))
+    if naxis == 0:
+        return 0
+    n = 1
+    for axis in range(1, naxis + 1):
+        n *= int(keywords.get('NAXIS{}'.format(axis), 0))
+    n = abs(int(keywords.get('BITPIX', 8))) // 8 * int(
+        keywords.get('GCOUNT', 1)) * (int(keywords.get('PCOUNT', 0)) + n)
+    return (n + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+
+def _uncompressed_header(primary, ext):
+    """Header of the image stored in a compressed-image extension."""
+    keywords = {k: v for k, v in primary.items()
+                if k not in ('SIMPLE', 'EXTEND') and not k.startswith('NAXIS')}
+    for key, value in ext.items():
+        if key == 'ZBITPIX':
+            keywords['BITPIX'] = value
+        elif key.startswith('ZNAXIS'):
+            keywords[key[1:]] = value
+        elif key == 'BITPIX' or key.startswith('NAXIS'):
+            continue
+        elif not _COMPRESSION_KEY_RE.match(key):
+            keywords[key] = value
+    return keywords
+
+
+def _find_image(buf, fits_path):
+    """Return (keywords, data_offset, compressed) of the image HDU in the
+    mapped file.
+
+    For a tile-compressed image compressed holds the raw keywords of the
+    binary-table extension and data_offset is the offset of its table;
+    otherwise compressed is None and data_offset points at the pixels.
+    """
+    if buf[:9] != b'SIMPLE  =':
+        raise ValueError('not a FITS file: {}'.format(fits_path))
+    primary, offset = _read_hdu_header(buf, 0)
+    if int(primary.get('NAXIS', 0)) >= 2:
+        return primary, offset, None
+    offset += _data_size(primary)
+    for _ in range(MAX_HDUS):
+        if offset >= len(buf):
+            break
+        ext, data_offset = _read_hdu_header(buf, offset)
+        if ext.get('ZIMAGE') is True:
+            return _uncompressed_header(primary, ext), data_offset, ext
+        if (str(ext.get('XTENSION', '')).strip() == 'IMAGE'
+                and int(ext.get('NAXIS', 0)) >= 2):
+            keywords = {k: v for k, v in primary.items()
+                        if k not in ('SIMPLE', 'EXTEND')
+                        and not k.startswith('NAXIS')}
+            keywords.update(ext)
+            return keywords, data_offset, None
+        offset = data_offset + _data_size(ext)
+    raise ValueError('no image HDU in {}'.format(fits_path))
+
+
+def _map_image(fits_path):
+    with open(fits_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < BLOCK_SIZE:
+            raise ValueError('not a FITS file: {}'.format(fits_path))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _find_image(buf, fits_path)
+
+
+def read_header(fits_path):
+    """Keywords of the image in fits_path as a dict.
+
+    That is the primary header when it holds an image, otherwise the first
+    image or compressed-image extension, with the primary-header keywords
+    inherited. Raises OSError if the file cannot be read and ValueError if
+    it is not a FITS file or holds no image.
+    """
+    return _map_image(fits_path)[0]
+
+
+def image_layout(fits_path):
+    """(keywords, data_offset) of an uncompressed image in fits_path.
+
+    data_offset is the byte offset of the first pixel, for mapping the
+    pixel array directly. Raises like read_header, and ValueError for a
+    tile-compressed image.
+    """
+    keywords, data_offset, compressed = _map_image(fits_path)
+    if compressed is not None:
+        raise ValueError('compressed image in {}'.format(fits_path))
+    return keywords, data_offset
+
+
+def compressed_layout(fits_path):
+    """(keywords, table_keywords, table_offset) of a tile-compressed image.
+
+    keywords is the header of the uncompressed image as from read_header,
+    table_keywords the raw keywords of the binary table holding the tiles
+    and table_offset the byte offset of its first row. Raises like
+    read_header, and ValueError if the image is not tile-compressed.
+    """
+    keywords, data_offset, compressed = _map_image(fits_path)
+    if compressed is None:
+        raise ValueError('not a compressed image: {}'.format(fits_path))
+    return keywords, compressed, data_offset
+
+
+def image_size(fits_path):
+    """(NAXIS1, NAXIS2) of the image in fits_path; raises like read_header."""
+    keywords = read_header(fits_path)
+    try:
+        return int(keywords['NAXIS1']), int(keywords['NAXIS2'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('no image size in {}'.format(fits_path))
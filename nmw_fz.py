@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Section reads of tile-compressed (fpack, .fz) FITS images.
+
+A zoom-in cutout covers at most 2 * DEFAULT_ZOOMIN_PIXELS square, but the
+pgfv tools decompress the whole wide-field frame to make one. fpack stores
+the image as a grid of independently compressed tiles (by default one
+image row each), one binary-table row per tile, so TileCompressedImage
+reads and decompresses only the tiles that intersect the requested box.
+
+Integer images compressed with RICE_1 (the fpack default), GZIP_1, GZIP_2
+or NOCOMPRESS are handled; quantized floating-point images and HCOMPRESS
+raise ValueError, and the caller falls back to the pgfv tools. Rice codes
+have to be read in order, so rice_decompress_tiles() walks the pixels of a
+batch of tiles in step, one NumPy operation per pixel column for all the
+tiles at once; a cutout's tiles are decoded as one batch. A 400-row
+cutout of a 4000-pixel-wide frame takes about 0.3 s, against about 0.2 s
+for CFITSIO to decode the whole frame, which the pgfv tools do for every
+thumbnail; the preview and hi-res zoom-ins share the decoded tiles.
+"""
+
+import re
+import zlib
+
+import numpy as np
+
+import nmw_fits
+
+
+SUPPORTED_COMPRESSION = ('RICE_1', 'GZIP_1', 'GZIP_2', 'NOCOMPRESS')
+RICE_DEFAULT_BLOCKSIZE = 32
+MAX_CACHED_TILES = 4096              # decoded tiles kept for the next section
+RICE_BATCH_BYTES = 1 << 20           # compressed bytes decoded in one batch
+
+# Bytes per element of the binary-table column types.
+_TFORM_SIZES = {'L': 1, 'B': 1, 'I': 2, 'J': 4, 'K': 8, 'A': 1, 'E': 4,
+                'D': 8, 'C': 8, 'M': 16, 'P': 8, 'Q': 16}
+_TFORM_RE = re.compile(r'^\s*(\d*)([LXBIJKAEDCMPQ])')
+
+# Rice parameters by bytes per pixel: (bits of the fs code, fs escape value).
+_RICE_PARAMS = {1: (3, 6), 2: (4, 14), 4: (5, 25)}
+
+
+def _column_offset(table, name):
+    """(byte offset within a row, TFORM letter) of the named column."""
+    offset = 0
+    for n in range(1, int(table.get('TFIELDS', 0)) + 1):
+        m = _TFORM_RE.match(str(table.get('TFORM{}'.format(n), '')))
+        if not m:
+            raise ValueError('bad TFORM{}'.format(n))
+        repeat = int(m.group(1)) if m.group(1) else 1
+        code = m.group(2)
+        if str(table.get('TTYPE{}'.format(n), '')).strip() == name:
+            return offset, code
+        if code == 'X':
+            offset += (repeat + 7) // 8
+        else:
+            offset += repeat * _TFORM_SIZES[code]
+    raise ValueError('no {} column'.format(name))
+
+
+# Leading zero bits of every 16-bit value (16 for zero).
+_LEADING_ZEROS = (16 - np.floor(np.log2(np.maximum(
+    np.arange(1 << 16), 1))) - 1).astype(np.int32)
+_LEADING_ZEROS[0] = 16
+
+
+def _run_length(window, at, cap):
+    """Zero bits from the positions at up to the next 1 bit, stopping
+    past cap."""
+    run = np.zeros(len(at), dtype=np.int32)
+    todo = np.arange(len(at))
+    while len(todo):
+        pos = at[todo] + run[todo]
+        zeros = _LEADING_ZEROS[(window[pos >> 3] >> (8 - (pos & 7))) & 0xffff]
+        run[todo] += zeros
+        todo = todo[(zeros == 16) & (pos + 16 <= cap)]
+    return run
+
+
+def _bit_words(buf, pos, width, max_width=32):
+    """Big-endian integers of width bits (0 to max_width <= 32, per
+    element) starting at the bit positions pos of the uint8 array buf, as
+    int64. buf must extend 5 bytes past the last position."""
+    nbytes = (max_width + 14) // 8
+    byte = pos >> 3
+    window = np.zeros(np.shape(pos), dtype=np.uint64)
+    for k in range(nbytes):
+        window = (window << np.uint64(8)) | buf[byte + k]
+    window <<= (pos & 7).astype(np.uint64) + np.uint64(64 - 8 * nbytes)
+    return ((window >> np.uint64(32)) >> np.asarray(
+        32 - width, dtype=np.uint64)).astype(np.int64)
+
+
+def rice_decompress_tiles(tiles, npix, blocksize, bytepix):
+    """Decode Rice-compressed tiles (as written by fpack/CFITSIO) of npix
+    pixels each into an int64 array of shape (len(tiles), npix) of unsigned
+    integers of 8 * bytepix bits.
+
+    Rice codes have to be read in order, so the tiles are walked in step:
+    one pass over the pixel index, each step locating the next code of
+    every tile at once. Raises ValueError if any tile is corrupt or
+    truncated.
+    """
+    try:
+        fsbits, fsmax = _RICE_PARAMS[bytepix]
+    except KeyError:
+        raise ValueError('unsupported Rice BYTEPIX {}'.format(bytepix))
+    bbits = 8 * bytepix
+    ntiles = len(tiles)
+    sizes = np.array([len(data) for data in tiles], dtype=np.int64)
+    if (sizes * 8 < bbits).any():
+        raise ValueError('truncated Rice tile')
+    # The tiles back to back; bit positions run over the whole buffer.
+    buf = np.frombuffer(b''.join(tiles) + bytes(8), dtype=np.uint8)
+    end = np.cumsum(sizes) * 8
+    start = end - sizes * 8
+    nbits = int(end[-1])
+    # A truncated tile runs past its end by at most (fsmax + 16) bits per
+    # code before its position is clipped to nbits + 1 at the next block
+    # header; the zero padding covers that.
+    reach = (fsmax + 16) * blocksize + bbits
+    buf = np.concatenate([buf, np.zeros(reach // 8 + 8, dtype=np.uint8)])
+    cap = nbits + 1
+    # window[b]: bytes b, b + 1 and b + 2 as one 24-bit integer, so the 16
+    # bits from any position are one shift and mask away.
+    wide = buf.astype(np.int32)
+    window = (wide[:-2] << 16) | (wide[1:-1] << 8) | wide[2:]
+    fs = np.empty((npix, ntiles), dtype=np.int64)
+    code_at = np.zeros((npix, ntiles), dtype=np.int64)
+    one_at = np.zeros((npix, ntiles), dtype=np.int64)
+    lastpix = _bit_words(buf, start, bbits)
+    pos = start + bbits
+    for i0 in range(0, npix, blocksize):
+        i1 = min(i0 + blocksize, npix)
+        block_fs = _bit_words(buf, pos, fsbits, fsbits) - 1
+        pos = np.minimum(pos + fsbits, cap)
+        fs[i0:i1] = block_fs
+        code_at[i0] = pos
+        verbatim = block_fs == fsmax
+        if verbatim.any():
+            # High-entropy block: bbits per difference, stored verbatim.
+            code_at[i0:i1, verbatim] = pos[verbatim] + bbits * np.arange(
+                i1 - i0)[:, np.newaxis]
+            pos[verbatim] += bbits * (i1 - i0)
+        coded = np.flatnonzero((block_fs >= 0) & ~verbatim)
+        if len(coded):
+            # Each code is zeros, a 1 and fs bits: the next one starts
+            # fs + 1 bits after the first 1 from here.
+            after = block_fs[coded].astype(np.int32) + 1
+            at = pos[coded].astype(np.int32)
+            ends = np.empty((i1 - i0, len(coded)), dtype=np.int32)
+            for k in range(i1 - i0):
+                zeros = _LEADING_ZEROS[
+                    (window[at >> 3] >> (8 - (at & 7))) & 0xffff]
+                long_run = zeros == 16
+                if long_run.any():
+                    zeros[long_run] = _run_length(window, at[long_run], cap)
+                at += zeros
+                at += after
+                ends[k] = at
+            one_at[i0:i1, coded] = ends - after
+            code_at[i0 + 1:i1, coded] = ends[:-1]
+            pos[coded] = ends[-1]
+        # Low-entropy blocks (fs < 0) take no bits: all differences zero.
+    if (pos > end).any():
+        raise ValueError('truncated Rice tile')
+    verbatim = fs == fsmax
+    coded = (fs >= 0) & ~verbatim
+    fs[~coded] = 0
+    # A coded difference is (zeros before the 1) << fs, then fs bits.
+    value = _bit_words(buf, np.where(verbatim, code_at, one_at + 1),
+                       np.where(verbatim, bbits, fs),
+                       bbits if verbatim.any() else fsmax - 1)
+    diffs = np.where(coded, ((one_at - code_at) << fs) | value,
+                     np.where(verbatim, value, 0))
+    # Undo the zigzag mapping of the differences, then add them up.
+    diffs = (diffs >> 1) ^ -(diffs & 1)
+    return ((lastpix + np.cumsum(diffs, axis=0)) & ((1 << bbits) - 1)).T
+
+
+def rice_decompress(data, npix, blocksize, bytepix):
+    """Decode one Rice-compressed tile into an int64 array of npix
+    unsigned integers (see rice_decompress_tiles)."""
+    return rice_decompress_tiles([data], npix, blocksize, bytepix)[0]
+
+
+class TileCompressedImage:
+    """Raw (unscaled) pixel sections of one tile-compressed image.
+
+    Raises OSError if the file cannot be read and ValueError if it is not
+    a tile-compressed 2-D integer image in a supported compression.
+    """
+
+    def __init__(self, fits_path):
+        keywords, table, table_offset = nmw_fits.compressed_layout(fits_path)
+        try:
+            self.nx = int(table['ZNAXIS1'])
+            self.ny = int(table['ZNAXIS2'])
+            self.bitpix = int(table['ZBITPIX'])
+            self.tile_nx = int(table.get('ZTILE1', self.nx))
+            self.tile_ny = int(table.get('ZTILE2', 1))
+            self._row_bytes = int(table['NAXIS1'])
+            self._nrows = int(table['NAXIS2'])
+            self._heap = table_offset + int(
+                table.get('THEAP', self._row_bytes * self._nrows))
+            self._col, code = _column_offset(table, 'COMPRESSED_DATA')
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('unsupported compressed image in {}'.format(
+                fits_path))
+        self.compression = str(table.get('ZCMPTYPE', '')).strip()
+        if (self.compression not in SUPPORTED_COMPRESSION
+                or self.bitpix not in (8, 16, 32)
+                or int(table.get('ZNAXIS', 0)) != 2 or code not in 'PQ'
+                or self.tile_nx < 1 or self.tile_ny < 1):
+            raise ValueError('unsupported compressed image in {}'.format(
+                fits_path))
+        self._descriptor = np.dtype('>i4' if code == 'P' else '>i8')
+        params = {}
+        for n in range(1, 10):
+            name = table.get('ZNAME{}'.format(n))
+            if name is None:
+                break
+            params[str(name).strip().upper()] = table.get('ZVAL{}'.format(n))
+        self._blocksize = int(params.get('BLOCKSIZE', RICE_DEFAULT_BLOCKSIZE))
+        self._bytepix = int(params.get('BYTEPIX', self.bitpix // 8))
+        self.keywords = keywords
+        self._tiles_x = (self.nx + self.tile_nx - 1) // self.tile_nx
+        self._table_offset = table_offset
+        self._path = fits_path
+        self._cache = {}
+
+    def _tile_data(self, fh, tx, ty):
+        """(compressed bytes, height, width) of tile (tx, ty)."""
+        row = ty * self._tiles_x + tx
+        if row >= self._nrows:
+            raise ValueError('missing tile {} in {}'.format(row, self._path))
+        fh.seek(self._table_offset + row * self._row_bytes + self._col)
+        count, offset = np.frombuffer(
+            fh.read(2 * self._descriptor.itemsize), dtype=self._descriptor)
+        fh.seek(self._heap + int(offset))
+        data = fh.read(int(count))
+        if len(data) != count or count == 0:
+            raise ValueError('missing tile {} in {}'.format(row, self._path))
+        return (data, min(self.tile_ny, self.ny - ty * self.tile_ny),
+                min(self.tile_nx, self.nx - tx * self.tile_nx))
+
+    def _decode(self, data, h, w):
+        """Pixels of one GZIP_1, GZIP_2 or NOCOMPRESS tile."""
+        if self.compression == 'GZIP_1':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif self.compression == 'GZIP_2':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            # Bytes were shuffled most significant first.
+            data = np.frombuffer(data, dtype=np.uint8).reshape(
+                self.bitpix // 8, -1).T.tobytes()
+        dtype = {8: 'u1', 16: '>i2', 32: '>i4'}[self.bitpix]
+        if len(data) != h * w * (self.bitpix // 8):
+            raise ValueError('bad tile in {}'.format(self._path))
+        return np.frombuffer(data, dtype=dtype).reshape(h, w)
+
+    def _read_tiles(self, fh, keys):
+        """{(tx, ty): pixels} of the tiles keys, int arrays of their shape.
+        Rice tiles of one shape are decoded in batches."""
+        tiles = {}
+        batches = {}                 # (h, w) -> [[key, data], ...]
+        for key in keys:
+            data, h, w = self._tile_data(fh, *key)
+            if self.compression != 'RICE_1':
+                tiles[key] = self._decode(data, h, w)
+                continue
+            batch = batches.setdefault((h, w), [[0]])
+            if batch[-1][0] >= RICE_BATCH_BYTES:
+                batch.append([0])
+            batch[-1][0] += len(data)
+            batch[-1].append((key, data))
+        bbits = 8 * self._bytepix
+        for (h, w), batch in batches.items():
+            for part in batch:
+                part = part[1:]      # after the byte count
+                values = rice_decompress_tiles(
+                    [data for _key, data in part], h * w, self._blocksize,
+                    self._bytepix)
+                if self.bitpix != 8:
+                    # Rice works on unsigned words; FITS 16/32-bit are signed.
+                    values[values >= 1 << (bbits - 1)] -= 1 << bbits
+                for (key, _data), tile in zip(part, values):
+                    tiles[key] = tile.reshape(h, w)
+        return tiles
+
+    def section(self, r0, r1, c0, c1):
+        """Pixels of rows r0..r1-1, columns c0..c1-1 (0-based) as int64,
+        decompressing only the tiles that intersect the box."""
+        out = np.empty((r1 - r0, c1 - c0), dtype=np.int64)
+        keys = [(tx, ty)
+                for ty in range(r0 // self.tile_ny, (r1 - 1) // self.tile_ny + 1)
+                for tx in range(c0 // self.tile_nx, (c1 - 1) // self.tile_nx + 1)]
+        missing = [key for key in keys if key not in self._cache]
+        tiles = {}
+        if missing:
+            with open(self._path, 'rb') as fh:
+                tiles = self._read_tiles(fh, missing)
+            for key in missing:
+                if len(self._cache) < MAX_CACHED_TILES:
+                    self._cache[key] = tiles[key]
+        for tx, ty in keys:
+            tile = self._cache.get((tx, ty))
+            if tile is None:
+                tile = tiles[(tx, ty)]
+            y0, x0 = ty * self.tile_ny, tx * self.tile_nx
+            ya, yb = max(r0, y0), min(r1, y0 + tile.shape[0])
+            xa, xb = max(c0, x0), min(c1, x0 + tile.shape[1])
+            out[ya - r0:yb - r0, xa - c0:xb - c0] = \
+                tile[ya - y0:yb - y0, xa - x0:xb - x0]
+        return out
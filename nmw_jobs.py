@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Background jobs for the long-running coordinate CGIs.
+
+A forced-photometry request can keep the HTTP connection (and a concurrency
+slot) open for up to FORCED_PHOT_TIMEOUT_SECONDS per image; if the browser
+goes away the work is lost. In job mode the CGI instead writes the request
+parameters into a job directory under uploads/, starts a detached worker
+(the same script with '--job <id>') and answers at once with a redirect to
+the job's status URL. The job directory holds:
+  job.json      request parameters (the form fields)
+  status.json   state ('queued', 'running', 'done', 'failed'), a short
+                phase description, progress counters and timestamps;
+                rewritten atomically by Job.update
+  rows.ndjson   one JSON object per result row, appended as rows finish
+  index.html    the results page, written incrementally by the worker
+                (JobPage) exactly as it would have been streamed
+  worker.log    stderr of the worker
+so a finished job can be revisited and shared for as long as housekeeping
+keeps the directory.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+JOB_FILE = 'job.json'
+STATUS_FILE = 'status.json'
+ROWS_FILE = 'rows.ndjson'
+PAGE_FILE = 'index.html'
+LOG_FILE = 'worker.log'
+ACTIVE_STATES = ('queued', 'running')
+
+
+def valid_job_id(job_id, prefix):
+    """True if job_id is '<prefix><digits><8 letters>', the name of a
+    per-request output directory (so it cannot point outside uploads/)."""
+    return bool(job_id) and re.match(
+        r'^{}\d+[A-Za-z]{{8}}$'.format(re.escape(prefix)), job_id) is not None
+
+
+def _write_json(path, obj):
+    """Write obj to path atomically, readable by the web server."""
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(obj, fh, sort_keys=True)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    """Contents of a JSON file, or None if it is missing or unreadable."""
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+class Job:
+    """Status and results of one job directory."""
+
+    def __init__(self, job_dir):
+        self.dir = job_dir
+        self.id = os.path.basename(os.path.normpath(job_dir))
+        self._status = read_json(os.path.join(job_dir, STATUS_FILE)) or {}
+
+    @classmethod
+    def create(cls, job_dir, params):
+        """Write job.json and a 'queued' status into the existing job_dir."""
+        _write_json(os.path.join(job_dir, JOB_FILE), params)
+        job = cls(job_dir)
+        job.update(state='queued', phase='Waiting to start',
+                   created=time.time())
+        return job
+
+    @property
+    def params(self):
+        return read_json(os.path.join(self.dir, JOB_FILE)) or {}
+
+    @property
+    def status(self):
+        return dict(self._status)
+
+    def update(self, **fields):
+        """Merge fields into status.json (with an 'updated' timestamp)."""
+        self._status.update(fields)
+        self._status['updated'] = time.time()
+        _write_json(os.path.join(self.dir, STATUS_FILE), self._status)
+
+    def add_row(self, row):
+        """Append one result row to rows.ndjson."""
+        with open(os.path.join(self.dir, ROWS_FILE), 'a') as fh:
+            fh.write(json.dumps(row, sort_keys=True) + '\n')
+
+
+def read_status(job_dir):
+    """status.json of job_dir, or None if there is no such job."""
+    return read_json(os.path.join(job_dir, STATUS_FILE))
+
+
+def start_worker(script_path, job_dir):
+    """Start 'python3 script_path --job <id>' detached from the request.
+
+    The worker runs in its own session with stdin/stdout off the CGI
+    pipes, so the web server finishes the request right away and a closed
+    browser connection cannot stop the job. Raises OSError.
+    """
+    with open(os.path.join(job_dir, LOG_FILE), 'ab') as log:
+        subprocess.Popen(
+            [sys.executable, script_path, '--job',
+             os.path.basename(os.path.normpath(job_dir))],
+            cwd=os.path.dirname(script_path), stdin=subprocess.DEVNULL,
+            stdout=log, stderr=log, start_new_session=True, close_fds=True)
+
+
+class JobPage:
+    """Writable stand-in for sys.stdout in a worker: the CGI header block
+    (everything up to the first empty line) is dropped and the page body
+    goes to index.html, flushed as the CGI flushes it."""
+
+    def __init__(self, job_dir):
+        self._fh = open(os.path.join(job_dir, PAGE_FILE), 'w')
+        os.chmod(self._fh.name, 0o644)
+        self._in_header = True
+        self._pending = ''
+
+    def write(self, text):
+        n = len(text)
+        if self._in_header:
+            self._pending += text
+            if '\n\n' not in self._pending:
+                return n
+            text = self._pending.split('\n\n', 1)[1]
+            self._in_header = False
+            self._pending = ''
+        self._fh.write(text)
+        return n
+
+    def flush(self):
+        self._fh.flush()
+
+    def close(self):
+        self._fh.close()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Persistent cache of nmw_coord_lib.get_image_metadata() results.
+
+get_image_metadata() runs util/fov_of_wcs_calibrated_image.sh, which costs
+one subprocess per image; in list_all mode that is one per reference image
+on every page view. The parsed result (nx, ny, arcmin_str, deg_str,
+scale_x, scale_y, center_radec) is stored in an SQLite file under
+nmw_coord_lib.CACHE_DIR keyed by the image's real path, and reused for as
+long as the file's size and mtime are unchanged. The database runs in WAL
+mode, so the parallel CGI processes (and the threads within one) read
+concurrently while another one writes.
+
+Command-line use (run from the directory holding local_config.sh, e.g. from
+cron after new reference images are added):
+  python3 nmw_meta_cache.py           pre-warm the cache for every image in
+                                      $REFERENCE_IMAGES and drop the entries
+                                      of files that no longer exist
+"""
+
+import warnings
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import nmw_coord_lib as ncl
+
+
+META_DB_NAME = 'image_meta.sqlite'
+SQLITE_TIMEOUT_SECONDS = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_meta (
+    path    TEXT PRIMARY KEY,   -- os.path.realpath() of the image
+    size    INTEGER NOT NULL,
+    mtime   REAL NOT NULL,
+    info    TEXT NOT NULL       -- JSON object as returned by get_image_metadata
+);
+"""
+
+
+def open_cache():
+    """Open (creating if needed) the metadata cache database.
+
+    Raises OSError if the cache directory cannot be created and
+    sqlite3.Error if the database cannot be opened.
+    """
+    conn = sqlite3.connect(ncl.cache_path(META_DB_NAME),
+                           timeout=SQLITE_TIMEOUT_SECONDS)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.Error:
+        pass
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def cache_key(fits_path):
+    """(realpath, size, mtime) identifying the current content of
+    fits_path. Raises OSError if the file cannot be stat'ed."""
+    real = os.path.realpath(fits_path)
+    st = os.stat(real)
+    return real, st.st_size, st.st_mtime
+
+
+def lookup(key):
+    """Cached metadata dict for a cache_key(), or None on a miss.
+
+    Raises OSError / sqlite3.Error if the cache is unusable.
+    """
+    conn = open_cache()
+    try:
+        row = conn.execute(
+            'SELECT info FROM image_meta WHERE path = ? AND size = ? '
+            'AND mtime = ?', key).fetchone()
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row else None
+
+
+def store(key, info):
+    """Remember info under a cache_key() taken before info was computed,
+    so a file replaced in the meantime is not stored under its new size
+    and mtime."""
+    conn = open_cache()
+    try:
+        conn.execute(
+            'INSERT OR REPLACE INTO image_meta (path, size, mtime, info) '
+            'VALUES (?, ?, ?, ?)', tuple(key) + (json.dumps(info),))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def cached_image_metadata(fits_path, vast_dir, compute):
+    """compute(fits_path, vast_dir) through the cache.
+
+    Failures (compute returning None) are not cached, so an image that
+    could not be read is retried on the next request. If the cache cannot
+    be used the result is computed directly.
+    """
+    key = None
+    try:
+        key = cache_key(fits_path)
+        info = lookup(key)
+        if info is not None:
+            return info
+    except (OSError, sqlite3.Error, ValueError):
+        pass
+    info = compute(fits_path, vast_dir)
+    if info is not None and key is not None:
+        try:
+            store(key, info)
+        except (OSError, sqlite3.Error):
+            pass
+    return info
+
+
+def prune():
+    """Drop the entries of files that no longer exist or have changed.
+    Returns the number of entries removed."""
+    conn = open_cache()
+    try:
+        dead = []
+        for path, size, mtime in conn.execute(
+                'SELECT path, size, mtime FROM image_meta'):
+            try:
+                st = os.stat(path)
+            except OSError:
+                dead.append(path)
+                continue
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                dead.append(path)
+        conn.executemany('DELETE FROM image_meta WHERE path = ?',
+                         [(p,) for p in dead])
+        conn.commit()
+    finally:
+        conn.close()
+    return len(dead)
+
+
+# ---------- command line ----------
+
+def main(argv):
+    if len(argv) != 1:
+        print('Usage: `python3 nmw_meta_cache.py` to pre-warm the image '
+              'metadata cache for $REFERENCE_IMAGES')
+        return 1
+    # Same cwd convention as the CGIs: local_config.sh and uploads/ live
+    # next to this script.
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    cfg = ncl.read_config_vars('REFERENCE_IMAGES', 'VAST_REFERENCE_COPY')
+    ref_dir = cfg['REFERENCE_IMAGES'].strip()
+    vast_dir = cfg['VAST_REFERENCE_COPY'].strip()
+    if not os.path.isdir(ref_dir) or not os.path.isdir(vast_dir):
+        print('ERROR: REFERENCE_IMAGES or VAST_REFERENCE_COPY is not a '
+              'directory (check local_config.sh)', file=sys.stderr)
+        return 1
+    start = time.time()
+    removed = prune()
+    paths = ncl.list_fits_files(ref_dir)
+    with ThreadPoolExecutor(max_workers=ncl.DEFAULT_PARALLEL_WORKERS) as ex:
+        results = list(ex.map(
+            lambda p: ncl.get_image_metadata(p, vast_dir), paths))
+    failed = sum(1 for r in results if r is None)
+    print('Image metadata cache: {} images, {} unreadable, {} stale entries '
+          'removed; {:.1f} s'.format(len(paths), failed, removed,
+                                     time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    if 'REQUEST_METHOD' in os.environ:
+        print("This script cannot be run via a web request.", file=sys.stderr)
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Shared cache of the Phase 1 calibration products of coord_forced_photometry.
+
+Phase 1 runs lib/sextract_single_image_noninteractive and
+util/solve_plate_with_UCAC5 on every image of a request (30-60 s per image,
+mostly the UCAC5 + APASS queries) inside a disposable VaST working copy, so
+the same night's images were solved again for every position asked about.
+After a successful solve the products Phase 2 short-circuits on are now
+kept under nmw_coord_lib.CACHE_DIR/phase1, one directory per image:
+
+  image.cat, image.cat.aperture  the SExtractor catalogue (default.param)
+  wcs.cat                        wcs_<basename>.cat (wcs.param)
+  wcs.cat.ucac5                  the photometric wcs_<basename>.cat.ucac5
+  wcs.fits                       the plate-solved image, if the solve wrote
+                                 one next to the catalogues
+
+The key is the identity of the original image (real path, size, mtime) and
+the contents of the working copy's KEY_FILES (hashed: the working copy is
+rsynced with --no-times, so their mtimes change with every copy), so a
+replaced image or an updated VaST tree is solved again. A later request copies the
+products into its working copy under the names the VaST scripts look for,
+registers the catalogue in vast_images_catalogs.log the way
+_seed_sextractor_catalog does, and skips both tools. The files are copied,
+not hard linked: the VaST scripts rewrite some of them in place with shell
+redirections, which through a link would change the cached copy.
+
+An entry is written to a temporary directory and renamed into place, so
+concurrent requests never see half an entry. The cache is trimmed to
+CACHE_MAX_MB, least recently used first (a hit bumps the manifest's
+mtime), at most every EVICT_INTERVAL_SECONDS.
+
+Command-line use:
+  python3 nmw_phase1_cache.py         report the cache size and trim it to
+                                      COORD_PHASE1_CACHE_MB from
+                                      local_config.sh
+"""
+
+import warnings
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import nmw_coord_lib as ncl
+
+
+PHASE1_DIR_NAME = 'phase1'
+CACHE_MAX_MB = 4096                  # coord_forced_photometry sets it from
+                                     # COORD_PHASE1_CACHE_MB (0 = off)
+EVICT_INTERVAL_SECONDS = 300
+EVICT_TARGET_FRACTION = 0.9          # trim to this fraction of the budget
+MANIFEST = 'manifest.json'
+# Files of the working copy whose contents are part of the key.
+KEY_FILES = ('util/solve_plate_with_UCAC5', 'default.sex')
+CATALOG_LOG = 'vast_images_catalogs.log'
+_EVICT_STAMP = '.last_evict'
+
+
+def cache_budget_mb(raw):
+    """Parse COORD_PHASE1_CACHE_MB; empty or invalid gives the default."""
+    try:
+        value = int(raw.strip()) if raw.strip() else CACHE_MAX_MB
+    except ValueError:
+        return CACHE_MAX_MB
+    return max(0, value)
+
+
+def phase1_dir():
+    """Return the cache directory, creating it. Raises OSError."""
+    path = ncl.cache_path(PHASE1_DIR_NAME)
+    os.makedirs(path, mode=0o755, exist_ok=True)
+    return path
+
+
+def entry_key(fits_path, work_dir):
+    """Hash identifying the Phase 1 products of fits_path solved in
+    work_dir, or None if the cache is off or a file cannot be stat'ed."""
+    if CACHE_MAX_MB <= 0:
+        return None
+    try:
+        real = os.path.realpath(fits_path)
+        st = os.stat(real)
+        tools = []
+        for name in KEY_FILES:
+            with open(os.path.join(work_dir, name), 'rb') as fh:
+                tools.append(hashlib.sha256(fh.read()).hexdigest())
+    except OSError:
+        return None
+    ident = [real, st.st_size, st.st_mtime_ns, tools]
+    return hashlib.sha256(json.dumps(ident).encode('utf-8')).hexdigest()
+
+
+def wcs_name(compute_path):
+    """Name of the plate-solved image solve_plate_with_UCAC5 derives from
+    compute_path ('wcs_' is not doubled)."""
+    base = os.path.basename(compute_path)
+    return base if base.startswith('wcs_') else 'wcs_' + base
+
+
+def _logged_catalog(work_dir, compute_path):
+    """The catalogue vast_images_catalogs.log lists for compute_path (the
+    last such line), as a path, or None."""
+    found = None
+    try:
+        with open(os.path.join(work_dir, CATALOG_LOG)) as fh:
+            for line in fh:
+                toks = line.split()
+                if len(toks) == 2 and toks[1] == compute_path:
+                    found = toks[0]
+    except OSError:
+        return None
+    if found is None:
+        return None
+    return os.path.join(work_dir, found)
+
+
+def _products(work_dir, compute_path):
+    """{cache name: path in work_dir} of the products to keep, or None if
+    a required one is missing."""
+    cat = _logged_catalog(work_dir, compute_path)
+    wcs = os.path.join(work_dir, wcs_name(compute_path))
+    files = {
+        'image.cat': cat,
+        'image.cat.aperture': cat and cat + '.aperture',
+        'wcs.cat.ucac5': wcs + '.cat.ucac5',
+    }
+    if not all(path and os.path.isfile(path) for path in files.values()):
+        return None
+    if os.path.isfile(wcs + '.cat'):
+        files['wcs.cat'] = wcs + '.cat'
+    # For .fz uploads compute_path itself is the wcs_ image in work_dir; it
+    # is funpacked again on every request, so it is not kept.
+    if wcs != compute_path and os.path.isfile(wcs):
+        files['wcs.fits'] = wcs
+    return files
+
+
+def store(key, work_dir, compute_path):
+    """Keep the Phase 1 products of compute_path from work_dir under key.
+    Returns True if an entry was added."""
+    files = _products(work_dir, compute_path)
+    if files is None:
+        return False
+    try:
+        cache = phase1_dir()
+        entry = os.path.join(cache, key[:2], key)
+        if os.path.isdir(entry):
+            return False
+        os.makedirs(os.path.dirname(entry), mode=0o755, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp', dir=os.path.dirname(entry))
+    except OSError:
+        return False
+    try:
+        for name, src in files.items():
+            shutil.copyfile(src, os.path.join(tmp, name))
+        with open(os.path.join(tmp, MANIFEST), 'w') as fh:
+            json.dump({'files': sorted(files), 'stored': time.time()}, fh)
+        os.chmod(tmp, 0o755)
+        os.rename(tmp, entry)
+    except OSError:
+        # Includes losing the race to another request storing the same key.
+        shutil.rmtree(tmp, ignore_errors=True)
+        return False
+    maybe_evict(cache, CACHE_MAX_MB)
+    return True
+
+
+def restore(key, work_dir, compute_path):
+    """Copy the products cached under key into work_dir for compute_path and
+    register its catalogue in vast_images_catalogs.log.
+
+    Returns True on a hit; the caller can then skip SExtractor and the plate
+    solve. Nothing is registered on a miss or a failed copy.
+    """
+    try:
+        entry = os.path.join(phase1_dir(), key[:2], key)
+        with open(os.path.join(entry, MANIFEST)) as fh:
+            names = json.load(fh)['files']
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    compute_base = os.path.basename(compute_path)
+    wcs = wcs_name(compute_path)
+    # Named like sextract_single_image_noninteractive's image_pid<PID>.cat:
+    # <compute_base>.cat would be wcs.cat itself for a wcs_ upload.
+    image_cat = 'image_{}.cat'.format(compute_base)
+    targets = {
+        'image.cat': image_cat,
+        'image.cat.aperture': image_cat + '.aperture',
+        'wcs.cat': wcs + '.cat',
+        'wcs.cat.ucac5': wcs + '.cat.ucac5',
+        'wcs.fits': wcs,
+    }
+    try:
+        for name in names:
+            dst = os.path.join(work_dir, targets[name])
+            shutil.copyfile(os.path.join(entry, name), dst)
+            # Fresh mtime, newer than default.sex, like a catalogue seeded
+            # by _seed_sextractor_catalog.
+            os.utime(dst, None)
+        with open(os.path.join(work_dir, CATALOG_LOG), 'a') as fh:
+            fh.write('{} {}\n'.format(image_cat, compute_path))
+    except (OSError, KeyError):
+        return False
+    try:
+        os.utime(os.path.join(entry, MANIFEST), None)
+    except OSError:
+        pass
+    return True
+
+
+def cache_usage(cache):
+    """List (last use, size, entry dir) of the cached entries, oldest
+    first."""
+    entries = []
+    for sub in os.listdir(cache):
+        sub_path = os.path.join(cache, sub)
+        if not os.path.isdir(sub_path):
+            continue
+        for name in os.listdir(sub_path):
+            if '.' in name:
+                continue             # being written or deleted
+            entry = os.path.join(sub_path, name)
+            try:
+                used = os.stat(os.path.join(entry, MANIFEST)).st_mtime
+                size = sum(os.stat(os.path.join(entry, f)).st_size
+                           for f in os.listdir(entry))
+            except OSError:
+                continue
+            entries.append((used, size, entry))
+    entries.sort()
+    return entries
+
+
+def evict(cache, max_mb):
+    """Delete least recently used entries until the cache fits in
+    EVICT_TARGET_FRACTION of max_mb. Returns (n_removed, bytes_left)."""
+    entries = cache_usage(cache)
+    total = sum(size for _used, size, _entry in entries)
+    if total <= max_mb * 1024 * 1024:
+        return 0, total
+    target = max_mb * 1024 * 1024 * EVICT_TARGET_FRACTION
+    removed = 0
+    for _used, size, entry in entries:
+        if total <= target:
+            break
+        # Rename first so a request never copies from a half-deleted entry.
+        doomed = '{}.del{}'.format(entry, os.getpid())
+        try:
+            os.rename(entry, doomed)
+        except OSError:
+            continue
+        shutil.rmtree(doomed, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed, total
+
+
+def maybe_evict(cache, max_mb):
+    """Run evict() if nobody did in the last EVICT_INTERVAL_SECONDS."""
+    stamp = os.path.join(cache, _EVICT_STAMP)
+    try:
+        if time.time() - os.stat(stamp).st_mtime < EVICT_INTERVAL_SECONDS:
+            return
+    except OSError:
+        pass
+    try:
+        fd = open(stamp, 'a')
+    except OSError:
+        return
+    try:
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fd.close()
+        return
+    try:
+        os.utime(stamp, None)
+        evict(cache, max_mb)
+    except OSError:
+        pass
+    finally:
+        fd.close()
+
+
+# ---------- command line ----------
+
+def main(argv):
+    if len(argv) != 1:
+        print('Usage: `python3 nmw_phase1_cache.py` to report the Phase 1 '
+              'cache size and trim it to COORD_PHASE1_CACHE_MB')
+        return 1
+    # Same cwd convention as the CGIs: local_config.sh and uploads/ live
+    # next to this script.
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    max_mb = cache_budget_mb(
+        ncl.read_config_vars('COORD_PHASE1_CACHE_MB')
+        ['COORD_PHASE1_CACHE_MB'])
+    cache = phase1_dir()
+    entries = cache_usage(cache)
+    removed, left = evict(cache, max_mb) if max_mb > 0 else (0, None)
+    print('Phase 1 cache: {} images, {:.1f} MB; budget {} MB; {} evicted'
+          .format(len(entries) - removed,
+                  (left if left is not None else
+                   sum(e[1] for e in entries)) / 1048576.0,
+                  max_mb, removed))
+    return 0
+
+
+if __name__ == '__main__':
+    if 'REQUEST_METHOD' in os.environ:
+        print("This script cannot be run via a web request.", file=sys.stderr)
+        sys.exit(1)
+    sys.exit(main(sys.argv))
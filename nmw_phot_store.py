@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Persistent store of coord_forced_photometry measurements.
+
+Every successful run_forced_photometry_c() result (jd, mag, err, status,
+x, y, aperture) is kept in an SQLite file under nmw_coord_lib.CACHE_DIR,
+keyed by
+
+  the image          real path, size and mtime, as in nmw_meta_cache
+  the position       R.A. and Dec. rounded to a COORD_GRID_ARCSEC grid
+  the band           the calibration band the image was measured in
+  the configuration  a hash of the VaST tools that did the measurement
+                     (MEASURE_KEY_FILES) and of the SExtractor
+                     configuration of the image's camera
+
+so a later request at the same position, or a wider window_days, only
+measures the images that are not in the store yet. The aperture is chosen
+by the tools from the image itself (the SExtractor seeing), so it is kept
+as a result; the tools and configuration that determine it are what the
+key holds. Failed and off-frame measurements are not stored: they are
+retried on the next request. The database runs in WAL mode, so the
+parallel CGI processes (and the threads within one) read concurrently
+while another one writes.
+
+Command-line use (run from the directory holding local_config.sh, e.g.
+from cron):
+  python3 nmw_phot_store.py           drop the measurements of images that
+                                      no longer exist or have changed
+"""
+
+import warnings
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+import nmw_coord_lib as ncl
+
+
+PHOT_DB_NAME = 'forced_phot.sqlite'
+SQLITE_TIMEOUT_SECONDS = 30
+COORD_GRID_ARCSEC = 0.1
+# Files of the VaST tree whose contents are part of the configuration key.
+MEASURE_KEY_FILES = ('util/forced_photometry.sh',
+                     'util/solve_plate_with_UCAC5')
+DEFAULT_SEXTRACTOR_CONFIG = 'default.sex'
+RESULT_FIELDS = ('jd', 'mag', 'err', 'status', 'x', 'y', 'aperture')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS phot (
+    path     TEXT NOT NULL,     -- os.path.realpath() of the image
+    size     INTEGER NOT NULL,
+    mtime    REAL NOT NULL,
+    ra_cell  INTEGER NOT NULL,  -- R.A. / COORD_GRID_ARCSEC
+    dec_cell INTEGER NOT NULL,  -- Dec. / COORD_GRID_ARCSEC
+    band     TEXT NOT NULL,
+    config   TEXT NOT NULL,     -- config_key()
+    jd       TEXT NOT NULL,     -- as printed by the C engine
+    mag      TEXT NOT NULL,
+    err      TEXT NOT NULL,
+    status   TEXT NOT NULL,
+    x        REAL NOT NULL,
+    y        REAL NOT NULL,
+    aperture REAL,
+    stored   REAL NOT NULL,
+    PRIMARY KEY (path, size, mtime, ra_cell, dec_cell, band, config)
+);
+"""
+
+
+def open_store():
+    """Open (creating if needed) the measurement store.
+
+    Raises OSError if the cache directory cannot be created and
+    sqlite3.Error if the database cannot be opened.
+    """
+    conn = sqlite3.connect(ncl.cache_path(PHOT_DB_NAME),
+                           timeout=SQLITE_TIMEOUT_SECONDS)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.Error:
+        pass
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def position_cells(ra_deg, dec_deg):
+    """(ra_cell, dec_cell) of a position on the COORD_GRID_ARCSEC grid;
+    R.A. wraps at 360 deg."""
+    per_deg = 3600.0 / COORD_GRID_ARCSEC
+    ra_cells = int(round(360.0 * per_deg))
+    return (int(round((ra_deg % 360.0) * per_deg)) % ra_cells,
+            int(round(dec_deg * per_deg)))
+
+
+def config_key(vast_dir, sextractor_config=None):
+    """Hash of the MEASURE_KEY_FILES and the SExtractor configuration file
+    (default.sex if None) in vast_dir. Raises OSError if one is
+    unreadable."""
+    digest = hashlib.sha256()
+    for name in MEASURE_KEY_FILES + (
+            sextractor_config or DEFAULT_SEXTRACTOR_CONFIG,):
+        with open(os.path.join(vast_dir, name), 'rb') as fh:
+            digest.update(hashlib.sha256(fh.read()).digest())
+    return digest.hexdigest()
+
+
+def measurement_key(fits_path, cells, band, config):
+    """Full key of a measurement of fits_path. Raises OSError if the file
+    cannot be stat'ed."""
+    real = os.path.realpath(fits_path)
+    st = os.stat(real)
+    return (real, st.st_size, st.st_mtime) + tuple(cells) + (band, config)
+
+
+_KEY_WHERE = ('path = ? AND size = ? AND mtime = ? AND ra_cell = ? '
+              'AND dec_cell = ? AND band = ? AND config = ?')
+
+
+def lookup(keys):
+    """{key: result dict} of the measurement_key()s found in the store
+    (one connection for all of them).
+
+    Raises OSError / sqlite3.Error if the store is unusable.
+    """
+    found = {}
+    conn = open_store()
+    try:
+        for key in keys:
+            row = conn.execute(
+                'SELECT {} FROM phot WHERE {}'.format(
+                    ', '.join(RESULT_FIELDS), _KEY_WHERE), key).fetchone()
+            if row is not None:
+                found[key] = dict(zip(RESULT_FIELDS, row))
+    finally:
+        conn.close()
+    return found
+
+
+def store(key, result):
+    """Remember the result dict of run_forced_photometry_c() under a
+    measurement_key() taken before the measurement, so an image replaced
+    in the meantime is not stored under its new size and mtime."""
+    conn = open_store()
+    try:
+        conn.execute(
+            'INSERT OR REPLACE INTO phot (path, size, mtime, ra_cell, '
+            'dec_cell, band, config, {}, stored) VALUES ({})'.format(
+                ', '.join(RESULT_FIELDS),
+                ', '.join('?' * (len(key) + len(RESULT_FIELDS) + 1))),
+            tuple(key) + tuple(result[f] for f in RESULT_FIELDS)
+            + (time.time(),))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def prune():
+    """Drop the measurements of images that no longer exist or have
+    changed. Returns the number of rows removed."""
+    conn = open_store()
+    try:
+        dead = []
+        for path, size, mtime in conn.execute(
+                'SELECT DISTINCT path, size, mtime FROM phot'):
+            try:
+                st = os.stat(path)
+            except OSError:
+                dead.append((path, size, mtime))
+                continue
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                dead.append((path, size, mtime))
+        removed = 0
+        for ident in dead:
+            removed += conn.execute(
+                'DELETE FROM phot WHERE path = ? AND size = ? AND mtime = ?',
+                ident).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return removed
+
+
+# ---------- command line ----------
+
+def main(argv):
+    if len(argv) != 1:
+        print('Usage: `python3 nmw_phot_store.py` to drop the stored '
+              'measurements of images that no longer exist')
+        return 1
+    # Same cwd convention as the CGIs: local_config.sh and uploads/ live
+    # next to this script.
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    start = time.time()
+    removed = prune()
+    conn = open_store()
+    try:
+        left = conn.execute('SELECT COUNT(*) FROM phot').fetchone()[0]
+    finally:
+        conn.close()
+    print('Forced-photometry store: {} measurements, {} stale removed; '
+          '{:.1f} s'.format(left, removed, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    if 'REQUEST_METHOD' in os.environ:
+        print("This script cannot be run via a web request.", file=sys.stderr)
+        sys.exit(1)
+    sys.exit(main(sys.argv))
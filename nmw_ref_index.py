@@ -0,0 +1,671 @@
+#!/usr/bin/env python3
+"""
+Persistent footprint index of the reference images in $REFERENCE_IMAGES.
+
+run_sky2xy_scan() used to fork lib/bin/sky2xy once per reference image on
+every request. This module keeps, for every reference FITS file, its WCS
+header keywords, the sky position of the image centre, a polygon tracing
+the image border and a bounding cap (centre + radius) in an SQLite file
+under nmw_coord_lib.CACHE_DIR. A position query then reduces to a cap test
+and a point-in-polygon test per reference. A HEALPix cell table (nested
+scheme, CELL_NSIDE) lists for every sky cell the references whose footprint
+may overlap it, so a lookup only tests the short list of references filed
+under the cell containing the position. The candidates whose footprint
+contains the point are then projected in-process by nmw_wcs (one NumPy
+operation for all of them); sky2xy is only needed for headers nmw_wcs does
+not support, or when NumPy is not installed.
+
+Entries are keyed by path and rebuilt only when the file's size or mtime
+changes (together with their cell entries), so adding or replacing a
+reference costs one footprint computation rather than a full rebuild.
+Files that could not be indexed yet (another process holds the index
+lock, or the per-request refresh budget ran out) are returned as
+candidates, so an incomplete index never hides a match.
+
+Command-line use (run from the directory holding local_config.sh, e.g. from
+cron after new reference images are added):
+  python3 nmw_ref_index.py            refresh the index for $REFERENCE_IMAGES
+  python3 nmw_ref_index.py RA DEC     list the references whose footprint
+                                      contains RA DEC
+  python3 nmw_ref_index.py --cell RA DEC
+                                      print the HEALPix cell of RA DEC and
+                                      the references filed under it
+"""
+
+import warnings
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+import fcntl
+import json
+import math
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+
+import nmw_coord_lib as ncl
+import nmw_fits
+import nmw_wcs
+
+
+INDEX_DB_NAME = 'ref_index.sqlite'
+INDEX_LOCK_NAME = 'ref_index.lock'
+SQLITE_TIMEOUT_SECONDS = 30
+REFRESH_BUDGET_SECONDS = 30          # in-request cap on (re)building footprints
+XY2SKY_TIMEOUT_SECONDS = 10
+FOOTPRINT_MARGIN_PIX = 16.0          # outline drawn this far outside the frame,
+                                     # so edge rounding never drops a true match
+OUTLINE_POINTS_PER_SIDE = 4          # follows field curvature of wide-field WCS
+CELL_NSIDE = 32                      # HEALPix resolution, ~1.8 deg cells
+_CELL_REACH_DEG = 64.0               # NSIDE times a bound on the centre-to-corner
+                                     # distance of any cell (61.3 deg / NSIDE)
+
+# Header keywords describing the image geometry and its WCS (TAN, TAN-SIP
+# and TPV). Everything else in the header is not stored.
+_WCS_KEY_RE = re.compile(
+    r'^(?:Z?NAXIS[12]|CTYPE[12]|CUNIT[12]|CRVAL[12]|CRPIX[12]|CDELT[12]'
+    r'|CROTA[12]|CD[12]_[12]|PC[12]_[12]|EQUINOX|EPOCH|RADESYS|RADECSYS'
+    r'|LONPOLE|LATPOLE|A_ORDER|B_ORDER|AP_ORDER|BP_ORDER'
+    r'|A_\d+_\d+|B_\d+_\d+|AP_\d+_\d+|BP_\d+_\d+|PV[12]_\d+)$')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS footprints (
+    path    TEXT PRIMARY KEY,
+    size    INTEGER NOT NULL,
+    mtime   REAL NOT NULL,
+    status  TEXT NOT NULL,      -- 'ok', 'no_wcs' or 'error'
+    nx      INTEGER,
+    ny      INTEGER,
+    wcs     TEXT,               -- JSON object of _WCS_KEY_RE header keywords
+    ra      REAL,               -- image centre, degrees
+    dec     REAL,
+    radius  REAL,               -- bounding cap radius around the centre, degrees
+    outline TEXT                -- JSON list of [ra, dec] border points, degrees
+);
+CREATE TABLE IF NOT EXISTS cells (
+    nside   INTEGER NOT NULL,
+    cell    INTEGER NOT NULL,   -- HEALPix nested cell number
+    path    TEXT NOT NULL,      -- reference whose footprint may overlap the cell
+    PRIMARY KEY (nside, cell, path)
+);
+CREATE INDEX IF NOT EXISTS cells_by_path ON cells (path, nside);
+"""
+
+
+# ---------- FITS header ----------
+
+def read_wcs_keywords(fits_path):
+    """Return a dict of the geometry/WCS keywords of fits_path, or None if
+    it cannot be read.
+
+    Read in-process by nmw_fits, so it also works for compressed FITS: the
+    ZNAXISn keywords of the compressed-image extension come back as NAXISn.
+    """
+    try:
+        keywords = nmw_fits.read_header(fits_path)
+    except (OSError, ValueError):
+        return None
+    return {k: v for k, v in keywords.items() if _WCS_KEY_RE.match(k)}
+
+
+# ---------- pixel -> sky via lib/bin/xy2sky ----------
+
+def _pixels_to_sky(fits_path, vast_dir, points):
+    """Convert a list of (x, y) pixel positions to (ra, dec) degrees with a
+    single lib/bin/xy2sky call. Raises ValueError if any point fails."""
+    argv = [os.path.join(vast_dir, 'lib', 'bin', 'xy2sky'), '-d', fits_path]
+    for x, y in points:
+        argv.extend(['{:.3f}'.format(x), '{:.3f}'.format(y)])
+    try:
+        result = subprocess.run(argv, capture_output=True, text=True,
+                                timeout=XY2SKY_TIMEOUT_SECONDS)
+    except (subprocess.TimeoutExpired, OSError) as err:
+        raise ValueError('xy2sky failed: {}'.format(err))
+    sky = []
+    for line in result.stdout.splitlines():
+        tokens = line.split()
+        if '<-' not in tokens or len(tokens) < 2:
+            continue
+        sky.append((float(tokens[0]), float(tokens[1])))
+    if len(sky) != len(points):
+        raise ValueError('xy2sky returned {} of {} points'.format(
+            len(sky), len(points)))
+    return sky
+
+
+def outline_pixels(nx, ny, margin=FOOTPRINT_MARGIN_PIX,
+                   per_side=OUTLINE_POINTS_PER_SIDE):
+    """Pixel positions tracing the frame border (FITS 1-based convention,
+    pixel centres at integers, so the frame spans 0.5 .. n + 0.5), pushed
+    outwards by margin pixels. Points run anticlockwise from the lower left.
+    """
+    x0, x1 = 0.5 - margin, nx + 0.5 + margin
+    y0, y1 = 0.5 - margin, ny + 0.5 + margin
+    pts = []
+    for i in range(per_side):
+        pts.append((x0 + (x1 - x0) * i / per_side, y0))
+    for i in range(per_side):
+        pts.append((x1, y0 + (y1 - y0) * i / per_side))
+    for i in range(per_side):
+        pts.append((x1 - (x1 - x0) * i / per_side, y1))
+    for i in range(per_side):
+        pts.append((x0, y1 - (y1 - y0) * i / per_side))
+    return pts
+
+
+def build_footprint(fits_path, vast_dir):
+    """Compute the index record for one reference image.
+
+    Returns a dict with keys status, nx, ny, wcs, ra, dec, radius, outline.
+    status is 'no_wcs' for images without a celestial WCS and 'error' when
+    the header could not be read (or xy2sky failed on a projection nmw_wcs
+    does not handle).
+    """
+    rec = {'status': 'error', 'nx': None, 'ny': None, 'wcs': None,
+           'ra': None, 'dec': None, 'radius': None, 'outline': None}
+    wcs = read_wcs_keywords(fits_path)
+    if wcs is None:
+        return rec
+    try:
+        nx = int(wcs['NAXIS1'])
+        ny = int(wcs['NAXIS2'])
+    except (KeyError, TypeError, ValueError):
+        return rec
+    rec['nx'], rec['ny'], rec['wcs'] = nx, ny, wcs
+    if not str(wcs.get('CTYPE1', '')).startswith('RA'):
+        rec['status'] = 'no_wcs'
+        return rec
+    points = [(nx / 2.0 + 0.5, ny / 2.0 + 0.5)] + outline_pixels(nx, ny)
+    parsed = nmw_wcs.parse_wcs(wcs) if nmw_wcs.HAVE_NUMPY else None
+    if parsed is not None:
+        stack = nmw_wcs.stack_wcs([parsed])
+        ra_arr, dec_arr = nmw_wcs.pixel_to_sky(
+            stack, [[p[0] for p in points]], [[p[1] for p in points]])
+        sky = [(float(a), float(d)) for a, d in zip(ra_arr[0], dec_arr[0])]
+    else:
+        try:
+            sky = _pixels_to_sky(fits_path, vast_dir, points)
+        except ValueError:
+            return rec
+    ra_c, dec_c = sky[0]
+    outline = sky[1:]
+    rec.update({
+        'status': 'ok',
+        'ra': ra_c,
+        'dec': dec_c,
+        'radius': max(angular_separation(ra_c, dec_c, ra, dec)
+                      for ra, dec in outline),
+        'outline': outline,
+    })
+    return rec
+
+
+# ---------- spherical geometry ----------
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Great-circle distance in degrees between two positions in degrees."""
+    ra1, dec1, ra2, dec2 = (math.radians(v) for v in (ra1, dec1, ra2, dec2))
+    h = (math.sin((dec2 - dec1) / 2.0) ** 2 +
+         math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2.0) ** 2)
+    return math.degrees(2.0 * math.asin(min(1.0, math.sqrt(h))))
+
+
+def _gnomonic(ra0, dec0, ra, dec):
+    """Standard coordinates (xi, eta) of (ra, dec) on the plane tangent at
+    (ra0, dec0); all in degrees. Raises ValueError for points 90 degrees
+    or more away from the tangent point."""
+    ra0, dec0, ra, dec = (math.radians(v) for v in (ra0, dec0, ra, dec))
+    cos_c = (math.sin(dec0) * math.sin(dec) +
+             math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0))
+    if cos_c <= 1e-9:
+        raise ValueError('point is not on the tangent hemisphere')
+    xi = math.cos(dec) * math.sin(ra - ra0) / cos_c
+    eta = (math.cos(dec0) * math.sin(dec) -
+           math.sin(dec0) * math.cos(dec) * math.cos(ra - ra0)) / cos_c
+    return xi, eta
+
+
+def _point_in_polygon(x, y, poly):
+    """Even-odd ray-casting test of (x, y) against a list of (x, y) vertices."""
+    inside = False
+    n = len(poly)
+    for i in range(n):
+        xa, ya = poly[i]
+        xb, yb = poly[(i + 1) % n]
+        if (ya > y) != (yb > y):
+            if x < xa + (y - ya) * (xb - xa) / (yb - ya):
+                inside = not inside
+    return inside
+
+
+def footprint_contains(ra_c, dec_c, radius, outline, ra, dec):
+    """True if (ra, dec) lies inside the footprint outline (degrees)."""
+    if angular_separation(ra_c, dec_c, ra, dec) > radius:
+        return False
+    try:
+        poly = [_gnomonic(ra_c, dec_c, a, d) for a, d in outline]
+        px, py = _gnomonic(ra_c, dec_c, ra, dec)
+    except ValueError:
+        return False
+    return _point_in_polygon(px, py, poly)
+
+
+# ---------- HEALPix cells ----------
+
+# Per-face offsets of the nested scheme (HEALPix C++ healpix_base).
+_JRLL = (2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4)
+_JPLL = (1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7)
+
+_cell_centres = {}                   # nside -> list of unit vectors, built lazily
+
+
+def _spread_bits(v):
+    r = 0
+    bit = 0
+    while v:
+        r |= (v & 1) << (2 * bit)
+        v >>= 1
+        bit += 1
+    return r
+
+
+def _compress_bits(v):
+    r = 0
+    bit = 0
+    while v:
+        r |= (v & 1) << bit
+        v >>= 2
+        bit += 1
+    return r
+
+
+def healpix_cell(nside, ra, dec):
+    """Nested-scheme HEALPix cell number of (ra, dec) in degrees.
+
+    nside must be a power of two.
+    """
+    z = math.sin(math.radians(dec))
+    za = abs(z)
+    tt = (ra % 360.0) / 90.0
+    if za <= 2.0 / 3.0:
+        # Equatorial region.
+        temp1 = nside * (0.5 + tt)
+        temp2 = nside * z * 0.75
+        jp = int(temp1 - temp2)
+        jm = int(temp1 + temp2)
+        ifp = jp // nside
+        ifm = jm // nside
+        if ifp == ifm:
+            face = ifp | 4
+        elif ifp < ifm:
+            face = ifp
+        else:
+            face = ifm + 8
+        ix = jm & (nside - 1)
+        iy = nside - (jp & (nside - 1)) - 1
+    else:
+        # Polar caps.
+        ntt = min(3, int(tt))
+        tp = tt - ntt
+        tmp = nside * math.sqrt(3.0 * (1.0 - za))
+        jp = min(int(tp * tmp), nside - 1)
+        jm = min(int((1.0 - tp) * tmp), nside - 1)
+        if z >= 0:
+            face, ix, iy = ntt, nside - jm - 1, nside - jp - 1
+        else:
+            face, ix, iy = ntt + 8, jp, jm
+    return face * nside * nside + _spread_bits(ix) + (_spread_bits(iy) << 1)
+
+
+def healpix_cell_centre(nside, cell):
+    """(ra, dec) in degrees of the centre of a nested-scheme HEALPix cell."""
+    npface = nside * nside
+    face, ipf = divmod(cell, npface)
+    ix = _compress_bits(ipf)
+    iy = _compress_bits(ipf >> 1)
+    jr = _JRLL[face] * nside - ix - iy - 1
+    fact2 = 4.0 / (12 * npface)
+    if jr < nside:
+        nr = jr
+        z = 1.0 - nr * nr * fact2
+        kshift = 0
+    elif jr > 3 * nside:
+        nr = 4 * nside - jr
+        z = nr * nr * fact2 - 1.0
+        kshift = 0
+    else:
+        nr = nside
+        z = (2 * nside - jr) * 2 * nside * fact2
+        kshift = (jr - nside) & 1
+    jp = (_JPLL[face] * nr + ix - iy + 1 + kshift) // 2
+    if jp > 4 * nside:
+        jp -= 4 * nside
+    if jp < 1:
+        jp += 4 * nside
+    ra = (jp - (kshift + 1) * 0.5) * (90.0 / nr)
+    return ra % 360.0, math.degrees(math.asin(max(-1.0, min(1.0, z))))
+
+
+def _unit_vector(ra, dec):
+    ra, dec = math.radians(ra), math.radians(dec)
+    return (math.cos(dec) * math.cos(ra), math.cos(dec) * math.sin(ra),
+            math.sin(dec))
+
+
+def footprint_cells(ra_c, dec_c, radius, nside=CELL_NSIDE):
+    """Cells that may overlap the cap of the given radius around (ra_c, dec_c).
+
+    Conservative: a cell is listed when its centre lies within radius plus
+    the largest cell radius, so any point of the cap falls in a listed cell.
+    """
+    centres = _cell_centres.get(nside)
+    if centres is None:
+        centres = [_unit_vector(*healpix_cell_centre(nside, c))
+                   for c in range(12 * nside * nside)]
+        _cell_centres[nside] = centres
+    cx, cy, cz = _unit_vector(ra_c, dec_c)
+    reach = radius + _CELL_REACH_DEG / nside
+    if reach >= 180.0:
+        return list(range(len(centres)))
+    min_dot = math.cos(math.radians(reach))
+    return [c for c, (x, y, z) in enumerate(centres)
+            if x * cx + y * cy + z * cz >= min_dot]
+
+
+# ---------- the index ----------
+
+def open_index():
+    """Open (creating if needed) the footprint index database.
+
+    Raises OSError if the cache directory cannot be created and
+    sqlite3.Error if the database cannot be opened.
+    """
+    conn = sqlite3.connect(ncl.cache_path(INDEX_DB_NAME),
+                           timeout=SQLITE_TIMEOUT_SECONDS)
+    try:
+        # WAL lets the many reading CGIs proceed while one refreshes.
+        conn.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.Error:
+        pass
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _try_lock():
+    """Non-blocking exclusive flock on the index lock file, or None."""
+    try:
+        fd = open(ncl.cache_path(INDEX_LOCK_NAME), 'w')
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fd.close()
+        return None
+    return fd
+
+
+def _store(conn, path, size, mtime, rec):
+    conn.execute(
+        'INSERT OR REPLACE INTO footprints '
+        '(path, size, mtime, status, nx, ny, wcs, ra, dec, radius, outline) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (path, size, mtime, rec['status'], rec['nx'], rec['ny'],
+         json.dumps(rec['wcs']) if rec['wcs'] is not None else None,
+         rec['ra'], rec['dec'], rec['radius'],
+         json.dumps(rec['outline']) if rec['outline'] is not None else None))
+    conn.execute('DELETE FROM cells WHERE path = ?', (path,))
+    if rec['status'] == 'ok':
+        _store_cells(conn, path, rec['ra'], rec['dec'], rec['radius'])
+
+
+def _store_cells(conn, path, ra_c, dec_c, radius):
+    conn.executemany(
+        'INSERT OR REPLACE INTO cells (nside, cell, path) VALUES (?, ?, ?)',
+        [(CELL_NSIDE, c, path)
+         for c in footprint_cells(ra_c, dec_c, radius, CELL_NSIDE)])
+
+
+def _same_dir(path, ref_dir):
+    return os.path.dirname(path) == os.path.normpath(ref_dir)
+
+
+def refresh_index(conn, ref_dir, vast_dir, deadline=None):
+    """Bring the index entries for ref_dir in line with the files on disk.
+
+    New files and files whose size or mtime changed get their footprint
+    and cell entries (re)computed; entries for files that disappeared are
+    dropped, and footprints indexed without cells at CELL_NSIDE (older
+    index, or NSIDE changed) get them added. Only one process refreshes at
+    a time; the others skip the rebuild.
+
+    Returns the list of paths whose entry is still missing or stale
+    (deadline reached, or another process holds the lock), so the caller
+    can treat them as unindexed.
+    """
+    current = {}
+    for path in ncl.list_fits_files(ref_dir):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        current[path] = (st.st_size, st.st_mtime)
+    known = {}
+    for path, size, mtime in conn.execute(
+            'SELECT path, size, mtime FROM footprints'):
+        if _same_dir(path, ref_dir):
+            known[path] = (size, mtime)
+    stale = [p for p in sorted(current) if known.get(p) != current[p]]
+    gone = [p for p in known if p not in current]
+    uncelled = [row for row in conn.execute(
+        "SELECT path, ra, dec, radius FROM footprints WHERE status = 'ok' "
+        'AND NOT EXISTS (SELECT 1 FROM cells '
+        'WHERE cells.path = footprints.path AND cells.nside = ?)',
+        (CELL_NSIDE,))
+        if _same_dir(row[0], ref_dir) and row[0] in current
+        and row[0] not in stale]
+    if not stale and not gone and not uncelled:
+        return []
+
+    lock = _try_lock()
+    if lock is None:
+        return stale + [row[0] for row in uncelled]
+    try:
+        if gone:
+            conn.executemany('DELETE FROM footprints WHERE path = ?',
+                             [(p,) for p in gone])
+            conn.executemany('DELETE FROM cells WHERE path = ?',
+                             [(p,) for p in gone])
+            conn.commit()
+        if uncelled:
+            conn.execute('DELETE FROM cells WHERE nside != ?', (CELL_NSIDE,))
+            for path, ra_c, dec_c, radius in uncelled:
+                _store_cells(conn, path, ra_c, dec_c, radius)
+            conn.commit()
+        for i, path in enumerate(stale):
+            if deadline is not None and time.time() > deadline:
+                return stale[i:]
+            rec = build_footprint(path, vast_dir)
+            size, mtime = current[path]
+            _store(conn, path, size, mtime, rec)
+            # Commit per file so an interrupted refresh keeps its progress.
+            conn.commit()
+    finally:
+        lock.close()
+    return []
+
+
+def _query(ref_dir, vast_dir, points, deadline):
+    """Refresh the index, then return (pending, hits) for the positions.
+
+    points is a list of (ra, dec). pending is the set of paths that could
+    not be indexed in time; hits[k] lists (path, status, wcs) for every
+    other reference in ref_dir that is filed under the HEALPix cell of
+    points[k] and whose footprint contains it, plus the 'error' entries.
+    """
+    conn = open_index()
+    try:
+        pending = set(refresh_index(conn, ref_dir, vast_dir, deadline))
+        errors = [(path, status, wcs) for path, status, wcs in conn.execute(
+            "SELECT path, status, wcs FROM footprints WHERE status = 'error'")
+            if path not in pending and _same_dir(path, ref_dir)]
+        hits = []
+        for ra, dec in points:
+            point_hits = []
+            for path, status, wcs, ra_c, dec_c, radius, outline in conn.execute(
+                    'SELECT f.path, f.status, f.wcs, f.ra, f.dec, f.radius, '
+                    'f.outline FROM cells c JOIN footprints f ON f.path = c.path '
+                    'WHERE c.nside = ? AND c.cell = ?',
+                    (CELL_NSIDE, healpix_cell(CELL_NSIDE, ra, dec))):
+                if path in pending or not _same_dir(path, ref_dir):
+                    continue
+                if footprint_contains(ra_c, dec_c, radius, json.loads(outline),
+                                      ra, dec):
+                    point_hits.append((path, status, wcs))
+            hits.append(point_hits + errors)
+    finally:
+        conn.close()
+    return pending, hits
+
+
+def candidate_references(ref_dir, vast_dir, ra, dec, deadline=None):
+    """Return the sorted list of reference paths that may cover (ra, dec).
+
+    That is every indexed image whose footprint contains the position, plus
+    the images that could not be indexed (tool errors, or not refreshed yet)
+    so that sky2xy can decide for them as before.
+    """
+    pending, hits = _query(ref_dir, vast_dir, [(ra, dec)], deadline)
+    return sorted(pending | {path for path, _status, _wcs in hits[0]})
+
+
+def locate_in_references(ref_dir, vast_dir, ra, dec, deadline=None):
+    """Pixel position of (ra, dec) on every reference image covering it.
+
+    Returns (matches, unresolved): matches is a sorted list of (path, x, y)
+    computed in-process by nmw_wcs, unresolved the sorted list of candidate
+    paths it could not handle (not indexed yet, unreadable, unsupported
+    projection, no NumPy) that still need sky2xy.
+    """
+    matches, unresolved = locate_many_in_references(
+        ref_dir, vast_dir, [(ra, dec)], deadline)
+    return matches[0], unresolved[0]
+
+
+def locate_many_in_references(ref_dir, vast_dir, points, deadline=None):
+    """locate_in_references() for a list of (ra, dec) positions at once.
+
+    The index is refreshed once, and the WCS of every reference covering
+    any of the positions is parsed once and projected for all of them in a
+    single nmw_wcs call. Returns (matches, unresolved), two lists with one
+    entry per position, each as returned by locate_in_references().
+    """
+    pending, hits = _query(ref_dir, vast_dir, points, deadline)
+    unresolved = [set(pending) for _ in points]
+    columns = {}                     # path -> index into parsed
+    parsed = []
+    wanted = [[] for _ in points]
+    for k, point_hits in enumerate(hits):
+        for path, status, wcs in point_hits:
+            if path not in columns:
+                wcs_params = None
+                if status == 'ok' and nmw_wcs.HAVE_NUMPY:
+                    wcs_params = nmw_wcs.parse_wcs(json.loads(wcs))
+                columns[path] = len(parsed) if wcs_params is not None else None
+                if wcs_params is not None:
+                    parsed.append(wcs_params)
+            if columns[path] is None:
+                unresolved[k].add(path)
+            else:
+                wanted[k].append(path)
+    matches = [[] for _ in points]
+    if parsed:
+        stack = nmw_wcs.stack_wcs(parsed)
+        x, y, status = nmw_wcs.sky_to_pixel(
+            stack, [[ra for ra, _dec in points]] * len(parsed),
+            [[dec for _ra, dec in points]] * len(parsed))
+        for k, paths in enumerate(wanted):
+            for path in paths:
+                i = columns[path]
+                if status[i, k] == 'ok':
+                    matches[k].append((path, float(x[i, k]), float(y[i, k])))
+    return ([sorted(m) for m in matches],
+            [sorted(u) for u in unresolved])
+
+
+# ---------- command line ----------
+
+def main(argv):
+    args = argv[1:]
+    show_cell = bool(args) and args[0] == '--cell'
+    if show_cell:
+        args = args[1:]
+    if len(args) not in (0, 2) or (show_cell and not args) or \
+            (args and args[0] in ('-h', '--help')):
+        print('Usage: `python3 nmw_ref_index.py` to refresh the index, '
+              '`python3 nmw_ref_index.py RA DEC` to query it, or '
+              '`python3 nmw_ref_index.py --cell RA DEC` to show the HEALPix '
+              'cell of RA DEC and the references filed under it')
+        return 1
+    # Same cwd convention as the CGIs: local_config.sh and uploads/ live
+    # next to this script.
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    cfg = ncl.read_config_vars('REFERENCE_IMAGES', 'VAST_REFERENCE_COPY')
+    ref_dir = cfg['REFERENCE_IMAGES'].strip()
+    vast_dir = cfg['VAST_REFERENCE_COPY'].strip()
+    if not os.path.isdir(ref_dir) or not os.path.isdir(vast_dir):
+        print('ERROR: REFERENCE_IMAGES or VAST_REFERENCE_COPY is not a '
+              'directory (check local_config.sh)', file=sys.stderr)
+        return 1
+    if args:
+        try:
+            ra, dec = ncl.parse_coordinates(' '.join(args))
+            ra_deg, dec_deg = ncl.radec_to_degrees(ra, dec)
+        except ValueError as err:
+            print('ERROR: {}'.format(err), file=sys.stderr)
+            return 1
+        if show_cell:
+            cell = healpix_cell(CELL_NSIDE, ra_deg, dec_deg)
+            conn = open_index()
+            try:
+                refresh_index(conn, ref_dir, vast_dir)
+                paths = sorted(p for (p,) in conn.execute(
+                    'SELECT path FROM cells WHERE nside = ? AND cell = ?',
+                    (CELL_NSIDE, cell)) if _same_dir(p, ref_dir))
+            finally:
+                conn.close()
+            print('NSIDE={} nested cell {}: {} references'.format(
+                CELL_NSIDE, cell, len(paths)))
+            for path in paths:
+                print(path)
+            return 0
+        for path in candidate_references(ref_dir, vast_dir, ra_deg, dec_deg):
+            print(path)
+        return 0
+    start = time.time()
+    conn = open_index()
+    try:
+        pending = refresh_index(conn, ref_dir, vast_dir)
+        counts = dict(conn.execute(
+            'SELECT status, COUNT(*) FROM footprints GROUP BY status'))
+        (n_cells,), = conn.execute(
+            'SELECT COUNT(DISTINCT cell) FROM cells WHERE nside = ?',
+            (CELL_NSIDE,))
+    finally:
+        conn.close()
+    print('Footprint index: {} ok, {} without WCS, {} unreadable; '
+          '{} not refreshed (index locked); {} of {} HEALPix cells '
+          '(NSIDE={}) covered; {:.1f} s'.format(
+              counts.get('ok', 0), counts.get('no_wcs', 0),
+              counts.get('error', 0), len(pending), n_cells,
+              12 * CELL_NSIDE * CELL_NSIDE, CELL_NSIDE, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    if 'REQUEST_METHOD' in os.environ:
+        print("This script cannot be run via a web request.", file=sys.stderr)
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+In-process PNG thumbnail renderer for the coordinate pages.
+
+An alternative to util/fits2png and util/make_finding_chart, selected with
+COORD_THUMBNAIL_RENDERER=numpy in local_config.sh. The pgfv tools decode
+the whole frame for every thumbnail, so a search result row (preview and
+hi-res zoom-out, preview and hi-res zoom-in) read each image four times.
+FitsImage memory-maps the pixel array of one FITS file instead:
+  - zoom-outs are block averages of the full frame; the first one requested
+    bins it ZOOMOUT_BASE_MULTIPLIER times finer than it needs and keeps
+    that, and the other sizes are binned further from it, so the preview
+    and its hi-res version come from one decode in either order;
+  - zoom-ins only read the rows and columns of the cutout; for
+    tile-compressed (.fz) images only the tiles intersecting the cutout
+    are decompressed (nmw_fz).
+Both are shown with a percentile stretch, dark stars on a light background
+like the pgfv charts, with the target marked by a red cross and (zoom-in)
+the photometric aperture circle, and are encoded to PNG with zlib.
+
+Zoom-outs of tile-compressed images raise ValueError and are left to the
+pgfv tools, which decompress a full frame much faster than Python. NumPy
+is optional: without it HAVE_NUMPY is False and the pgfv tools are used.
+"""
+
+import os
+import struct
+import zlib
+
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+import nmw_fits
+
+
+STRETCH_LOW_PERCENTILE = 1.0
+STRETCH_HIGH_PERCENTILE = 99.5
+STRETCH_SAMPLE_PIXELS = 250000       # percentiles come from at most this many pixels
+BIN_CHUNK_PIXELS = 1 << 22           # source pixels converted to float per step
+# The pages render the zoom-out preview and then its hi-res version
+# nmw_coord_lib.HIRES_THUMBNAIL_MULTIPLIER times larger; the first zoom-out
+# of an image is binned this many times finer so both share one decode.
+ZOOMOUT_BASE_MULTIPLIER = 4
+MARKER_RGB = (255, 0, 0)
+PNG_COMPRESSION_LEVEL = 6
+
+_BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8',
+                  -32: '>f4', -64: '>f8'}
+
+
+class FitsImage:
+    """Pixel array of one FITS image, mapped on first use.
+
+    Raises OSError if the file cannot be read and ValueError if it is not
+    a 2-D image with a supported BITPIX (and, if tile-compressed, a
+    compression nmw_fz can decode).
+    """
+
+    def __init__(self, fits_path):
+        try:
+            keywords, offset = nmw_fits.image_layout(fits_path)
+            self._tiles = None
+        except ValueError:
+            # Imported here: only tile-compressed images need it.
+            import nmw_fz
+            self._tiles = nmw_fz.TileCompressedImage(fits_path)
+            keywords, offset = self._tiles.keywords, None
+        try:
+            self.nx = int(keywords['NAXIS1'])
+            self.ny = int(keywords['NAXIS2'])
+            self._dtype = _BITPIX_DTYPES[int(keywords['BITPIX'])]
+            self._bscale = float(keywords.get('BSCALE', 1.0))
+            self._bzero = float(keywords.get('BZERO', 0.0))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('unsupported image in {}'.format(fits_path))
+        if self.nx < 1 or self.ny < 1:
+            raise ValueError('empty image in {}'.format(fits_path))
+        if offset is not None and offset + self.nx * self.ny * \
+                np.dtype(self._dtype).itemsize > os.path.getsize(fits_path):
+            raise ValueError('truncated image in {}'.format(fits_path))
+        self.path = fits_path
+        self._offset = offset
+        self._data = None
+        self._binned = None          # (factor, array) zoom-outs are binned from
+
+    def _pixels(self):
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=self._dtype, mode='r',
+                                   offset=self._offset,
+                                   shape=(self.ny, self.nx))
+        return self._data
+
+    def _section(self, r0, r1, c0, c1):
+        """Raw pixels of rows r0..r1-1, columns c0..c1-1 (0-based)."""
+        if self._tiles is not None:
+            return self._tiles.section(r0, r1, c0, c1)
+        return self._pixels()[r0:r1, c0:c1]
+
+    def _scaled(self, raw):
+        values = np.asarray(raw, dtype=np.float32)
+        if self._bscale != 1.0 or self._bzero != 0.0:
+            values = values * np.float32(self._bscale) + np.float32(self._bzero)
+        return values
+
+    def _bin_frame(self, factor):
+        """Block average of the frame by factor, decoded in row strips."""
+        data = self._pixels()
+        by, bx = self.ny // factor, self.nx // factor
+        out = np.empty((by, bx), dtype=np.float32)
+        step = max(1, BIN_CHUNK_PIXELS // (factor * factor * bx))
+        for r0 in range(0, by, step):
+            r1 = min(by, r0 + step)
+            block = self._scaled(data[r0 * factor:r1 * factor, :bx * factor])
+            out[r0:r1] = block.reshape(r1 - r0, factor, bx, factor).mean(
+                axis=(1, 3))
+        return out
+
+    def zoomout(self, png_w, png_h):
+        """Full frame resampled to png_h x png_w (row 0 = top of the PNG).
+
+        Raises ValueError for a tile-compressed image.
+        """
+        if self._tiles is not None:
+            raise ValueError('no zoom-out of compressed {}'.format(self.path))
+        factor = max(1, int(min(self.nx / float(png_w),
+                                self.ny / float(png_h))))
+        if self._binned is None or self._binned[0] > factor:
+            base_factor = max(1, factor // ZOOMOUT_BASE_MULTIPLIER)
+            self._binned = (base_factor, self._bin_frame(base_factor))
+        base_factor, base = self._binned
+        step = factor // base_factor
+        if step > 1:
+            by, bx = base.shape[0] // step, base.shape[1] // step
+            base = base[:by * step, :bx * step].reshape(
+                by, step, bx, step).mean(axis=(1, 3))
+        rows = ((np.arange(png_h) + 0.5) * base.shape[0] / png_h).astype(int)
+        cols = ((np.arange(png_w) + 0.5) * base.shape[1] / png_w).astype(int)
+        return base[np.ix_(rows[::-1], cols)]
+
+    def zoomin(self, x, y, half_width, png_pixels):
+        """png_pixels square covering (x - half_width .. x + half_width) and
+        the same in y, FITS pixel coordinates; NaN outside the frame.
+
+        Only the bounding box of the cutout is read from the file.
+        """
+        centres = (np.arange(png_pixels) + 0.5) * (2.0 * half_width / png_pixels)
+        cols = np.floor(x - half_width + centres + 0.5).astype(int) - 1
+        rows = np.floor(y + half_width - centres + 0.5).astype(int) - 1
+        col_ok = (cols >= 0) & (cols < self.nx)
+        row_ok = (rows >= 0) & (rows < self.ny)
+        out = np.full((png_pixels, png_pixels), np.nan, dtype=np.float32)
+        if col_ok.any() and row_ok.any():
+            rows, cols = rows[row_ok], cols[col_ok]
+            r0, c0 = rows.min(), cols.min()
+            box = self._section(r0, rows.max() + 1, c0, cols.max() + 1)
+            out[np.ix_(row_ok, col_ok)] = self._scaled(
+                box[np.ix_(rows - r0, cols - c0)])
+        return out
+
+
+def stretch(values):
+    """uint8 grey levels for values, percentile stretch, dark = bright sky."""
+    finite = values[np.isfinite(values)]
+    if finite.size > STRETCH_SAMPLE_PIXELS:
+        finite = finite[::finite.size // STRETCH_SAMPLE_PIXELS + 1]
+    if finite.size == 0:
+        return np.full(values.shape, 255, dtype=np.uint8)
+    lo, hi = np.percentile(finite, (STRETCH_LOW_PERCENTILE,
+                                    STRETCH_HIGH_PERCENTILE))
+    if hi <= lo:
+        hi = lo + 1.0
+    level = np.clip((np.nan_to_num(values, nan=lo) - lo) / (hi - lo), 0.0, 1.0)
+    return (255.0 - level * 255.0 + 0.5).astype(np.uint8)
+
+
+def _grey_to_rgb(grey):
+    return np.repeat(grey[:, :, np.newaxis], 3, axis=2)
+
+
+def _line_width(png_h):
+    return max(1, png_h // 256)
+
+
+def draw_cross(rgb, cx, cy, gap, arm, width):
+    """Four red ticks from gap to gap + arm PNG pixels around (cx, cy)."""
+    h, w = rgb.shape[:2]
+    cx = int(round(cx))
+    cy = int(round(cy))
+    half = width // 2
+    across = (cy - half, cy - half + width)
+    along = (cx - half, cx - half + width)
+    for (r0, r1), (c0, c1) in ((across, (cx - gap - arm, cx - gap)),
+                               (across, (cx + gap + 1, cx + gap + arm + 1)),
+                               ((cy - gap - arm, cy - gap), along),
+                               ((cy + gap + 1, cy + gap + arm + 1), along)):
+        r0, r1 = max(0, r0), min(h, r1)
+        c0, c1 = max(0, c0), min(w, c1)
+        if r0 < r1 and c0 < c1:
+            rgb[r0:r1, c0:c1] = MARKER_RGB
+
+
+def draw_circle(rgb, cx, cy, radius, width):
+    """Red circle of the given radius (PNG pixels) centred on (cx, cy)."""
+    h, w = rgb.shape[:2]
+    reach = int(radius + width) + 1
+    r0, r1 = max(0, int(cy) - reach), min(h, int(cy) + reach + 1)
+    c0, c1 = max(0, int(cx) - reach), min(w, int(cx) + reach + 1)
+    if r0 >= r1 or c0 >= c1:
+        return
+    yy, xx = np.mgrid[r0:r1, c0:c1]
+    dist = np.hypot(xx + 0.5 - cx, yy + 0.5 - cy)
+    rgb[r0:r1, c0:c1][np.abs(dist - radius) <= width / 2.0 + 0.25] = MARKER_RGB
+
+
+def encode_png(rgb):
+    """8-bit RGB PNG file contents for an (h, w, 3) uint8 array."""
+    h, w = rgb.shape[:2]
+    raw = np.zeros((h, 1 + 3 * w), dtype=np.uint8)   # filter byte 0 per row
+    raw[:, 1:] = rgb.reshape(h, 3 * w)
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), PNG_COMPRESSION_LEVEL)) +
+            chunk(b'IEND', b''))
+
+
+def zoomout_png(image, x, y, png_w, png_h):
+    """PNG of the full frame; marks pixel (x, y) unless x or y is None."""
+    rgb = _grey_to_rgb(stretch(image.zoomout(png_w, png_h)))
+    if x is not None and y is not None:
+        arm = max(4, png_h // 16)
+        draw_cross(rgb, (x - 0.5) * png_w / image.nx,
+                   png_h - (y - 0.5) * png_h / image.ny,
+                   arm // 2, arm, _line_width(png_h))
+    return encode_png(rgb)
+
+
+def zoomin_png(image, x, y, half_width, png_pixels, aperture_diameter=None):
+    """PNG of the 2*half_width square around (x, y), target marked with a
+    cross and, if aperture_diameter (source pixels) is given, a circle."""
+    rgb = _grey_to_rgb(stretch(image.zoomin(x, y, half_width, png_pixels)))
+    scale = png_pixels / (2.0 * half_width)
+    centre = png_pixels / 2.0
+    width = _line_width(png_pixels)
+    gap = max(3, png_pixels // 40)
+    if aperture_diameter:
+        radius = aperture_diameter / 2.0 * scale
+        draw_circle(rgb, centre, centre, radius, width)
+        gap = max(gap, int(radius) + 2 * width + 1)
+    draw_cross(rgb, centre, centre, gap, max(4, png_pixels // 12), width)
+    return encode_png(rgb)
+
+
+def write_png(path, data):
+    """Write PNG bytes to path atomically (readable by the web server)."""
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as fh:
+        fh.write(data)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of the PNG thumbnails rendered by nmw_coord_lib.
+
+Every coord_search / forced-photometry request renders its thumbnails with
+util/fits2png and util/make_finding_chart into its own output directory,
+so the same reference image was re-rendered on every visit. A rendered PNG
+is now also kept under nmw_coord_lib.CACHE_DIR/thumbs, named after a hash
+of everything that determines its pixels: the FITS file identity (real
+path, size, mtime), the tool and its mtime, the tool arguments (marker
+position, zoom width, aperture circle) and the PNG size. A hit is hard
+linked into the request's output directory, so page markup and URLs are
+unchanged.
+
+Renders of the same key are serialised by an flock on one of
+LOCK_STRIPES lock files, so concurrent requests render a PNG once and the
+others link the result. The cache is trimmed to
+nmw_coord_lib.THUMB_CACHE_MAX_MB, least recently used first (a hit bumps
+the file's mtime), at most every EVICT_INTERVAL_SECONDS.
+
+Command-line use:
+  python3 nmw_thumb_cache.py          report the cache size and trim it to
+                                      COORD_THUMBNAIL_CACHE_MB from
+                                      local_config.sh
+"""
+
+import warnings
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import nmw_coord_lib as ncl
+
+
+THUMB_DIR_NAME = 'thumbs'
+LOCK_STRIPES = 256
+EVICT_INTERVAL_SECONDS = 300
+EVICT_TARGET_FRACTION = 0.9          # trim to this fraction of the budget
+_EVICT_STAMP = '.last_evict'
+
+
+def thumb_dir():
+    """Return the cache directory, creating it. Raises OSError."""
+    path = ncl.cache_path(THUMB_DIR_NAME)
+    os.makedirs(os.path.join(path, 'locks'), mode=0o755, exist_ok=True)
+    return path
+
+
+def thumb_key(argv, fits_path, png_w, png_h):
+    """Hash identifying the PNG that argv renders from fits_path.
+
+    Raises OSError if the FITS file or the tool cannot be stat'ed.
+    """
+    real = os.path.realpath(fits_path)
+    st = os.stat(real)
+    tool_st = os.stat(argv[0])
+    ident = [real, st.st_size, st.st_mtime_ns,
+             os.path.basename(argv[0]), tool_st.st_mtime_ns,
+             ['<fits>' if a == fits_path else a for a in argv[1:]],
+             png_w, png_h]
+    return hashlib.sha256(json.dumps(ident).encode('utf-8')).hexdigest()
+
+
+def _link(src, dst):
+    """Hard-link src to dst (replacing dst), copying if linking is not
+    possible. Returns False if src does not exist."""
+    try:
+        os.unlink(dst)
+    except OSError:
+        pass
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        try:
+            shutil.copyfile(src, dst)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            return False
+    return True
+
+
+def _serve(entry, dst):
+    """Link a cached entry to dst and mark it recently used."""
+    if not _link(entry, dst):
+        return False
+    try:
+        os.utime(entry, None)
+    except OSError:
+        pass
+    return True
+
+
+def _store(src, entry):
+    """Atomically add the rendered PNG src to the cache as entry."""
+    tmp = '{}.tmp{}'.format(entry, os.getpid())
+    if _link(src, tmp):
+        try:
+            os.replace(tmp, entry)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+def cached_render(argv, out_dir, png_w, png_h, fits_path, dst_name, render):
+    """Produce out_dir/dst_name through the cache.
+
+    render() runs the tool and returns dst_name (or None on failure); it is
+    only called on a miss, under the lock for this key. If the cache cannot
+    be used, render() is called directly.
+    """
+    max_mb = ncl.THUMB_CACHE_MAX_MB
+    if max_mb <= 0:
+        return render()
+    try:
+        cache = thumb_dir()
+        key = thumb_key(argv, fits_path, png_w, png_h)
+    except OSError:
+        return render()
+    entry = os.path.join(cache, key[:2], key + '.png')
+    dst = os.path.join(out_dir, dst_name)
+    if _serve(entry, dst):
+        return dst_name
+    try:
+        os.makedirs(os.path.dirname(entry), mode=0o755, exist_ok=True)
+        lock = open(os.path.join(cache, 'locks', '{:02x}.lock'.format(
+            int(key[:4], 16) % LOCK_STRIPES)), 'w')
+    except OSError:
+        return render()
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        # Another request may have rendered it while we waited.
+        if _serve(entry, dst):
+            return dst_name
+        name = render()
+        if name is not None:
+            _store(os.path.join(out_dir, name), entry)
+    finally:
+        lock.close()
+    maybe_evict(cache, max_mb)
+    return name
+
+
+def cache_usage(cache):
+    """List (mtime, size, path) of the cached PNGs, oldest first."""
+    entries = []
+    for sub in os.listdir(cache):
+        sub_path = os.path.join(cache, sub)
+        if sub == 'locks' or not os.path.isdir(sub_path):
+            continue
+        for name in os.listdir(sub_path):
+            if not name.endswith('.png'):
+                continue
+            path = os.path.join(sub_path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    return entries
+
+
+def evict(cache, max_mb):
+    """Delete least recently used PNGs until the cache fits in
+    EVICT_TARGET_FRACTION of max_mb. Returns (n_removed, bytes_left)."""
+    entries = cache_usage(cache)
+    total = sum(size for _mtime, size, _path in entries)
+    if total <= max_mb * 1024 * 1024:
+        return 0, total
+    target = max_mb * 1024 * 1024 * EVICT_TARGET_FRACTION
+    removed = 0
+    for _mtime, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed, total
+
+
+def maybe_evict(cache, max_mb):
+    """Run evict() if nobody did in the last EVICT_INTERVAL_SECONDS."""
+    stamp = os.path.join(cache, _EVICT_STAMP)
+    try:
+        if time.time() - os.stat(stamp).st_mtime < EVICT_INTERVAL_SECONDS:
+            return
+    except OSError:
+        pass
+    try:
+        fd = open(stamp, 'a')
+    except OSError:
+        return
+    try:
+        fcntl.flock(fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fd.close()
+        return
+    try:
+        os.utime(stamp, None)
+        evict(cache, max_mb)
+    except OSError:
+        pass
+    finally:
+        fd.close()
+
+
+# ---------- command line ----------
+
+def main(argv):
+    if len(argv) != 1:
+        print('Usage: `python3 nmw_thumb_cache.py` to report the thumbnail '
+              'cache size and trim it to COORD_THUMBNAIL_CACHE_MB')
+        return 1
+    # Same cwd convention as the CGIs: local_config.sh and uploads/ live
+    # next to this script.
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    max_mb = ncl.thumb_cache_budget_mb(
+        ncl.read_config_vars('COORD_THUMBNAIL_CACHE_MB')
+        ['COORD_THUMBNAIL_CACHE_MB'])
+    cache = thumb_dir()
+    entries = cache_usage(cache)
+    removed, left = evict(cache, max_mb) if max_mb > 0 else (0, None)
+    print('Thumbnail cache: {} PNGs, {:.1f} MB; budget {} MB; {} evicted'
+          .format(len(entries) - removed,
+                  (left if left is not None else
+                   sum(e[1] for e in entries)) / 1048576.0,
+                  max_mb, removed))
+    return 0
+
+
+if __name__ == '__main__':
+    if 'REQUEST_METHOD' in os.environ:
+        print("This script cannot be run via a web request.", file=sys.stderr)
+        sys.exit(1)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Per-request phase timings of the Python CGIs.
+
+Each CGI's main() is wrapped with timed_request(script); inside it, the
+phases of the request (config load, slot wait, scan, metadata, every
+thumbnail render, Phase 1, Phase 2, the lightcurve, ...) are timed with
+
+    with nmw_timing.phase('scan') as counts:
+        ...
+        counts['matches'] = n
+
+or recorded afterwards with record(name, seconds, **counts) (thread-safe,
+for work done in worker threads). Nothing is written until the request
+ends; then one JSON line per phase name goes to LOG_PATH with the request
+id, the script, the summed seconds, the number of occurrences ('n'), the
+individual durations when there were several ('samples') and the counts
+given for it, plus a 'total' line with the whole request. Outside a
+timed request the helpers do nothing.
+
+Command-line use:
+  python3 nmw_timing.py [--days N] [--script NAME] [LOG_PATH]
+prints p50/p95/p99 of every phase per day (UTC) and script, over the last
+N days (default 7).
+"""
+
+import fcntl
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+# Absolute, so it does not depend on the cwd the CGI chose.
+LOG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        'uploads', 'coord_cache', 'request_timing.jsonl')
+REPORT_DAYS = 7
+PERCENTILES = (50, 95, 99)
+
+_request = None                      # the RequestTimer of this process
+_lock = threading.Lock()
+
+
+class RequestTimer:
+    """Phase durations and counts of one request."""
+
+    def __init__(self, script):
+        self.script = script
+        self.id = uuid.uuid4().hex[:12]
+        self.start = time.time()
+        self.phases = {}             # name -> {'samples': [...], counts}
+        self.counts = {}
+
+    def add(self, name, seconds, counts):
+        with _lock:
+            entry = self.phases.setdefault(name, {'samples': []})
+            entry['samples'].append(seconds)
+            for key, value in counts.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool) \
+                        and isinstance(entry.get(key), (int, float)):
+                    entry[key] += value
+                else:
+                    entry[key] = value
+
+    def records(self):
+        """The JSON-able log lines of this request."""
+        base = {'ts': round(self.start, 3), 'request': self.id,
+                'script': self.script}
+        out = []
+        with _lock:
+            phases = sorted(self.phases.items())
+        for name, entry in phases:
+            rec = dict(base, phase=name)
+            samples = entry['samples']
+            rec.update((k, v) for k, v in entry.items() if k != 'samples')
+            rec['s'] = round(sum(samples), 4)
+            rec['n'] = len(samples)
+            if len(samples) > 1:
+                rec['samples'] = [round(t, 4) for t in samples]
+            out.append(rec)
+        out.append(dict(base, phase='total',
+                        s=round(time.time() - self.start, 4), n=1,
+                        **self.counts))
+        return out
+
+
+def start(script):
+    """Begin timing a request of script (one per process at a time)."""
+    global _request
+    _request = RequestTimer(script)
+    return _request
+
+
+def finish(log_path=None):
+    """Append the records of the current request to the log and stop."""
+    global _request
+    request, _request = _request, None
+    if request is None:
+        return
+    lines = ''.join(json.dumps(rec, sort_keys=True) + '\n'
+                    for rec in request.records())
+    path = log_path or LOG_PATH
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as fh:
+            # One locked write per request, so concurrent requests never
+            # interleave their lines.
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            fh.write(lines)
+    except OSError as err:
+        sys.stderr.write('request timing not logged: {}\n'.format(err))
+
+
+def timed_request(script):
+    """Decorator for a CGI main(): times the call as one request."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start(script)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                finish()
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def phase(name, **counts):
+    """Time the block as phase name; the yielded dict takes counts."""
+    counts = dict(counts)
+    t0 = time.time()
+    try:
+        yield counts
+    finally:
+        record(name, time.time() - t0, **counts)
+
+
+def record(name, seconds, **counts):
+    """Add one occurrence of phase name to the current request."""
+    request = _request
+    if request is not None:
+        request.add(name, seconds, counts)
+
+
+def count(**counts):
+    """Set request-level counts, logged with the 'total' line."""
+    request = _request
+    if request is not None:
+        with _lock:
+            request.counts.update(counts)
+
+
+# ---------- report ----------
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of a non-empty sorted list."""
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def load_samples(log_path, since=0.0, script=None):
+    """{(day, script, phase): [seconds, ...]} from the log."""
+    groups = {}
+    try:
+        fh = open(log_path)
+    except OSError:
+        return groups
+    with fh:
+        for line in fh:
+            try:
+                rec = json.loads(line)
+                ts = float(rec['ts'])
+                key = (time.strftime('%Y-%m-%d', time.gmtime(ts)),
+                       rec['script'], rec['phase'])
+                samples = rec.get('samples') or [rec['s']]
+            except (ValueError, KeyError, TypeError):
+                continue
+            if ts < since or (script and rec['script'] != script):
+                continue
+            groups.setdefault(key, []).extend(float(t) for t in samples)
+    return groups
+
+
+def report(log_path=None, days=REPORT_DAYS, script=None, out=sys.stdout):
+    """Print the percentile table; returns the number of rows."""
+    groups = load_samples(log_path or LOG_PATH,
+                          since=time.time() - days * 86400, script=script)
+    header = '{:<10} {:<24} {:<14} {:>7} {:>9} {:>9} {:>9}'.format(
+        'day', 'script', 'phase', 'n',
+        *('p{}'.format(p) for p in PERCENTILES))
+    print(header, file=out)
+    for (day, script_name, name), values in sorted(groups.items()):
+        values.sort()
+        print('{:<10} {:<24} {:<14} {:>7} {}'.format(
+            day, script_name, name, len(values),
+            ' '.join('{:>9.3f}'.format(percentile(values, p))
+                     for p in PERCENTILES)), file=out)
+    return len(groups)
+
+
+def main():
+    args = sys.argv[1:]
+    days, script, log_path = REPORT_DAYS, None, None
+    while args:
+        arg = args.pop(0)
+        if arg == '--days' and args and args[0].isdigit():
+            days = int(args.pop(0))
+        elif arg == '--script' and args:
+            script = args.pop(0)
+        elif not arg.startswith('-') and log_path is None:
+            log_path = arg
+        else:
+            sys.exit('usage: {} [--days N] [--script NAME] [LOG_PATH]'.format(
+                sys.argv[0]))
+    if not report(log_path, days, script):
+        print('no timing records in the last {} days'.format(days))
+
+
+if __name__ == '__main__':
+    main()
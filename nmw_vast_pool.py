@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Pool of ready VaST working copies, replacing the per-request rsync.
+
+coord_forced_photometry.py and fastplot_wrapper.sh used to rsync the whole
+VaST reference copy (minus COPY_EXCLUDES) into a disposable directory for
+every request and delete it afterwards. Instead, up to POOL_SIZE copies are
+kept in <parent>/vast_pool_<hash of the reference path>/<i>/ and handed out
+one caller at a time:
+
+  checkout()  claims a free copy for the calling process (or the given
+              owner pid) and returns its path, or None if the pool is off,
+              all copies are busy or the copy cannot be prepared; the
+              caller then falls back to the rsync copy.
+  checkin()   resets the copy and frees it.
+
+A manifest of the reference tree (path, type, size, mtime, inode, mode of
+every entry, rebuilt when older than MANIFEST_CHECK_SECONDS) tells what a
+clean copy holds. Executables are hard links to the reference (the
+read-only part of the tree: binaries and scripts, which the pipeline never
+writes to); every other file (configuration such as default.sex, data
+tables) is a private copy, and astorb.dat and lib/catalogs are symlinked
+back as autoprocess.sh does. Resetting walks the copy once: files not in
+the manifest (scratch, catalogs, logs) are deleted, and only the entries
+that are missing, replaced or written to since checkout (inode, size,
+mtime or ctime changed) are restored from the reference. Copied files get
+a fresh mtime at checkout, as rsync --no-times gave them.
+
+Ownership is a pid in the copy's state file, so a copy whose owner died
+without checking it in is reset and reused by the next checkout. POOL_SIZE
+comes from VAST_WORKING_COPY_POOL_SIZE in local_config.sh (0 = off).
+
+Command-line use (fastplot_wrapper.sh; cron for warm):
+  python3 nmw_vast_pool.py checkout VAST_REF PARENT_DIR OWNER_PID
+                                      print the path of a checked-out copy
+                                      (exit status 1 if there is none)
+  python3 nmw_vast_pool.py checkin PATH
+  python3 nmw_vast_pool.py warm       build every copy of the pool of
+                                      $VAST_REFERENCE_COPY in uploads/
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+import time
+from contextlib import contextmanager
+
+
+POOL_SIZE = 4                        # the callers set it from
+                                     # VAST_WORKING_COPY_POOL_SIZE (0 = off)
+MAX_POOL_SIZE = 32
+POOL_PREFIX = 'vast_pool_'
+# Same as the rsync in autoprocess.sh: patterns without '/' match a name at
+# any depth, the others a path relative to the tree.
+COPY_EXCLUDES = ('astorb.dat', 'lib/catalogs', 'src', '.git', '.github')
+LINK_BACK = ('astorb.dat', 'lib/catalogs')   # excluded, symlinked back
+MANIFEST_CHECK_SECONDS = 60
+MANIFEST_NAME = 'manifest.json'
+LOCK_NAME = 'pool.lock'
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def pool_size(raw):
+    """Parse VAST_WORKING_COPY_POOL_SIZE; empty or invalid gives the
+    default."""
+    try:
+        value = int(raw.strip()) if raw.strip() else POOL_SIZE
+    except ValueError:
+        return POOL_SIZE
+    return max(0, min(value, MAX_POOL_SIZE))
+
+
+def pool_root(vast_ref, parent_dir):
+    """Directory of the pool of copies of vast_ref kept in parent_dir."""
+    ident = hashlib.sha256(
+        os.path.realpath(vast_ref).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(os.path.realpath(parent_dir), POOL_PREFIX + ident)
+
+
+@contextmanager
+def _locked(root):
+    with open(os.path.join(root, LOCK_NAME), 'a') as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _write_json(path, data):
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(data, fh)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+# ---------- manifest ----------
+
+def _excluded(rel):
+    name = os.path.basename(rel)
+    for pattern in COPY_EXCLUDES:
+        if '/' in pattern:
+            if rel == pattern or rel.endswith('/' + pattern):
+                return True
+        elif name == pattern:
+            return True
+    return False
+
+
+def build_manifest(vast_ref, link):
+    """{relative path: entry} of a clean copy of vast_ref. Entries are
+    ['d', mode], ['l', target], or [kind, size, mtime_ns, inode, mode]
+    with kind 'h' (hard link; only if link is true) or 'f' (copy)."""
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(vast_ref):
+        rel_dir = os.path.relpath(dirpath, vast_ref)
+        for name in list(dirnames) + filenames:
+            rel = name if rel_dir == '.' else os.path.join(rel_dir, name)
+            if _excluded(rel):
+                if name in dirnames:
+                    dirnames.remove(name)
+                continue
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                entries[rel] = ['l', os.readlink(path)]
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif stat.S_ISDIR(st.st_mode):
+                entries[rel] = ['d', stat.S_IMODE(st.st_mode)]
+            elif stat.S_ISREG(st.st_mode):
+                kind = 'h' if link and st.st_mode & stat.S_IXUSR else 'f'
+                entries[rel] = [kind, st.st_size, st.st_mtime_ns, st.st_ino,
+                                stat.S_IMODE(st.st_mode)]
+    for rel in LINK_BACK:
+        if os.path.lexists(os.path.join(vast_ref, rel)) and \
+                (os.path.dirname(rel) in entries or '/' not in rel):
+            entries[rel] = ['l', os.path.join(vast_ref, rel)]
+    return entries
+
+
+def current_manifest(root, vast_ref):
+    """The manifest of vast_ref, rebuilt if older than
+    MANIFEST_CHECK_SECONDS. Raises OSError."""
+    path = os.path.join(root, MANIFEST_NAME)
+    manifest = _read_json(path)
+    if manifest.get('ref') == vast_ref and \
+            time.time() - manifest.get('checked', 0) < MANIFEST_CHECK_SECONDS:
+        return manifest
+    link = os.stat(vast_ref).st_dev == os.stat(root).st_dev
+    entries = build_manifest(vast_ref, link)
+    ident = hashlib.sha256(
+        json.dumps(entries, sort_keys=True).encode('utf-8')).hexdigest()
+    manifest = {'ref': vast_ref, 'checked': time.time(), 'id': ident,
+                'entries': entries}
+    _write_json(path, manifest)
+    return manifest
+
+
+# ---------- copies ----------
+
+def _matches(entry, st, path, record):
+    kind = entry[0]
+    if kind == 'd':
+        return stat.S_ISDIR(st.st_mode)
+    if kind == 'l':
+        return stat.S_ISLNK(st.st_mode) and os.readlink(path) == entry[1]
+    if not stat.S_ISREG(st.st_mode):
+        return False
+    if kind == 'h':
+        return st.st_ino == entry[3]
+    return record == [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+                      entry[1], entry[2]]
+
+
+def _create(vast_ref, copy_dir, rel, entry):
+    path = os.path.join(copy_dir, rel)
+    kind = entry[0]
+    if kind == 'd':
+        os.mkdir(path, entry[1] | stat.S_IRWXU)
+    elif kind == 'l':
+        os.symlink(entry[1], path)
+    else:
+        src = os.path.join(vast_ref, rel)
+        if kind == 'h':
+            try:
+                os.link(src, path)
+                return
+            except OSError:
+                pass                 # e.g. linking not permitted: copy
+        shutil.copyfile(src, path)
+        os.chmod(path, entry[4])
+
+
+def reset(copy_dir, manifest, state):
+    """Make copy_dir match the manifest, touching only what differs.
+    Returns the number of entries deleted or restored. Raises OSError."""
+    vast_ref = manifest['ref']
+    entries = manifest['entries']
+    files = state.setdefault('files', {})
+    os.makedirs(copy_dir, exist_ok=True)
+    ok = set()
+    changed = 0
+    for dirpath, dirnames, filenames in os.walk(copy_dir):
+        rel_dir = os.path.relpath(dirpath, copy_dir)
+        for name in list(dirnames) + filenames:
+            rel = name if rel_dir == '.' else os.path.join(rel_dir, name)
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            entry = entries.get(rel)
+            if entry is not None and _matches(entry, st, path,
+                                              files.get(rel)):
+                ok.add(rel)
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+            files.pop(rel, None)
+            changed += 1
+            if name in dirnames:
+                dirnames.remove(name)
+    # Sorted, so every directory is created before its contents.
+    for rel in sorted(set(entries) - ok):
+        _create(vast_ref, copy_dir, rel, entries[rel])
+        files.pop(rel, None)
+        changed += 1
+    for rel in list(files):
+        if rel not in entries:
+            del files[rel]
+    state['manifest'] = manifest['id']
+    return changed
+
+
+def _touch(copy_dir, manifest, state):
+    """Give the copied files a fresh mtime and record what they look like,
+    so reset() can tell which ones were written to."""
+    now = time.time_ns()
+    files = state.setdefault('files', {})
+    for rel, entry in manifest['entries'].items():
+        if entry[0] != 'f':
+            continue
+        path = os.path.join(copy_dir, rel)
+        os.utime(path, ns=(now, now), follow_symlinks=False)
+        st = os.lstat(path)
+        if stat.S_ISREG(st.st_mode):
+            files[rel] = [st.st_ino, st.st_size, st.st_mtime_ns,
+                          st.st_ctime_ns, entry[1], entry[2]]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass                         # exists, owned by another user
+    return True
+
+
+def _state_path(root, index):
+    return os.path.join(root, '{}.json'.format(index))
+
+
+def checkout(vast_ref, parent_dir, owner=None):
+    """Claim a clean copy of vast_ref for owner (default: this process).
+
+    Returns its absolute path, or None if the pool is off, every copy is
+    checked out by a live process or preparing the copy failed.
+    """
+    if POOL_SIZE <= 0:
+        return None
+    vast_ref = os.path.realpath(vast_ref)
+    owner = owner or os.getpid()
+    root = pool_root(vast_ref, parent_dir)
+    try:
+        os.makedirs(root, mode=0o755, exist_ok=True)
+        with _locked(root):
+            manifest = current_manifest(root, vast_ref)
+            for index in range(POOL_SIZE):
+                state = _read_json(_state_path(root, index))
+                if state.get('owner') and _alive(state['owner']):
+                    continue
+                # Checked in cleanly against this manifest: nothing to reset.
+                clean = ('owner' in state and state['owner'] is None and
+                         state.get('manifest') == manifest['id'])
+                state['owner'] = owner
+                _write_json(_state_path(root, index), state)
+                break
+            else:
+                return None
+    except OSError:
+        return None
+    copy_dir = os.path.join(root, str(index))
+    try:
+        if not clean:
+            reset(copy_dir, manifest, state)
+        _touch(copy_dir, manifest, state)
+        _write_json(_state_path(root, index), state)
+    except OSError:
+        _release(root, index, state, clean=False)
+        return None
+    return copy_dir
+
+
+def _release(root, index, state, clean):
+    state['owner'] = None
+    if not clean:
+        state['manifest'] = None
+    try:
+        _write_json(_state_path(root, index), state)
+    except OSError:
+        pass
+
+
+def checkin(copy_dir):
+    """Reset a copy returned by checkout() and give it back to the pool.
+    Never raises; a copy that cannot be reset is reset at its next
+    checkout."""
+    copy_dir = os.path.realpath(copy_dir)
+    root, index = os.path.split(copy_dir)
+    state = _read_json(_state_path(root, index))
+    manifest = _read_json(os.path.join(root, MANIFEST_NAME))
+    try:
+        reset(copy_dir, manifest, state)
+    except (OSError, KeyError, TypeError):
+        _release(root, index, state, clean=False)
+        return
+    _release(root, index, state, clean=True)
+
+
+def warm(vast_ref, parent_dir):
+    """Build (or reset) every free copy of the pool; returns how many."""
+    copies = []
+    for _ in range(POOL_SIZE):
+        copy_dir = checkout(vast_ref, parent_dir)
+        if copy_dir is None:
+            break
+        copies.append(copy_dir)
+    for copy_dir in copies:
+        checkin(copy_dir)
+    return len(copies)
+
+
+# ---------- scratch directories ----------
+
+def make_scratch(copy_dir, vast_ref, scratch, shared_prefixes=(),
+                 private_names=()):
+    """Create scratch, a light copy of the working copy copy_dir in which
+    a VaST script can run alongside others in the same working copy.
+    Raises OSError.
+
+    The VaST scripts write their scratch (calib.txt, catalogues, logs) into
+    the current directory, and some rewrite files of the tree in place
+    (default.sex is replaced per camera). Of the top-level entries of
+    copy_dir that belong to the tree of vast_ref, directories, executables
+    and LINK_BACK are symlinked (the read-only part of the tree, as in a
+    pool copy); every other file is a private copy (shutil.copy2, keeping
+    its mtime), so no write through a symlink reaches the other scratch
+    directories. Entries named in private_names are copied too; those
+    starting with one of shared_prefixes are symlinked (files one script
+    at a time works on). Anything else in copy_dir is left out.
+    """
+    tree_names = set(os.listdir(vast_ref))
+    tree_names.update(rel.split('/')[0] for rel in LINK_BACK)
+    os.mkdir(scratch)
+    for name in os.listdir(copy_dir):
+        src = os.path.join(copy_dir, name)
+        dst = os.path.join(scratch, name)
+        if src == scratch:
+            continue
+        if name in private_names:
+            shutil.copy2(src, dst)
+        elif name.startswith(tuple(shared_prefixes)):
+            os.symlink(src, dst)
+        elif name in tree_names:
+            if (os.path.isdir(src) or name in LINK_BACK
+                    or (os.path.isfile(src) and os.access(src, os.X_OK))):
+                os.symlink(src, dst)
+            else:
+                shutil.copy2(src, dst)
+    return scratch
+
+
+# ---------- command line ----------
+
+def main(argv):
+    global POOL_SIZE
+    import nmw_config
+    POOL_SIZE = pool_size(nmw_config.read_vars(
+        'VAST_WORKING_COPY_POOL_SIZE',
+        config_path=os.path.join(SCRIPT_DIR, 'local_config.sh'))
+        ['VAST_WORKING_COPY_POOL_SIZE'])
+    if len(argv) == 5 and argv[1] == 'checkout' and argv[4].isdigit():
+        copy_dir = checkout(argv[2], argv[3], owner=int(argv[4]))
+        if copy_dir is None:
+            return 1
+        print(copy_dir)
+        return 0
+    if len(argv) == 3 and argv[1] == 'checkin':
+        checkin(argv[2])
+        return 0
+    if len(argv) == 2 and argv[1] == 'warm':
+        os.chdir(SCRIPT_DIR)
+        vast_ref = nmw_config.read_vars('VAST_REFERENCE_COPY')[
+            'VAST_REFERENCE_COPY'].strip()
+        if not vast_ref:
+            print('VAST_REFERENCE_COPY is not set in local_config.sh')
+            return 1
+        print('VaST working copy pool: {} of {} copies ready'.format(
+            warm(vast_ref, 'uploads'), POOL_SIZE))
+        return 0
+    print('Usage: {0} checkout VAST_REF PARENT_DIR OWNER_PID\n'
+          '       {0} checkin PATH\n'
+          '       {0} warm'.format(argv[0]))
+    return 1
+
+
+if __name__ == '__main__':
+    if 'REQUEST_METHOD' in os.environ:
+        print("This script cannot be run via a web request.", file=sys.stderr)
+        sys.exit(1)
+    sys.exit(main(sys.argv))
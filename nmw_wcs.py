@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+In-process TAN / TAN-SIP / TPV world coordinate transformations.
+
+Replaces the per-file lib/bin/sky2xy (and xy2sky) subprocesses of the
+coordinate pages: the WCS keywords of many reference images are stacked
+into NumPy arrays so that one sky position is projected onto all of them
+in a single array operation.
+
+Both distortion conventions are handled as a polynomial pair applied in a
+different plane:
+  pixel -> sky:  (u, v) = pixel - CRPIX
+                 (u', v') = SIP(u, v)            (identity unless -SIP)
+                 (x, y)   = CD (u', v')          intermediate, degrees
+                 (xi, eta) = TPV(x, y)           (identity unless TPV)
+                 (ra, dec) = TAN^-1(xi, eta)
+and sky -> pixel runs the chain backwards, inverting the polynomials by
+Newton iteration (the SIP AP_/BP_ inverse coefficients are approximations
+and are not needed). Pixel coordinates follow the FITS convention used by
+sky2xy: the centre of the first pixel is (1, 1).
+
+NumPy is optional: without it HAVE_NUMPY is False and callers fall back
+to the VaST command-line tools.
+"""
+
+import math
+
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
+
+MAX_POLY_DEGREE = 9                  # SIP orders above this are not supported
+NEWTON_MAX_ITERATIONS = 50
+SIP_TOLERANCE_PIX = 1e-8
+TPV_TOLERANCE_DEG = 1e-11
+
+_CELESTIAL_FRAMES = ('', 'ICRS', 'FK5')
+
+# Polynomial terms shared by SIP and TPV: (i, j, 0) is x**i * y**j and
+# (0, 0, n) is r**n with r = sqrt(x**2 + y**2) (the odd radial TPV terms).
+_TERMS = [(i, d - i, 0) for d in range(MAX_POLY_DEGREE + 1)
+          for i in range(d, -1, -1)] + [(0, 0, n) for n in (1, 3, 5, 7)]
+_TERM_INDEX = {t: k for k, t in enumerate(_TERMS)}
+
+# TPV term k (PVi_k) as (i, j, n), in the order defined by the TPV convention.
+_TPV_TERMS = []
+for _deg, _radial in ((0, None), (1, 1), (2, None), (3, 3), (4, None),
+                      (5, 5), (6, None), (7, 7)):
+    _TPV_TERMS.extend((i, _deg - i, 0) for i in range(_deg, -1, -1))
+    if _radial is not None:
+        _TPV_TERMS.append((0, 0, _radial))
+del _deg, _radial
+
+
+def _float(keywords, name, default=None):
+    value = keywords.get(name, default)
+    if value is None:
+        raise KeyError(name)
+    return float(value)
+
+
+def _cd_matrix(keywords):
+    """CD matrix from CDi_j, PCi_j + CDELTi, or CDELTi + CROTA2."""
+    if any(k in keywords for k in ('CD1_1', 'CD1_2', 'CD2_1', 'CD2_2')):
+        return ((_float(keywords, 'CD1_1', 0.0), _float(keywords, 'CD1_2', 0.0)),
+                (_float(keywords, 'CD2_1', 0.0), _float(keywords, 'CD2_2', 0.0)))
+    cdelt1 = _float(keywords, 'CDELT1')
+    cdelt2 = _float(keywords, 'CDELT2')
+    if any(k in keywords for k in ('PC1_1', 'PC1_2', 'PC2_1', 'PC2_2')):
+        pc11 = _float(keywords, 'PC1_1', 1.0)
+        pc12 = _float(keywords, 'PC1_2', 0.0)
+        pc21 = _float(keywords, 'PC2_1', 0.0)
+        pc22 = _float(keywords, 'PC2_2', 1.0)
+        return ((cdelt1 * pc11, cdelt1 * pc12), (cdelt2 * pc21, cdelt2 * pc22))
+    rot = math.radians(_float(keywords, 'CROTA2', 0.0))
+    return ((cdelt1 * math.cos(rot), -cdelt2 * math.sin(rot)),
+            (cdelt1 * math.sin(rot), cdelt2 * math.cos(rot)))
+
+
+def parse_wcs(keywords):
+    """Turn a dict of FITS header keywords into WCS parameters.
+
+    Returns a dict (crval, crpix, cd, pix_poly, int_poly, nx, ny) or None
+    if the header does not describe a supported celestial WCS (TAN,
+    TAN-SIP or TPV with the default LONPOLE, in ICRS/FK5 J2000).
+    The two *_poly entries map polynomial terms (see _TERMS) to a pair of
+    coefficients; None means the identity.
+    """
+    ctype1 = str(keywords.get('CTYPE1', '')).strip()
+    ctype2 = str(keywords.get('CTYPE2', '')).strip()
+    proj = ctype1[4:]
+    if not ctype1.startswith('RA--') or not ctype2.startswith('DEC-'):
+        return None
+    if proj not in ('-TAN', '-TAN-SIP', '-TPV') or ctype2[4:] != proj:
+        return None
+    frame = str(keywords.get('RADESYS', keywords.get('RADECSYS', ''))).strip()
+    if frame not in _CELESTIAL_FRAMES:
+        return None
+    try:
+        if _float(keywords, 'LONPOLE', 180.0) != 180.0:
+            return None
+        if _float(keywords, 'EQUINOX',
+                  keywords.get('EPOCH', 2000.0)) != 2000.0:
+            return None
+        wcs = {
+            'crval': (_float(keywords, 'CRVAL1'), _float(keywords, 'CRVAL2')),
+            'crpix': (_float(keywords, 'CRPIX1'), _float(keywords, 'CRPIX2')),
+            'cd': _cd_matrix(keywords),
+            'nx': int(keywords.get('NAXIS1', 0)),
+            'ny': int(keywords.get('NAXIS2', 0)),
+            'pix_poly': None,
+            'int_poly': None,
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+    (a, b), (c, d) = wcs['cd']
+    if a * d - b * c == 0.0:
+        return None
+
+    try:
+        if proj == '-TAN-SIP':
+            poly = {(1, 0, 0): [1.0, 0.0], (0, 1, 0): [0.0, 1.0]}
+            for prefix, col in (('A', 0), ('B', 1)):
+                order = int(keywords.get(prefix + '_ORDER', 0))
+                if order > MAX_POLY_DEGREE:
+                    return None
+                for p in range(order + 1):
+                    for q in range(order + 1 - p):
+                        name = '{}_{}_{}'.format(prefix, p, q)
+                        if name in keywords:
+                            poly.setdefault((p, q, 0), [0.0, 0.0])[col] += float(
+                                keywords[name])
+            wcs['pix_poly'] = poly
+        elif proj == '-TPV':
+            poly = {}
+            for k, (i, j, n) in enumerate(_TPV_TERMS):
+                default = 1.0 if k == 1 else 0.0
+                c1 = float(keywords.get('PV1_{}'.format(k), default))
+                c2 = float(keywords.get('PV2_{}'.format(k), default))
+                # PV2 polynomials are written in (y, x): swap the exponents so
+                # both coordinates share the (x, y) terms.
+                if c1:
+                    poly.setdefault((i, j, n), [0.0, 0.0])[0] += c1
+                if c2:
+                    poly.setdefault((j, i, n), [0.0, 0.0])[1] += c2
+            wcs['int_poly'] = poly
+    except (TypeError, ValueError):
+        return None
+    return wcs
+
+
+def stack_wcs(wcs_list):
+    """Stack a list of parse_wcs() results into arrays (one row each)."""
+    def _poly_arrays(key):
+        polys = [w[key] for w in wcs_list]
+        used = sorted({t for p in polys if p for t in p},
+                      key=_TERM_INDEX.__getitem__)
+        if not used:
+            return None
+        c = np.zeros((len(polys), len(used), 2))
+        for row, p in enumerate(polys):
+            if p is None:
+                # Identity for references without this distortion.
+                p = {(1, 0, 0): [1.0, 0.0], (0, 1, 0): [0.0, 1.0]}
+            for col, term in enumerate(used):
+                if term in p:
+                    c[row, col] = p[term]
+        return used, c
+
+    cd = np.array([w['cd'] for w in wcs_list], dtype=float)
+    return {
+        'crval': np.radians(np.array([w['crval'] for w in wcs_list], dtype=float)),
+        'crpix': np.array([w['crpix'] for w in wcs_list], dtype=float),
+        'cd': cd,
+        'cd_inv': np.linalg.inv(cd),
+        'nx': np.array([w['nx'] for w in wcs_list], dtype=float),
+        'ny': np.array([w['ny'] for w in wcs_list], dtype=float),
+        'pix_poly': _poly_arrays('pix_poly'),
+        'int_poly': _poly_arrays('int_poly'),
+    }
+
+
+# ---------- polynomial distortions ----------
+
+def _poly_pair(poly, a, b):
+    """Evaluate a stacked polynomial pair and its Jacobian at (a, b).
+
+    a and b have shape (N, M); returns (f1, f2, f1a, f1b, f2a, f2b).
+    """
+    terms, coeffs = poly
+    f1 = np.zeros_like(a)
+    f2 = np.zeros_like(a)
+    f1a = np.zeros_like(a)
+    f1b = np.zeros_like(a)
+    f2a = np.zeros_like(a)
+    f2b = np.zeros_like(a)
+    r = np.hypot(a, b)
+    for k, (i, j, n) in enumerate(terms):
+        c1 = coeffs[:, k, 0][:, None]
+        c2 = coeffs[:, k, 1][:, None]
+        if n:
+            val = r ** n
+            # d(r**n)/da = n * r**(n-2) * a, finite at r = 0 for n >= 1.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                common = np.where(r > 0, n * r ** (n - 2), 0.0)
+            da = common * a
+            db = common * b
+        else:
+            val = a ** i * b ** j
+            da = i * a ** (i - 1) * b ** j if i else np.zeros_like(a)
+            db = j * a ** i * b ** (j - 1) if j else np.zeros_like(a)
+        f1 += c1 * val
+        f2 += c2 * val
+        f1a += c1 * da
+        f1b += c1 * db
+        f2a += c2 * da
+        f2b += c2 * db
+    return f1, f2, f1a, f1b, f2a, f2b
+
+
+def _apply_poly(poly, a, b):
+    if poly is None:
+        return a, b
+    f1, f2 = _poly_pair(poly, a, b)[:2]
+    return f1, f2
+
+
+def _invert_poly(poly, t1, t2, tol):
+    """Solve poly(a, b) = (t1, t2) by Newton iteration.
+
+    Returns (a, b, converged) with converged a boolean array.
+    """
+    if poly is None:
+        return t1, t2, np.ones(t1.shape, dtype=bool)
+    a = t1.copy()
+    b = t2.copy()
+    for _ in range(NEWTON_MAX_ITERATIONS):
+        f1, f2, f1a, f1b, f2a, f2b = _poly_pair(poly, a, b)
+        r1 = f1 - t1
+        r2 = f2 - t2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            det = f1a * f2b - f1b * f2a
+            da = (r1 * f2b - r2 * f1b) / det
+            db = (f1a * r2 - f2a * r1) / det
+        da = np.nan_to_num(da, nan=0.0, posinf=0.0, neginf=0.0)
+        db = np.nan_to_num(db, nan=0.0, posinf=0.0, neginf=0.0)
+        a = a - da
+        b = b - db
+        if max(np.max(np.abs(da)), np.max(np.abs(db))) < tol:
+            break
+    f1, f2 = _poly_pair(poly, a, b)[:2]
+    converged = (np.abs(f1 - t1) < 100 * tol) & (np.abs(f2 - t2) < 100 * tol)
+    return a, b, converged
+
+
+# ---------- TAN projection ----------
+
+def _tan_project(crval, ra, dec):
+    """Sky (radians) -> standard coordinates (degrees) about crval.
+
+    Returns (xi, eta, on_hemisphere)."""
+    ra0 = crval[:, 0][:, None]
+    dec0 = crval[:, 1][:, None]
+    cos_c = (np.sin(dec0) * np.sin(dec) +
+             np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0))
+    ok = cos_c > 1e-9
+    safe = np.where(ok, cos_c, 1.0)
+    xi = np.cos(dec) * np.sin(ra - ra0) / safe
+    eta = (np.cos(dec0) * np.sin(dec) -
+           np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / safe
+    return np.degrees(xi), np.degrees(eta), ok
+
+
+def _tan_deproject(crval, xi, eta):
+    """Standard coordinates (degrees) about crval -> sky (degrees)."""
+    ra0 = crval[:, 0][:, None]
+    dec0 = crval[:, 1][:, None]
+    xi = np.radians(xi)
+    eta = np.radians(eta)
+    denom = np.cos(dec0) - eta * np.sin(dec0)
+    ra = ra0 + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.hypot(xi, denom))
+    return np.degrees(ra) % 360.0, np.degrees(dec)
+
+
+# ---------- public transformations ----------
+
+def _as_2d(stack, v):
+    v = np.asarray(v, dtype=float)
+    n = len(stack['crpix'])
+    if v.ndim == 0:
+        return np.full((n, 1), float(v))
+    if v.ndim == 1:
+        return v.reshape(n, 1)
+    return v
+
+
+def pixel_to_sky(stack, x, y):
+    """Pixel (x, y) -> (ra, dec) in degrees for every stacked WCS.
+
+    x and y are scalars, (N,) arrays (one point per WCS) or (N, M) arrays.
+    Returns two (N, M) arrays.
+    """
+    x = _as_2d(stack, x)
+    y = _as_2d(stack, y)
+    u = x - stack['crpix'][:, 0][:, None]
+    v = y - stack['crpix'][:, 1][:, None]
+    u, v = _apply_poly(stack['pix_poly'], u, v)
+    cd = stack['cd']
+    ix = cd[:, 0, 0][:, None] * u + cd[:, 0, 1][:, None] * v
+    iy = cd[:, 1, 0][:, None] * u + cd[:, 1, 1][:, None] * v
+    xi, eta = _apply_poly(stack['int_poly'], ix, iy)
+    return _tan_deproject(stack['crval'], xi, eta)
+
+
+def sky_to_pixel(stack, ra, dec):
+    """(ra, dec) in degrees -> pixel (x, y) for every stacked WCS.
+
+    Returns (x, y, status) as (N, M) arrays; status is 'ok', 'offscale'
+    (no valid projection) or 'off image' (outside 0.5 .. NAXISn + 0.5),
+    mirroring the sky2xy wording.
+    """
+    ra = np.radians(_as_2d(stack, ra))
+    dec = np.radians(_as_2d(stack, dec))
+    xi, eta, on_sky = _tan_project(stack['crval'], ra, dec)
+    ix, iy, ok1 = _invert_poly(stack['int_poly'], xi, eta, TPV_TOLERANCE_DEG)
+    ci = stack['cd_inv']
+    u = ci[:, 0, 0][:, None] * ix + ci[:, 0, 1][:, None] * iy
+    v = ci[:, 1, 0][:, None] * ix + ci[:, 1, 1][:, None] * iy
+    u, v, ok2 = _invert_poly(stack['pix_poly'], u, v, SIP_TOLERANCE_PIX)
+    x = u + stack['crpix'][:, 0][:, None]
+    y = v + stack['crpix'][:, 1][:, None]
+    nx = stack['nx'][:, None]
+    ny = stack['ny'][:, None]
+    on_image = (x >= 0.5) & (x <= nx + 0.5) & (y >= 0.5) & (y <= ny + 0.5)
+    status = np.where(on_sky & ok1 & ok2,
+                      np.where(on_image, 'ok', 'off image'), 'offscale')
+    return x, y, status
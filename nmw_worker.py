@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Pre-forked worker serving the Python CGIs over a Unix socket.
+
+Every CGI request used to start a new interpreter that then imported cgi,
+concurrent.futures, sqlite3, nmw_coord_lib (and NumPy with the in-process
+renderer) before doing any work. This server imports the CGI modules in
+SCRIPTS once, loads the local_config.sh snapshot (nmw_config), and keeps
+a pool of forked children waiting on a Unix socket. Each child serves
+exactly one request and exits, so module globals (the request's config,
+sent headers, a job) never leak into the next request; the parent forks a
+replacement right away, so no fork happens on the request path.
+
+The CGI scripts stay the entry points Apache runs: at the top of each,
+forward_request() (the shim) connects to the socket before the heavy
+imports and, if a server is listening, hands over the request environment
+and body and copies the response back as it streams. Without a server the
+script simply runs as before.
+
+Protocol: the shim sends a 4-byte big-endian length and a JSON header
+{"script": name, "env": {...}}, then the request body (CONTENT_LENGTH
+bytes); the child runs the script's main() with that environment, cwd set
+to the script directory and fd 0/1 on the connection, and closes it when
+done. The shim treats the response as raw CGI output.
+
+The child replaces os.environ with the request's environment just before
+main(), after the scripts were imported under the server's. Settings are
+therefore read per request only where main() (or what it calls) reads
+them: the nmw_coord_lib globals the CGIs set from read_config_vars(),
+fastplot's get_config(), upload.py3's disk-space limits and the
+REQUEST_*/QUERY_STRING/HTTP_* variables. A served script must not read the
+environment into a module-level constant; it would keep the server's value.
+
+When one of the served source files changes (e.g. git_unmw_automated_update.sh),
+the parent re-executes itself: it unlinks the socket path first, so new
+requests wait for the new server, and the old idle children exit when they
+notice their socket is gone. Busy children finish their request.
+
+Command-line use (as the web server user, e.g. from an @reboot cron job):
+  python3 nmw_worker.py [--workers N]
+"""
+
+import hashlib
+import json
+import os
+import socket
+import struct
+import sys
+
+
+DEFAULT_WORKERS = 4
+MAX_WORKERS = 64
+LISTEN_BACKLOG = 64
+SOCKET_DIR = '/tmp'                  # next to the locks and config snapshot
+CONNECT_TIMEOUT_SECONDS = 2.0
+CHILD_POLL_SECONDS = 1.0             # idle children re-check their socket
+SOURCE_CHECK_SECONDS = 2.0
+COPY_CHUNK = 65536
+
+# Script name (as sent by the shim) -> file in this directory.
+SCRIPTS = {
+    'coord_search': 'coord_search.py',
+    'coord_forced_photometry': 'coord_forced_photometry.py',
+    'fastplot': 'fastplot.py',
+    'upload': 'upload.py3',
+}
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def socket_path():
+    """Socket of the server of this installation: per user, and per script
+    directory so several deployments on one host do not collide."""
+    ident = hashlib.sha256(SCRIPT_DIR.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(SOCKET_DIR, 'unmw_worker_{}_{}.sock'.format(
+        os.getuid(), ident))
+
+
+def _recv_exact(conn, n):
+    data = b''
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return data
+
+
+# ---------- shim (runs in the CGI process) ----------
+
+def forward_request(script):
+    """Serve this CGI request through the worker, if one is listening.
+
+    Returns without doing anything (the caller then runs the script
+    itself) when not called as a CGI or when no server is running;
+    otherwise relays the request and exits the process.
+    """
+    if len(sys.argv) > 1 or not os.environ.get('GATEWAY_INTERFACE'):
+        return
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(CONNECT_TIMEOUT_SECONDS)
+    try:
+        conn.connect(socket_path())
+    except OSError:
+        conn.close()
+        return
+    conn.settimeout(None)
+    out = sys.stdout.buffer
+    try:
+        header = json.dumps({'script': script,
+                             'env': dict(os.environ)}).encode('utf-8')
+        conn.sendall(struct.pack('>I', len(header)) + header)
+        try:
+            remaining = int(os.environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            remaining = 0
+        while remaining > 0:
+            chunk = sys.stdin.buffer.read(min(COPY_CHUNK, remaining))
+            if not chunk:
+                break
+            conn.sendall(chunk)
+            remaining -= len(chunk)
+        conn.shutdown(socket.SHUT_WR)
+        got_any = False
+        while True:
+            chunk = conn.recv(COPY_CHUNK)
+            if not chunk:
+                break
+            got_any = True
+            out.write(chunk)
+            out.flush()
+    except OSError as err:
+        got_any = False
+        sys.stderr.write('nmw_worker shim: {}\n'.format(err))
+    finally:
+        conn.close()
+    if not got_any:
+        out.write(b'Status: 502 Bad Gateway\nContent-Type: text/plain\n\n'
+                  b'The request worker failed; please try again.\n')
+        out.flush()
+    sys.exit(0)
+
+
+# ---------- server ----------
+
+def _lib_settings():
+    """Current upper-case globals of nmw_coord_lib (empty if not loaded)."""
+    lib = sys.modules.get('nmw_coord_lib')
+    if lib is None:
+        return {}
+    return {k: v for k, v in vars(lib).items() if k.isupper()}
+
+
+def _load_scripts():
+    """Import every script in SCRIPTS; returns {name: (module, settings)}.
+
+    The scripts share nmw_coord_lib and some point its globals at their
+    own values on import (ncl.DEFAULT_FORM_PATH); each script's changes are
+    recorded as its settings and undone before the next script is loaded,
+    and _serve_one applies them again for that script's requests.
+    """
+    # Imported here: the shim must stay light.
+    import importlib.machinery
+    import importlib.util
+    modules = {}
+    for name, filename in SCRIPTS.items():
+        path = os.path.join(SCRIPT_DIR, filename)
+        if not os.path.isfile(path):
+            continue
+        loader = importlib.machinery.SourceFileLoader(name, path)
+        spec = importlib.util.spec_from_loader(name, loader)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        before = _lib_settings()
+        try:
+            loader.exec_module(module)
+        except (Exception, SystemExit) as err:
+            sys.stderr.write('nmw_worker: cannot load {}: {}\n'.format(
+                filename, err))
+            del sys.modules[name]
+            continue
+        after = _lib_settings()
+        settings = {k: v for k, v in after.items()
+                    if k in before and before[k] is not v}
+        lib = sys.modules.get('nmw_coord_lib')
+        for k in settings:
+            setattr(lib, k, before[k])
+        modules[name] = (module, settings)
+    return modules
+
+
+def _source_stamp():
+    """Content hashes of the served scripts and the modules they imported
+    from this directory; a change means the server must reload. Not
+    mtimes: a git checkout touches files it does not change."""
+    stamp = {}
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if path and os.path.dirname(os.path.realpath(path)) == SCRIPT_DIR:
+            try:
+                with open(path, 'rb') as fh:
+                    stamp[path] = hashlib.sha256(fh.read()).hexdigest()
+            except OSError:
+                stamp[path] = None
+    return stamp
+
+
+def _serve_one(conn, modules):
+    """Run one request in this (child) process and exit."""
+    conn.setblocking(True)
+    (length,) = struct.unpack('>I', _recv_exact(conn, 4))
+    request = json.loads(_recv_exact(conn, length).decode('utf-8'))
+    module, settings = modules.get(request.get('script'), (None, {}))
+    os.dup2(conn.fileno(), 0)
+    os.dup2(conn.fileno(), 1)
+    conn.close()
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', closefd=False)
+    if module is None:
+        print("Status: 404 Not Found\nContent-Type: text/plain\n")
+        print("Unknown script")
+        return
+    lib = sys.modules.get('nmw_coord_lib')
+    for k, v in settings.items():
+        setattr(lib, k, v)
+    os.environ.clear()
+    os.environ.update(request.get('env') or {})
+    sys.argv = [module.__file__]
+    os.chdir(SCRIPT_DIR)
+    try:
+        module.main()
+    except SystemExit:
+        pass
+
+
+def _child(listener, listen_ino, modules):
+    """Body of a pre-forked child: wait for one connection and serve it."""
+    import signal
+    import traceback
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    listener.settimeout(CHILD_POLL_SECONDS)
+    while True:
+        try:
+            conn, _addr = listener.accept()
+            break
+        except socket.timeout:
+            try:
+                if os.stat(socket_path()).st_ino != listen_ino:
+                    os._exit(0)      # replaced by a reloaded server
+            except OSError:
+                os._exit(0)          # server stopped
+    listener.close()
+    status = 0
+    try:
+        _serve_one(conn, modules)
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    try:
+        sys.stdout.flush()
+    except OSError:
+        pass
+    os._exit(status)
+
+
+def serve(n_workers):
+    """Run the server until SIGTERM/SIGINT; re-exec on source changes."""
+    import signal
+    import time
+
+    os.chdir(SCRIPT_DIR)
+    if SCRIPT_DIR not in sys.path:
+        sys.path.insert(0, SCRIPT_DIR)
+    modules = _load_scripts()
+    # Imported here: loading the scripts put SCRIPT_DIR on sys.path.
+    import nmw_config
+    nmw_config.load()
+    stamp = _source_stamp()
+
+    path = socket_path()
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.unlink(tmp_path)
+    except OSError:
+        pass
+    listener.bind(tmp_path)
+    os.chmod(tmp_path, 0o600)
+    listener.listen(LISTEN_BACKLOG)
+    os.replace(tmp_path, path)       # atomically take over the path
+    listen_ino = os.stat(path).st_ino
+    sys.stderr.write('nmw_worker: {} workers on {} ({})\n'.format(
+        n_workers, path, ', '.join(sorted(modules))))
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *a: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *a: stopping.append(True))
+
+    children = set()
+    last_check = time.time()
+    while not stopping:
+        while len(children) < n_workers:
+            pid = os.fork()
+            if pid == 0:
+                _child(listener, listen_ino, modules)
+            children.add(pid)
+        try:
+            pid, _status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid:
+            children.discard(pid)    # may be a child of an earlier server
+            continue
+        if time.time() - last_check >= SOURCE_CHECK_SECONDS:
+            last_check = time.time()
+            if _source_stamp() != stamp:
+                sys.stderr.write('nmw_worker: sources changed, reloading\n')
+                _unlink_if_ours(path, listen_ino)
+                listener.close()
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+        time.sleep(0.05)
+
+    _unlink_if_ours(path, listen_ino)
+    listener.close()
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def _unlink_if_ours(path, listen_ino):
+    try:
+        if os.stat(path).st_ino == listen_ino:
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+def main():
+    n_workers = DEFAULT_WORKERS
+    args = sys.argv[1:]
+    if args[:1] == ['--workers'] and len(args) == 2 and args[1].isdigit():
+        n_workers = max(1, min(int(args[1]), MAX_WORKERS))
+    elif args:
+        sys.exit('usage: {} [--workers N]'.format(sys.argv[0]))
+    serve(n_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,54 @@
 #!/usr/bin/env python3
 """
-Unit tests for filter_report.py and upload.py3
+Unit tests for filter_report.py, upload.py3 and the nmw_* coordinate-search
+helper modules
 Run with: pytest test_python.py -v
 """
 
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+import json
 import os
 import sys
 import tempfile
+import time
 import zipfile
 import re
+import struct
+
 import pytest
 
 # Import functions from filter_report.py
 from filter_report import is_asteroid, is_variable_star, is_ast_or_vs, filter_report
 
+import nmw_catalogue
+import nmw_config
+import nmw_coord_lib
+import nmw_date
+import nmw_fits
+import nmw_fz
+import nmw_jobs
+import nmw_meta_cache
+import nmw_phase1_cache
+import nmw_phot_store
+import nmw_render
+import nmw_ref_index
+import nmw_thumb_cache
+import nmw_timing
+import nmw_vast_pool
+import nmw_wcs
+import nmw_worker
+
+# The CGI scripts need the cgi module (legacy-cgi on Python 3.13+).
+try:
+    import cgi  # noqa: F401
+except ImportError:
+    coord_forced_photometry = coord_search = None
+else:
+    import coord_forced_photometry
+    import coord_search
+
 # Import functions from upload.py3 by reading the file and extracting functions
 # (avoiding the cgi import which was removed in Python 3.13)
 # We extract the pure functions that don't depend on cgi
@@ -689,5 +721,1637 @@ echo "$FWHM_PIX"
             os.unlink(temp_path)
 
 
+class TestRadecToDegrees:
+    """Tests for nmw_coord_lib.radec_to_degrees"""
+
+    def test_sexagesimal(self):
+        """R.A. hours and Dec. degrees are converted to degrees"""
+        ra, dec = nmw_coord_lib.radec_to_degrees('12:30:00', '-45:30:00')
+        assert ra == pytest.approx(187.5)
+        assert dec == pytest.approx(-45.5)
+
+    def test_negative_zero_degrees(self):
+        """The sign of a -00:MM:SS declination is kept"""
+        _, dec = nmw_coord_lib.radec_to_degrees('00:00:00', '-00:30:00')
+        assert dec == pytest.approx(-0.5)
+
+    def test_decimal(self):
+        """Decimal values are taken as degrees"""
+        assert nmw_coord_lib.radec_to_degrees('10.5', '+20.25') == (10.5, 20.25)
+
+    def test_out_of_range(self):
+        """Out-of-range values are rejected"""
+        with pytest.raises(ValueError):
+            nmw_coord_lib.radec_to_degrees('361', '0')
+        with pytest.raises(ValueError):
+            nmw_coord_lib.radec_to_degrees('10', '91')
+
+
+class TestFootprintIndex:
+    """Tests for the geometry and header parsing in nmw_ref_index"""
+
+    def test_angular_separation(self):
+        """Known separations"""
+        sep = nmw_ref_index.angular_separation
+        assert sep(0, 0, 90, 0) == pytest.approx(90.0)
+        assert sep(10, 89, 190, 89) == pytest.approx(2.0)
+        assert sep(359.5, 0, 0.5, 0) == pytest.approx(1.0)
+
+    def test_outline_pixels_encloses_frame(self):
+        """The outline runs around the frame, outside it by the margin"""
+        pts = nmw_ref_index.outline_pixels(100, 50, margin=2.0, per_side=2)
+        assert len(pts) == 8
+        xs = [p[0] for p in pts]
+        ys = [p[1] for p in pts]
+        assert min(xs) == pytest.approx(-1.5) and max(xs) == pytest.approx(102.5)
+        assert min(ys) == pytest.approx(-1.5) and max(ys) == pytest.approx(52.5)
+
+    def test_footprint_contains_across_ra_zero(self):
+        """A square footprint straddling R.A. = 0 contains its centre only"""
+        outline = [(358.0, -2.0), (2.0, -2.0), (2.0, 2.0), (358.0, 2.0)]
+        contains = nmw_ref_index.footprint_contains
+        assert contains(0.0, 0.0, 3.0, outline, 359.0, 1.0) is True
+        assert contains(0.0, 0.0, 3.0, outline, 1.5, -1.5) is True
+        assert contains(0.0, 0.0, 3.0, outline, 2.5, 0.0) is False
+        assert contains(0.0, 0.0, 3.0, outline, 180.0, 0.0) is False
+
+    def test_healpix_cell_centre_round_trip(self):
+        """Every cell centre maps back to its own cell"""
+        nside = 8
+        for cell in range(12 * nside * nside):
+            ra, dec = nmw_ref_index.healpix_cell_centre(nside, cell)
+            assert nmw_ref_index.healpix_cell(nside, ra, dec) == cell
+
+    def test_healpix_known_cells(self):
+        """Nested numbering agrees with the HEALPix reference implementation"""
+        cell = nmw_ref_index.healpix_cell
+        assert cell(1, 10.0, 80.0) == 0
+        assert cell(1, 100.0, 5.0) == 5
+        assert cell(1, 200.0, -70.0) == 10
+        assert cell(32, 287.548, 1.678) == 7580
+        assert cell(32, 10.0, -45.0) == 8845
+
+    def test_footprint_cells_cover_the_cap(self):
+        """Any position inside the cap falls in a listed cell, also near the pole"""
+        import random
+        rng = random.Random(1)
+        for ra_c, dec_c, radius in ((359.0, 41.0, 5.0), (120.0, 88.5, 4.0)):
+            cells = set(nmw_ref_index.footprint_cells(ra_c, dec_c, radius))
+            assert len(cells) < 200
+            for _ in range(2000):
+                ra = ra_c + rng.uniform(-90.0, 90.0)
+                dec = max(-90.0, min(90.0, dec_c + rng.uniform(-radius, radius)))
+                if nmw_ref_index.angular_separation(ra_c, dec_c, ra % 360.0, dec) <= radius:
+                    assert nmw_ref_index.healpix_cell(nmw_ref_index.CELL_NSIDE, ra % 360.0, dec) in cells
+
+
+class TestImageMetadataCache:
+    """Tests for the persistent get_image_metadata cache in nmw_meta_cache"""
+
+    def test_cached_until_file_changes(self, tmp_path, monkeypatch):
+        """The expensive call runs once per (path, size, mtime); failures are not cached"""
+        monkeypatch.chdir(tmp_path)
+        image = tmp_path / 'image.fits'
+        image.write_bytes(b'x' * 2880)
+        calls = []
+
+        def compute(path, vast_dir):
+            calls.append(path)
+            return {'nx': 4, 'ny': 3, 'scale_x': 8.4, 'center_radec': None}
+
+        get = nmw_meta_cache.cached_image_metadata
+        assert get(str(image), 'vast', compute)['nx'] == 4
+        assert get(str(image), 'vast', compute) == {'nx': 4, 'ny': 3, 'scale_x': 8.4, 'center_radec': None}
+        assert len(calls) == 1
+        image.write_bytes(b'y' * 5760)
+        get(str(image), 'vast', compute)
+        assert len(calls) == 2
+        assert get(str(tmp_path / 'missing.fits'), 'vast', lambda p, v: None) is None
+        assert nmw_meta_cache.prune() == 0
+        image.unlink()
+        assert nmw_meta_cache.prune() == 1
+
+
+class TestThumbnailCache:
+    """Tests for the shared PNG thumbnail cache in nmw_thumb_cache"""
+
+    def _fake_vast(self, tmp_path):
+        """VaST tree whose util/fits2png writes <base>.png and counts calls"""
+        util = tmp_path / 'vast' / 'util'
+        util.mkdir(parents=True)
+        tool = util / 'fits2png'
+        tool.write_text('#!/bin/sh\n'
+                        'echo x >> "{}"\n'
+                        'b=$(basename "$1"); printf PNG > "${{b%.*}}.png"\n'
+                        .format(tmp_path / 'calls'))
+        tool.chmod(0o755)
+        return str(tmp_path / 'vast')
+
+    def test_second_request_links_cached_png(self, tmp_path, monkeypatch):
+        """The same thumbnail is rendered once and hard linked afterwards"""
+        monkeypatch.chdir(tmp_path)
+        vast_dir = self._fake_vast(tmp_path)
+        image = tmp_path / 'ref.fits'
+        image.write_bytes(b'\0' * 2880)
+        out1 = tmp_path / 'req1'
+        out2 = tmp_path / 'req2'
+        out1.mkdir()
+        out2.mkdir()
+        name1 = nmw_coord_lib.make_zoomout_thumbnail(str(image), 10.0, 20.0, 400, 300, str(out1), vast_dir, 64)
+        name2 = nmw_coord_lib.make_zoomout_thumbnail(str(image), 10.0, 20.0, 400, 300, str(out2), vast_dir, 64)
+        assert name1 == name2 == 'ref_zoomout.png'
+        assert (tmp_path / 'calls').read_text().count('x') == 1
+        assert os.path.samefile(str(out1 / name1), str(out2 / name2))
+        # A different marker position is a different thumbnail.
+        nmw_coord_lib.make_zoomout_thumbnail(str(image), 11.0, 20.0, 400, 300, str(out2), vast_dir, 64)
+        assert (tmp_path / 'calls').read_text().count('x') == 2
+
+    def test_disabled_cache_renders_every_time(self, tmp_path, monkeypatch):
+        """A zero budget bypasses the cache"""
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(nmw_coord_lib, 'THUMB_CACHE_MAX_MB', 0)
+        vast_dir = self._fake_vast(tmp_path)
+        image = tmp_path / 'ref.fits'
+        image.write_bytes(b'\0' * 2880)
+        for _ in range(2):
+            nmw_coord_lib.make_zoomout_thumbnail(str(image), None, None, 400, 300, str(tmp_path), vast_dir, 64)
+        assert (tmp_path / 'calls').read_text().count('x') == 2
+        assert not os.path.exists(nmw_coord_lib.CACHE_DIR)
+
+    def test_evict_least_recently_used(self, tmp_path):
+        """Eviction removes the oldest entries first, down to the target size"""
+        for i in range(10):
+            sub = tmp_path / 'ab'
+            sub.mkdir(exist_ok=True)
+            png = sub / '{}.png'.format(i)
+            png.write_bytes(b'\0' * 200000)
+            os.utime(str(png), (1000 + i, 1000 + i))
+        removed, left = nmw_thumb_cache.evict(str(tmp_path), 1)
+        assert removed == 6 and left == 800000
+        assert sorted(os.listdir(str(tmp_path / 'ab'))) == ['6.png', '7.png', '8.png', '9.png']
+
+
+class TestPhase1Cache:
+    """Tests for the shared Phase 1 product cache in nmw_phase1_cache"""
+
+    def _work_dir(self, tmp_path, name):
+        """Working copy holding the files the cache key depends on"""
+        work = tmp_path / name
+        (work / 'util').mkdir(parents=True)
+        for rel in nmw_phase1_cache.KEY_FILES:
+            (work / rel).write_text('x')
+        return work
+
+    def test_products_reused_by_next_request(self, tmp_path, monkeypatch):
+        """Products of a solve are restored under the names VaST looks for"""
+        monkeypatch.chdir(tmp_path)
+        image = tmp_path / 'wcs_fd_field_2024.fits'
+        image.write_bytes(b'\0' * 2880)
+        work1 = self._work_dir(tmp_path, 'work1')
+        key = nmw_phase1_cache.entry_key(str(image), str(work1))
+        assert key is not None
+        assert not nmw_phase1_cache.restore(key, str(work1), str(image))
+        # What sextract + solve_plate_with_UCAC5 leave behind.
+        (work1 / 'vast_images_catalogs.log').write_text('image_pid7.cat {}\n'.format(image))
+        (work1 / 'image_pid7.cat').write_text('sextractor')
+        (work1 / 'image_pid7.cat.aperture').write_text('4.5')
+        assert not nmw_phase1_cache.store(key, str(work1), str(image))
+        (work1 / 'wcs_fd_field_2024.fits.cat').write_text('wcs')
+        (work1 / 'wcs_fd_field_2024.fits.cat.ucac5').write_text('ucac5')
+        assert nmw_phase1_cache.store(key, str(work1), str(image))
+
+        work2 = self._work_dir(tmp_path, 'work2')
+        assert nmw_phase1_cache.entry_key(str(image), str(work2)) == key
+        assert nmw_phase1_cache.restore(key, str(work2), str(image))
+        assert (work2 / 'wcs_fd_field_2024.fits.cat.ucac5').read_text() == 'ucac5'
+        assert (work2 / 'wcs_fd_field_2024.fits.cat').read_text() == 'wcs'
+        cat = 'image_wcs_fd_field_2024.fits.cat'
+        assert (work2 / cat).read_text() == 'sextractor'
+        assert (work2 / (cat + '.aperture')).read_text() == '4.5'
+        assert (work2 / 'vast_images_catalogs.log').read_text() == '{} {}\n'.format(cat, image)
+
+        # A replaced image or another VaST version is a different entry.
+        image.write_bytes(b'\1' * 5760)
+        assert nmw_phase1_cache.entry_key(str(image), str(work2)) != key
+        key2 = nmw_phase1_cache.entry_key(str(image), str(work2))
+        (work2 / 'default.sex').write_text('y')
+        assert nmw_phase1_cache.entry_key(str(image), str(work2)) != key2
+        monkeypatch.setattr(nmw_phase1_cache, 'CACHE_MAX_MB', 0)
+        assert nmw_phase1_cache.entry_key(str(image), str(work2)) is None
+
+    def test_evict_least_recently_used(self, tmp_path):
+        """Whole entries are evicted, oldest manifest first"""
+        for i in range(5):
+            entry = tmp_path / 'ab' / 'ab{}'.format(i)
+            entry.mkdir(parents=True)
+            (entry / 'wcs.cat.ucac5').write_bytes(b'\0' * 400000)
+            manifest = entry / nmw_phase1_cache.MANIFEST
+            manifest.write_text('{}')
+            os.utime(str(manifest), (1000 + i, 1000 + i))
+        (tmp_path / 'ab' / '.tmpwriting').mkdir()
+        removed, left = nmw_phase1_cache.evict(str(tmp_path), 1)
+        assert removed == 3
+        assert sorted(os.listdir(str(tmp_path / 'ab'))) == ['.tmpwriting', 'ab3', 'ab4']
+
+
+class TestPhotStore:
+    """Tests for the forced-photometry result store in nmw_phot_store"""
+
+    def _vast_dir(self, tmp_path):
+        """VaST tree holding the files the configuration key depends on"""
+        vast = tmp_path / 'vast'
+        (vast / 'util').mkdir(parents=True)
+        for rel in nmw_phot_store.MEASURE_KEY_FILES + ('default.sex', 'default.sex.cam'):
+            (vast / rel).write_text(rel)
+        return vast
+
+    def test_measurement_reused_at_same_position(self, tmp_path, monkeypatch):
+        """A stored result is found again for the same image, grid cell, band and configuration"""
+        monkeypatch.chdir(tmp_path)
+        vast = self._vast_dir(tmp_path)
+        image = tmp_path / 'wcs_fd_field_2024.fits'
+        image.write_bytes(b'\0' * 2880)
+        config = nmw_phot_store.config_key(str(vast))
+        cells = nmw_phot_store.position_cells(359.8, 41.3)
+        key = nmw_phot_store.measurement_key(str(image), cells, 'V', config)
+        assert nmw_phot_store.lookup([key]) == {}
+        result = {'jd': '2460000.5000', 'mag': '12.30', 'err': '0.05', 'status': 'OK',
+                  'x': 180.0, 'y': 160.5, 'aperture': 4.0, 'basename': image.name}
+        nmw_phot_store.store(key, result)
+        found = nmw_phot_store.lookup([key])[key]
+        assert found == dict((f, result[f]) for f in nmw_phot_store.RESULT_FIELDS)
+
+        # Within the grid cell is the same position; R.A. wraps at 360 deg.
+        assert nmw_phot_store.position_cells(359.8 + 0.01 / 3600, 41.3) == cells
+        assert nmw_phot_store.position_cells(360.0, 0.0) == nmw_phot_store.position_cells(0.0, 0.0)
+        # Another band, position, camera configuration or image is a miss.
+        others = [
+            nmw_phot_store.measurement_key(str(image), cells, 'R', config),
+            nmw_phot_store.measurement_key(
+                str(image), nmw_phot_store.position_cells(359.8, 41.31), 'V', config),
+            nmw_phot_store.measurement_key(
+                str(image), cells, 'V', nmw_phot_store.config_key(str(vast), 'default.sex.cam')),
+        ]
+        image.write_bytes(b'\1' * 5760)
+        others.append(nmw_phot_store.measurement_key(str(image), cells, 'V', config))
+        assert nmw_phot_store.lookup(others) == {}
+        assert nmw_phot_store.prune() == 1
+        image.unlink()
+        with pytest.raises(OSError):
+            nmw_phot_store.measurement_key(str(image), cells, 'V', config)
+
+
+def _find_vast_dir():
+    """VaST installed by unmw_selftest.sh, or pointed to by $VAST_DIR"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    for vast_dir in (os.environ.get('VAST_DIR', ''),
+                     os.path.join(here, 'uploads', 'vast')):
+        if vast_dir and os.access(os.path.join(vast_dir, 'lib', 'bin', 'sky2xy'), os.X_OK):
+            return vast_dir
+    return None
+
+
+def _selftest_images():
+    """The NMW images unmw_selftest.sh downloads into uploads/, if any"""
+    import glob
+    here = os.path.dirname(os.path.abspath(__file__))
+    return sorted(glob.glob(os.path.join(here, 'uploads', 'NMW__NovaVul24_Stas_test', '**', '*.fts'),
+                            recursive=True))
+
+
+class TestVastPool:
+    """Tests for the pool of VaST working copies in nmw_vast_pool"""
+
+    def _reference(self, tmp_path):
+        """Small VaST tree: an executable, config files, excluded data"""
+        ref = tmp_path / 'vast'
+        (ref / 'lib' / 'bin').mkdir(parents=True)
+        (ref / 'lib' / 'catalogs').mkdir()
+        (ref / 'src').mkdir()
+        tool = ref / 'lib' / 'bin' / 'tool'
+        tool.write_text('#!/bin/sh\n')
+        tool.chmod(0o755)
+        (ref / 'default.sex').write_text('generic')
+        (ref / 'default.sex.cam').write_text('camera')
+        (ref / 'src' / 'vast.c').write_text('int main;')
+        (ref / 'astorb.dat').write_text('orbits')
+        (tmp_path / 'uploads').mkdir()
+        return ref
+
+    def test_checkout_resets_dirty_files(self, tmp_path):
+        """A checked-in copy comes back clean; executables are hard links"""
+        ref = self._reference(tmp_path)
+        parent = str(tmp_path / 'uploads')
+        work = nmw_vast_pool.checkout(str(ref), parent)
+        assert work is not None
+        assert sorted(os.listdir(work)) == ['astorb.dat', 'default.sex', 'default.sex.cam', 'lib']
+        assert os.path.samefile(os.path.join(work, 'lib', 'bin', 'tool'), str(ref / 'lib' / 'bin' / 'tool'))
+        assert os.readlink(os.path.join(work, 'lib', 'catalogs')) == str(ref / 'lib' / 'catalogs')
+        # Busy copies are not handed out twice.
+        other = nmw_vast_pool.checkout(str(ref), parent)
+        assert other not in (None, work)
+        nmw_vast_pool.checkin(other)
+
+        # What a request leaves behind.
+        with open(os.path.join(work, 'scratch.cat'), 'w') as fh:
+            fh.write('x')
+        os.mkdir(os.path.join(work, 'tmp'))
+        with open(os.path.join(work, 'default.sex'), 'w') as fh:
+            fh.write('camera')
+        os.unlink(os.path.join(work, 'default.sex.cam'))
+        nmw_vast_pool.checkin(work)
+        assert sorted(os.listdir(work)) == ['astorb.dat', 'default.sex', 'default.sex.cam', 'lib']
+        with open(os.path.join(work, 'default.sex')) as fh:
+            assert fh.read() == 'generic'
+        assert (ref / 'default.sex').read_text() == 'generic'
+        assert nmw_vast_pool.checkout(str(ref), parent) == work
+
+    def test_copy_of_dead_owner_is_reused(self, tmp_path, monkeypatch):
+        """A copy never checked in is reset and reused; size 0 is off"""
+        ref = self._reference(tmp_path)
+        parent = str(tmp_path / 'uploads')
+        monkeypatch.setattr(nmw_vast_pool, 'POOL_SIZE', 1)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        work = nmw_vast_pool.checkout(str(ref), parent, owner=pid)
+        with open(os.path.join(work, 'scratch.cat'), 'w') as fh:
+            fh.write('x')
+        assert nmw_vast_pool.checkout(str(ref), parent) == work
+        assert 'scratch.cat' not in os.listdir(work)
+        assert nmw_vast_pool.checkout(str(ref), parent) is None
+        monkeypatch.setattr(nmw_vast_pool, 'POOL_SIZE', 0)
+        assert nmw_vast_pool.checkout(str(ref), parent) is None
+        assert nmw_vast_pool.pool_size(' 2 ') == 2
+        assert nmw_vast_pool.pool_size('999') == nmw_vast_pool.MAX_POOL_SIZE
+
+
+    def test_scratch_gets_private_tree_files(self, tmp_path):
+        """Scratch directories share only directories, executables and the
+        per-image products; every other file of the tree is their own"""
+        ref = self._reference(tmp_path)
+        (ref / 'calib.txt').write_text('tree')
+        work = nmw_vast_pool.checkout(str(ref), str(tmp_path / 'uploads'))
+        for name, text in (('wcs_img1.fts.cat', 'cat'), ('vast_images_catalogs.log', 'log\n'),
+                           ('phase1.log', 'scratch')):
+            with open(os.path.join(work, name), 'w') as fh:
+                fh.write(text)
+        scratches = [nmw_vast_pool.make_scratch(
+            work, str(ref), os.path.join(work, 'scratch_{}'.format(i)),
+            shared_prefixes=('wcs_img1.fts',), private_names=('vast_images_catalogs.log',))
+            for i in range(2)]
+        first, second = scratches
+        assert sorted(os.listdir(first)) == ['astorb.dat', 'calib.txt', 'default.sex', 'default.sex.cam',
+                                             'lib', 'vast_images_catalogs.log', 'wcs_img1.fts.cat']
+        for name in ('lib', 'astorb.dat', 'wcs_img1.fts.cat'):
+            assert os.path.islink(os.path.join(first, name))
+        for name in ('calib.txt', 'default.sex', 'vast_images_catalogs.log'):
+            assert not os.path.islink(os.path.join(first, name))
+            with open(os.path.join(first, name), 'w') as fh:
+                fh.write('first')
+            with open(os.path.join(second, name)) as fh:
+                assert fh.read() != 'first'
+            with open(os.path.join(work, name)) as fh:
+                assert fh.read() != 'first'
+        nmw_vast_pool.checkin(work)
+
+    def test_parallel_scratch_runs_match_serial(self, tmp_path):
+        """A script that rewrites a file of the tree gives the same results
+        in two scratch directories at once as one after the other"""
+        import subprocess
+        import concurrent.futures
+        ref = self._reference(tmp_path)
+        (ref / 'calib.txt').write_text('tree')
+        script = ref / 'measure.sh'
+        script.write_text('#!/bin/sh\necho "$1" > calib.txt\nsleep 0.3\ncat calib.txt default.sex\n')
+        script.chmod(0o755)
+        work = nmw_vast_pool.checkout(str(ref), str(tmp_path / 'uploads'))
+
+        def run(cwd, arg):
+            with open(os.path.join(cwd, 'default.sex'), 'w') as fh:
+                fh.write(arg + '.sex\n')
+            return subprocess.run([os.path.join(cwd, 'measure.sh'), arg], cwd=cwd,
+                                  capture_output=True, text=True, timeout=30).stdout
+
+        serial = [run(work, arg) for arg in ('a', 'b')]
+        scratches = [nmw_vast_pool.make_scratch(work, str(ref), os.path.join(work, 'scratch_{}'.format(i)))
+                     for i in range(2)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            parallel = list(pool.map(run, scratches, ('a', 'b')))
+        assert parallel == serial == ['a\na.sex\n', 'b\nb.sex\n']
+        nmw_vast_pool.checkin(work)
+
+    @pytest.mark.skipif(_find_vast_dir() is None or not _selftest_images(),
+                        reason="VaST and the self-test images are not available")
+    def test_parallel_forced_photometry_matches_serial(self, tmp_path):
+        """util/forced_photometry.sh run in two scratch directories of one
+        working copy at once measures the self-test images exactly as
+        serial runs in a working copy of its own do"""
+        import subprocess
+        import concurrent.futures
+        vast_dir = _find_vast_dir()
+        images = _selftest_images()[:2]
+        parent = str(tmp_path)
+        serial_dir = nmw_vast_pool.checkout(vast_dir, parent)
+        parallel_dir = nmw_vast_pool.checkout(vast_dir, parent)
+        assert serial_dir and parallel_dir
+
+        def run(cwd, args):
+            env = dict(os.environ, FORCED_PHOTOMETRY_ONLY_C='yes', VAST_PATH=os.path.join(cwd, ''))
+            return subprocess.run([os.path.join(cwd, 'util', 'forced_photometry.sh')] + args,
+                                  cwd=cwd, env=env, capture_output=True, text=True, timeout=900)
+
+        def c_line(result):
+            lines = result.stdout.splitlines()
+            for idx, line in enumerate(lines[:-1]):
+                if line.startswith('# C implementation:'):
+                    return lines[idx + 1].split()[:4]
+            return None
+
+        try:
+            # A position on the frame: the centre of the plate solution.
+            subprocess.run([os.path.join(serial_dir, 'util', 'solve_plate_with_UCAC5'), images[0]],
+                           cwd=serial_dir, capture_output=True, timeout=900)
+            solved = [n for n in os.listdir(serial_dir) if n.startswith('wcs_') and n.endswith('.fts')]
+            if not solved:
+                pytest.skip('the self-test image could not be plate-solved')
+            header = nmw_fits.read_header(os.path.join(serial_dir, solved[0]))
+            position = ['{:.6f}'.format(header['CRVAL1']), '{:.6f}'.format(header['CRVAL2']), 'V']
+            serial = [c_line(run(serial_dir, [img] + position)) for img in images]
+            scratches = [nmw_vast_pool.make_scratch(
+                parallel_dir, vast_dir, os.path.join(parallel_dir, 'scratch_{}'.format(i)))
+                for i in range(len(images))]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(images)) as pool:
+                parallel = [c_line(r) for r in pool.map(
+                    run, scratches, [[img] + position for img in images])]
+            assert serial[0] is not None
+            assert parallel == serial
+        finally:
+            nmw_vast_pool.checkin(serial_dir)
+            nmw_vast_pool.checkin(parallel_dir)
+
+
+class TestReferenceCatalogue:
+    """Tests for the incremental all-reference-images page in nmw_catalogue"""
+
+    def _setup(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(nmw_coord_lib, 'THUMB_CACHE_MAX_MB', 0)
+        monkeypatch.setattr(nmw_coord_lib, 'get_image_metadata', lambda p, v: {
+            'nx': 400, 'ny': 300, 'arcmin_str': "1'", 'deg_str': '',
+            'scale_x': 8.4, 'scale_y': 8.4, 'center_radec': '00:00:00 +00:00:00'})
+        vast_dir = TestThumbnailCache()._fake_vast(tmp_path)
+        ref_dir = tmp_path / 'refs'
+        ref_dir.mkdir()
+        for name in ('a.fits', 'b.fits'):
+            (ref_dir / name).write_bytes(b'\0' * 2880)
+        return str(ref_dir), vast_dir
+
+    def test_rebuild_renders_only_changed_references(self, tmp_path, monkeypatch):
+        """Unchanged rows are reused; changed and removed ones are updated"""
+        ref_dir, vast_dir = self._setup(tmp_path, monkeypatch)
+        assert nmw_catalogue.build(ref_dir, vast_dir, 64, 2) == (2, 2, 0)
+        assert (tmp_path / 'calls').read_text().count('x') == 4
+        assert not nmw_catalogue.is_stale(nmw_catalogue.load_state(), ref_dir, 64)
+        assert nmw_catalogue.build(ref_dir, vast_dir, 64, 2) == (2, 0, 0)
+        assert (tmp_path / 'calls').read_text().count('x') == 4
+        (tmp_path / 'refs' / 'a.fits').write_bytes(b'\0' * 5760)
+        os.unlink(str(tmp_path / 'refs' / 'b.fits'))
+        assert nmw_catalogue.is_stale(nmw_catalogue.load_state(), ref_dir, 64)
+        assert nmw_catalogue.build(ref_dir, vast_dir, 64, 2) == (1, 1, 2)
+        out_dir = tmp_path / 'uploads' / 'reference_catalogue'
+        assert sorted(p for p in os.listdir(str(out_dir)) if p.endswith('.png')) == [
+            'a_zoomout.png', 'a_zoomout_hires.png']
+        page = (out_dir / 'index.html').read_text()
+        assert '../reference_catalogue/a_zoomout_hires.png' in page
+        assert 'b.fits' not in page
+
+    def test_new_thumbnail_size_is_stale(self, tmp_path, monkeypatch):
+        """Changing the thumbnail size invalidates every row"""
+        ref_dir, vast_dir = self._setup(tmp_path, monkeypatch)
+        assert nmw_catalogue.is_stale(None, ref_dir, 64)
+        nmw_catalogue.build(ref_dir, vast_dir, 64, 1)
+        assert nmw_catalogue.is_stale(nmw_catalogue.load_state(), ref_dir, 128)
+        assert nmw_catalogue.build(ref_dir, vast_dir, 128, 1) == (2, 2, 0)
+
+
+# Synthetic WCS headers resembling NMW frames (8.4"/pix, slightly rotated)
+_WCS_BASE = {
+    'NAXIS1': 400, 'NAXIS2': 300,
+    'CRVAL1': 359.8, 'CRVAL2': 41.3, 'CRPIX1': 180.5, 'CRPIX2': 160.0,
+    'CD1_1': -2.3e-3, 'CD1_2': 1.1e-4, 'CD2_1': 1.2e-4, 'CD2_2': 2.3e-3,
+}
+_WCS_HEADERS = {
+    'TAN': dict(_WCS_BASE, CTYPE1='RA---TAN', CTYPE2='DEC--TAN'),
+    'TAN-SIP': dict(_WCS_BASE, CTYPE1='RA---TAN-SIP', CTYPE2='DEC--TAN-SIP',
+                    A_ORDER=3, B_ORDER=3,
+                    A_2_0=2.1e-6, A_1_1=-1.3e-6, A_0_2=4.0e-7, A_3_0=-8.0e-9,
+                    A_1_2=3.0e-9, B_2_0=-6.0e-7, B_0_2=1.7e-6, B_2_1=-5.0e-9,
+                    B_0_3=7.0e-9),
+    'TPV': dict(_WCS_BASE, CTYPE1='RA---TPV', CTYPE2='DEC--TPV',
+                PV1_0=1.0e-4, PV1_1=1.0003, PV1_2=2.0e-4, PV1_4=3.0e-3,
+                PV1_7=-2.0e-2, PV1_11=1.5e-2,
+                PV2_0=-2.0e-4, PV2_1=0.9998, PV2_2=-1.0e-4, PV2_5=2.5e-3,
+                PV2_10=1.0e-2, PV2_11=-1.0e-2),
+}
+
+
+def _fits_hdu(keywords, data=b''):
+    """One FITS HDU (header + data) with the cards in the given order"""
+    cards = []
+    for key, value in keywords.items():
+        if isinstance(value, bool):
+            value = 'T' if value else 'F'
+        elif isinstance(value, str):
+            value = "'{:<8}'".format(value)
+        elif isinstance(value, float):
+            value = '{:.12E}'.format(value)
+        cards.append('{:<8}= {:>20}'.format(key, value))
+    cards.append('END')
+    header = ''.join(c.ljust(80) for c in cards)
+    header += ' ' * (-len(header) % 2880)
+    return header.encode('ascii') + data + b'\0' * (-len(data) % 2880)
+
+
+def _write_fits_header_only(path, keywords):
+    """Write a minimal 8-bit FITS image carrying the given keywords"""
+    hdu = dict(SIMPLE=True, BITPIX=8, NAXIS=2)
+    hdu.update(keywords)
+    with open(path, 'wb') as f:
+        f.write(_fits_hdu(hdu, b'\0' * (keywords['NAXIS1'] * keywords['NAXIS2'])))
+
+
+@pytest.mark.skipif(not nmw_wcs.HAVE_NUMPY, reason="NumPy is not installed")
+class TestWcsEngine:
+    """Tests for the in-process sky <-> pixel transformations in nmw_wcs"""
+
+    @pytest.mark.parametrize('kind', sorted(_WCS_HEADERS))
+    def test_reference_pixel_maps_to_crval(self, kind):
+        """Without a constant distortion term CRPIX lands on CRVAL"""
+        header = dict(_WCS_HEADERS[kind])
+        header.pop('PV1_0', None)
+        header.pop('PV2_0', None)
+        stack = nmw_wcs.stack_wcs([nmw_wcs.parse_wcs(header)])
+        ra, dec = nmw_wcs.pixel_to_sky(stack, 180.5, 160.0)
+        assert ra[0, 0] == pytest.approx(359.8)
+        assert dec[0, 0] == pytest.approx(41.3)
+
+    def test_round_trip_many_references(self):
+        """pixel -> sky -> pixel is exact for all projections at once"""
+        headers = [_WCS_HEADERS[k] for k in sorted(_WCS_HEADERS)]
+        stack = nmw_wcs.stack_wcs([nmw_wcs.parse_wcs(h) for h in headers])
+        px = [[1.0, 200.0, 399.5, 37.25]] * len(headers)
+        py = [[1.0, 150.0, 12.0, 299.75]] * len(headers)
+        ra, dec = nmw_wcs.pixel_to_sky(stack, px, py)
+        x, y, status = nmw_wcs.sky_to_pixel(stack, ra, dec)
+        assert (status == 'ok').all()
+        assert x.tolist() == [pytest.approx(row, abs=1e-6) for row in px]
+        assert y.tolist() == [pytest.approx(row, abs=1e-6) for row in py]
+
+    def test_off_image_and_offscale(self):
+        """Positions off the frame or on the far hemisphere are flagged"""
+        stack = nmw_wcs.stack_wcs([nmw_wcs.parse_wcs(_WCS_HEADERS['TAN'])] * 2)
+        _, _, status = nmw_wcs.sky_to_pixel(stack, [5.0, 179.8], [41.3, -41.3])
+        assert status[:, 0].tolist() == ['off image', 'offscale']
+
+    def test_unsupported_headers(self):
+        """Non-TAN projections and other frames are left to sky2xy"""
+        assert nmw_wcs.parse_wcs(dict(_WCS_BASE, CTYPE1='RA---ZPN', CTYPE2='DEC--ZPN')) is None
+        assert nmw_wcs.parse_wcs(dict(_WCS_HEADERS['TAN'], RADESYS='FK4', EQUINOX=1950.0)) is None
+        assert nmw_wcs.parse_wcs({'NAXIS1': 10, 'NAXIS2': 10}) is None
+
+    def test_garbage_keywords(self, tmp_path):
+        """Non-numeric LONPOLE / EQUINOX / SIP cards make the header
+        unsupported instead of raising, so the index build goes on"""
+        for bad in (dict(EQUINOX='J2000'), dict(EPOCH='1950-ish'), dict(LONPOLE='north'),
+                    dict(CTYPE1='RA---TAN-SIP', CTYPE2='DEC--TAN-SIP', A_ORDER=2, A_2_0='x')):
+            assert nmw_wcs.parse_wcs(dict(_WCS_HEADERS['TAN'], **bad)) is None
+        fits_path = str(tmp_path / 'garbage.fits')
+        _write_fits_header_only(fits_path, dict(_WCS_HEADERS['TAN'], EQUINOX='J2000'))
+        rec = nmw_ref_index.build_footprint(fits_path, str(tmp_path / 'no_vast'))
+        assert rec['status'] == 'error'
+
+    @pytest.mark.skipif(_find_vast_dir() is None, reason="VaST lib/bin/sky2xy is not available")
+    @pytest.mark.parametrize('kind', sorted(_WCS_HEADERS))
+    def test_matches_sky2xy(self, kind, tmp_path):
+        """nmw_wcs agrees with lib/bin/sky2xy to well below a pixel"""
+        import subprocess
+        vast_dir = _find_vast_dir()
+        fits_path = str(tmp_path / 'synthetic.fits')
+        _write_fits_header_only(fits_path, _WCS_HEADERS[kind])
+        stack = nmw_wcs.stack_wcs([nmw_wcs.parse_wcs(_WCS_HEADERS[kind])])
+        for px, py in ((10.0, 20.0), (200.0, 150.0), (390.0, 290.0)):
+            ra, dec = nmw_wcs.pixel_to_sky(stack, px, py)
+            x, y, status = nmw_wcs.sky_to_pixel(stack, ra, dec)
+            out = subprocess.run(
+                [os.path.join(vast_dir, 'lib', 'bin', 'sky2xy'), fits_path,
+                 '{:.8f}'.format(ra[0, 0]), '{:.8f}'.format(dec[0, 0])],
+                capture_output=True, text=True, timeout=30).stdout.split()
+            assert status[0, 0] == 'ok'
+            assert float(out[-2]) == pytest.approx(x[0, 0], abs=0.1)
+            assert float(out[-1]) == pytest.approx(y[0, 0], abs=0.1)
+
+
+@pytest.mark.skipif(not nmw_wcs.HAVE_NUMPY, reason="NumPy is not installed")
+class TestBatchSearch:
+    """Tests for the multi-position search in nmw_coord_lib / nmw_ref_index"""
+
+    def test_parse_position_list(self):
+        """Valid lines are kept in order; bad ones are reported by line number"""
+        text = "# targets\n17:45:37.199 -28:56:10.22\n\n266.4050 -28.9362\nfoo bar\n10 95\n"
+        positions, errors = nmw_coord_lib.parse_position_list(text)
+        assert positions == [('17:45:37.199 -28:56:10.22', '17:45:37.199', '-28:56:10.22'),
+                             ('266.4050 -28.9362', '266.4050', '-28.9362')]
+        assert [e[0] for e in errors] == [5, 6]
+        with pytest.raises(ValueError):
+            nmw_coord_lib.parse_position_list('1 2\n' * 3, max_positions=2)
+
+    def test_one_pass_for_all_targets(self, tmp_path, monkeypatch):
+        """Every target gets the references covering it, in one index query"""
+        monkeypatch.chdir(tmp_path)
+        ref_dir = tmp_path / 'refs'
+        ref_dir.mkdir()
+        _write_fits_header_only(str(ref_dir / 'a.fits'), _WCS_HEADERS['TAN'])
+        _write_fits_header_only(str(ref_dir / 'b.fits'), dict(_WCS_HEADERS['TAN'], CRVAL1=0.8))
+        queries = []
+        real_query = nmw_ref_index._query
+        monkeypatch.setattr(nmw_ref_index, '_query',
+                            lambda *args: queries.append(args) or real_query(*args))
+        positions = [('359.8', '41.3'), ('0.8', '41.3'), ('0.3', '41.3'), ('180.0', '-41.3')]
+        matches, truncated = nmw_coord_lib.run_sky2xy_batch_scan(
+            str(ref_dir), positions, str(tmp_path / 'no_vast'))
+        assert not truncated and len(queries) == 1
+        names = [[os.path.basename(p) for p, _x, _y in m] for m in matches]
+        assert names == [['a.fits'], ['b.fits'], ['a.fits', 'b.fits'], []]
+        assert matches[0][0][1:] == (pytest.approx(180.5), pytest.approx(160.0))
+        single, _ = nmw_coord_lib.run_sky2xy_scan(str(ref_dir), '0.3', '41.3', str(tmp_path / 'no_vast'))
+        assert single == matches[2]
+
+    def _fake_sky2xy(self, tmp_path, monkeypatch, delay):
+        """References a.fits, b.fits and a sky2xy that answers after delay s"""
+        ref_dir = tmp_path / 'refs'
+        ref_dir.mkdir()
+        for name in ('a.fits', 'b.fits'):
+            (ref_dir / name).write_bytes(b'')
+        bin_dir = tmp_path / 'vast' / 'lib' / 'bin'
+        bin_dir.mkdir(parents=True)
+        sky2xy = bin_dir / 'sky2xy'
+        sky2xy.write_text('#!/bin/bash\n'
+                          'case "$1" in *b.fits) sleep {} ;; esac\n'
+                          'echo "$2 $3 J2000 -> 10.5 20.5"\n'.format(delay))
+        sky2xy.chmod(0o755)
+
+        def no_index(*args, **kwargs):
+            raise OSError('no index')
+        monkeypatch.setattr(nmw_ref_index, 'locate_many_in_references', no_index)
+        return str(ref_dir), str(tmp_path / 'vast')
+
+    def test_scan_streams_matches(self, tmp_path, monkeypatch):
+        """sky2xy matches are yielded as they appear, not after the scan"""
+        ref_dir, vast_dir = self._fake_sky2xy(tmp_path, monkeypatch, 1)
+        start = time.time()
+        arrivals = []
+        scan = nmw_coord_lib.Sky2xyScan(ref_dir, [('0.3', '41.3')], vast_dir)
+        for k, path, x, y in scan:
+            arrivals.append((os.path.basename(path), time.time() - start))
+            assert (k, x, y) == (0, 10.5, 20.5)
+        assert [name for name, _t in arrivals] == ['a.fits', 'b.fits']
+        assert arrivals[0][1] < 0.8 <= arrivals[1][1]
+        assert not scan.truncated
+
+    def test_scan_timeout_keeps_partial_matches(self, tmp_path, monkeypatch):
+        """A scan over SCAN_TIMEOUT_SECONDS is stopped and marked truncated"""
+        ref_dir, vast_dir = self._fake_sky2xy(tmp_path, monkeypatch, 30)
+        monkeypatch.setattr(nmw_coord_lib, 'SCAN_TIMEOUT_SECONDS', 0)
+        start = time.time()
+        matches, truncated = nmw_coord_lib.run_sky2xy_batch_scan(
+            ref_dir, [('0.3', '41.3')], vast_dir)
+        assert truncated and time.time() - start < 10
+        assert [os.path.basename(p) for p, _x, _y in matches[0]] == ['a.fits']
+
+
+@pytest.mark.skipif(coord_forced_photometry is None, reason="cgi module is not installed")
+class TestMultiTargetPhotometry:
+    """Tests for measure_targets and the --targets command line of
+    coord_forced_photometry"""
+
+    def test_measure_targets(self, tmp_path, monkeypatch):
+        """Phase 1 once per image, off-frame targets dropped, rows in image order"""
+        cfp = coord_forced_photometry
+        pipelines = []
+
+        class FakePipeline:
+            measure_workers = 3
+            solve_workers = 3
+
+            def __init__(self, work_dir, vast_dir, local_config_path, factory_text,
+                         images, debug_log=None):
+                self.images = list(images)
+                self.solved = 0
+                self.measured = []
+                pipelines.append(self)
+
+            def solve(self, progress_callback=None):
+                self.solved += 1
+
+            def measure(self, img, band, positions):
+                # The first image finishes last.
+                time.sleep(0.1 * (img == 'a.fits'))
+                self.measured.append((img, [ra for ra, _dec, _key in positions]))
+                return [None if (img, ra) == ('b.fits', '30') else
+                        {'img': img, 'ra': ra, 'key': key}
+                        for ra, _dec, key in positions]
+
+        released = []
+        monkeypatch.setattr(cfp, 'ImagePipeline', FakePipeline)
+        monkeypatch.setattr(cfp, 'checkout_working_copy', lambda vast_dir: (str(tmp_path), True))
+        monkeypatch.setattr(cfp, 'release_working_copy', lambda *args: released.append(args))
+        monkeypatch.setattr(cfp, 'target_off_frame',
+                            lambda img, ra, dec: (img, ra) == ('c.fits', 30.0))
+        monkeypatch.setattr(nmw_phot_store, 'position_cells', lambda ra, dec: ra)
+        monkeypatch.setattr(nmw_phot_store, 'config_key', lambda vast_dir, name: 'cfg')
+        monkeypatch.setattr(nmw_phot_store, 'measurement_key',
+                            lambda img, cells, band, config: (img, cells))
+        monkeypatch.setattr(nmw_phot_store, 'lookup', lambda keys: {
+            ('a.fits', 50.0): {'img': 'a.fits', 'ra': '50', 'stored': True}})
+        targets = [('10 20', '10', '20'), ('30 40', '30', '40'), ('50 60', '50', '60')]
+        target_images = [['a.fits', 'b.fits', 'c.fits'], ['b.fits', 'c.fits'],
+                         ['c.fits', 'a.fits']]
+        results, stats = cfp.measure_targets(
+            str(tmp_path / 'vast'), 'local_config.sh', targets, target_images,
+            '', 'V', None)
+        (pipeline,) = pipelines
+        assert pipeline.images == ['a.fits', 'b.fits', 'c.fits'] and pipeline.solved == 1
+        assert sorted(pipeline.measured) == [('a.fits', ['10']), ('b.fits', ['10', '30']),
+                                             ('c.fits', ['10', '50'])]
+        assert len(released) == 1
+        rows = [[(img, band, fp and fp['ra']) for img, band, fp in target_rows]
+                for target_rows in results]
+        assert rows == [[('a.fits', 'V', '10'), ('b.fits', 'V', '10'), ('c.fits', 'V', '10')],
+                        [('b.fits', 'V', None)],
+                        [('c.fits', 'V', '50'), ('a.fits', 'V', '50')]]
+        assert results[0][1][2]['key'] == ('b.fits', 10.0)
+        assert results[2][1][2]['stored']
+        assert stats == {'images': 3, 'stored': 1, 'measured': 4, 'workers': 3}
+
+    def test_rows_in_image_order(self, tmp_path, monkeypatch):
+        """main() streams rows in image order while measurements and thumbnails
+        finish out of order; a failed image gets a skipped row"""
+        cfp = coord_forced_photometry
+        uploads = tmp_path / 'uploads'
+        images = [str(uploads / 'img_2026-10-0{0}_x'.format(day) /
+                      'wcs_fd_F1_2026-10-0{0}_00-00-00.fits'.format(day))
+                  for day in (4, 3, 2, 1)]
+        failed = images[2]
+        delays = dict(zip(images, (0.4, 0.2, 0.0, 0.0)))
+        thumbnailed = []
+
+        class FakePipeline:
+            solve_workers = measure_workers = 4
+            n_solved = sextractor_cache_hits = phase1_cache_hits = n_funpacked = 0
+            solve_elapsed = 0.0
+
+            def __init__(self, work_dir, vast_dir, local_config_path, factory_text,
+                         images, debug_log=None):
+                pass
+
+            def solve(self, progress_callback=None):
+                pass
+
+            def measure(self, img, band, positions):
+                time.sleep(delays[img])
+                if img == failed:
+                    return [None]
+                return [{'jd': '2461320.5', 'mag': '12.345', 'err': '0.012',
+                         'status': 'detection', 'x': 10.0, 'y': 20.0, 'aperture': 5.0}]
+
+        def fake_thumbnails(r, img, fp, *args, **kwargs):
+            time.sleep(delays[img])
+            thumbnailed.append(img)
+
+        class FakeSlot:
+            def close(self):
+                pass
+
+        config = {'REFERENCE_IMAGES': str(tmp_path), 'VAST_REFERENCE_COPY': str(tmp_path),
+                  'URL_OF_DATA_PROCESSING_ROOT': 'http://localhost/unmw/uploads'}
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv('REQUEST_METHOD', 'GET')
+        monkeypatch.setenv('QUERY_STRING', 'coords=10.0+20.0')
+        monkeypatch.setattr(nmw_timing, 'LOG_PATH', str(tmp_path / 'timing.jsonl'))
+        monkeypatch.setattr(sys, 'excepthook', sys.excepthook)    # cgitb.enable()
+        for name in ('_headers_sent', 'QUEUE_MAX_DEPTH', 'QUEUE_MAX_WAIT_SECONDS',
+                     'THUMB_CACHE_MAX_MB', 'THUMBNAIL_RENDERER', 'RENDER_BUDGET'):
+            monkeypatch.setattr(nmw_coord_lib, name, getattr(nmw_coord_lib, name))
+        nmw_coord_lib._headers_sent = False
+        monkeypatch.setattr(nmw_phase1_cache, 'CACHE_MAX_MB', nmw_phase1_cache.CACHE_MAX_MB)
+        monkeypatch.setattr(nmw_vast_pool, 'POOL_SIZE', nmw_vast_pool.POOL_SIZE)
+        monkeypatch.setattr(cfp, 'TEMP_PARENT', str(uploads))
+        monkeypatch.setattr(cfp, 'read_config_vars',
+                            lambda *names: dict((n, config.get(n, '')) for n in names))
+        monkeypatch.setattr(cfp, 'wait_for_concurrency_slot', lambda **kw: (FakeSlot(), None))
+        monkeypatch.setattr(cfp, 'run_sky2xy_scan', lambda *args: (
+            [(str(tmp_path / 'wcs_fd_F1_ref.fits'), 1.0, 2.0)], False))
+        monkeypatch.setattr(cfp, 'list_recent_field_images', lambda *args: list(images))
+        monkeypatch.setattr(cfp, 'target_off_frame', lambda *args: False)
+        monkeypatch.setattr(cfp, '_phot_store_keys', lambda *args: {})
+        monkeypatch.setattr(nmw_phot_store, 'lookup', lambda keys: {})
+        monkeypatch.setattr(cfp, 'checkout_working_copy', lambda vast_dir: (str(tmp_path), True))
+        monkeypatch.setattr(cfp, 'release_working_copy', lambda *args: None)
+        monkeypatch.setattr(cfp, 'ImagePipeline', FakePipeline)
+        monkeypatch.setattr(cfp, 'add_row_thumbnails', fake_thumbnails)
+        monkeypatch.setattr(cfp, 'emit_lightcurve', lambda *args, **kwargs: None)
+        import io
+        out = io.StringIO()
+        monkeypatch.setattr(sys, 'stdout', out)
+        cfp.main()
+        table = out.getvalue().split("<table class='main'>", 1)[1].split('</table>', 1)[0]
+        rows = [line for line in table.splitlines() if 'wcs_fd_F1_' in line]
+        assert [[img for img in images if os.path.basename(img) in row] for row in rows] == [
+            [img] for img in images]
+        assert ["class='skipped'" in row for row in rows] == [False, False, True, False]
+        assert thumbnailed == [images[3], images[1], images[0]]
+
+    def test_targets_cli_arguments(self, tmp_path, monkeypatch, capsys):
+        """Bad options and bands exit 2, an unusable target list exits 1"""
+        cfp = coord_forced_photometry
+        monkeypatch.setattr(nmw_timing, 'LOG_PATH', str(tmp_path / 'timing.jsonl'))
+        targets = tmp_path / 'targets.txt'
+        targets.write_text('10.0 20.0\n')
+        empty = tmp_path / 'empty.txt'
+        empty.write_text('# nothing here\nnot a position\n')
+        for argv in (['--bogus', '1'], ['--targets'], ['--days', '7'],
+                     ['--targets', str(targets), '--days', 'many'],
+                     ['--targets', str(targets), '--band', 'X']):
+            assert cfp.run_targets_cli(argv) == 2
+            assert capsys.readouterr().err.startswith('usage:')
+        assert cfp.run_targets_cli(['--targets', str(empty)]) == 1
+        assert 'no valid position' in capsys.readouterr().err
+        assert cfp.run_targets_cli(['--targets', str(tmp_path / 'missing.txt')]) == 1
+        assert cfp.run_targets_cli(['--targets', str(targets), '--lightcurves',
+                                    str(tmp_path / 'missing')]) == 1
+
+
+@pytest.mark.skipif(coord_search is None, reason="cgi module is not installed")
+class TestNdjsonSearch:
+    """Tests for the format=ndjson answers of coord_search"""
+
+    def _search(self, tmp_path, monkeypatch, query, matches=()):
+        """The JSON objects written by coord_search.main() for query, with
+        a scan that finds matches ((k, path, x, y), ...), and the
+        thumbnail renders it asked for"""
+        cs = coord_search
+        renders = []
+
+        class FakeScan:
+            truncated = False
+
+            def __init__(self, ref_dir, positions, vast_dir):
+                pass
+
+            def __iter__(self):
+                return iter(matches)
+
+        class FakeSlot:
+            def close(self):
+                pass
+
+        def fake_render(r, image, out_dir_abs, *args, **kwargs):
+            renders.append((r['path'], out_dir_abs))
+            for key in ('png_zoomin', 'png_zoomin_hires', 'png_zoomout', 'png_zoomout_hires'):
+                r[key] = key + '.png'
+            return r
+
+        config = {'REFERENCE_IMAGES': str(tmp_path), 'VAST_REFERENCE_COPY': str(tmp_path),
+                  'URL_OF_DATA_PROCESSING_ROOT': 'http://localhost/unmw/uploads'}
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setenv('REQUEST_METHOD', 'GET')
+        monkeypatch.setenv('QUERY_STRING', query)
+        monkeypatch.setattr(nmw_timing, 'LOG_PATH', str(tmp_path / 'timing.jsonl'))
+        monkeypatch.setattr(sys, 'excepthook', sys.excepthook)    # cgitb.enable()
+        for name in ('_headers_sent', 'QUEUE_MAX_DEPTH', 'QUEUE_MAX_WAIT_SECONDS',
+                     'THUMB_CACHE_MAX_MB', 'THUMBNAIL_RENDERER', 'RENDER_BUDGET'):
+            monkeypatch.setattr(nmw_coord_lib, name, getattr(nmw_coord_lib, name))
+        nmw_coord_lib._headers_sent = False
+        monkeypatch.setattr(nmw_coord_lib, 'open_thumbnail_image', lambda path: None)
+        monkeypatch.setattr(cs, 'TEMP_PARENT', str(tmp_path / 'uploads'))
+        monkeypatch.setattr(cs, 'read_config_vars',
+                            lambda *names: dict((n, config.get(n, '')) for n in names))
+        monkeypatch.setattr(cs, 'wait_for_concurrency_slot', lambda **kw: (FakeSlot(), None))
+        monkeypatch.setattr(cs, 'Sky2xyScan', FakeScan)
+        monkeypatch.setattr(cs, 'get_image_metadata', lambda path, vast_dir: {
+            'nx': 400, 'ny': 300, 'arcmin_str': "1'x1'", 'deg_str': '1x1',
+            'scale_x': 8.0, 'scale_y': 8.5})
+        monkeypatch.setattr(cs, 'render_match_thumbnails', fake_render)
+        import io
+        out = io.StringIO()
+        monkeypatch.setattr(sys, 'stdout', out)
+        cs.main()
+        header, _blank, body = out.getvalue().partition('\n\n')
+        assert 'Content-Type: application/x-ndjson' in header
+        return [json.loads(line) for line in body.splitlines()], renders
+
+    def test_matches_then_done(self, tmp_path, monkeypatch):
+        """One object per match, then 'done'; no thumbnails, nothing on disk"""
+        matches = [(0, 'a.fits', 10.0, 20.0), (1, 'b.fits', 30.0, 40.0),
+                   (0, 'b.fits', 50.0, 60.0)]
+        objs, renders = self._search(
+            tmp_path, monkeypatch,
+            'action=batch&format=ndjson&positions=10+20%0Afoo%0A30+40', matches)
+        assert objs[0]['type'] == 'skipped' and objs[0]['line'] == 2
+        assert sorted((o['target'], o['path'], o['x']) for o in objs[1:-1]) == [
+            (1, 'a.fits', 10.0), (1, 'b.fits', 50.0), (2, 'b.fits', 30.0)]
+        assert all(o['type'] == 'match' and not any(key.endswith('_url') for key in o)
+                   for o in objs[1:-1])
+        assert objs[-1]['type'] == 'done'
+        assert (objs[-1]['targets'], objs[-1]['matches']) == (2, 3)
+        assert renders == [] and not (tmp_path / 'uploads').exists()
+
+    def test_thumbnails(self, tmp_path, monkeypatch):
+        """thumbnails=1 renders into a new output directory and adds the URLs"""
+        objs, renders = self._search(
+            tmp_path, monkeypatch, 'coords=10+20&format=ndjson&thumbnails=1',
+            [(0, 'a.fits', 10.0, 20.0)])
+        assert [o['type'] for o in objs] == ['match', 'done']
+        (out_dir,) = os.listdir(str(tmp_path / 'uploads'))
+        assert renders == [('a.fits', str(tmp_path / 'uploads' / out_dir))]
+        assert objs[0]['zoomin_url'] == 'http://localhost/unmw/uploads/{}/png_zoomin.png'.format(
+            out_dir)
+
+    def test_bad_input_is_one_error(self, tmp_path, monkeypatch):
+        """Unusable input gives a single 'error' object and nothing else"""
+        for query in ('format=ndjson', 'coords=99+99+99+99&format=ndjson',
+                      'action=batch&format=ndjson&positions=foo'):
+            objs, renders = self._search(tmp_path, monkeypatch, query)
+            assert len(objs) == 1 and objs[0]['type'] == 'error' and objs[0]['message']
+            assert renders == [] and not (tmp_path / 'uploads').exists()
+
+
+@pytest.mark.skipif(not nmw_render.HAVE_NUMPY, reason="NumPy is not installed")
+class TestTileCompressedSections:
+    """Tests for the tile-by-tile .fz reader in nmw_fz"""
+
+    def test_rice_decompress(self):
+        """Rice tiles written by CFITSIO decode exactly (all block types)"""
+        row0 = [1000] * 32 + [1001, 999, 1003, 1000, 998, 1002, 1000, 1001]
+        row1 = [0, 32000, -32000, 5, -7, 20000, -15000, 123] * 5
+        tile0 = bytes.fromhex('03e8024c236134')
+        tile1 = bytes.fromhex(
+            '0000f0000fa000c00fa0a00179c4eee90762600f5fa000c00fa0a00179c4eee907'
+            '62600f5fa000c00fa0a00179c4eee90762600f5fa000c00fa0a00179c4eee90762'
+            '6f00f5fa000c00fa0a00179c4eee907626')
+        assert nmw_fz.rice_decompress(tile0, 40, 32, 2).tolist() == row0
+        assert nmw_fz.rice_decompress(tile1, 40, 32, 2).tolist() == [
+            v & 0xffff for v in row1]
+        with pytest.raises(ValueError):
+            nmw_fz.rice_decompress(tile1[:20], 40, 32, 2)
+
+    @staticmethod
+    def _rice_compress(values, blocksize, bytepix):
+        """Rice-code values the way CFITSIO's fits_rcomp does"""
+        fsbits, fsmax = nmw_fz._RICE_PARAMS[bytepix]
+        bbits = 8 * bytepix
+        half = 1 << (bbits - 1)
+        bits = [format(values[0] & ((1 << bbits) - 1), '0{}b'.format(bbits))]
+        last = values[0]
+        for i in range(0, len(values), blocksize):
+            diffs = []
+            for value in values[i:i + blocksize]:
+                diff = (value - last + half) % (1 << bbits) - half
+                diffs.append(2 * diff if diff >= 0 else -2 * diff - 1)
+                last = value
+            mean = max(0, (sum(diffs) - len(diffs) // 2 - 1) // len(diffs))
+            fs = (mean >> 1).bit_length()
+            if fs >= fsmax:
+                bits.append(format(fsmax + 1, '0{}b'.format(fsbits)))
+                bits += [format(d, '0{}b'.format(bbits)) for d in diffs]
+            elif not any(diffs):
+                bits.append('0' * fsbits)
+            else:
+                bits.append(format(fs + 1, '0{}b'.format(fsbits)))
+                for d in diffs:
+                    low = format(d & ((1 << fs) - 1), '0{}b'.format(fs)) if fs else ''
+                    bits.append('0' * (d >> fs) + '1' + low)
+        bits = ''.join(bits)
+        bits += '0' * (-len(bits) % 8)
+        return int(bits, 2).to_bytes(len(bits) // 8, 'big')
+
+    def test_rice_decompress_tiles(self):
+        """A batch of tiles of every word size decodes like each tile alone"""
+        import numpy as np
+        rng = np.random.default_rng(1)
+        for bytepix in (1, 2, 4):
+            bbits = 8 * bytepix
+            rows = []
+            for scale in (0, 1, 30, 1 << (bbits - 2)):
+                row = 100 + rng.normal(0, scale + 1e-9, 90).astype(np.int64)
+                row[17] += 5000  # one long unary run in a quiet block
+                rows.append(row.tolist())
+            tiles = [self._rice_compress(row, 32, bytepix) for row in rows]
+            mask = (1 << bbits) - 1
+            decoded = nmw_fz.rice_decompress_tiles(tiles, 90, 32, bytepix)
+            assert decoded.tolist() == [[v & mask for v in row] for row in rows]
+            for tile, row in zip(tiles, decoded):
+                assert nmw_fz.rice_decompress(tile, 90, 32, bytepix).tolist() == row.tolist()
+            with pytest.raises(ValueError):
+                nmw_fz.rice_decompress_tiles(tiles[:2] + [tiles[2][:-4]], 90, 32, bytepix)
+
+    def test_zoomin_decompresses_only_intersecting_tiles(self, tmp_path):
+        """A cutout of a GZIP_1 image touches only the rows it covers"""
+        import gzip
+        import numpy as np
+        pixels = (np.arange(300 * 400).reshape(300, 400) % 30000).astype('>i2')
+        tiles = [gzip.compress(row.tobytes()) for row in pixels]
+        heap = b''.join(tiles)
+        offsets = np.cumsum([0] + [len(t) for t in tiles[:-1]])
+        table = b''.join(struct.pack('>ii', len(t), o) for t, o in zip(tiles, offsets))
+        ext = dict(XTENSION='BINTABLE', BITPIX=8, NAXIS=2, NAXIS1=8, NAXIS2=300,
+                   PCOUNT=len(heap), GCOUNT=1, TFIELDS=1, TTYPE1='COMPRESSED_DATA',
+                   TFORM1='1PB', ZIMAGE=True, ZBITPIX=16, ZNAXIS=2, ZNAXIS1=400,
+                   ZNAXIS2=300, ZTILE1=400, ZTILE2=1, ZCMPTYPE='GZIP_1')
+        path = str(tmp_path / 'ref.fits.fz')
+        with open(path, 'wb') as f:
+            f.write(_fits_hdu(dict(SIMPLE=True, BITPIX=8, NAXIS=0, EXTEND=True)))
+            f.write(_fits_hdu(ext, table + heap))
+        image = nmw_render.FitsImage(path)
+        cutout = image.zoomin(100.5, 150.5, 10, 20)
+        assert cutout.tolist() == pixels[140:160, 90:110][::-1].astype(float).tolist()
+        assert sorted(ty for _tx, ty in image._tiles._cache) == list(range(140, 160))
+        with pytest.raises(ValueError):
+            image.zoomout(80, 60)
+
+
+class TestConfigSnapshot:
+    """Tests for the cached local_config.sh snapshot in nmw_config"""
+
+    def _setup(self, tmp_path, monkeypatch, text):
+        monkeypatch.setattr(nmw_config, 'SNAPSHOT_DIR', str(tmp_path))
+        monkeypatch.setattr(nmw_config, '_memo', {})
+        config = tmp_path / 'local_config.sh'
+        config.write_text(text)
+        calls = []
+        real_source = nmw_config.source_config
+        monkeypatch.setattr(nmw_config, 'source_config',
+                            lambda *a: calls.append(a) or real_source(*a))
+        return str(config), calls
+
+    def test_bash_expansion(self, tmp_path, monkeypatch):
+        """Values are expanded by bash, including $PWD and the environment"""
+        monkeypatch.setenv('UNMW_FREE_PORT', '8123')
+        config, _calls = self._setup(tmp_path, monkeypatch,
+            'export DATA_ROOT="$PWD/uploads"\n'
+            'PLAIN=$DATA_ROOT/x  # comment\n'
+            'if [ -n "$UNMW_FREE_PORT" ];then\n'
+            ' export URL="http://localhost:$UNMW_FREE_PORT/uploads"\n'
+            'fi\n')
+        values = nmw_config.read_vars('DATA_ROOT', 'PLAIN', 'URL', 'MISSING',
+                                      config_path=config)
+        assert values == {'DATA_ROOT': str(tmp_path) + '/uploads',
+                          'PLAIN': str(tmp_path) + '/uploads/x',
+                          'URL': 'http://localhost:8123/uploads', 'MISSING': ''}
+
+    def test_snapshot_reused_until_file_changes(self, tmp_path, monkeypatch):
+        """bash runs once per file version, whatever the request variables"""
+        config, calls = self._setup(tmp_path, monkeypatch, 'export A=1\n')
+        monkeypatch.setenv('QUERY_STRING', 'coords=1+2')
+        assert nmw_config.load(config)['A'] == '1'
+        monkeypatch.setattr(nmw_config, '_memo', {})     # a new process
+        monkeypatch.setenv('QUERY_STRING', 'coords=3+4')
+        monkeypatch.setenv('HTTP_HOST', 'example.org')
+        values = nmw_config.load(config)
+        assert values['A'] == '1' and 'QUERY_STRING' not in values
+        assert len(calls) == 1
+        with open(config, 'w') as f:
+            f.write('export A=22\n')
+        assert nmw_config.load(config)['A'] == '22'
+        assert len(calls) == 2
+
+    def test_planted_snapshot_is_ignored(self, tmp_path, monkeypatch):
+        """A snapshot readable by others, or a symlink in its place, is
+        neither trusted nor written through"""
+        config, calls = self._setup(tmp_path, monkeypatch, 'export A=1\n')
+        key = nmw_config._snapshot_key(config, nmw_config._source_environment())
+        path = nmw_config._snapshot_path(config)
+        with open(path, 'w') as f:
+            json.dump({'key': key, 'values': {'A': 'evil'}}, f)
+        os.chmod(path, 0o644)
+        assert nmw_config.load(config)['A'] == '1'
+        victim = tmp_path / 'victim.txt'
+        victim.write_text('keep')
+        os.unlink(path)
+        os.symlink(str(victim), path)
+        monkeypatch.setattr(nmw_config, '_memo', {})
+        assert nmw_config.load(config)['A'] == '1'
+        assert victim.read_text() == 'keep'
+        assert len(calls) == 2
+
+    def test_missing_or_failing_config(self, tmp_path, monkeypatch):
+        """A missing file or one that fails to source gives no values"""
+        config, _calls = self._setup(tmp_path, monkeypatch, 'export A=1\nfalse\n')
+        assert nmw_config.load(config) == {}
+        assert nmw_config.load(str(tmp_path / 'none.sh')) == {}
+
+
+class TestAdmissionQueue:
+    """Tests for the first-come, first-served slot queue in nmw_coord_lib"""
+
+    def test_free_slot_is_taken_at_once(self, tmp_path, monkeypatch):
+        """No waiting and no progress report when a slot is free"""
+        monkeypatch.setattr(nmw_coord_lib, 'LOCK_DIR', str(tmp_path))
+        calls = []
+        slot, reason = nmw_coord_lib.wait_for_concurrency_slot(
+            'q', 1, progress=lambda *a: calls.append(a))
+        assert slot is not None and reason is None and calls == []
+        assert nmw_coord_lib.acquire_concurrency_slot('q', 1) is None
+        slot.close()
+        assert nmw_coord_lib.service_time('q') < nmw_coord_lib.QUEUE_DEFAULT_SERVICE_SECONDS
+        assert not [n for n in os.listdir(str(tmp_path)) if '_ticket_' in n]
+
+    def test_older_ticket_goes_first(self, tmp_path, monkeypatch):
+        """A free slot goes to the oldest waiter; later ones see their position"""
+        monkeypatch.setattr(nmw_coord_lib, 'LOCK_DIR', str(tmp_path))
+        ticket, fh = nmw_coord_lib._take_ticket('q')
+        calls = []
+        slot, reason = nmw_coord_lib.wait_for_concurrency_slot(
+            'q', 1, max_wait=0.3, progress=lambda *a: calls.append(a))
+        assert slot is None and reason == 'timeout'
+        assert calls[0][0] == 2 and calls[0][1] > 0
+        slot, reason = nmw_coord_lib.wait_for_concurrency_slot('q', 1, max_depth=1)
+        assert slot is None and reason == 'full'
+        nmw_coord_lib._drop_ticket('q', ticket, fh)
+        slot, reason = nmw_coord_lib.wait_for_concurrency_slot('q', 1, max_wait=0.3)
+        assert slot is not None
+        slot.close()
+
+    def test_dead_waiters_are_skipped(self, tmp_path, monkeypatch):
+        """Ticket files nobody holds a lock on do not count and are removed"""
+        monkeypatch.setattr(nmw_coord_lib, 'LOCK_DIR', str(tmp_path))
+        stale = tmp_path / 'q_ticket_000000000001.lock'
+        stale.write_text('')
+        assert nmw_coord_lib.queue_position('q', 5) == 0
+        assert not stale.exists()
+
+    def test_queue_limits(self):
+        """Config values are parsed; empty or invalid ones give the defaults"""
+        assert nmw_coord_lib.queue_limits('5', '30') == (5, 30)
+        assert nmw_coord_lib.queue_limits('', 'x') == (
+            nmw_coord_lib.QUEUE_MAX_DEPTH, nmw_coord_lib.QUEUE_MAX_WAIT_SECONDS)
+
+
+class TestLoadAwareSizing:
+    """Tests for the load-aware pool size and renderer budget in nmw_coord_lib"""
+
+    def test_pool_shrinks_with_load(self):
+        """Idle servers get the full ceiling, loaded ones the floor"""
+        aw = nmw_coord_lib.adaptive_workers
+        assert aw(None, cpus=16, load=0.0) == nmw_coord_lib.MAX_PARALLEL_WORKERS
+        assert aw(None, cpus=4, load=0.0) == nmw_coord_lib.DEFAULT_PARALLEL_WORKERS
+        assert aw(8, cpus=4, load=2.0) == 4
+        assert aw(8, cpus=4, load=9.0) == nmw_coord_lib.ADAPTIVE_MIN_WORKERS
+        assert aw(1, cpus=4, load=9.0) == 1
+
+    def test_render_budget(self):
+        """COORD_RENDER_BUDGET: empty or invalid means one per CPU"""
+        assert nmw_coord_lib.render_budget('3') == 3
+        assert nmw_coord_lib.render_budget('-1') == 0
+        assert nmw_coord_lib.render_budget('') is None
+        assert nmw_coord_lib.render_budget('x') is None
+
+    def test_render_tokens_are_shared(self, tmp_path, monkeypatch):
+        """A full budget makes the next renderer wait (here: time out)"""
+        import threading
+        monkeypatch.setattr(nmw_coord_lib, 'LOCK_DIR', str(tmp_path))
+        monkeypatch.setattr(nmw_coord_lib, 'RENDER_BUDGET', 1)
+        monkeypatch.setattr(nmw_coord_lib, 'RENDER_TOKEN_WAIT_SECONDS', 0.3)
+        held = threading.Event()
+        release = threading.Event()
+
+        def holder():
+            with nmw_coord_lib.render_token():
+                held.set()
+                release.wait(5)
+
+        t = threading.Thread(target=holder)
+        t.start()
+        held.wait(5)
+        start = time.time()
+        with nmw_coord_lib.render_token():
+            waited = time.time() - start
+        release.set()
+        t.join()
+        assert waited >= 0.25
+        start = time.time()
+        with nmw_coord_lib.render_token():
+            assert time.time() - start < 0.25
+
+
+class TestRequestTiming:
+    """Tests for the per-request phase log and report in nmw_timing"""
+
+    def test_request_records(self, tmp_path, monkeypatch):
+        """One line per phase name, with samples, counts and a total"""
+        log = tmp_path / 'timing.jsonl'
+        monkeypatch.setattr(nmw_timing, 'LOG_PATH', str(log))
+
+        @nmw_timing.timed_request('coord_search')
+        def main():
+            with nmw_timing.phase('scan') as counts:
+                counts['matches'] = 3
+            nmw_timing.record('render', 0.5, renderer='pgfv')
+            nmw_timing.record('render', 1.5, renderer='pgfv')
+            nmw_timing.count(targets=1)
+            sys.exit(0)
+
+        with pytest.raises(SystemExit):
+            main()
+        nmw_timing.record('render', 9.0)      # outside a request: ignored
+        import json
+        records = {r['phase']: r for r in map(json.loads, log.read_text().splitlines())}
+        assert sorted(records) == ['render', 'scan', 'total']
+        assert len(set(r['request'] for r in records.values())) == 1
+        assert records['scan']['matches'] == 3 and records['scan']['n'] == 1
+        assert records['render']['s'] == 2.0 and records['render']['samples'] == [0.5, 1.5]
+        assert records['total']['targets'] == 1
+        assert records['total']['script'] == 'coord_search'
+
+    def test_report_percentiles(self, tmp_path):
+        """p50/p95/p99 per day, script and phase"""
+        import io
+        import json
+        log = tmp_path / 'timing.jsonl'
+        now = time.time()
+        with open(str(log), 'w') as f:
+            f.write(json.dumps({'ts': now, 'request': 'a', 'script': 'upload',
+                                'phase': 'wrapper', 's': 55.0, 'n': 100,
+                                'samples': [float(i) for i in range(1, 101)]}) + '\n')
+            f.write('not json\n')
+            f.write(json.dumps({'ts': now - 30 * 86400, 'request': 'b', 'script': 'upload',
+                                'phase': 'wrapper', 's': 1000.0, 'n': 1}) + '\n')
+        out = io.StringIO()
+        assert nmw_timing.report(str(log), days=7, out=out) == 1
+        row = out.getvalue().splitlines()[1].split()
+        assert row[1:4] == ['upload', 'wrapper', '100']
+        assert [float(v) for v in row[4:]] == [50.0, 95.0, 99.0]
+
+
+class TestJobs:
+    """Tests for the background job directories in nmw_jobs"""
+
+    def test_valid_job_id(self):
+        """Only names of per-request output directories are accepted"""
+        assert nmw_jobs.valid_job_id('forced_phot_1234abcdEFGH', 'forced_phot_')
+        for bad in ('', 'forced_phot_1234abcdEFG', '../forced_phot_1234abcdEFGH',
+                    'coord_search_1234abcdEFGH', 'forced_phot_1234abcdEFGH/..'):
+            assert not nmw_jobs.valid_job_id(bad, 'forced_phot_')
+
+    def test_status_and_rows(self, tmp_path):
+        """Status updates are merged into status.json; rows are appended"""
+        job = nmw_jobs.Job.create(str(tmp_path), {'coords': '1 2'})
+        assert job.id == tmp_path.name and job.params == {'coords': '1 2'}
+        assert nmw_jobs.read_status(str(tmp_path))['state'] == 'queued'
+        job.update(state='running', images=3)
+        job.add_row({'mag': '12.34'})
+        job.add_row({'mag': '>15.00'})
+        status = nmw_jobs.Job(str(tmp_path)).status
+        assert status['state'] == 'running' and status['images'] == 3
+        assert 'created' in status and status['updated'] >= status['created']
+        with open(str(tmp_path / nmw_jobs.ROWS_FILE)) as f:
+            assert [line.strip() for line in f] == ['{"mag": "12.34"}', '{"mag": ">15.00"}']
+        assert nmw_jobs.read_status(str(tmp_path / 'missing')) is None
+
+    def test_page_drops_cgi_header(self, tmp_path):
+        """The worker's page file starts with the body, not the CGI header"""
+        page = nmw_jobs.JobPage(str(tmp_path))
+        print("Status: 200 OK", file=page)
+        print("Content-Type: text/html", file=page)
+        print("", file=page)
+        print("<html>", file=page, flush=True)
+        print("</html>", file=page)
+        page.close()
+        with open(str(tmp_path / nmw_jobs.PAGE_FILE)) as f:
+            assert f.read() == "<html>\n</html>\n"
+
+
+class TestWorker:
+    """Tests for the pre-forked CGI worker in nmw_worker"""
+
+    def test_shim_falls_back_without_server(self, tmp_path, monkeypatch):
+        """Without a listening server the script runs itself as before"""
+        monkeypatch.setattr(nmw_worker, 'SOCKET_DIR', str(tmp_path))
+        monkeypatch.setattr(sys, 'argv', ['coord_search.py'])
+        monkeypatch.delenv('GATEWAY_INTERFACE', raising=False)
+        assert nmw_worker.forward_request('coord_search') is None
+        monkeypatch.setenv('GATEWAY_INTERFACE', 'CGI/1.1')
+        assert nmw_worker.forward_request('coord_search') is None
+
+    def test_reload_only_on_content_change(self, tmp_path, monkeypatch):
+        """Touching a served module (as a git checkout does) is no change"""
+        import types
+        source = tmp_path / 'served.py'
+        source.write_text('X = 1\n')
+        monkeypatch.setattr(nmw_worker, 'SCRIPT_DIR', str(tmp_path))
+        monkeypatch.setitem(sys.modules, 'served_fake',
+                            types.SimpleNamespace(__file__=str(source)))
+        stamp = nmw_worker._source_stamp()
+        assert list(stamp) == [str(source)]
+        os.utime(str(source), (1000, 1000))
+        assert nmw_worker._source_stamp() == stamp
+        source.write_text('X = 2\n')
+        assert nmw_worker._source_stamp() != stamp
+
+    def test_child_serves_one_request(self):
+        """A child runs main() with the request environment, body and stdout"""
+        import json
+        import socket
+        import types
+
+        def fake_main():
+            body = sys.stdin.read(int(os.environ['CONTENT_LENGTH']))
+            print("Content-Type: text/plain\n")
+            print(os.environ['QUERY_STRING'], body, nmw_coord_lib.DEFAULT_FORM_PATH)
+            sys.exit(0)
+
+        fake = types.SimpleNamespace(__file__='fake.py', main=fake_main)
+        parent, child = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent.close()
+            try:
+                nmw_worker._serve_one(child, {
+                    'fake': (fake, {'DEFAULT_FORM_PATH': '/unmw/fake.html'})})
+                sys.stdout.flush()
+            finally:
+                os._exit(0)
+        child.close()
+        header = json.dumps({'script': 'fake', 'env': {
+            'QUERY_STRING': 'a=1', 'CONTENT_LENGTH': '4'}}).encode('utf-8')
+        parent.sendall(struct.pack('>I', len(header)) + header + b'body')
+        parent.shutdown(socket.SHUT_WR)
+        response = b''
+        while True:
+            chunk = parent.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        parent.close()
+        os.waitpid(pid, 0)
+        assert response == b"Content-Type: text/plain\n\na=1 body /unmw/fake.html\n"
+
+
+class TestFitsHeader:
+    """Tests for the in-process FITS header reader in nmw_fits"""
+
+    def test_parse_card(self):
+        """Values of all FITS types are parsed, comments dropped"""
+        parse = nmw_fits.parse_card
+        assert parse("CTYPE1  = 'RA---TAN-SIP'       / TAN with SIP") == ('CTYPE1', 'RA---TAN-SIP')
+        assert parse("NAXIS1  =                 4000 / length") == ('NAXIS1', 4000)
+        assert parse("CD1_1   =   -2.3456789012D-03") == ('CD1_1', pytest.approx(-2.3456789012e-3))
+        assert parse("SIMPLE  =                    T") == ('SIMPLE', True)
+        assert parse("OBJECT  = 'O''Brien '") == ('OBJECT', "O'Brien")
+        assert parse("COMMENT no value here") is None
+
+    def test_plain_image(self, tmp_path):
+        """The primary header of a plain image is returned as is"""
+        path = str(tmp_path / 'plain.fits')
+        _write_fits_header_only(path, dict(_WCS_HEADERS['TAN'], EXPTIME=40.0))
+        header = nmw_fits.read_header(path)
+        assert header['CTYPE1'] == 'RA---TAN'
+        assert header['EXPTIME'] == 40.0
+        assert nmw_fits.image_size(path) == (400, 300)
+
+    def test_tile_compressed_image(self, tmp_path):
+        """The compressed-image extension is read as the uncompressed header"""
+        path = str(tmp_path / 'image.fits.fz')
+        primary = dict(SIMPLE=True, BITPIX=8, NAXIS=0, EXTEND=True, ORIGIN='test')
+        heap = b'\x01' * 5000
+        ext = dict(XTENSION='BINTABLE', BITPIX=8, NAXIS=2, NAXIS1=8, NAXIS2=300,
+                   PCOUNT=len(heap), GCOUNT=1, TFIELDS=1, TTYPE1='COMPRESSED_DATA',
+                   TFORM1='1PB(0)', ZIMAGE=True, ZBITPIX=16, ZNAXIS=2,
+                   ZNAXIS1=4000, ZNAXIS2=3000, ZTILE1=4000, ZTILE2=1,
+                   ZCMPTYPE='RICE_1', DATE_OBS='2024-07-19T21:26:29')
+        with open(path, 'wb') as f:
+            f.write(_fits_hdu(primary))
+            f.write(_fits_hdu(ext, b'\0' * (8 * 300) + heap))
+        header = nmw_fits.read_header(path)
+        assert nmw_fits.image_size(path) == (4000, 3000)
+        assert header['BITPIX'] == 16 and header['NAXIS'] == 2
+        assert header['ORIGIN'] == 'test'
+        assert header['DATE_OBS'] == '2024-07-19T21:26:29'
+        for key in ('ZIMAGE', 'ZCMPTYPE', 'TFORM1', 'PCOUNT', 'XTENSION', 'ZNAXIS1'):
+            assert key not in header
+
+    def test_image_extension_after_table(self, tmp_path):
+        """Non-image extensions are skipped by their data size"""
+        path = str(tmp_path / 'ext.fits')
+        table = dict(XTENSION='BINTABLE', BITPIX=8, NAXIS=2, NAXIS1=4, NAXIS2=1000,
+                     PCOUNT=0, GCOUNT=1, TFIELDS=1)
+        image = dict(XTENSION='IMAGE', BITPIX=8, NAXIS=2, NAXIS1=20, NAXIS2=10,
+                     PCOUNT=0, GCOUNT=1)
+        with open(path, 'wb') as f:
+            f.write(_fits_hdu(dict(SIMPLE=True, BITPIX=8, NAXIS=0, EXTEND=True)))
+            f.write(_fits_hdu(table, b'\0' * 4000))
+            f.write(_fits_hdu(image, b'\0' * 200))
+        assert nmw_fits.image_size(path) == (20, 10)
+
+    def test_not_fits(self, tmp_path):
+        """Non-FITS and truncated files raise ValueError"""
+        path = tmp_path / 'junk.fits'
+        path.write_bytes(b'x' * 6000)
+        with pytest.raises(ValueError):
+            nmw_fits.read_header(str(path))
+        path.write_bytes(_fits_hdu(dict(SIMPLE=True, BITPIX=8, NAXIS=2, NAXIS1=5, NAXIS2=5))[:2880 - 80])
+        with pytest.raises(ValueError):
+            nmw_fits.read_header(str(path))
+
+
+def _find_get_image_date():
+    """util/get_image_date of $VAST_REFERENCE_COPY or of _find_vast_dir()"""
+    for vast_dir in (os.environ.get('VAST_REFERENCE_COPY', ''), _find_vast_dir()):
+        if vast_dir and os.access(os.path.join(vast_dir, 'util', 'get_image_date'), os.X_OK):
+            return os.path.join(vast_dir, 'util', 'get_image_date')
+    return None
+
+
+# Synthetic headers, one per date convention get_image_date handles; the
+# real NMW camera headers are those of the self-test images.
+_DATE_HEADERS = {
+    'nmw_canon': dict(DATE_OBS='2023-07-19T21:26:29', EXPTIME=20.0),
+    'fractional': dict(DATE_OBS='2024-01-31T23:59:50.250', EXPTIME=30.0),
+    'time_obs': dict(DATE_OBS='2022-12-05', TIME_OBS='03:14:15.5', EXPTIME=60.0),
+    'ut_start': dict(DATE_OBS='2021-03-01', UT_START='00:00:01', EXPOSURE=120.0),
+    'old_style': dict(DATE_OBS='17/10/98', TIME_OBS='22:05:00', EXPTIME=180.0),
+    'mjd_obs': dict(MJD_OBS=60001.25, EXPTIME=10.0),
+}
+
+
+def _fits_keywords(header):
+    """FITS keyword names for the dict(...)-friendly names above"""
+    return {key.replace('_', '-'): value for key, value in header.items()}
+
+
+class TestImageDate:
+    """Tests for the in-process image timestamps in nmw_date"""
+
+    def test_mid_exposure(self):
+        """DATE-OBS is the start; half of the exposure is added"""
+        jd = nmw_date.mid_exposure_jd(_fits_keywords(_DATE_HEADERS['nmw_canon']))
+        assert jd == pytest.approx(2460144.5 + (21 * 3600 + 26 * 60 + 39) / 86400.0, abs=1e-9)
+        assert nmw_date.iso_utc(jd) == '2023-07-19T21:26:39'
+        assert nmw_date.atel_date(jd) == '2023-07-19.89350'
+
+    def test_header_conventions(self):
+        """Separate time keywords, DD/MM/YY dates, EXPOSURE and MJD-OBS"""
+        def iso(kind):
+            return nmw_date.iso_utc(nmw_date.mid_exposure_jd(_fits_keywords(_DATE_HEADERS[kind])))
+        assert iso('fractional') == '2024-02-01T00:00:05'
+        assert iso('time_obs') == '2022-12-05T03:14:46'
+        assert iso('ut_start') == '2021-03-01T00:01:01'
+        assert iso('old_style') == '1998-10-17T22:06:30'
+        assert iso('mjd_obs') == '2023-02-26T06:00:05'
+        for bad in ({}, {'DATE-OBS': '2022-12-05'}, {'DATE-OBS': 'yesterday'}):
+            with pytest.raises(ValueError):
+                nmw_date.start_jd(bad)
+
+    def test_formatting(self):
+        """The ATel day fraction is truncated, the ISO time rounded"""
+        assert nmw_date.atel_date(2461170.46127) == '2026-05-09.96127'
+        assert nmw_date.atel_date(2460000.4999999, digits=4) == '2023-02-24.9999'
+        assert nmw_date.iso_utc(2461170.46127) == '2026-05-09T23:04:14'
+        # The example of filter_report_json_format.md
+        from filter_report import _jd_to_iso_utc
+        assert _jd_to_iso_utc(2461170.46127) == '2026-05-09T23:04:14Z'
+        assert _jd_to_iso_utc(None) is None
+
+    def test_image_file(self, tmp_path):
+        """image_jd() reads the date from the image header"""
+        path = str(tmp_path / 'image.fits')
+        _write_fits_header_only(path, dict(_fits_keywords(_DATE_HEADERS['time_obs']), NAXIS1=4, NAXIS2=4))
+        assert nmw_date.iso_utc(nmw_date.image_jd(path)) == '2022-12-05T03:14:46'
+        _write_fits_header_only(path, dict(NAXIS1=4, NAXIS2=4))
+        with pytest.raises(ValueError):
+            nmw_date.image_jd(path)
+
+    @pytest.mark.skipif(_find_get_image_date() is None, reason="VaST util/get_image_date is not available")
+    def test_matches_get_image_date(self, tmp_path):
+        """nmw_date agrees with util/get_image_date on the synthetic headers,
+        on the real headers of the self-test images and on bare JDs (CI runs
+        this after unmw_selftest.sh has installed VaST)"""
+        import glob
+        import subprocess
+        here = os.path.dirname(os.path.abspath(__file__))
+        inputs = []
+        for kind in sorted(_DATE_HEADERS):
+            path = str(tmp_path / (kind + '.fits'))
+            _write_fits_header_only(path, dict(_fits_keywords(_DATE_HEADERS[kind]), NAXIS1=4, NAXIS2=4))
+            inputs.append((path, nmw_date.image_jd(path)))
+        for path in sorted(glob.glob(os.path.join(here, 'uploads', 'NMW__NovaVul24_Stas_test', '**', '*.fts'),
+                                     recursive=True))[:20]:
+            inputs.append((path, nmw_date.image_jd(path)))
+        inputs += [('{:.8f}'.format(jd), jd) for jd in (2461170.46127, 2460000.0, 2451544.99999)]
+        for arg, jd in inputs:
+            out = subprocess.run([_find_get_image_date(), arg], capture_output=True,
+                                 text=True, timeout=60).stdout
+            lines = [line.strip() for line in out.splitlines()]
+            binary_jd = float(next(l for l in lines if l.startswith('JD ')).split()[1])
+            atel = next(l for l in lines if l.startswith('ATel style ')).split()[-1]
+            mid = re.search(r'\(mid\. exp\)\s+(\S+)', out).group(1)
+            assert binary_jd == pytest.approx(jd, abs=1e-6), arg
+            assert float(atel[8:]) == pytest.approx(float(nmw_date.atel_date(jd)[8:]), abs=1.1e-5), arg
+            assert mid[:19] == nmw_date.iso_utc(jd), arg
+
+
+@pytest.mark.skipif(not nmw_render.HAVE_NUMPY, reason="NumPy is not installed")
+class TestThumbnailRenderer:
+    """Tests for the in-process PNG renderer in nmw_render"""
+
+    def _star_image(self, path):
+        """400x300 16-bit image (BZERO 32768) with one star at (101, 51)"""
+        import numpy as np
+        yy, xx = np.mgrid[1:301, 1:401]
+        pixels = 1000.0 + 20000.0 * np.exp(-((xx - 101) ** 2 + (yy - 51) ** 2) / 8.0)
+        data = (pixels - 32768).astype('>i2').tobytes()
+        with open(path, 'wb') as f:
+            f.write(_fits_hdu(dict(SIMPLE=True, BITPIX=16, NAXIS=2, NAXIS1=400,
+                                   NAXIS2=300, BZERO=32768.0, BSCALE=1.0), data))
+
+    @staticmethod
+    def _png_size(path):
+        with open(path, 'rb') as f:
+            head = f.read(24)
+        assert head[:8] == b'\x89PNG\r\n\x1a\n'
+        return struct.unpack('>II', head[16:24])
+
+    def test_zoomout_and_zoomin(self, tmp_path, monkeypatch):
+        """All four thumbnails come from one decode; the star is dark"""
+        import numpy as np
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(nmw_coord_lib, 'THUMBNAIL_RENDERER', 'numpy')
+        path = str(tmp_path / 'ref.fits')
+        self._star_image(path)
+        image = nmw_coord_lib.open_thumbnail_image(path)
+        binned = []
+        real_bin = image._bin_frame
+        monkeypatch.setattr(image, '_bin_frame', lambda f: binned.append(f) or real_bin(f))
+        out = str(tmp_path)
+        # No VaST tree: any fallback to the pgfv tools would fail. The
+        # preview comes first, then the hi-res version, as on the pages.
+        assert nmw_coord_lib.make_zoomout_thumbnail(
+            path, 101.0, 51.0, 400, 300, out, '/nonexistent', 64, image=image) == 'ref_zoomout.png'
+        assert nmw_coord_lib.make_zoomout_thumbnail(
+            path, 101.0, 51.0, 400, 300, out, '/nonexistent', 256,
+            suffix='zoomout_hires', image=image) == 'ref_zoomout_hires.png'
+        assert nmw_coord_lib.make_zoomin_thumbnail(
+            path, 101.0, 51.0, out, '/nonexistent', 64, 20, image=image,
+            aperture_circle_diameter=4.0) == 'ref_zoomin.png'
+        assert binned == [1]
+        assert self._png_size(str(tmp_path / 'ref_zoomout_hires.png')) == (341, 256)
+        assert self._png_size(str(tmp_path / 'ref_zoomout.png')) == (85, 64)
+        assert self._png_size(str(tmp_path / 'ref_zoomin.png')) == (64, 64)
+        grey = nmw_render.stretch(image.zoomin(101.0, 51.0, 20, 40))
+        assert grey[20, 20] == 0 and grey[0, 0] == 255
+        # Rows run top-down: the star near the bottom of the frame is low.
+        preview = image.zoomout(400, 300)
+        assert np.unravel_index(np.argmax(preview), preview.shape) == (249, 100)
+
+    def test_zoomout_sizes_share_one_decode(self, tmp_path, monkeypatch):
+        """Preview and hi-res zoom-outs of a large frame bin it once, in
+        either order, and match zoom-outs binned from scratch"""
+        import numpy as np
+        path = str(tmp_path / 'ref.fits')
+        self._star_image(path)
+        for sizes in (((40, 30), (160, 120)), ((160, 120), (40, 30))):
+            image = nmw_render.FitsImage(path)
+            binned = []
+            real_bin = image._bin_frame
+            monkeypatch.setattr(image, '_bin_frame', lambda f: binned.append(f) or real_bin(f))
+            views = [image.zoomout(w, h) for w, h in sizes]
+            assert len(binned) == 1
+            for (w, h), view in zip(sizes, views):
+                fresh = nmw_render.FitsImage(path).zoomout(w, h)
+                assert view.shape == (h, w)
+                assert np.unravel_index(np.argmax(view), view.shape) == \
+                    np.unravel_index(np.argmax(fresh), fresh.shape)
+
+    def test_unsupported_files_use_pgfv(self, tmp_path, monkeypatch):
+        """The pgfv renderer is the default; undecodable .fz images fall back to it"""
+        path = str(tmp_path / 'ref.fits')
+        self._star_image(path)
+        assert nmw_coord_lib.open_thumbnail_image(path) is None
+        monkeypatch.setattr(nmw_coord_lib, 'THUMBNAIL_RENDERER', 'numpy')
+        assert nmw_coord_lib.open_thumbnail_image(path).nx == 400
+        fz = str(tmp_path / 'ref.fits.fz')
+        ext = dict(XTENSION='BINTABLE', BITPIX=8, NAXIS=2, NAXIS1=8, NAXIS2=3,
+                   PCOUNT=0, GCOUNT=1, TFIELDS=1, ZIMAGE=True, ZBITPIX=16,
+                   ZNAXIS=2, ZNAXIS1=4, ZNAXIS2=3)
+        with open(fz, 'wb') as f:
+            f.write(_fits_hdu(dict(SIMPLE=True, BITPIX=8, NAXIS=0, EXTEND=True)))
+            f.write(_fits_hdu(ext, b'\0' * 24))
+        assert nmw_coord_lib.open_thumbnail_image(fz) is None
+        assert nmw_coord_lib.thumbnail_renderer(' NumPy ') == 'numpy'
+        assert nmw_coord_lib.thumbnail_renderer('') == 'pgfv'
+
+
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])